@@ -10,6 +10,10 @@ probabilities summed within each target category. Also output a new
 "index-to-name" JSON file which identifies the sequential order of the target
 categories.
 
+The classifier output may be either a CSV file or a binary (.npy) file written
+by run_classifier.py; the output is written in binary format if the output
+filename ends in .npy, otherwise as a CSV file.
+
 """
 
 #%% Imports
@@ -19,9 +23,14 @@ from __future__ import annotations
 import argparse
 import json
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from megadetector.classification.classifier_output import \
+    BinaryClassifierOutputWriter, is_binary_classifier_output, \
+    load_binary_classifier_output
+
 #%%  Example usage
 
 """
@@ -32,32 +41,75 @@ python aggregate_classifier_probs.py \
     --output-label-index label_index_remapped.json
 """
 
-#%% Main function
+#%% Support functions
 
-def main(classifier_results_csv_path: str,
-         target_mapping_json_path: str,
-         output_csv_path: str,
-         output_label_index_json_path: str) -> None:
+def aggregate_binary_probs(classifier_results_path: str,
+                           target_mapping: dict[str, list[str]],
+                           target_names: list[str],
+                           output_path: str,
+                           chunk_size: int = 100000) -> None:
     """
-    Main function.
+    Aggregates probabilities from a binary classifier output file, reading
+    the memory-mapped probability array in chunks of rows.
+
+    Args:
+        classifier_results_path: str, path to .npy classifier output
+        target_mapping: dict, target name => list of classifier label names
+        target_names: list of str, target names in output column order
+        output_path: str, path to .npy or .csv output
+        chunk_size: int, number of rows to process at a time
+    """
+
+    probs, paths, label_names = load_binary_classifier_output(
+        classifier_results_path)
+
+    assert set(label_names) == set().union(*target_mapping.values())
+    label_to_column = {label: i for i, label in enumerate(label_names)}
+    target_columns = [
+        np.asarray([label_to_column[label] for label in target_mapping[target]],
+                   dtype=np.int64)
+        for target in target_names
+    ]
+
+    binary_output = is_binary_classifier_output(output_path)
+    writer = None
+    if binary_output:
+        writer = BinaryClassifierOutputWriter(
+            output_path, n_rows=len(paths), label_names=target_names,
+            dtype=probs.dtype.name)
+
+    for start in tqdm(range(0, len(paths), chunk_size)):
+        chunk = np.asarray(probs[start:start + chunk_size], dtype=np.float32)
+        agg = np.empty((len(chunk), len(target_names)), dtype=np.float32)
+        for i, columns in enumerate(target_columns):
+            agg[:, i] = chunk[:, columns].sum(axis=1)
+        chunk_paths = paths[start:start + chunk_size]
+        if binary_output:
+            writer.write(agg.astype(probs.dtype), chunk_paths)
+        else:
+            agg_df = pd.DataFrame(data=agg, columns=target_names,
+                                  index=pd.Index(chunk_paths, name='path'))
+            header, mode = (True, 'w') if start == 0 else (False, 'a')
+            agg_df.to_csv(output_path, index=True, header=header, mode=mode)
+
+    if writer is not None:
+        writer.close()
 
-    Because the output CSV is often very large, we process it in chunks of 1000
-    rows at a time.
+
+def aggregate_csv_probs(classifier_results_csv_path: str,
+                        target_mapping: dict[str, list[str]],
+                        target_names: list[str],
+                        all_classifier_labels: set[str],
+                        output_csv_path: str) -> None:
     """
-    
+    Aggregates probabilities from a classifier output CSV, reading 1000 rows
+    at a time.
+    """
+
     chunked_df_iterator = pd.read_csv(
         classifier_results_csv_path, chunksize=1000, float_precision='high',
         index_col='path')
 
-    with open(target_mapping_json_path, 'r') as f:
-        target_mapping = json.load(f)
-    target_names = sorted(target_mapping.keys())
-
-    all_classifier_labels: set[str] = set()
-    for classifier_labels in target_mapping.values():
-        assert all_classifier_labels.isdisjoint(classifier_labels)
-        all_classifier_labels.update(classifier_labels)
-
     for i, chunk_df in tqdm(enumerate(chunked_df_iterator)):
         if i == 0:
             assert set(chunk_df.columns) == all_classifier_labels
@@ -73,6 +125,39 @@ def main(classifier_results_csv_path: str,
 
         agg_df.to_csv(output_csv_path, index=True, header=header, mode=mode)
 
+
+#%% Main function
+
+def main(classifier_results_csv_path: str,
+         target_mapping_json_path: str,
+         output_csv_path: str,
+         output_label_index_json_path: str) -> None:
+    """
+    Main function.
+
+    Because classifier outputs are often very large, we process them in chunks
+    of rows.
+    """
+    
+    with open(target_mapping_json_path, 'r') as f:
+        target_mapping = json.load(f)
+    target_names = sorted(target_mapping.keys())
+
+    all_classifier_labels: set[str] = set()
+    for classifier_labels in target_mapping.values():
+        assert all_classifier_labels.isdisjoint(classifier_labels)
+        all_classifier_labels.update(classifier_labels)
+
+    if is_binary_classifier_output(classifier_results_csv_path):
+        aggregate_binary_probs(classifier_results_csv_path, target_mapping,
+                               target_names, output_csv_path)
+    else:
+        assert not is_binary_classifier_output(output_csv_path), \
+            'Binary output is only supported for binary classifier results'
+        aggregate_csv_probs(classifier_results_csv_path, target_mapping,
+                            target_names, all_classifier_labels,
+                            output_csv_path)
+
     with open(output_label_index_json_path, 'w') as f:
         json.dump(dict(enumerate(target_names)), f, indent=1)
 
@@ -86,13 +171,14 @@ def _parse_args() -> argparse.Namespace:
         description='Aggregate classifier probabilities to target classes.')
     parser.add_argument(
         'classifier_results_csv',
-        help='path to CSV with classifier probabilities')
+        help='path to CSV (or binary .npy file) with classifier probabilities')
     parser.add_argument(
         '-t', '--target-mapping', required=True,
         help='path to JSON file mapping target categories to classifier labels')
     parser.add_argument(
         '-o', '--output-csv', required=True,
-        help='path to save output CSV with aggregated probabilities')
+        help='path to save output CSV with aggregated probabilities (use a '
+             '.npy extension to save in binary format)')
     parser.add_argument(
         '-i', '--output-label-index', required=True,
         help='path to save output label index JSON')
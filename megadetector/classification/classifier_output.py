@@ -0,0 +1,209 @@
+"""
+
+classifier_output.py
+
+Functions for reading and writing classifier results in the binary format
+written by run_classifier.py when the output filename ends in .npy.
+
+A binary classifier output is a pair of files:
+
+* <output>.npy: an array of shape [n_crops, n_classes] (float16 by default),
+  with one row of output probabilities per crop. This is a standard .npy file,
+  so it can be opened as a memory-mapped array with np.load(..., mmap_mode='r').
+* <output>.npy.json: a JSON file with fields 'paths' (the crop path for each
+  row) and 'label_names' (the label name for each column). This file is
+  written last, so its presence indicates that the .npy file is complete.
+
+Compared to CSV output, this avoids formatting and parsing one text value per
+class per crop, which dominates runtime for classifiers with thousands of
+classes.
+
+"""
+
+#%% Imports
+
+from __future__ import annotations
+
+import json
+import os
+import queue
+import threading
+
+from collections.abc import Sequence
+
+import numpy as np
+
+from megadetector.utils.ct_utils import round_float
+
+
+#%% Support functions
+
+def is_binary_classifier_output(path: str) -> bool:
+    """
+    Returns True if [path] refers to a binary classifier output file (rather
+    than a CSV file).
+    """
+
+    return path.lower().endswith('.npy')
+
+
+def binary_classifier_output_index_path(path: str) -> str:
+    """
+    Returns the path of the JSON file that stores crop paths and label names
+    for the binary classifier output file [path].
+    """
+
+    return path + '.json'
+
+
+def load_binary_classifier_output(path: str, mmap: bool = True
+                                  ) -> tuple[np.ndarray, list[str], list[str]]:
+    """
+    Loads a binary classifier output file written by run_classifier.py.
+
+    Args:
+        path: str, path to .npy file
+        mmap: bool, whether to memory-map the probability array rather than
+            reading it into memory
+
+    Returns:
+        probs: np.ndarray, shape [n_crops, n_classes]
+        paths: list of str, crop path for each row of probs
+        label_names: list of str, label name for each column of probs
+    """
+
+    index_path = binary_classifier_output_index_path(path)
+    assert os.path.isfile(index_path), \
+        'Index file {} not found, {} may be incomplete'.format(index_path, path)
+
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+
+    probs = np.load(path, mmap_mode=('r' if mmap else None))
+    paths = index['paths']
+    label_names = index['label_names']
+
+    assert probs.shape == (len(paths), len(label_names)), \
+        'Shape mismatch between {} and {}'.format(path, index_path)
+
+    return probs, paths, label_names
+
+
+def probs_to_classification_list(probs: np.ndarray, threshold: float
+                                 ) -> list[tuple[str, float]]:
+    """
+    Given a vector of output probabilities, returns a list of tuples,
+    (str(label_id), prob), for labels whose probability is at least
+    threshold, sorted from highest to lowest probability. This is the
+    format produced by
+    merge_classification_detection_output.row_to_classification_list().
+    """
+
+    label_ids = np.flatnonzero(probs >= threshold)
+    result = [(str(i), round_float(float(probs[i]), precision=4))
+              for i in label_ids]
+    return sorted(result, key=lambda x: x[1], reverse=True)
+
+
+#%% Classes
+
+class BinaryClassifierOutputWriter:
+    """
+    Writes classifier probabilities to a memory-mapped .npy file on a
+    background thread, so the caller (typically a GPU inference loop) doesn't
+    wait for disk I/O.
+
+    Rows are written in the order in which batches are passed to write().
+    """
+
+    def __init__(self, output_path: str, n_rows: int,
+                 label_names: Sequence[str], dtype: str = 'float16',
+                 max_queued_batches: int = 16):
+        """
+        Creates a BinaryClassifierOutputWriter.
+
+        Args:
+            output_path: str, path to .npy output file
+            n_rows: int, total number of crops that will be written
+            label_names: list of str, label name for each class
+            dtype: str, numpy dtype for stored probabilities
+            max_queued_batches: int, write() blocks if this many batches are
+                waiting to be written
+        """
+        assert is_binary_classifier_output(output_path), \
+            'Binary classifier output files must end in .npy'
+        output_dir = os.path.dirname(output_path)
+        if len(output_dir) > 0:
+            os.makedirs(output_dir, exist_ok=True)
+
+        # Remove any stale index file first, so a partially-written output is
+        # never mistaken for a complete one
+        index_path = binary_classifier_output_index_path(output_path)
+        if os.path.isfile(index_path):
+            os.remove(index_path)
+
+        self.output_path = output_path
+        self.label_names = list(label_names)
+        self.n_rows = n_rows
+        self.paths: list[str] = []
+        self.probs = np.lib.format.open_memmap(
+            output_path, mode='w+', dtype=dtype,
+            shape=(n_rows, len(self.label_names)))
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queued_batches)
+        self._error: BaseException | None = None
+        self._thread = threading.Thread(target=self._write_batches, daemon=True)
+        self._thread.start()
+
+    def _write_batches(self) -> None:
+        """
+        Thread function: copies queued batches into the memory-mapped array.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            start_row, batch_probs = item
+            try:
+                self.probs[start_row:start_row + len(batch_probs)] = batch_probs
+            except BaseException as e:  # pylint: disable=broad-except
+                self._error = e
+
+    def write(self, probs: np.ndarray, paths: Sequence[str]) -> None:
+        """
+        Queues a batch of probabilities for writing.
+
+        Args:
+            probs: np.ndarray, shape [batch_size, n_classes]
+            paths: list of str, crop path for each row of probs
+        """
+        if self._error is not None:
+            raise self._error
+        assert len(probs) == len(paths)
+        assert probs.shape[1] == len(self.label_names), \
+            'Expected {} classes, got {}'.format(len(self.label_names), probs.shape[1])
+        start_row = len(self.paths)
+        assert start_row + len(probs) <= self.n_rows, \
+            'Too many rows written to {}'.format(self.output_path)
+        self.paths.extend(paths)
+        self._queue.put((start_row, probs))
+
+    def close(self) -> None:
+        """
+        Waits for all queued batches to be written, then flushes the .npy
+        file and writes the index file.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        assert len(self.paths) == self.n_rows, \
+            'Expected {} rows, wrote {}'.format(self.n_rows, len(self.paths))
+        self.probs.flush()
+        del self.probs
+
+        index = {'paths': self.paths, 'label_names': self.label_names}
+        with open(binary_classifier_output_index_path(self.output_path), 'w') as f:
+            json.dump(index, f)
@@ -0,0 +1,420 @@
+"""
+
+classify_detections.py
+
+Runs a species classifier directly on a detections JSON file (usually the output
+of MegaDetector), without writing crops to disk.
+
+The three-step classification workflow (crop_detections.py, run_classifier.py,
+merge_classification_detection_output.py) writes every detection to a .jpg
+file, reads those crops back to run the classifier, and then maps classifier
+results back to detections. This script does the same work in a single pass:
+
+* each image is loaded once (in DataLoader worker processes)
+* all detections above the confidence threshold are cropped in memory
+* crops from many images are batched together for the classifier
+* results are written directly to the "classifications" field of each
+  detection, in the same format used by merge_classification_detection_output.py
+
+Crops are never JPEG-compressed, so confidence values can differ very slightly
+from the three-step workflow. Images are loaded with
+visualization_utils.load_image(), so EXIF rotation is applied before cropping,
+consistent with the way MegaDetector loads images.
+
+"""
+
+#%% Imports
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import json
+import os
+
+from collections.abc import Callable, Iterator, Mapping, Sequence
+from typing import Any
+
+import PIL
+import torch
+import torch.utils
+from tqdm import tqdm
+
+from megadetector.classification import train_classifier
+from megadetector.classification.classifier_output import \
+    probs_to_classification_list
+from megadetector.classification.crop_detections import crop_image
+from megadetector.classification.run_classifier import create_transform
+from megadetector.visualization import visualization_utils as vis_utils
+
+
+#%% Example usage
+
+"""
+    python classify_detections.py \
+        detections.json \
+        /path/to/images \
+        /path/to/model.pt \
+        /path/to/label_index.json \
+        --output-json detections_with_classifications.json \
+        --classifier-name "my-classifier" \
+        --image-size 300 \
+        --batch-size 64 \
+        --num-workers 8 \
+        --detection-threshold 0.65 \
+        --square-crops
+"""
+
+
+#%% Classes
+
+class DetectionCropDataset(torch.utils.data.IterableDataset):
+    """
+    Iterable dataset that loads each image once and yields transformed crops
+    for all of its selected detections.
+
+    Each item is a tuple (crop, image_index, detection_index). When used with
+    multiple DataLoader workers, images are divided among workers, so batches
+    contain crops from many images.
+    """
+
+    def __init__(self,
+                 images_dir: str | None,
+                 image_files: Sequence[str],
+                 bboxes_to_classify: Sequence[Sequence[tuple[int, Sequence[float]]]],
+                 square_crops: bool,
+                 transform: Callable[[PIL.Image.Image], Any]):
+        """
+        Creates a DetectionCropDataset.
+
+        Args:
+            images_dir: optional str, base directory for image_files
+            image_files: list of str, image paths
+            bboxes_to_classify: list of the same length as image_files; for
+                each image, a list of (detection_index, bbox) tuples, where
+                bbox is [xmin, ymin, width, height] in normalized coordinates
+            square_crops: bool, whether to crop bounding boxes as squares
+            transform: callable, applied to each crop
+        """
+        assert len(image_files) == len(bboxes_to_classify)
+        self.images_dir = images_dir
+        self.image_files = image_files
+        self.bboxes_to_classify = bboxes_to_classify
+        self.square_crops = square_crops
+        self.transform = transform
+
+    def _crops_for_image(self, image_index: int) -> Iterator[tuple[Any, int, int]]:
+        """
+        Loads one image and yields (crop, image_index, detection_index) tuples.
+        """
+        img_file = self.image_files[image_index]
+        if self.images_dir is not None:
+            img_path = os.path.join(self.images_dir, img_file)
+        else:
+            img_path = img_file
+        try:
+            img = vis_utils.load_image(img_path)
+        except Exception as e:  # pylint: disable=broad-except
+            exception_type = type(e).__name__
+            tqdm.write(f'Unable to load {img_path}. {exception_type}: {e}.')
+            return
+        for detection_index, bbox in self.bboxes_to_classify[image_index]:
+            crop = crop_image(img, bbox_norm=bbox, square_crop=self.square_crops)
+            if crop is None:
+                tqdm.write(f'Skipping size-0 crop for detection '
+                           f'{detection_index} in {img_file}')
+                continue
+            yield self.transform(crop), image_index, detection_index
+
+    def __iter__(self) -> Iterator[tuple[Any, int, int]]:
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            image_indices = range(len(self.image_files))
+        else:
+            image_indices = range(worker_info.id, len(self.image_files),
+                                  worker_info.num_workers)
+        for image_index in image_indices:
+            yield from self._crops_for_image(image_index)
+
+
+#%% Support functions
+
+def select_detections_to_classify(
+        images: Sequence[Mapping[str, Any]],
+        detection_categories: Mapping[str, str],
+        confidence_threshold: float,
+        category_names_to_classify: Sequence[str] = ('animal',)
+        ) -> tuple[list[int], list[list[tuple[int, list[float]]]]]:
+    """
+    Finds the detections that should be classified.
+
+    Args:
+        images: list of dicts, the 'images' field from a detections JSON file
+        detection_categories: dict, detection category ID => category name
+        confidence_threshold: float, only classify detections with at least
+            this confidence
+        category_names_to_classify: list of str, only classify detections in
+            these detection categories
+
+    Returns:
+        image_indices: list of int, indices into images for images with at
+            least one detection to classify
+        bboxes_to_classify: list of the same length as image_indices; for each
+            image, a list of (detection_index, bbox) tuples
+    """
+
+    category_ids_to_classify = set(
+        category_id for category_id, name in detection_categories.items()
+        if name in category_names_to_classify)
+
+    image_indices = []
+    bboxes_to_classify = []
+
+    for image_index, im in enumerate(images):
+        if 'detections' not in im or im['detections'] is None:
+            continue
+        image_bboxes = []
+        for detection_index, d in enumerate(im['detections']):
+            if d['category'] not in category_ids_to_classify:
+                continue
+            # only ground-truth bboxes do not have a "conf" value
+            if 'conf' in d and d['conf'] < confidence_threshold:
+                continue
+            image_bboxes.append((detection_index, d['bbox']))
+        if len(image_bboxes) > 0:
+            image_indices.append(image_index)
+            bboxes_to_classify.append(image_bboxes)
+
+    return image_indices, bboxes_to_classify
+
+
+def classify_crops(model: torch.nn.Module,
+                   loader: torch.utils.data.DataLoader,
+                   device: torch.device,
+                   images: Sequence[dict[str, Any]],
+                   threshold: float,
+                   total: int | None = None) -> int:
+    """
+    Runs the classifier on every crop from a DetectionCropDataset loader, and
+    writes results to the 'classifications' field of the corresponding
+    detections, in place.
+
+    Args:
+        model: torch.nn.Module
+        loader: torch.utils.data.DataLoader, wraps a DetectionCropDataset
+        device: torch.device
+        images: list of dicts, the 'images' field from a detections JSON file
+        threshold: float, for each crop, omit classification results for
+            categories whose confidence is below this threshold
+        total: optional int, number of crops, only used for progress reporting
+
+    Returns: int, number of crops classified
+    """
+
+    # set dropout and BN layers to eval mode
+    model.eval()
+
+    n_crops = 0
+
+    with torch.no_grad(), tqdm(total=total) as pbar:
+        for inputs, image_indices, detection_indices in loader:
+            inputs = inputs.to(device, non_blocking=True)
+            outputs = model(inputs)
+            probs = torch.nn.functional.softmax(outputs, dim=1).cpu().numpy()
+
+            for i_crop in range(len(probs)):
+                image_index = int(image_indices[i_crop])
+                detection_index = int(detection_indices[i_crop])
+                detection = images[image_index]['detections'][detection_index]
+                detection['classifications'] = probs_to_classification_list(
+                    probs[i_crop], threshold=threshold)
+
+            n_crops += len(probs)
+            pbar.update(len(probs))
+
+    return n_crops
+
+
+#%% Main function
+
+def main(detections_json_path: str,
+         images_dir: str | None,
+         model_path: str,
+         classifier_categories_json_path: str,
+         output_json_path: str,
+         classifier_name: str,
+         img_size: int,
+         batch_size: int,
+         num_workers: int,
+         detection_threshold: float,
+         square_crops: bool,
+         classification_threshold: float,
+         typical_confidence_threshold: float | None = None,
+         device_id: int | None = None) -> None:
+    """
+    Args:
+        detections_json_path: str, path to detections JSON file
+        images_dir: optional str, path to local directory where images are
+            saved; if None, image paths in the detections JSON must be absolute
+        model_path: str, path to TorchScript compiled model
+        classifier_categories_json_path: str, path to JSON file mapping label
+            index to label name
+        output_json_path: str, path to save output JSON with both detection and
+            classification results
+        classifier_name: str, name of classifier to include in output JSON
+        img_size: int, size of input image to model
+        batch_size: int, number of crops per batch
+        num_workers: int, # of workers for loading and cropping images
+        detection_threshold: float, only classify detections above this value
+        square_crops: bool, whether to crop bounding boxes as squares
+        classification_threshold: float, for each crop, omit classification
+            results for categories whose confidence is below this threshold
+        typical_confidence_threshold: optional float, useful default confidence
+            threshold; not used directly, just passed along to the output file
+        device_id: optional int, preferred CUDA device
+    """
+
+    # input validation
+    assert os.path.exists(detections_json_path)
+    assert os.path.exists(classifier_categories_json_path)
+    assert 0 <= detection_threshold <= 1
+    assert 0 <= classification_threshold <= 1
+
+    print('Loading detections JSON')
+    with open(detections_json_path, 'r') as f:
+        detection_js = json.load(f)
+
+    with open(classifier_categories_json_path, 'r') as f:
+        idx_to_label = json.load(f)
+
+    images = detection_js['images']
+    image_indices, bboxes_to_classify = select_detections_to_classify(
+        images, detection_categories=detection_js['detection_categories'],
+        confidence_threshold=detection_threshold)
+    n_crops = sum(len(bboxes) for bboxes in bboxes_to_classify)
+    print(f'Classifying {n_crops} detections from {len(image_indices)} images')
+
+    if n_crops > 0:
+
+        # DetectionCropDataset yields indices into the list of images it was
+        # given, so give it the subset of images with detections to classify
+        images_to_classify = [images[i] for i in image_indices]
+        dataset = DetectionCropDataset(
+            images_dir=images_dir,
+            image_files=[im['file'] for im in images_to_classify],
+            bboxes_to_classify=bboxes_to_classify,
+            square_crops=square_crops,
+            transform=create_transform(img_size))
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_size=batch_size, num_workers=num_workers,
+            pin_memory=True)
+
+        print('Loading saved model')
+        model = torch.jit.load(model_path)
+        model, device = train_classifier.prep_device(model, device_id=device_id)
+
+        n_classified = classify_crops(
+            model, loader, device=device, images=images_to_classify,
+            threshold=classification_threshold, total=n_crops)
+        if n_classified != n_crops:
+            print(f'Warning: {n_crops - n_classified} detections could not be '
+                  'classified')
+
+    classification_metadata = {
+        'classifier': classifier_name,
+        'classification_completion_time':
+            datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    if typical_confidence_threshold is not None:
+        classification_metadata['classifier_metadata'] = \
+        {'typical_classification_threshold':typical_confidence_threshold}
+
+    if 'info' not in detection_js:
+        detection_js['info'] = {}
+    detection_js['info'].update(classification_metadata)
+    detection_js['classification_categories'] = idx_to_label
+
+    output_dir = os.path.dirname(output_json_path)
+    if len(output_dir) > 0:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(output_json_path, 'w') as f:
+        json.dump(detection_js, f, indent=1)
+
+    print('Wrote merged classification/detection results to {}'.format(output_json_path))
+
+
+#%% Command-line driver
+
+def _parse_args() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Run a classifier on detections without writing crops '
+                    'to disk.')
+    parser.add_argument(
+        'detections_json',
+        help='path to detections JSON file')
+    parser.add_argument(
+        'images_dir',
+        help='path to directory where images are stored')
+    parser.add_argument(
+        'model',
+        help='path to TorchScript compiled model')
+    parser.add_argument(
+        'classifier_categories',
+        help='path to JSON file mapping label index to label name')
+    parser.add_argument(
+        '-o', '--output-json', required=True,
+        help='(required) path to save output JSON with both detection and '
+             'classification results')
+    parser.add_argument(
+        '-n', '--classifier-name', required=True,
+        help='(required) name of classifier')
+    parser.add_argument(
+        '--image-size', type=int, default=224,
+        help='size of input image to model, usually 224px, but may be larger '
+             'especially for EfficientNet models')
+    parser.add_argument(
+        '--batch-size', type=int, default=64,
+        help='number of crops per batch')
+    parser.add_argument(
+        '--num-workers', type=int, default=8,
+        help='# of workers for loading and cropping images')
+    parser.add_argument(
+        '--detection-threshold', type=float, default=0.0,
+        help='confidence threshold above which to classify bounding boxes')
+    parser.add_argument(
+        '--square-crops', action='store_true',
+        help='crop bounding boxes as squares')
+    parser.add_argument(
+        '-t', '--threshold', type=float, default=0.1,
+        help='Confidence threshold between 0 and 1. In the output file, omit '
+             'classifier results on classes whose confidence is below this '
+             'threshold.')
+    parser.add_argument(
+        '--typical-confidence-threshold', type=float, default=None,
+        help='useful default confidence threshold; not used directly, just '
+             'passed along to the output file')
+    parser.add_argument(
+        '--device', type=int, default=None,
+        help='preferred CUDA device')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = _parse_args()
+    main(detections_json_path=args.detections_json,
+         images_dir=args.images_dir,
+         model_path=args.model,
+         classifier_categories_json_path=args.classifier_categories,
+         output_json_path=args.output_json,
+         classifier_name=args.classifier_name,
+         img_size=args.image_size,
+         batch_size=args.batch_size,
+         num_workers=args.num_workers,
+         detection_threshold=args.detection_threshold,
+         square_crops=args.square_crops,
+         classification_threshold=args.threshold,
+         typical_confidence_threshold=args.typical_confidence_threshold,
+         device_id=args.device)
@@ -12,7 +12,9 @@ detection/run_tf_detector_batch.py or the output of the Batch API in the
 See https://github.com/agentmorris/MegaDetector/tree/main/megadetector/api/batch_processing.
 
 The script can crop images that are either available locally or that need to be
-downloaded from an Azure Blob Storage container.
+downloaded from an Azure Blob Storage container. Local images are cropped with the
+crop engine in postprocessing/create_crop_folder.py, which decodes each image once
+and applies EXIF rotation, so crops line up with MegaDetector's boxes.
 
 We assume that no image contains over 100 bounding boxes, and we always save
 crops as RGB .jpg files for consistency. For each image, each bounding box is
@@ -53,11 +55,15 @@ import json
 import os
 from typing import Any, BinaryIO, Optional
 
-from azure.storage.blob import ContainerClient
 from PIL import Image, ImageOps
 from tqdm import tqdm
 
 
+# Name of the .jsonl file in cropped_images_dir that records which crops have been
+# written by crop_local_images()
+crop_manifest_filename = 'crop_manifest.jsonl'
+
+
 #%% Example usage
 
 """
@@ -155,17 +161,30 @@ def main(detections_json_path: str,
             else:
                 d['category'] = detection_categories[d['category']]
 
-    images_failed_dload_crop, num_downloads, num_crops = download_and_crop(
-        detections=detections,
-        cropped_images_dir=cropped_images_dir,
-        images_dir=images_dir,
-        container_url=container_url,
-        detector_version=detector_version,
-        confidence_threshold=confidence_threshold,
-        save_full_images=save_full_images,
-        square_crops=square_crops,
-        check_crops_valid=check_crops_valid,
-        threads=threads)
+    if container_url is None and not check_crops_valid:
+        assert images_dir is not None, \
+            'images_dir must be given if container_url is not given'
+        images_failed_dload_crop, num_crops = crop_local_images(
+            detections=detections,
+            cropped_images_dir=cropped_images_dir,
+            images_dir=images_dir,
+            detector_version=detector_version,
+            confidence_threshold=confidence_threshold,
+            square_crops=square_crops,
+            threads=threads)
+        num_downloads = 0
+    else:
+        images_failed_dload_crop, num_downloads, num_crops = download_and_crop(
+            detections=detections,
+            cropped_images_dir=cropped_images_dir,
+            images_dir=images_dir,
+            container_url=container_url,
+            detector_version=detector_version,
+            confidence_threshold=confidence_threshold,
+            save_full_images=save_full_images,
+            square_crops=square_crops,
+            check_crops_valid=check_crops_valid,
+            threads=threads)
     print(f'{len(images_failed_dload_crop)} images failed to download or crop.')
 
     # save log of bad images
@@ -184,6 +203,96 @@ def main(detections_json_path: str,
 
 #%% Support functions
 
+def get_crop_path_template(detector_version: str, is_ground_truth: bool) -> str:
+    """
+    Returns the template for crop paths (relative to the crop directory), with
+    placeholders {img_path} and {n}. See module docstring for more info.
+    """
+    
+    # always save as .jpg for consistency
+    if is_ground_truth:
+        return '{img_path}___crop{n:>02d}.jpg'
+    return '{img_path}___crop{n:>02d}_' + f'{detector_version}.jpg'
+
+
+def crop_local_images(
+        detections: Mapping[str, Mapping[str, Any]],
+        cropped_images_dir: str,
+        images_dir: str,
+        detector_version: str,
+        confidence_threshold: float,
+        square_crops: bool,
+        threads: int = 1
+        ) -> tuple[list[str], int]:
+    """
+    Crops images that are available locally, using the crop engine in
+    postprocessing/create_crop_folder.py: each image is decoded once, in a
+    thread pool, and images whose crops all exist are not opened. Crops that
+    have been written are recorded in a manifest file in cropped_images_dir
+    (crop_manifest_filename). Crops are named as in download_and_crop().
+
+    Args:
+        detections: dict, maps image paths to info dict, see download_and_crop()
+        cropped_images_dir: str, path to folder where cropped images are saved
+        images_dir: str, path to folder where full images are saved
+        detector_version: str, detector version string, e.g., '4.1'
+        confidence_threshold: float, only crop bounding boxes above this value
+        square_crops: bool, whether to crop bounding boxes as squares
+        threads: int, number of threads to use for cropping images
+
+    Returns:
+        images_failed_crop: list of str, images with bounding boxes that
+            failed to load or crop properly
+        total_new_crops: int, number of new crops saved to cropped_images_dir
+    """
+    
+    # imported here to avoid a circular import
+    from megadetector.postprocessing.create_crop_folder import (
+        CreateCropFolderOptions, generate_crops)
+
+    image_fn_relative_to_crops: dict[str, list[dict[str, Any]]] = {}
+    for img_path in sorted(detections.keys()):
+        info_dict = detections[img_path]
+        crop_path_template = get_crop_path_template(
+            detector_version, info_dict.get('is_ground_truth', False))
+        crops_this_image = []
+        for i, bbox_dict in enumerate(info_dict['detections']):
+            # only ground-truth bboxes do not have a "confidence" value
+            if 'conf' in bbox_dict and bbox_dict['conf'] < confidence_threshold:
+                continue
+            if bbox_dict['category'] != 'animal':
+                continue
+            crops_this_image.append({
+                'image_fn_relative': img_path,
+                'crop_filename_relative': crop_path_template.format(
+                    img_path=img_path, n=i),
+                'detection': bbox_dict})
+        if len(crops_this_image) > 0:
+            image_fn_relative_to_crops[img_path] = crops_this_image
+
+    options = CreateCropFolderOptions()
+    options.crop_shape = 'square' if square_crops else 'box'
+    options.overwrite = False
+    options.n_workers = threads
+    options.pool_type = 'thread'
+    # PIL's default JPEG quality, for consistency with download_and_crop()
+    options.quality = 75
+    # Record written crops in cropped_images_dir, so we don't need to check for each
+    # crop file on subsequent runs.  Crops written before this manifest existed are
+    # not in the manifest, so they will be re-generated once.
+    options.manifest_file = os.path.join(cropped_images_dir, crop_manifest_filename)
+
+    records = generate_crops(image_fn_relative_to_crops,
+                             input_folder=images_dir,
+                             output_folder=cropped_images_dir,
+                             options=options)
+
+    images_failed_crop = [r['image'] for r in records if r['error'] is not None]
+    total_new_crops = sum(len(r['crops']) for r in records)
+    print(f'Made {total_new_crops} new crops.')
+    return images_failed_crop, total_new_crops
+
+
 def download_and_crop(
         detections: Mapping[str, Mapping[str, Any]],
         cropped_images_dir: str,
@@ -237,12 +346,11 @@ def download_and_crop(
     """
     
     # True for ground truth, False for MegaDetector
-    # always save as .jpg for consistency
     crop_path_template = {
-        True: os.path.join(cropped_images_dir, '{img_path}___crop{n:>02d}.jpg'),
-        False: os.path.join(
+        is_ground_truth: os.path.join(
             cropped_images_dir,
-            '{img_path}___crop{n:>02d}_' + f'{detector_version}.jpg')
+            get_crop_path_template(detector_version, is_ground_truth))
+        for is_ground_truth in (True, False)
     }
 
     pool = futures.ThreadPoolExecutor(max_workers=threads)
@@ -251,6 +359,7 @@ def download_and_crop(
 
     container_client = None
     if container_url is not None:
+        from azure.storage.blob import ContainerClient
         container_client = ContainerClient.from_container_url(container_url)
 
     print(f'Getting bbox info for {len(detections)} images...')
@@ -404,19 +513,18 @@ def load_and_crop(img_path: str,
     return did_download, num_new_crops
 
 
-def save_crop(img: Image.Image, bbox_norm: Sequence[float], square_crop: bool,
-              save: str) -> bool:
+def crop_image(img: Image.Image, bbox_norm: Sequence[float],
+               square_crop: bool) -> Optional[Image.Image]:
     """
-    Crops an image and saves the crop to file.
+    Crops an image to a bounding box.
 
     Args:
         img: PIL.Image.Image object, already loaded
         bbox_norm: list or tuple of float, [xmin, ymin, width, height] all in
             normalized coordinates
         square_crop: bool, whether to crop bounding boxes as a square
-        save: str, path to save cropped image
 
-    Returns: bool, True if a crop was saved, False otherwise
+    Returns: PIL.Image.Image, the crop, or None if the crop would be empty
     """
     
     img_w, img_h = img.size
@@ -438,8 +546,7 @@ def save_crop(img: Image.Image, bbox_norm: Sequence[float], square_crop: bool,
         box_h = min(img_h, box_size)
 
     if box_w == 0 or box_h == 0:
-        tqdm.write(f'Skipping size-0 crop (w={box_w}, h={box_h}) at {save}')
-        return False
+        return None
 
     # Image.crop() takes box=[left, upper, right, lower]
     crop = img.crop(box=[xmin, ymin, xmin + box_w, ymin + box_h])
@@ -448,6 +555,30 @@ def save_crop(img: Image.Image, bbox_norm: Sequence[float], square_crop: bool,
         # pad to square using 0s
         crop = ImageOps.pad(crop, size=(box_size, box_size), color=0)
 
+    return crop
+
+
+def save_crop(img: Image.Image, bbox_norm: Sequence[float], square_crop: bool,
+              save: str) -> bool:
+    """
+    Crops an image and saves the crop to file.
+
+    Args:
+        img: PIL.Image.Image object, already loaded
+        bbox_norm: list or tuple of float, [xmin, ymin, width, height] all in
+            normalized coordinates
+        square_crop: bool, whether to crop bounding boxes as a square
+        save: str, path to save cropped image
+
+    Returns: bool, True if a crop was saved, False otherwise
+    """
+    
+    crop = crop_image(img, bbox_norm=bbox_norm, square_crop=square_crop)
+
+    if crop is None:
+        tqdm.write(f'Skipping size-0 crop at {save}')
+        return False
+
     os.makedirs(os.path.dirname(save), exist_ok=True)
     crop.save(save)
     return True
@@ -0,0 +1,409 @@
+"""
+
+crop_loading.py
+
+Fast loading of image crops for classifier training and inference.
+
+This module provides:
+
+* decode_crop(), which loads an image crop, optionally using PIL's "draft" mode
+  so JPEG crops are decoded at reduced size (a power-of-two downscale done
+  during decoding) when the classifier's input size is much smaller than the
+  crop
+* a "crop shard" format: crops are packed into a small number of uncompressed
+  .tar files, with an index that maps each crop path to its shard, byte
+  offset, and size. Reading a crop from a shard is a seek and a read on an
+  already-open file, rather than opening one of millions of small files.
+* CropReader, which loads crops either from a folder or from crop shards, and
+  can be used by the datasets in run_classifier.py and train_classifier.py
+* normalize_uint8_batch(), which converts a batch of uint8 images to
+  normalized float tensors, typically on the GPU, so DataLoader workers don't
+  need to do floating-point transforms and only a quarter as many bytes are
+  copied to the device
+
+Crop shards can be written directly with CropShardWriter (as
+postprocessing/create_crop_folder.py does), created from a folder of crops
+with pack_crops(), or created from the command line:
+
+    python crop_loading.py /path/to/crops /path/to/crop_shards --threads 8
+
+A folder of crop shards can be passed to run_classifier.py or
+train_classifier.py anywhere a folder of crops is expected.
+
+"""
+
+#%% Imports and constants
+
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import os
+import posixpath
+import tarfile
+import time
+
+from collections.abc import Sequence
+from multiprocessing.pool import ThreadPool
+from typing import BinaryIO
+
+import numpy as np
+import PIL.Image
+from tqdm import tqdm
+
+from megadetector.utils.path_utils import recursive_file_list
+
+# Name of the index file in a folder of crop shards
+crop_shard_index_file_name = 'crop_shard_index.json'
+
+default_crops_per_shard = 10000
+
+
+#%% Support functions
+
+def decode_crop(source: str | BinaryIO, decode_size: int | None = None
+                ) -> PIL.Image.Image:
+    """
+    Loads a crop as an RGB PIL image.
+
+    Args:
+        source: str or file-like object, the image to load
+        decode_size: optional int, if not None and the image is a JPEG, decode
+            at the smallest supported reduced size where both dimensions are
+            still at least decode_size. Because this changes pixel values
+            slightly relative to a full-size decode followed by resizing, it
+            is only appropriate when the crop will be resized to at most
+            decode_size anyway (e.g., for inference).
+
+    Returns: PIL.Image.Image, in RGB mode
+    """
+
+    img = PIL.Image.open(source)
+    if decode_size is not None and img.format == 'JPEG':
+        img.draft('RGB', (decode_size, decode_size))
+    return img.convert('RGB')
+
+
+def _normalize_crop_path(crop_path: str) -> str:
+    """
+    Normalizes crop paths so that crop shard index lookups don't depend on
+    slash direction or leading './'.
+    """
+
+    return posixpath.normpath(crop_path.replace('\\', '/'))
+
+
+def is_crop_shard_dir(path: str) -> bool:
+    """
+    Returns True if [path] is a folder of crop shards created by pack_crops().
+    """
+
+    return os.path.isfile(os.path.join(path, crop_shard_index_file_name))
+
+
+def _read_crop_file(crop_info: tuple[str, str]) -> tuple[str, bytes]:
+    """
+    Reads the bytes of a single crop file, for pack_crops().
+    """
+
+    crops_dir, crop_file = crop_info
+    with open(os.path.join(crops_dir, crop_file), 'rb') as f:
+        return crop_file, f.read()
+
+
+def pack_crops(crops_dir: str,
+               output_dir: str,
+               crop_files: Sequence[str] | None = None,
+               crops_per_shard: int = default_crops_per_shard,
+               threads: int = 1) -> str:
+    """
+    Packs a folder of crops into crop shards.
+
+    Args:
+        crops_dir: str, folder containing crops
+        output_dir: str, folder to which we should write shards and the index
+        crop_files: optional list of str, crop paths relative to crops_dir;
+            if None, packs all files in crops_dir (recursively)
+        crops_per_shard: int, number of crops in each .tar file
+        threads: int, number of threads used to read crops
+
+    Returns: str, path to the shard index file
+    """
+
+    assert os.path.isdir(crops_dir), 'Could not find folder {}'.format(crops_dir)
+    if crop_files is None:
+        crop_files = recursive_file_list(crops_dir, return_relative_paths=True,
+                                         convert_slashes=True)
+    crop_files = sorted(crop_files)
+
+    print('Packing {} crops'.format(len(crop_files)))
+
+    writer = CropShardWriter(output_dir, crops_per_shard=crops_per_shard)
+    crop_infos = [(crops_dir, crop_file) for crop_file in crop_files]
+
+    pool = None
+    if threads <= 1:
+        results = (_read_crop_file(info) for info in crop_infos)
+    else:
+        pool = ThreadPool(threads)
+        results = pool.imap(_read_crop_file, crop_infos)
+
+    try:
+        for crop_file, data in tqdm(results, total=len(crop_infos)):
+            writer.add(crop_file, data)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    writer.close()
+    print('Wrote {} shards'.format(len(writer.shard_names)))
+
+    return writer.index_path
+
+
+def normalize_uint8_batch(inputs, means: Sequence[float], stds: Sequence[float]):
+    """
+    Converts a batch of uint8 images (shape [N, C, H, W], values in [0, 255])
+    to float tensors normalized with the given per-channel means and standard
+    deviations, on whatever device [inputs] is already on. Float inputs are
+    returned unmodified, so this can be called unconditionally.
+
+    Args:
+        inputs: torch.Tensor, batch of images
+        means: list of float, per-channel means for inputs scaled to [0, 1]
+        stds: list of float, per-channel standard deviations for inputs
+            scaled to [0, 1]
+
+    Returns: torch.Tensor, float32 normalized batch
+    """
+
+    import torch
+
+    if inputs.dtype != torch.uint8:
+        return inputs
+    mean = torch.as_tensor(np.asarray(means) * 255, dtype=torch.float32,
+                           device=inputs.device).view(1, -1, 1, 1)
+    std = torch.as_tensor(np.asarray(stds) * 255, dtype=torch.float32,
+                          device=inputs.device).view(1, -1, 1, 1)
+    return inputs.float().sub_(mean).div_(std)
+
+
+#%% Classes
+
+class CropShardWriter:
+    """
+    Writes encoded crops to crop shards, sequentially.
+
+    The index is rewritten each time a shard is completed and when the writer
+    is closed, so if a job is interrupted, every crop in the index is still
+    readable, and a new writer created with append=True can pick up where
+    the previous one left off.
+    """
+
+    def __init__(self, output_dir: str,
+                 crops_per_shard: int = default_crops_per_shard,
+                 append: bool = False):
+        """
+        Creates a CropShardWriter.
+
+        Args:
+            output_dir: str, folder to which we should write shards
+            crops_per_shard: int, number of crops in each .tar file
+            append: bool, if output_dir already contains crop shards, add new
+                shards to the existing index; otherwise existing shards are
+                replaced
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.crops_per_shard = crops_per_shard
+        self.index_path = os.path.join(output_dir, crop_shard_index_file_name)
+        self.shard_names: list[str] = []
+        self.crops: dict[str, list[int]] = {}
+
+        if os.path.isfile(self.index_path):
+            if append:
+                with open(self.index_path, 'r') as f:
+                    index = json.load(f)
+                self.shard_names = index['shards']
+                self.crops = index['crops']
+            else:
+                os.remove(self.index_path)
+
+        self._tar: tarfile.TarFile | None = None
+        self._n_crops_in_shard = 0
+
+    def __contains__(self, crop_path: str) -> bool:
+        return _normalize_crop_path(crop_path) in self.crops
+
+    def _close_shard(self) -> None:
+        if self._tar is None:
+            return
+        self._tar.close()
+        self._tar = None
+        self._write_index()
+
+    def _write_index(self) -> None:
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'shards': self.shard_names, 'crops': self.crops}, f)
+        os.replace(temp_path, self.index_path)
+
+    def add(self, crop_path: str, data: bytes) -> None:
+        """
+        Adds an encoded crop (typically JPEG bytes) to the current shard.
+
+        Args:
+            crop_path: str, relative path used to look up this crop
+            data: bytes, encoded crop
+        """
+        if self._tar is None or self._n_crops_in_shard >= self.crops_per_shard:
+            self._close_shard()
+            shard_name = 'crops_{:05d}.tar'.format(len(self.shard_names))
+            self.shard_names.append(shard_name)
+            # PAX format supports arbitrarily long crop paths
+            self._tar = tarfile.open(os.path.join(self.output_dir, shard_name),
+                                     'w', format=tarfile.PAX_FORMAT)
+            self._n_crops_in_shard = 0
+
+        crop_path = _normalize_crop_path(crop_path)
+        info = tarfile.TarInfo(crop_path)
+        info.size = len(data)
+        info.mtime = int(time.time())
+
+        # addfile() writes exactly this header, followed by the data
+        header_size = len(info.tobuf(self._tar.format, self._tar.encoding,
+                                     self._tar.errors))
+        offset = self._tar.offset + header_size
+        self._tar.addfile(info, io.BytesIO(data))
+
+        # the index on disk isn't updated until this shard is complete
+        self.crops[crop_path] = [len(self.shard_names) - 1, offset, len(data)]
+        self._n_crops_in_shard += 1
+
+    def close(self) -> None:
+        """
+        Closes the current shard and writes the index.
+        """
+        self._close_shard()
+        self._write_index()
+
+
+class CropReader:
+    """
+    Loads crops by relative path, either from a folder of crops or from a
+    folder of crop shards. Instances can be passed to DataLoader worker
+    processes; shard files are opened lazily in each process.
+    """
+
+    def __init__(self, crops_dir: str, decode_size: int | None = None):
+        """
+        Creates a CropReader.
+
+        Args:
+            crops_dir: str, folder of crops, or folder of crop shards
+            decode_size: optional int, see decode_crop()
+        """
+        self.crops_dir = crops_dir
+        self.decode_size = decode_size
+        self.shard_names: list[str] | None = None
+        self.crops: dict[str, list[int]] | None = None
+        if is_crop_shard_dir(crops_dir):
+            with open(os.path.join(crops_dir, crop_shard_index_file_name),
+                      'r') as f:
+                index = json.load(f)
+            self.shard_names = index['shards']
+            self.crops = index['crops']
+        self._pid: int | None = None
+        self._shard_files: dict[int, BinaryIO] = {}
+
+    @property
+    def uses_shards(self) -> bool:
+        return self.crops is not None
+
+    def crop_files(self) -> list[str]:
+        """
+        Returns: list of str, relative paths of all available crops
+        """
+        if self.uses_shards:
+            return sorted(self.crops.keys())
+        return recursive_file_list(self.crops_dir, return_relative_paths=True,
+                                   convert_slashes=True)
+
+    def contains(self, crop_file: str) -> bool:
+        """
+        Returns: bool, whether crop_file is available
+        """
+        if self.uses_shards:
+            return _normalize_crop_path(crop_file) in self.crops
+        return os.path.exists(os.path.join(self.crops_dir, crop_file))
+
+    def read_bytes(self, crop_file: str) -> bytes:
+        """
+        Returns: bytes, the encoded contents of crop_file
+        """
+        if not self.uses_shards:
+            with open(os.path.join(self.crops_dir, crop_file), 'rb') as f:
+                return f.read()
+
+        # file handles can't be shared with forked worker processes
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._shard_files = {}
+
+        i_shard, offset, size = self.crops[_normalize_crop_path(crop_file)]
+        if i_shard not in self._shard_files:
+            self._shard_files[i_shard] = open(
+                os.path.join(self.crops_dir, self.shard_names[i_shard]), 'rb')
+        f = self._shard_files[i_shard]
+        f.seek(offset)
+        return f.read(size)
+
+    def __call__(self, crop_file: str) -> PIL.Image.Image:
+        """
+        Returns: PIL.Image.Image, crop_file loaded in RGB mode
+        """
+        if self.uses_shards:
+            source = io.BytesIO(self.read_bytes(crop_file))
+        else:
+            source = os.path.join(self.crops_dir, crop_file)
+        return decode_crop(source, decode_size=self.decode_size)
+
+    def __getstate__(self) -> dict:
+        # don't pickle open file handles
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state['_shard_files'] = {}
+        return state
+
+
+#%% Command-line driver
+
+def _parse_args() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Packs a folder of crops into crop shards.')
+    parser.add_argument(
+        'crops_dir',
+        help='path to folder of crops')
+    parser.add_argument(
+        'output_dir',
+        help='path to folder where crop shards will be written')
+    parser.add_argument(
+        '--crops-per-shard', type=int, default=default_crops_per_shard,
+        help='number of crops in each shard')
+    parser.add_argument(
+        '--threads', type=int, default=1,
+        help='number of threads used to read crops')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = _parse_args()
+    pack_crops(crops_dir=args.crops_dir,
+               output_dir=args.output_dir,
+               crops_per_shard=args.crops_per_shard,
+               threads=args.threads)
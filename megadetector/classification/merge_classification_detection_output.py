@@ -19,6 +19,9 @@ This script takes 2 main files as input:
     * 'label': str, label assigned to this crop
     * [label names]: float, confidence in each label
 
+    Instead of a CSV, the binary (.npy) output of run_classifier.py may be
+    given; this contains [label names] probabilities but no 'label' column.
+
 2) Either a "detections JSON" (output of MegaDetector) or a "queried images
     JSON" (output of json_validatory.py).
 
@@ -67,9 +70,13 @@ import os
 from collections.abc import Mapping, Sequence
 from typing import Any
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from megadetector.classification.classifier_output import \
+    is_binary_classifier_output, load_binary_classifier_output, \
+    probs_to_classification_list
 from megadetector.utils.ct_utils import round_float
 
 
@@ -273,7 +280,9 @@ def combine_classification_with_detection(
         threshold: float,
         label_pos: str | None = None,
         relative_conf: bool = False,
-        typical_confidence_threshold: float = None
+        typical_confidence_threshold: float = None,
+        probs: np.ndarray | None = None,
+        probs_label_names: Sequence[str] | None = None
         ) -> dict[str, Any]:    
     """
     Adds classification information to a detection JSON. Classification
@@ -299,6 +308,12 @@ def combine_classification_with_detection(
             to be in CSV
         typical_confidence_threshold: float, useful default confidence
             threshold; not used directly, just passed along to the output file
+        probs: optional np.ndarray, classifier probabilities loaded from a
+            binary classifier output file; if given, df only needs a 'row'
+            column with the index of each crop's row in probs
+        probs_label_names: list of str, label name for each column of probs,
+            required if probs is given; must contain the same labels as
+            label_names, but may be in a different order
 
     Returns: dict, detections JSON file updated with classification results
     """
@@ -315,12 +330,43 @@ def combine_classification_with_detection(
     detection_js['info'].update(classification_metadata)
     detection_js['classification_categories'] = idx_to_label
 
+    images = detection_js['images']
+
+    if probs is not None:
+        assert label_pos is None and not relative_conf, \
+            'Binary classifier outputs do not contain labels'
+        assert probs_label_names is not None, \
+            'Label names are required for binary classifier outputs'
+        assert probs.shape[1] == len(label_names) == len(probs_label_names)
+        assert set(probs_label_names) == set(label_names), \
+            'Classifier output labels do not match label names'
+
+        # Map columns of probs to the order of label_names, if necessary
+        column_order = None
+        if list(probs_label_names) != list(label_names):
+            print('Reordering classifier output columns to match label names')
+            label_to_column = {name: i for i, name in enumerate(probs_label_names)}
+            column_order = np.array([label_to_column[name] for name in label_names])
+
+        for crop_path, row in tqdm(zip(df.index, df['row']), total=len(df)):
+            img_path, suffix = crop_path.split('___crop')
+            crop_index = int(suffix[:2])
+
+            row_probs = probs[row]
+            if column_order is not None:
+                row_probs = row_probs[column_order]
+
+            detection_dict = images[img_path]['detections'][crop_index]
+            detection_dict['classifications'] = probs_to_classification_list(
+                row_probs, threshold=threshold)
+
+        detection_js['images'] = list(images.values())
+        return detection_js
+
     contains_preds = (set(label_names) <= set(df.columns))
     if not contains_preds:
         print('CSV does not contain predictions. Outputting labels only.')
 
-    images = detection_js['images']
-
     for crop_path in tqdm(df.index):
         # crop_path: <dataset>/<img_file>___cropXX_mdvY.Y.jpg
         #            [----<img_path>----]       [-<suffix>--]
@@ -364,10 +410,20 @@ def main(classification_csv_path: str,
             assert os.path.exists(x)
     assert label_pos in [None, 'first', 'last']
 
-    # load classification CSV
-    print('Loading classification CSV...')
-    df = pd.read_csv(classification_csv_path, float_precision='high',
-                     index_col='path')
+    # load classification results
+    probs = None
+    probs_label_names = None
+    if is_binary_classifier_output(classification_csv_path):
+        # memory-mapped, so rows are only read as they're needed
+        print('Loading binary classification results...')
+        probs, crop_paths, probs_label_names = load_binary_classifier_output(
+            classification_csv_path)
+        df = pd.DataFrame({'row': np.arange(len(crop_paths))},
+                          index=pd.Index(crop_paths, name='path'))
+    else:
+        print('Loading classification CSV...')
+        df = pd.read_csv(classification_csv_path, float_precision='high',
+                         index_col='path')
     if relative_conf or label_pos is not None:
         assert 'label' in df.columns
 
@@ -406,7 +462,8 @@ def main(classification_csv_path: str,
         label_names=label_names, classifier_name=classifier_name,
         classifier_timestamp=classifier_timestamp, threshold=threshold,
         label_pos=label_pos, relative_conf=relative_conf,
-        typical_confidence_threshold=typical_confidence_threshold)
+        typical_confidence_threshold=typical_confidence_threshold,
+        probs=probs, probs_label_names=probs_label_names)
 
     os.makedirs(os.path.dirname(output_json_path), exist_ok=True)
     with open(output_json_path, 'w') as f:
@@ -425,7 +482,8 @@ def _parse_args() -> argparse.Namespace:
                     'outputs.')
     parser.add_argument(
         'classification_csv',
-        help='path to classification CSV')
+        help='path to classification CSV, or binary (.npy) output of '
+             'run_classifier.py')
     parser.add_argument(
         'label_names_json',
         help='path to JSON file mapping label index to label name')
@@ -9,12 +9,16 @@ This script takes as input:
 1) a detections JSON file, usually the output of run_tf_detector_batch.py or the
     output of the Batch API in the "Batch processing API output format"
 2) a path to a directory containing crops of bounding boxes from the detections
-    JSON file
+    JSON file, or a directory of crop shards created by crop_loading.py
 3) a path to a PyTorch TorchScript compiled model file
 4) (if the model is EfficientNet) an image size
 
-By default, this script overwrites the detections JSON file, adding in
-classification results. To output a new JSON file, use the --output argument.
+Results are written to a CSV file with one column per class. If the output
+filename ends in .npy, results are instead written in a binary format (a
+memory-mapped probability array plus a JSON index of crop paths and label
+names; see classifier_output.py), which is much faster to write and to read
+for classifiers with many classes. aggregate_classifier_probs.py and
+merge_classification_detection_output.py read both formats.
 
 """
 
@@ -38,6 +42,10 @@ import torchvision as tv
 from torchvision.datasets.folder import default_loader
 
 from megadetector.classification import train_classifier
+from megadetector.classification.classifier_output import \
+    BinaryClassifierOutputWriter, is_binary_classifier_output
+from megadetector.classification.crop_loading import \
+    CropReader, is_crop_shard_dir, normalize_uint8_batch
 
 
 #%% Example usage
@@ -60,22 +68,32 @@ class SimpleDataset(torch.utils.data.Dataset):
 
     def __init__(self, img_files: Sequence[str],
                  images_dir: str | None = None,
-                 transform: Callable[[PIL.Image.Image], Any] | None = None):
-        """Creates a SimpleDataset."""
+                 transform: Callable[[PIL.Image.Image], Any] | None = None,
+                 crop_reader: CropReader | None = None):
+        """
+        Creates a SimpleDataset.
+
+        If crop_reader is given, it's used to load images (by relative path),
+        and images_dir is ignored.
+        """
         self.img_files = img_files
         self.images_dir = images_dir
         self.transform = transform
+        self.crop_reader = crop_reader
 
     def __getitem__(self, index: int) -> tuple[Any, str]:
         """
         Returns: tuple, (img, img_file)
         """
         img_file = self.img_files[index]
-        if self.images_dir is not None:
-            img_path = os.path.join(self.images_dir, img_file)
+        if self.crop_reader is not None:
+            img = self.crop_reader(img_file)
         else:
-            img_path = img_file
-        img = default_loader(img_path)
+            if self.images_dir is not None:
+                img_path = os.path.join(self.images_dir, img_file)
+            else:
+                img_path = img_file
+            img = default_loader(img_path)
         if self.transform is not None:
             img = self.transform(img)
         return img, img_file
@@ -86,27 +104,72 @@ class SimpleDataset(torch.utils.data.Dataset):
 
 #%% Support functions
 
+def create_transform(img_size: int, uint8_inputs: bool = False
+                     ) -> Callable[[PIL.Image.Image], Any]:
+    """
+    Creates the transform used to prepare crops for the classifier: resizes the
+    smallest side of each crop to img_size, then center-crops to
+    (img_size, img_size) and normalizes.
+
+    If uint8_inputs is True, normalization is skipped and the transform
+    returns uint8 tensors, which should be normalized (typically on the GPU)
+    with crop_loading.normalize_uint8_batch().
+    """
+    
+    transforms = [
+        # resizes smaller edge to img_size
+        tv.transforms.Resize(img_size, interpolation=PIL.Image.BICUBIC),
+        tv.transforms.CenterCrop(img_size)
+    ]
+    if uint8_inputs:
+        transforms.append(tv.transforms.PILToTensor())
+    else:
+        transforms.extend([
+            tv.transforms.ToTensor(),
+            tv.transforms.Normalize(mean=train_classifier.MEANS,
+                                    std=train_classifier.STDS, inplace=True)
+        ])
+    return tv.transforms.Compose(transforms)
+
+
 def create_loader(cropped_images_dir: str,
                   detections_json_path: str | None,
                   img_size: int,
                   batch_size: int,
-                  num_workers: int
+                  num_workers: int,
+                  fast_decode: bool = False,
+                  uint8_inputs: bool = False
                   ) -> torch.utils.data.DataLoader:
     """
     Creates a DataLoader.
 
     Args:
-        cropped_images_dir: str, path to image crops
+        cropped_images_dir: str, path to image crops, or to crop shards
         detections_json_path: optional str, path to detections JSON
         img_size: int, resizes smallest side of image to img_size,
             then center-crops to (img_size, img_size)
         batch_size: int, batch size in dataloader
         num_workers: int, # of workers in dataloader
+        fast_decode: bool, decode JPEG crops at reduced size when they're
+            much larger than img_size
+        uint8_inputs: bool, produce uint8 batches, to be normalized on the
+            device, see create_transform()
     """
     
     crop_files = []
 
-    if detections_json_path is None:
+    # the default loader supports the accimage backend, so only use a
+    # CropReader when we need one
+    crop_reader = None
+    if fast_decode or uint8_inputs or is_crop_shard_dir(cropped_images_dir):
+        crop_reader = CropReader(cropped_images_dir,
+                                 decode_size=(img_size if fast_decode else None))
+
+    if detections_json_path is None and crop_reader is not None and \
+            crop_reader.uses_shards:
+        crop_files = crop_reader.crop_files()
+
+    elif detections_json_path is None:
         # recursively find all files in cropped_images_dir
         for subdir, _, files in os.walk(cropped_images_dir):
             for file_name in files:
@@ -127,21 +190,18 @@ def create_loader(cropped_images_dir: str,
                 continue
             for i in range(len(info_dict['detections'])):
                 crop_filename = img_file + f'___crop{i:02d}_{detector_version}.jpg'
+                if crop_reader is not None:
+                    if crop_reader.contains(crop_filename):
+                        crop_files.append(crop_filename)
+                    continue
                 crop_path = os.path.join(cropped_images_dir, crop_filename)
                 if os.path.exists(crop_path):
                     crop_files.append(crop_filename)
 
-    transform = tv.transforms.Compose([
-        # resizes smaller edge to img_size
-        tv.transforms.Resize(img_size, interpolation=PIL.Image.BICUBIC),
-        tv.transforms.CenterCrop(img_size),
-        tv.transforms.ToTensor(),
-        tv.transforms.Normalize(mean=train_classifier.MEANS,
-                                std=train_classifier.STDS, inplace=True)
-    ])
+    transform = create_transform(img_size, uint8_inputs=uint8_inputs)
 
     dataset = SimpleDataset(img_files=crop_files, images_dir=cropped_images_dir,
-                            transform=transform)
+                            transform=transform, crop_reader=crop_reader)
     assert len(dataset) > 0
     loader = torch.utils.data.DataLoader(
         dataset, batch_size=batch_size, num_workers=num_workers,
@@ -159,7 +219,10 @@ def main(model_path: str,
          img_size: int,
          batch_size: int,
          num_workers: int,
-         device_id: int | None = None) -> None:
+         device_id: int | None = None,
+         output_dtype: str = 'float16',
+         fast_decode: bool = False,
+         uint8_inputs: bool = False) -> None:
     
     # Evaluating with accimage is much faster than Pillow or Pillow-SIMD, but accimage
     # is Linux-only.
@@ -173,7 +236,8 @@ def main(model_path: str,
     print('Creating data loader')
     loader = create_loader(
         cropped_images_dir, detections_json_path=detections_json_path,
-        img_size=img_size, batch_size=batch_size, num_workers=num_workers)
+        img_size=img_size, batch_size=batch_size, num_workers=num_workers,
+        fast_decode=fast_decode, uint8_inputs=uint8_inputs)
 
     label_names = None
     if classifier_categories_json_path is not None:
@@ -187,25 +251,28 @@ def main(model_path: str,
     model, device = train_classifier.prep_device(model, device_id=device_id)
 
     test_epoch(model, loader, device=device, label_names=label_names,
-               output_csv_path=output_csv_path)
+               output_csv_path=output_csv_path, output_dtype=output_dtype)
 
 
 def test_epoch(model: torch.nn.Module,
                loader: torch.utils.data.DataLoader,
                device: torch.device,
                label_names: Sequence[str] | None,
-               output_csv_path: str) -> None:
+               output_csv_path: str,
+               output_dtype: str = 'float16') -> None:
     """
     Runs for 1 epoch.
 
-    Writes results to the output CSV in batches.
+    Writes results to the output CSV in batches. If output_csv_path ends in
+    .npy, results are written in binary format by a background thread instead.
 
     Args:
         model: torch.nn.Module
         loader: torch.utils.data.DataLoader
         device: torch.device
         label_names: optional list of str, label names
-        output_csv_path: str
+        output_csv_path: str, path to .csv/.csv.gz or .npy output file
+        output_dtype: str, dtype for probabilities, only used for .npy output
     """
     
     # set dropout and BN layers to eval mode
@@ -214,15 +281,33 @@ def test_epoch(model: torch.nn.Module,
     header = True
     mode = 'w'  # new file on first write
 
+    binary_output = is_binary_classifier_output(output_csv_path)
+    writer = None
+
     with torch.no_grad():
         for inputs, img_files in tqdm(loader):
             inputs = inputs.to(device, non_blocking=True)
+            inputs = normalize_uint8_batch(inputs, train_classifier.MEANS,
+                                           train_classifier.STDS)
             outputs = model(inputs)
-            probs = torch.nn.functional.softmax(outputs, dim=1).cpu().numpy()
+            probs = torch.nn.functional.softmax(outputs, dim=1)
+
+            if binary_output:
+                # convert on the device, so there's less to copy to the host
+                probs = probs.to(dtype=getattr(torch, output_dtype))
+            probs = probs.cpu().numpy()
 
             if label_names is None:
                 label_names = [str(i) for i in range(probs.shape[1])]
 
+            if binary_output:
+                if writer is None:
+                    writer = BinaryClassifierOutputWriter(
+                        output_csv_path, n_rows=len(loader.dataset),
+                        label_names=label_names, dtype=output_dtype)
+                writer.write(probs, img_files)
+                continue
+
             df = pd.DataFrame(data=probs, columns=label_names,
                               index=pd.Index(img_files, name='path'))
             df.to_csv(output_csv_path, index=True, header=header, mode=mode)
@@ -231,6 +316,9 @@ def test_epoch(model: torch.nn.Module,
                 header = False
                 mode = 'a'
 
+    if writer is not None:
+        writer.close()
+
 
 #%% Command-line driver
 
@@ -244,11 +332,13 @@ def _parse_args() -> argparse.Namespace:
         help='path to TorchScript compiled model')
     parser.add_argument(
         'crops_dir',
-        help='path to directory containing cropped images')
+        help='path to directory containing cropped images, or crop shards '
+             'created by crop_loading.py')
     parser.add_argument(
         'output',
         help='path to save CSV file with classifier results (can use .csv.gz '
-             'extension for compression)')
+             'extension for compression), or .npy file to save results in '
+             'binary format')
     parser.add_argument(
         '-d', '--detections-json',
         help='path to detections JSON file, used to filter paths within '
@@ -270,6 +360,17 @@ def _parse_args() -> argparse.Namespace:
     parser.add_argument(
         '--num-workers', type=int, default=8,
         help='# of workers for data loading')
+    parser.add_argument(
+        '--output-dtype', choices=['float16', 'float32'], default='float16',
+        help='dtype used to store probabilities, only used for .npy output')
+    parser.add_argument(
+        '--fast-decode', action='store_true',
+        help='decode JPEG crops at reduced size when they are much larger '
+             'than the model input size (changes results very slightly)')
+    parser.add_argument(
+        '--uint8-inputs', action='store_true',
+        help='load crops as uint8 tensors and normalize them on the device, '
+             'reducing CPU work in data loading workers')
     return parser.parse_args()
 
 
@@ -284,4 +385,7 @@ if __name__ == '__main__':
          img_size=args.image_size,
          batch_size=args.batch_size,
          num_workers=args.num_workers,
-         device_id=args.device)
+         device_id=args.device,
+         output_dtype=args.output_dtype,
+         fast_decode=args.fast_decode,
+         uint8_inputs=args.uint8_inputs)
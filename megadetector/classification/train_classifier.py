@@ -36,6 +36,8 @@ import torchvision as tv
 from torchvision.datasets.folder import default_loader
 
 from megadetector.classification import efficientnet, evaluate_model
+from megadetector.classification.crop_loading import (
+    CropReader, is_crop_shard_dir, normalize_uint8_batch)
 from megadetector.classification.train_utils import (
     HeapItem, recall_from_confusion_matrix, add_to_heap, fig_to_img,
     imgs_with_confidences, load_dataset_csv, prefix_all_keys)
@@ -88,14 +90,20 @@ class SimpleDataset(torch.utils.data.Dataset):
                  sample_weights: Sequence[float] | None = None,
                  img_base_dir: str = '',
                  transform: Callable[[PIL.Image.Image], Any] | None = None,
-                 target_transform: Callable[[Any], Any] | None = None):
-        """Creates a SimpleDataset."""
+                 target_transform: Callable[[Any], Any] | None = None,
+                 crop_reader: CropReader | None = None):
+        """Creates a SimpleDataset.
+
+        If crop_reader is given, it's used to load images (by relative path),
+        and img_base_dir is ignored.
+        """
         self.img_files = img_files
         self.labels = labels
         self.sample_weights = sample_weights
         self.img_base_dir = img_base_dir
         self.transform = transform
         self.target_transform = target_transform
+        self.crop_reader = crop_reader
 
         self.len = len(img_files)
         assert len(labels) == self.len
@@ -110,7 +118,10 @@ class SimpleDataset(torch.utils.data.Dataset):
         Returns: tuple, (sample, target) or (sample, target, sample_weight)
         """
         img_file = self.img_files[index]
-        img = default_loader(os.path.join(self.img_base_dir, img_file))
+        if self.crop_reader is not None:
+            img = self.crop_reader(img_file)
+        else:
+            img = default_loader(os.path.join(self.img_base_dir, img_file))
         if self.transform is not None:
             img = self.transform(img)
         target = self.labels[index]
@@ -135,7 +146,8 @@ def create_dataloaders(
         weight_by_detection_conf: bool | str,
         batch_size: int,
         num_workers: int,
-        augment_train: bool
+        augment_train: bool,
+        uint8_inputs: bool = False
         ) -> tuple[dict[str, torch.utils.data.DataLoader], list[str]]:
     """
     Args:
@@ -143,7 +155,11 @@ def create_dataloaders(
             ['dataset', 'location', 'label'], where label is a comma-delimited
             list of labels
         splits_json_path: str, path to JSON file
+        cropped_images_dir: str, path to image crops, or to crop shards
+            created by crop_loading.py
         augment_train: bool, whether to shuffle/augment the training set
+        uint8_inputs: bool, produce uint8 batches, which must be normalized
+            with crop_loading.normalize_uint8_batch() (run_epoch() does this)
 
     Returns:
         datasets: dict, maps split to DataLoader
@@ -154,8 +170,15 @@ def create_dataloaders(
         multilabel=multilabel, label_weighted=label_weighted,
         weight_by_detection_conf=weight_by_detection_conf)
 
-    # define the transforms
-    normalize = tv.transforms.Normalize(mean=MEANS, std=STDS, inplace=True)
+    # define the transforms; with uint8 inputs, normalization happens on the
+    # device instead
+    if uint8_inputs:
+        to_tensor = [tv.transforms.PILToTensor()]
+    else:
+        to_tensor = [
+            tv.transforms.ToTensor(),
+            tv.transforms.Normalize(mean=MEANS, std=STDS, inplace=True)
+        ]
     train_transform = tv.transforms.Compose([
         tv.transforms.RandomResizedCrop(img_size),
         tv.transforms.RandomRotation(degrees=(-90, 90)),
@@ -163,17 +186,21 @@ def create_dataloaders(
         tv.transforms.RandomVerticalFlip(p=0.1),
         tv.transforms.RandomGrayscale(p=0.1),
         tv.transforms.ColorJitter(brightness=.25, contrast=.25, saturation=.25),
-        tv.transforms.ToTensor(),
-        normalize
+        *to_tensor
     ])
     test_transform = tv.transforms.Compose([
         # resizes smaller edge to img_size
         tv.transforms.Resize(img_size, interpolation=PIL.Image.BICUBIC),
         tv.transforms.CenterCrop(img_size),
-        tv.transforms.ToTensor(),
-        normalize
+        *to_tensor
     ])
 
+    # the default loader supports the accimage backend, so only use a
+    # CropReader when we need one
+    crop_reader = None
+    if uint8_inputs or is_crop_shard_dir(cropped_images_dir):
+        crop_reader = CropReader(cropped_images_dir)
+
     dataloaders = {}
     for split, locs in split_to_locs.items():
         is_train = (split == 'train') and augment_train
@@ -200,11 +227,15 @@ def create_dataloaders(
             labels=split_df['label_index'].tolist(),
             sample_weights=weights,
             img_base_dir=cropped_images_dir,
-            transform=train_transform if is_train else test_transform)
+            transform=train_transform if is_train else test_transform,
+            crop_reader=crop_reader)
         assert len(dataset) > 0
+        # every loader is iterated once per epoch, so keep workers alive
+        # between epochs rather than re-spawning them
         dataloaders[split] = torch.utils.data.DataLoader(
             dataset, batch_size=batch_size, sampler=sampler,
-            num_workers=num_workers, pin_memory=True)
+            num_workers=num_workers, pin_memory=True,
+            persistent_workers=(num_workers > 0))
 
     return dataloaders, label_names
 
@@ -319,7 +350,8 @@ def main(dataset_dir: str,
          num_workers: int,
          logdir: str,
          log_extreme_examples: int,
-         seed: int | None = None) -> None:
+         seed: int | None = None,
+         uint8_inputs: bool = False) -> None:
     """Main function."""
     # input validation
     assert os.path.exists(dataset_dir)
@@ -363,7 +395,8 @@ def main(dataset_dir: str,
         weight_by_detection_conf=weight_by_detection_conf,
         batch_size=batch_size,
         num_workers=num_workers,
-        augment_train=True)
+        augment_train=True,
+        uint8_inputs=uint8_inputs)
 
     writer = tensorboard.SummaryWriter(logdir)
 
@@ -697,6 +730,7 @@ def run_epoch(model: torch.nn.Module,
                 weights = None
 
             inputs = inputs.to(device, non_blocking=True)
+            inputs = normalize_uint8_batch(inputs, MEANS, STDS)
 
             batch_size = labels.size(0)
             start_i = end_i
@@ -802,6 +836,10 @@ def _parse_args() -> argparse.Namespace:
     parser.add_argument(
         '--seed', type=int,
         help='random seed')
+    parser.add_argument(
+        '--uint8-inputs', action='store_true',
+        help='load crops as uint8 tensors and normalize them on the device, '
+             'reducing CPU work in data loading workers')
     return parser.parse_args()
 
 
@@ -824,4 +862,5 @@ if __name__ == '__main__':
          num_workers=args.num_workers,
          logdir=args.logdir,
          log_extreme_examples=args.log_extreme_examples,
-         seed=args.seed)
+         seed=args.seed,
+         uint8_inputs=args.uint8_inputs)
@@ -14,8 +14,8 @@ import json
 import os
 import datetime
 import dateutil
+import numpy as np
 
-from tqdm import tqdm
 from collections import defaultdict, OrderedDict
 
 
@@ -330,6 +330,22 @@ def write_object_with_serialized_datetimes(d,json_fn):
         json.dump(d,f,indent=1,default=json_serialize_datetime)
 
 
+def _parse_datetime_string(s):
+    """
+    Parse a single datetime string, trying the (much faster) ISO 8601 parser first, and
+    falling back to dateutil for everything else.  We only use the ISO parser's result 
+    for timezone-naive datetimes, where it's guaranteed to agree with dateutil.
+    """
+    
+    try:
+        dt = datetime.datetime.fromisoformat(s)
+        if dt.tzinfo is None:
+            return dt
+    except ValueError:
+        pass
+    return dateutil.parser.parse(s)
+    
+
 def parse_datetimes_from_cct_image_list(images,conversion_failure_behavior='error'):
     """
     Given the "images" field from a COCO camera traps dictionary, converts all
@@ -348,6 +364,10 @@ def parse_datetimes_from_cct_image_list(images,conversion_failure_behavior='erro
     
     assert isinstance(images,list)
     
+    # Camera traps typically write many images with the same timestamp (e.g. bursts), so 
+    # we parse each unique string once.
+    string_to_datetime = {}
+    
     for im in images:
         
         if 'datetime' not in im:
@@ -355,7 +375,13 @@ def parse_datetimes_from_cct_image_list(images,conversion_failure_behavior='erro
         if isinstance(im['datetime'],datetime.datetime):
             continue
         try:
-            dt = dateutil.parser.parse(im['datetime'])
+            if isinstance(im['datetime'],str):
+                s = im['datetime']
+                if s not in string_to_datetime:
+                    string_to_datetime[s] = _parse_datetime_string(s)
+                dt = string_to_datetime[s]
+            else:
+                dt = dateutil.parser.parse(im['datetime'])
             im['datetime'] = dt
         except Exception as e:
             s = 'could not parse datetime {}: {}'.format(str(im['datetime']),str(e))
@@ -468,71 +494,74 @@ def create_sequences(image_info,options=None):
     print('Found {} locations'.format(len(locations)))    
     locations = list(locations)
     locations.sort()
+    location_to_index = {location:i_location for i_location,location in enumerate(locations)}
     
-    all_sequences = set()
+    n_images = len(image_info)
     
-    # i_location = 0; location = locations[i_location]
-    for i_location,location in tqdm(enumerate(locations),total=len(locations)):
-        
-        images_this_location = [im for im in image_info if im['location'] == location]    
-        
-        # Sorting datetimes fails when there are None's in the list.  So instead of sorting datetimes 
-        # directly, sort tuples with a boolean for none-ness, then the datetime itself.
-        #
-        # https://stackoverflow.com/questions/18411560/sort-list-while-pushing-none-values-to-the-end
-        sorted_images_this_location = sorted(images_this_location, 
-                                             key = lambda im: (im['datetime'] is None,im['datetime']))
-        
-        sequence_id_to_images_this_location = defaultdict(list)
-
-        current_sequence_id = None
-        next_frame_number = 0
-        next_sequence_number = 0
-        previous_datetime = None
-            
-        # previous_datetime = sorted_images_this_location[0]['datetime']
-        # im = sorted_images_this_location[1]
-        for im in sorted_images_this_location:
-            
-            invalid_datetime = False
-            
-            if previous_datetime is None:
-                delta = None
-            elif im['datetime'] is None:
-                invalid_datetime = True
-            else:
-                delta = (im['datetime'] - previous_datetime).total_seconds()
-            
-            # Start a new sequence if necessary, including the case where this datetime is invalid
-            if delta is None or delta > options.episode_interval_seconds or invalid_datetime:
-                next_frame_number = 0
-                current_sequence_id = 'location_{}_sequence_index_{}'.format(
-                    location,str(next_sequence_number).zfill(5))
-                next_sequence_number = next_sequence_number + 1
-                assert current_sequence_id not in all_sequences
-                all_sequences.add(current_sequence_id)                
-                
-            im['seq_id'] = current_sequence_id
-            im['seq_num_frames'] = None
-            im['frame_num'] = next_frame_number
-            sequence_id_to_images_this_location[current_sequence_id].append(im)
-            next_frame_number = next_frame_number + 1
-            
-            # If this was an invalid datetime, this will record the previous datetime
-            # as None, which will force the next image to start a new sequence.
-            previous_datetime = im['datetime']
+    # Sort all images once by location, then by datetime.  Sorting datetimes fails when there 
+    # are None's in the list.  So instead of sorting datetimes directly, sort tuples with a 
+    # boolean for none-ness, then the datetime itself.  Invalid datetimes end up at the end of
+    # each location; the sort is stable, so ties preserve the input order.
+    #
+    # https://stackoverflow.com/questions/18411560/sort-list-while-pushing-none-values-to-the-end
+    sort_order = sorted(range(n_images),
+                        key = lambda i: (location_to_index[image_info[i]['location']],
+                                         image_info[i]['datetime'] is None,
+                                         image_info[i]['datetime']))
+    sorted_images = [image_info[i] for i in sort_order]
+    
+    location_indices = np.array([location_to_index[im['location']] for im in sorted_images],
+                                dtype=np.int64)
+    
+    # Represent datetimes as integer microseconds since the epoch (0 for invalid datetimes, 
+    # which we track separately), converting timezone-aware datetimes to UTC
+    epoch = datetime.datetime(1970,1,1)
+    one_microsecond = datetime.timedelta(microseconds=1)
+    
+    def _to_microseconds(dt):
+        if dt is None:
+            return 0
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return (dt - epoch) // one_microsecond
+    
+    invalid_datetimes = np.array([im['datetime'] is None for im in sorted_images],dtype=bool)
+    datetimes = np.fromiter((_to_microseconds(im['datetime']) for im in sorted_images),
+                            dtype=np.int64,count=n_images)
+    
+    # Start a new sequence at every location boundary, at every invalid datetime, after every
+    # invalid datetime, and wherever the gap to the previous image exceeds the episode interval.
+    new_sequence = np.ones(n_images,dtype=bool)
+    if n_images > 1:
+        delta_seconds = (datetimes[1:] - datetimes[:-1]) / 10**6
+        new_sequence[1:] = (location_indices[1:] != location_indices[:-1]) | \
+            invalid_datetimes[1:] | invalid_datetimes[:-1] | \
+            (delta_seconds > options.episode_interval_seconds)
         
-        # ...for each image in this location
-    
-        # Fill in seq_num_frames
-        for seq_id in sequence_id_to_images_this_location.keys():
-            assert seq_id in sequence_id_to_images_this_location
-            images_this_sequence = sequence_id_to_images_this_location[seq_id]
-            assert len(images_this_sequence) > 0
-            for im in images_this_sequence:
-                im['seq_num_frames'] = len(images_this_sequence)
-                
-    # ...for each location
+    # For each image, find the index of its sequence, and the position where that sequence starts
+    sequence_indices = np.cumsum(new_sequence) - 1
+    sequence_start_positions = np.flatnonzero(new_sequence)
+    n_sequences = len(sequence_start_positions)
+    frame_numbers = np.arange(n_images) - sequence_start_positions[sequence_indices]
+    sequence_lengths = np.bincount(sequence_indices,minlength=n_sequences)
+    
+    # Sequences are numbered starting from zero within each location
+    sequence_locations = location_indices[sequence_start_positions]
+    location_start_positions = np.flatnonzero(np.r_[True,sequence_locations[1:] != sequence_locations[:-1]])
+    location_run_lengths = np.diff(np.r_[location_start_positions,n_sequences])
+    sequence_numbers = np.arange(n_sequences) - \
+        np.repeat(location_start_positions,location_run_lengths)
+    
+    sequence_ids = ['location_{}_sequence_index_{}'.format(
+        locations[sequence_locations[i_sequence]],str(sequence_numbers[i_sequence]).zfill(5)) \
+        for i_sequence in range(n_sequences)]
+    all_sequences = set(sequence_ids)
+    assert len(all_sequences) == n_sequences, 'Duplicate sequence IDs'
+    
+    for i_image,im in enumerate(sorted_images):
+        im['seq_id'] = sequence_ids[sequence_indices[i_image]]
+        im['seq_num_frames'] = int(sequence_lengths[sequence_indices[i_image]])
+        im['frame_num'] = int(frame_numbers[i_image])
     
     print('Created {} sequences from {} images'.format(len(all_sequences),len(image_info)))
     
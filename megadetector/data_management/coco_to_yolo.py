@@ -22,10 +22,16 @@ import json
 import os
 import shutil
 
+import numpy as np
+
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from multiprocessing.pool import Pool
+from functools import partial
 from tqdm import tqdm
 
 from megadetector.utils.path_utils import safe_create_link,find_images
+from megadetector.visualization.visualization_utils import parallel_get_image_sizes
 
 
 #%% Support functions
@@ -81,6 +87,128 @@ def write_yolo_dataset_file(yolo_dataset_file,
 
 # ...def write_yolo_dataset_file(...)
 
+
+def coco_boxes_to_yolo_boxes(coco_boxes,image_widths,image_heights,clip_boxes=False):
+    """
+    Converts an array of COCO boxes (absolute [x_min, y_min, width, height]) to YOLO boxes
+    (normalized [x_center, y_center, width, height]), all at once.
+    
+    Args:
+        coco_boxes (array-like): an N x 4 array of COCO boxes
+        image_widths (array-like): a length-N array of widths of the images to which each box 
+            belongs
+        image_heights (array-like): a length-N array of heights of the images to which each box 
+            belongs
+        clip_boxes (bool, optional): whether to clip boxes to the range [0,1]
+        
+    Returns:
+        tuple: a tuple containing:
+            - an N x 4 float array of YOLO boxes
+            - a length-N boolean array indicating which boxes were clipped
+    """
+    
+    coco_boxes = np.asarray(coco_boxes,dtype=np.float64).reshape(-1,4)
+    image_widths = np.asarray(image_widths,dtype=np.float64)
+    image_heights = np.asarray(image_heights,dtype=np.float64)
+    
+    x_min_absolute = coco_boxes[:,0]
+    y_min_absolute = coco_boxes[:,1]
+    box_w_absolute = coco_boxes[:,2]
+    box_h_absolute = coco_boxes[:,3]
+    
+    x_center_absolute = (x_min_absolute + (x_min_absolute + box_w_absolute)) / 2
+    y_center_absolute = (y_min_absolute + (y_min_absolute + box_h_absolute)) / 2
+    
+    x_center_relative = x_center_absolute / image_widths
+    y_center_relative = y_center_absolute / image_heights
+    
+    box_w_relative = box_w_absolute / image_widths
+    box_h_relative = box_h_absolute / image_heights
+    
+    clipped = np.zeros(len(coco_boxes),dtype=bool)
+    
+    if clip_boxes:
+        
+        # Clip right, bottom, left, top, in that order, shrinking each box and shifting
+        # its center by half the overhang
+        overhang = x_center_relative + (box_w_relative / 2.0) - 1.0
+        overhang = np.where(overhang > 0,overhang,0.0)
+        box_w_relative = box_w_relative - overhang
+        x_center_relative = x_center_relative - (overhang / 2.0)
+        clipped |= (overhang > 0)
+        
+        overhang = y_center_relative + (box_h_relative / 2.0) - 1.0
+        overhang = np.where(overhang > 0,overhang,0.0)
+        box_h_relative = box_h_relative - overhang
+        y_center_relative = y_center_relative - (overhang / 2.0)
+        clipped |= (overhang > 0)
+        
+        box_left = x_center_relative - (box_w_relative / 2.0)
+        overhang = np.where(box_left < 0,np.abs(box_left),0.0)
+        box_w_relative = box_w_relative - overhang
+        x_center_relative = x_center_relative + (overhang / 2.0)
+        clipped |= (box_left < 0)
+        
+        box_top = y_center_relative - (box_h_relative / 2.0)
+        overhang = np.where(box_top < 0,np.abs(box_top),0.0)
+        box_h_relative = box_h_relative - overhang
+        y_center_relative = y_center_relative + (overhang / 2.0)
+        clipped |= (box_top < 0)
+        
+    yolo_boxes = np.stack([x_center_relative,y_center_relative,
+                           box_w_relative,box_h_relative],axis=1)
+    
+    return yolo_boxes,clipped
+
+# ...def coco_boxes_to_yolo_boxes(...)
+
+
+def _write_yolo_output_for_image(output_info,
+                                 dest_image_folder,
+                                 dest_txt_folder,
+                                 create_image_and_label_folders,
+                                 overwrite_images):
+    """
+    Internal support function for copying one image and writing its label file.
+    """
+    
+    source_image = output_info['source_image']
+    dest_image = os.path.join(dest_image_folder,output_info['dest_image_relative'])
+    dest_txt = os.path.join(dest_txt_folder,output_info['dest_txt_relative'])
+    
+    os.makedirs(os.path.dirname(dest_image),exist_ok=True)        
+    os.makedirs(os.path.dirname(dest_txt),exist_ok=True)
+    
+    if not create_image_and_label_folders:
+        assert os.path.dirname(dest_image) == os.path.dirname(dest_txt)
+    
+    if (not os.path.isfile(dest_image)) or (overwrite_images):
+        shutil.copyfile(source_image,dest_image)
+
+    bboxes = output_info['bboxes']        
+    
+    # Only write an annotation file if there are bounding boxes.  Images with 
+    # no .txt files are treated as hard negatives, at least by YOLOv5:
+    #
+    # https://github.com/ultralytics/yolov5/issues/3218
+    #
+    # I think this is also true for images with empty .txt files, but 
+    # I'm using the convention suggested on that issue, i.e. hard 
+    # negatives are expressed as images without .txt files.
+    if len(bboxes) > 0:
+        
+        lines = []
+        
+        # bbox = bboxes[0]
+        for bbox in bboxes:
+            assert len(bbox) == 5
+            lines.append('{} {} {} {} {}\n'.format(bbox[0],bbox[1],bbox[2],bbox[3],bbox[4]))
+            
+        with open(dest_txt,'w') as f:
+            f.write(''.join(lines))
+
+# ...def _write_yolo_output_for_image(...)
+
             
 def coco_to_yolo(input_image_folder,
                  output_folder,
@@ -97,7 +225,10 @@ def coco_to_yolo(input_image_folder,
                  category_names_to_exclude=None,
                  category_names_to_include=None,
                  write_output=True,
-                 flatten_paths=True):
+                 flatten_paths=True,
+                 n_workers=1,
+                 pool_type='thread',
+                 image_size_cache_file=None):
     """
     Converts a COCO-formatted dataset to a YOLO-formatted dataset, optionally flattening the 
     dataset to a single folder in the process.
@@ -145,6 +276,16 @@ def coco_to_yolo(input_image_folder,
         write_output (bool, optional): determines whether we actually copy images and write annotations;
             setting this to False mostly puts this function in "dry run" "mode.  The class list
             file is written regardless of the value of write_output.
+        flatten_paths (bool, optional): whether to flatten the output folder structure, see
+            [path_replacement_char]
+        n_workers (int, optional): number of concurrent workers to use for copying images and 
+            writing label files (and for reading image sizes, where necessary); set to <= 1 to 
+            disable parallelization
+        pool_type (str, optional): 'thread' or 'process', worker type to use for parallelization;
+            not used if [n_workers] <= 1
+        image_size_cache_file (str, optional): a .json file used to cache image sizes across calls
+            (see visualization_utils.parallel_get_image_sizes()); only used for images that don't 
+            have width and height fields in [input_file]
     
     Returns:
         dict: information about the coco --> yolo mapping, containing at least the fields:
@@ -159,6 +300,9 @@ def coco_to_yolo(input_image_folder,
     
     if category_names_to_include is not None and category_names_to_exclude is not None:
         raise ValueError('category_names_to_include and category_names_to_exclude are mutually exclusive')
+    
+    if n_workers > 1:
+        assert pool_type in ('thread','process'), 'Illegal pool type {}'.format(pool_type)
         
     if output_folder is None:
         output_folder = input_image_folder
@@ -248,8 +392,14 @@ def coco_to_yolo(input_image_folder,
     
     print('Processing annotations')
     
-    n_clipped_boxes = 0
-    n_total_boxes = 0
+    # For every box we're keeping, the index of its image (in images_to_copy), the YOLO
+    # category ID, and the COCO box
+    box_image_indices = []
+    box_category_ids = []
+    box_coco_boxes = []
+    
+    # The source images (dicts from the COCO file) corresponding to images_to_copy
+    source_images_to_copy = []
     
     # i_image = 0; im = data['images'][i_image]
     for i_image,im in tqdm(enumerate(data['images']),total=len(data['images'])):
@@ -292,8 +442,6 @@ def coco_to_yolo(input_image_folder,
         
         image_id = im['id']
         
-        image_bboxes = []
-            
         if image_id in image_id_to_annotations:
                         
             for ann in image_id_to_annotations[image_id]:
@@ -338,84 +486,74 @@ def coco_to_yolo(input_image_folder,
                 
                 yolo_category_id = coco_id_to_yolo_id[ann['category_id']]
                 
-                # COCO: [x_min, y_min, width, height] in absolute coordinates
-                # YOLO: [class, x_center, y_center, width, height] in normalized coordinates
-                
-                # Convert from COCO coordinates to YOLO coordinates
-                img_w = im['width']
-                img_h = im['height']
-                                
-                if source_format in ('coco','coco_camera_traps'):
-                    
-                    x_min_absolute = coco_bbox[0]
-                    y_min_absolute = coco_bbox[1]
-                    box_w_absolute = coco_bbox[2]
-                    box_h_absolute = coco_bbox[3]
-                    
-                    x_center_absolute = (x_min_absolute + (x_min_absolute + box_w_absolute)) / 2
-                    y_center_absolute = (y_min_absolute + (y_min_absolute + box_h_absolute)) / 2
-                    
-                    x_center_relative = x_center_absolute / img_w
-                    y_center_relative = y_center_absolute / img_h
-                    
-                    box_w_relative = box_w_absolute / img_w
-                    box_h_relative = box_h_absolute / img_h
-                    
-                else:
-                    
+                if source_format not in ('coco','coco_camera_traps'):
                     raise ValueError('Unrecognized source format {}'.format(source_format))
                 
-                if clip_boxes:
-                    
-                    clipped_box = False
-                    
-                    box_right = x_center_relative + (box_w_relative / 2.0)                    
-                    if box_right > 1.0:
-                        clipped_box = True
-                        overhang = box_right - 1.0
-                        box_w_relative -= overhang
-                        x_center_relative -= (overhang / 2.0)
-
-                    box_bottom = y_center_relative + (box_h_relative / 2.0)                                        
-                    if box_bottom > 1.0:
-                        clipped_box = True
-                        overhang = box_bottom - 1.0
-                        box_h_relative -= overhang
-                        y_center_relative -= (overhang / 2.0)
-                    
-                    box_left = x_center_relative - (box_w_relative / 2.0)
-                    if box_left < 0.0:
-                        clipped_box = True
-                        overhang = abs(box_left)
-                        box_w_relative -= overhang
-                        x_center_relative += (overhang / 2.0)
-                        
-                    box_top = y_center_relative - (box_h_relative / 2.0)
-                    if box_top < 0.0:
-                        clipped_box = True
-                        overhang = abs(box_top)
-                        box_h_relative -= overhang
-                        y_center_relative += (overhang / 2.0)
-                        
-                    if clipped_box:
-                        n_clipped_boxes += 1
-                
-                yolo_box = [yolo_category_id,
-                            x_center_relative, y_center_relative, 
-                            box_w_relative, box_h_relative]
-                
-                image_bboxes.append(yolo_box)
-                n_total_boxes += 1
+                # We'll convert all the boxes in the dataset at once, after this loop
+                box_image_indices.append(len(images_to_copy))
+                box_category_ids.append(yolo_category_id)
+                box_coco_boxes.append(coco_bbox)
                 
             # ...for each annotation 
             
         # ...if this image has annotations
         
-        output_info['bboxes'] = image_bboxes
-        
         images_to_copy.append(output_info)        
+        source_images_to_copy.append(im)
     
     # ...for each image
+    
+    
+    ## Convert boxes from COCO to YOLO format
+    
+    n_total_boxes = len(box_coco_boxes)
+    n_clipped_boxes = 0
+    
+    if n_total_boxes > 0:
+        
+        box_image_indices = np.array(box_image_indices,dtype=np.int64)
+        
+        # Use image sizes from the COCO file, falling back to reading them for images where 
+        # they're not available
+        image_widths = np.full(len(images_to_copy),np.nan)
+        image_heights = np.full(len(images_to_copy),np.nan)
+        
+        images_without_sizes = []
+        for i_image in np.unique(box_image_indices):
+            im = source_images_to_copy[i_image]
+            if ('width' in im) and ('height' in im):
+                image_widths[i_image] = im['width']
+                image_heights[i_image] = im['height']
+            else:
+                images_without_sizes.append(i_image)
+        
+        if len(images_without_sizes) > 0:
+            
+            print('Reading sizes for {} images'.format(len(images_without_sizes)))
+            source_paths = [images_to_copy[i_image]['source_image'] for \
+                            i_image in images_without_sizes]
+            image_sizes = parallel_get_image_sizes(source_paths,
+                                                   max_workers=n_workers,
+                                                   use_threads=(pool_type == 'thread'),
+                                                   cache_file=image_size_cache_file)
+            for i_image,source_path in zip(images_without_sizes,source_paths):
+                size = image_sizes[source_path]
+                assert size is not None, 'Could not read image size for {}'.format(source_path)
+                image_widths[i_image] = size[0]
+                image_heights[i_image] = size[1]
+                
+        yolo_boxes,clipped = coco_boxes_to_yolo_boxes(box_coco_boxes,
+                                                      image_widths[box_image_indices],
+                                                      image_heights[box_image_indices],
+                                                      clip_boxes=clip_boxes)
+        n_clipped_boxes = int(np.sum(clipped))
+        
+        # Convert to Python floats, which we'll write to the label files
+        yolo_boxes = yolo_boxes.tolist()
+        for i_box,i_image in enumerate(box_image_indices.tolist()):
+            images_to_copy[i_image]['bboxes'].append([box_category_ids[i_box]] + yolo_boxes[i_box])
+            
+    # ...if we have boxes to convert
         
     print('\nWriting {} boxes ({} clipped) for {} images'.format(n_total_boxes,
                                                                n_clipped_boxes,len(images_to_copy)))
@@ -457,54 +595,40 @@ def coco_to_yolo(input_image_folder,
         
     source_image_to_dest_image = {}
     
-    # TODO: parallelize this loop
-    #
-    # output_info = images_to_copy[0]
-    for output_info in tqdm(images_to_copy):
-
-        source_image = output_info['source_image']
-        dest_image_relative = output_info['dest_image_relative']
-        dest_txt_relative = output_info['dest_txt_relative']
-        
-        dest_image = os.path.join(dest_image_folder,dest_image_relative)
-        dest_txt = os.path.join(dest_txt_folder,dest_txt_relative)
+    for output_info in images_to_copy:
+        source_image_to_dest_image[output_info['source_image']] = \
+            os.path.join(dest_image_folder,output_info['dest_image_relative'])
+    
+    if write_output:
         
-        source_image_to_dest_image[source_image] = dest_image
+        p = partial(_write_yolo_output_for_image,
+                    dest_image_folder=dest_image_folder,
+                    dest_txt_folder=dest_txt_folder,
+                    create_image_and_label_folders=create_image_and_label_folders,
+                    overwrite_images=overwrite_images)
         
-        if write_output:
+        if n_workers <= 1:
             
-            os.makedirs(os.path.dirname(dest_image),exist_ok=True)        
-            os.makedirs(os.path.dirname(dest_txt),exist_ok=True)
+            # output_info = images_to_copy[0]
+            for output_info in tqdm(images_to_copy):
+                p(output_info)
+                
+        else:
             
-            if not create_image_and_label_folders:
-                assert os.path.dirname(dest_image) == os.path.dirname(dest_txt)
+            if pool_type == 'thread':
+                pool = ThreadPool(n_workers)
+            else:
+                pool = Pool(n_workers)
             
-            if (not os.path.isfile(dest_image)) or (overwrite_images):
-                shutil.copyfile(source_image,dest_image)
-        
-            bboxes = output_info['bboxes']        
+            print('Starting a {} pool of {} workers'.format(pool_type,n_workers))
             
-            # Only write an annotation file if there are bounding boxes.  Images with 
-            # no .txt files are treated as hard negatives, at least by YOLOv5:
-            #
-            # https://github.com/ultralytics/yolov5/issues/3218
-            #
-            # I think this is also true for images with empty .txt files, but 
-            # I'm using the convention suggested on that issue, i.e. hard 
-            # negatives are expressed as images without .txt files.
-            if len(bboxes) > 0:
-                
-                with open(dest_txt,'w') as f:
-                    
-                    # bbox = bboxes[0]
-                    for bbox in bboxes:
-                        assert len(bbox) == 5
-                        s = '{} {} {} {} {}'.format(bbox[0],bbox[1],bbox[2],bbox[3],bbox[4])
-                        f.write(s + '\n')
-                        
-        # ...if we're actually writing output
+            try:
+                _ = list(tqdm(pool.imap(p,images_to_copy,chunksize=64),total=len(images_to_copy)))
+            finally:
+                pool.close()
+                pool.join()
         
-    # ...for each image
+    # ...if we're actually writing output
     
     coco_to_yolo_info = {}
     coco_to_yolo_info['class_list_filename'] = class_list_filename
@@ -642,13 +766,28 @@ def main():
         action='store_true',
         help='Prepare symlinks so the whole folder appears to contain "images" and "labels" folderss')        
     
+    parser.add_argument(
+        '--n_workers',
+        type=int,
+        default=1,
+        help='Number of concurrent workers for copying images and writing labels (default 1)')
+    
+    parser.add_argument(
+        '--image_size_cache_file',
+        type=str,
+        default=None,
+        help='.json file used to cache image sizes across runs, only used for images without ' + \
+             'sizes in the input file')
+    
     if len(sys.argv[1:]) == 0:
         parser.print_help()
         parser.exit()
 
     args = parser.parse_args()
 
-    coco_to_yolo_results = coco_to_yolo(args.input_folder,args.output_folder,args.input_file)
+    coco_to_yolo_results = coco_to_yolo(args.input_folder,args.output_folder,args.input_file,
+                                        n_workers=args.n_workers,
+                                        image_size_cache_file=args.image_size_cache_file)
     
     if args.create_bounding_box_editor_symlinks:
         create_yolo_symlinks(source_folder=args.output_folder,
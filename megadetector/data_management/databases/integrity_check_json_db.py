@@ -9,10 +9,14 @@ Does some integrity-checking and computes basic statistics on a COCO Camera Trap
 * Verifies that annotations refer to valid categories
 * Verifies that image, category, and annotation IDs are unique 
 * Optionally checks file existence
+* Optionally checks image sizes
 * Finds un-annotated images
 * Finds unused categories
 * Prints a list of categories sorted by count
 
+For very large databases, the .json file can be streamed (rather than loaded all at once); 
+this requires the ijson package.
+
 """
 
 #%% Constants and environment
@@ -20,16 +24,21 @@ Does some integrity-checking and computes basic statistics on a COCO Camera Trap
 import argparse
 import json
 import os
+import posixpath
 import sys
 
+from collections import defaultdict
 from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 from tqdm import tqdm
 
-from megadetector.visualization.visualization_utils import open_image
+from megadetector.visualization.visualization_utils import get_image_size
 from megadetector.utils import ct_utils
 from megadetector.utils.path_utils import find_images
 
+# Number of images per work item when checking image sizes in parallel
+image_size_check_chunk_size = 1000
+
 
 #%% Classes and environment
 
@@ -66,55 +75,483 @@ class IntegrityCheckOptions:
         
         #: Allow integer-valued image and annotation IDs (COCO uses this, CCT files use strings)
         self.allowIntIDs = False
-    
-# This is used in a medium-hacky way to share modified options across threads
-default_options = IntegrityCheckOptions()
+        
+        #: Stream the .json file rather than loading it all at once, which uses much less
+        #: memory for very large databases.  Requires the ijson package.  Only relevant when
+        #: the database is supplied as a filename; in this mode, integrity_check_json_db() 
+        #: returns None in place of the loaded data.
+        self.bStreamJson = False
 
 
 #%% Functions
 
-def _check_image_existence_and_size(image,options=None):
+def _list_files_in_folder(folder):
+    """
+    Returns the set of (normcase'd) filenames in [folder], via a single os.scandir() call.
+    Returns an empty set if [folder] doesn't exist, or None if [folder] exists but can't be 
+    listed, in which case the caller should check files individually.
     """
-    Validate the image represented in the CCT image dict [image], which should have fields:
     
-    * file_name
-    * width
-    * height
+    filenames = set()
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_file():
+                    filenames.add(os.path.normcase(entry.name))
+    except (FileNotFoundError,NotADirectoryError):
+        pass
+    except OSError as e:
+        print('Warning: could not list folder {} ({}), checking files individually'.format(
+            folder,str(e)))
+        return None
+    return filenames
 
-    Args:
-        image (dict): image to validate
-        options (IntegrityCheckOptions): parameters impacting validation
+
+def _check_image_sizes(image_records,options):
+    """
+    Validate the sizes for a list of (index,file_name,width,height,id) tuples, for images
+    we already know to exist.  Returns a list of (index,error_string) tuples.
+    """
+    
+    errors = []
+    
+    for i_image,file_name,width,height,image_id in image_records:
+        
+        filePath = os.path.join(options.baseDir,file_name)
+        
+        if width is None or height is None:
+            errors.append((i_image,'Missing image size in {}'.format(filePath)))
+            continue
+        
+        # This reads only the image header for JPEG/PNG files
+        size = get_image_size(filePath)
+        if size is None:
+            errors.append((i_image,'Could not read image {}'.format(filePath)))
+            continue
+        
+        if size != (width,height):
+            s = 'Size mismatch for image {}: {} (reported {},{}, actual {},{})'.format(
+                    image_id, filePath, width, height, size[0], size[1])
+            errors.append((i_image,s))
+            
+    return errors
+
+
+def _check_image_files(image_records,options):
+    """
+    Check existence (and, if options.bCheckImageSizes is set, size) for the images represented 
+    by [image_records], a list of (file_name,width,height,id) tuples, where file_name is relative
+    to options.baseDir.
+    
+    Rather than stat'ing every file, lists each folder once (in parallel across folders).
     
     Returns:
-        str: None if this image passes validation, otherwise an error string
+        list: a list of (file_name,error_string) tuples, in the same order as [image_records]
     """
+    
+    folder_to_indices = defaultdict(list)
+    for i_image,record in enumerate(image_records):
+        folder_to_indices[posixpath.dirname(record[0])].append(i_image)
+    folders = list(folder_to_indices.keys())
+    
+    # os.scandir('') fails, so images at the top level of a relative (or empty) baseDir
+    # are listed via '.'
+    folders_abs = [os.path.join(options.baseDir,folder) for folder in folders]
+    folders_abs = [folder if len(folder) > 0 else '.' for folder in folders_abs]
+    
+    if options.verbose:
+        print('Listing {} folders...'.format(len(folders)))
+        
+    pool = None
+    
+    try:
+        
+        if options.nThreads is not None and options.nThreads > 1:
+            if options.verbose:
+                print('Starting a pool of {} workers'.format(options.nThreads))
+            pool = ThreadPool(options.nThreads)
+            folder_contents = list(tqdm(pool.imap(_list_files_in_folder, folders_abs), 
+                                        total=len(folders_abs)))
+        else:
+            folder_contents = [_list_files_in_folder(folder) for folder in tqdm(folders_abs)]
+            
+        # Check existence
+        errors = []
+        existing_image_records = []
+        for folder,filenames_in_folder in zip(folders,folder_contents):
+            for i_image in folder_to_indices[folder]:
+                record = image_records[i_image]
+                filePath = os.path.join(options.baseDir,record[0])
+                if filenames_in_folder is None:
+                    file_exists = os.path.isfile(filePath)
+                else:
+                    file_exists = \
+                        os.path.normcase(posixpath.basename(record[0])) in filenames_in_folder
+                if file_exists:
+                    existing_image_records.append((i_image,) + tuple(record))
+                else:
+                    errors.append((i_image,'Image path {} does not exist'.format(filePath)))
+                
+        # Check sizes
+        if options.bCheckImageSizes and len(existing_image_records) > 0:
+            
+            if options.verbose:
+                print('Checking sizes for {} images...'.format(len(existing_image_records)))
+                
+            chunks = [existing_image_records[i:i+image_size_check_chunk_size] for i in \
+                      range(0,len(existing_image_records),image_size_check_chunk_size)]
+            if pool is not None:
+                chunk_results = list(tqdm(pool.imap(
+                    lambda chunk: _check_image_sizes(chunk,options), chunks), total=len(chunks)))
+            else:
+                chunk_results = [_check_image_sizes(chunk,options) for chunk in tqdm(chunks)]
+            for chunk_errors in chunk_results:
+                errors.extend(chunk_errors)
+    
+    finally:
+        
+        if pool is not None:
+            pool.close()
+            pool.join()
+            
+    errors = sorted(errors,key=itemgetter(0))
+    return [(image_records[i_image][0],error) for i_image,error in errors]
 
-    if options is None:        
-        options = default_options
+# ..._check_image_files(...)
+
+
+def _check_category_fields(cat):
+    """
+    Confirm that required fields are present and have the right types for the category [cat].
+    """
     
-    assert options.bCheckImageExistence
+    assert 'name' in cat
+    assert 'id' in cat
     
-    filePath = os.path.join(options.baseDir,image['file_name'])
-    if not os.path.isfile(filePath):
-        s = 'Image path {} does not exist'.format(filePath)
-        return s
+    assert isinstance(cat['id'],int), 'Illegal category ID type: [{}]'.format(str(cat['id']))
+    assert isinstance(cat['name'],str), 'Illegal category name type [{}]'.format(str(cat['name']))
+
+
+def _check_image_fields(image,options):
+    """
+    Confirm that required fields are present and have the right types for the image [image].
+    Normalizes slashes in image['file_name'].
+    """
     
-    if options.bCheckImageSizes:
-        if not ('height' in image and 'width' in image):
-            s = 'Missing image size in {}'.format(filePath)
-            return s
+    assert 'file_name' in image
+    assert 'id' in image
 
-        # width, height = Image.open(filePath).size
-        pil_im = open_image(filePath)
-        width,height = pil_im.size
-        if (not (width == image['width'] and height == image['height'])):
-            s = 'Size mismatch for image {}: {} (reported {},{}, actual {},{})'.format(
-                    image['id'], filePath, image['width'], image['height'], width, height)
-            return s
+    image['file_name'] = image['file_name'].replace('\\','/')
+    
+    assert isinstance(image['file_name'],str), 'Illegal image filename type'
+    
+    if options.allowIntIDs:
+        assert isinstance(image['id'],str) or isinstance(image['id'],int), \
+            'Illegal image ID type'
+    else:
+        assert isinstance(image['id'],str), 'Illegal image ID type'
+        
+    if 'height' in image:
+        assert 'width' in image, 'Image with height but no width: {}'.format(image['id'])
+    
+    if 'width' in image:
+        assert 'height' in image, 'Image with width but no height: {}'.format(image['id'])
+
+    if options.bRequireLocation:
+        assert 'location' in image, 'No location available for: {}'.format(image['id'])
+        
+    if 'location' in image:
+        # We previously supported ints here; this should be strings now
+        # assert isinstance(image['location'], str) or isinstance(image['location'], int), \
+        #  'Illegal image location type'
+        assert isinstance(image['location'], str)
+        
+    assert not ('sequence_id' in image or 'sequence' in image), 'Illegal sequence identifier'
+
+
+def _check_annotation_fields(ann,options):
+    """
+    Confirm that required fields are present and have the right types for the annotation [ann].
+    """
+    
+    assert 'image_id' in ann
+    assert 'id' in ann
+    assert 'category_id' in ann
+    
+    if options.allowIntIDs:
+        assert isinstance(ann['id'],str) or isinstance(ann['id'],int), \
+            'Illegal annotation ID type'
+        assert isinstance(ann['image_id'],str) or isinstance(ann['image_id'],int), \
+            'Illegal annotation image ID type'
+    else:
+        assert isinstance(ann['id'],str), 'Illegal annotation ID type'
+        assert isinstance(ann['image_id'],str), 'Illegal annotation image ID type'
+    
+    assert isinstance(ann['category_id'],int), 'Illegal annotation category ID type'
+
+
+def _image_file_record(image):
+    """
+    The subset of an image dict we need for file existence/size checks.
+    """
+    
+    return (image['file_name'],image.get('width'),image.get('height'),image['id'])
+
+
+def _print_statistics(options, base_dir, n_images, n_annotations, n_boxes, n_unannotated, 
+                      n_multi_annotated, unused_files, categories, sorted_categories, 
+                      n_sequences, n_locations):
+    """
+    Print summary statistics at the end of integrity_check_json_db().
+    """
+    
+    print('Found {} unannotated images, {} images with multiple annotations'.format(
+            n_unannotated,n_multi_annotated))
+    
+    if (len(base_dir) > 0) and options.bFindUnusedImages:
+        print('Found {} unused image files'.format(len(unused_files)))
+        
+    n_unused_categories = 0
+    
+    # Find unused categories
+    for cat in categories:
+        if cat['_count'] == 0:
+            print('Unused category: {}'.format(cat['name']))
+            n_unused_categories += 1
+    
+    print('Found {} unused categories'.format(n_unused_categories))
+            
+    sequenceString = 'no sequence info'
+    if n_sequences > 0:
+        sequenceString = '{} sequences'.format(n_sequences)
+        
+    print('\nDB contains {} images, {} annotations, {} bboxes, {} categories, {}\n'.format(
+            n_images,n_annotations,n_boxes,len(categories),sequenceString))
+
+    if n_locations > 0:
+        print('DB contains images from {} locations\n'.format(n_locations))
+            
+    print('Categories and annotation (not image) counts:\n')
+    
+    for cat in sorted_categories:
+        print('{:6} {}'.format(cat['_count'],cat['name']))
+    
+    print('')
+
+# ...def _print_statistics(...)
+
+
+def _find_unused_files(base_dir,image_paths_in_json,options):
+    """
+    Find images in [base_dir] that don't appear in the set [image_paths_in_json].
+    """
+    
+    if options.verbose:
+        print('\nEnumerating images...')
+    
+    image_paths_relative = find_images(base_dir,return_relative_paths=True,recursive=True)
+    
+    unused_files = []
+    for fn_relative in image_paths_relative:
+        if fn_relative not in image_paths_in_json:
+            unused_files.append(fn_relative)
+            
+    return unused_files
+
+
+def _iterate_cct_json(json_filename):
+    """
+    Iterate over a CCT .json file without loading the whole file, yielding:
+    
+    * ('key',k) for each top-level key k
+    * ('info',info) for the top-level 'info' object
+    * ('images',im), ('annotations',ann), or ('categories',cat) for each element of the 
+      corresponding arrays.
+      
+    Elements are yielded in file order.  Requires the ijson package.
+    """
+    
+    # This is an import I'd rather not depend on outside of the rare case where we're
+    # streaming a giant .json file, so importing locally
+    #
+    # pip install ijson
+    import ijson
+    
+    prefix_to_field = {'info':'info',
+                       'images.item':'images',
+                       'annotations.item':'annotations',
+                       'categories.item':'categories'}
+    
+    builder = None
+    builder_prefix = None
+    
+    with open(json_filename,'rb') as f:
         
-    return None
+        for prefix,event,value in ijson.parse(f,use_float=True):
+            
+            if builder is not None:
+                builder.event(event,value)
+                if (prefix == builder_prefix) and (event in ('end_map','end_array')):
+                    yield prefix_to_field[builder_prefix],builder.value
+                    builder = None
+                continue
+            
+            if prefix == '' and event == 'map_key':
+                yield 'key',value
+            elif (prefix in prefix_to_field) and (event in ('start_map','start_array')):
+                builder = ijson.ObjectBuilder()
+                builder_prefix = prefix
+                builder.event(event,value)
+                
+        # ...for each parser event
+        
+    # ...with open(...)
+    
+# ...def _iterate_cct_json(...)
+
+
+def _integrity_check_json_db_streaming(jsonFile, options):
+    """
+    Streaming implementation of integrity_check_json_db(), which keeps only IDs and counts
+    in memory.  Because arrays can appear in any order in the file, referential integrity 
+    (annotations --> images, annotations --> categories) is verified after reading the 
+    whole file.
+    """
+    
+    base_dir = options.baseDir
+    
+    if options.verbose:
+        print('Streaming .json {} with base dir [{}]...'.format(jsonFile,base_dir))
+        
+    top_level_keys = set()
+    
+    categories = []
+    category_id_to_category = {}
+    category_name_to_category = {}
+    
+    image_ids = set()
+    n_images = 0
+    image_paths_in_json = set()
+    image_location_set = set()
+    sequences = set()
+    image_file_records = []
+    
+    annotation_ids = set()
+    n_annotations = 0
+    n_boxes = 0
+    annotation_count_by_image_id = defaultdict(int)
+    annotation_count_by_category_id = defaultdict(int)
+    
+    check_files = options.bCheckImageExistence or options.bCheckImageSizes
+    
+    for field,item in tqdm(_iterate_cct_json(jsonFile)):
+        
+        if field == 'key':
+            
+            top_level_keys.add(item)
+        
+        elif field == 'categories':
+            
+            cat = item
+            _check_category_fields(cat)
+            
+            # Confirm ID uniqueness
+            assert cat['id'] not in category_id_to_category, \
+                'Category ID {} is used more than once'.format(cat['id'])
+            category_id_to_category[cat['id']] = cat
+            assert cat['name'] not in category_name_to_category, \
+                'Category name {} is used more than once'.format(cat['name'])
+            category_name_to_category[cat['name']] = cat
+            categories.append(cat)
+            
+        elif field == 'images':
+            
+            if options.iMaxNumImages > 0 and n_images >= options.iMaxNumImages:
+                continue
+            
+            image = item
+            _check_image_fields(image,options)
+            
+            # Confirm ID uniqueness
+            assert image['id'] not in image_ids, 'Duplicate image ID {}'.format(image['id'])
+            image_ids.add(image['id'])
+            n_images += 1
+            
+            image_paths_in_json.add(image['file_name'])
+            if 'location' in image:
+                image_location_set.add(image['location'])
+            if 'seq_id' in image:
+                sequences.add(image['seq_id'])
+            if check_files:
+                image_file_records.append(_image_file_record(image))
+                
+        elif field == 'annotations':
+            
+            ann = item
+            _check_annotation_fields(ann,options)
+            
+            if 'bbox' in ann:
+                n_boxes += 1
+                
+            # Confirm ID uniqueness
+            assert ann['id'] not in annotation_ids, 'Duplicate annotation ID {}'.format(ann['id'])
+            annotation_ids.add(ann['id'])
+            n_annotations += 1
+            
+            annotation_count_by_image_id[ann['image_id']] += 1
+            annotation_count_by_category_id[ann['category_id']] += 1
+        
+    # ...for each item in the .json file
+    
+    for k in ('images','annotations','categories','info'):
+        assert k in top_level_keys, 'No {} field in database'.format(k)
+        
+    # Confirm validity of references
+    for category_id in annotation_count_by_category_id:
+        assert category_id in category_id_to_category, \
+            'Category {} not found in category list'.format(category_id)
+    for image_id in annotation_count_by_image_id:
+        assert image_id in image_ids, \
+            'Image ID {} referred to by an annotation, not available'.format(image_id)
+    
+    for cat in categories:
+        cat['_count'] = annotation_count_by_category_id[cat['id']]
+    sorted_categories = sorted(categories, key=itemgetter('_count'), reverse=True)
+    
+    if len(base_dir) > 0:        
+        assert os.path.isdir(base_dir), 'Base directory {} does not exist'.format(base_dir)
+        
+    unused_files = []
+    if (len(base_dir) > 0) and options.bFindUnusedImages:    
+        unused_files = _find_unused_files(base_dir,image_paths_in_json,options)
+        
+    validation_errors = []
+    if check_files:
+        if options.verbose:
+            print('Checking image existence and/or image sizes...')
+        validation_errors = _check_image_files(image_file_records,options)
+    
+    if options.verbose:
+        
+        print('{} validation errors (of {})'.format(len(validation_errors),n_images))
+        
+        n_annotated = len(annotation_count_by_image_id)
+        n_multi_annotated = sum(1 for c in annotation_count_by_image_id.values() if c > 1)
+        
+        _print_statistics(options, base_dir, n_images, n_annotations, n_boxes,
+                          n_images - n_annotated, n_multi_annotated, unused_files, 
+                          categories, sorted_categories, len(sequences), 
+                          len(image_location_set))
+    
+    error_info = {}
+    error_info['unused_files'] = unused_files
+    error_info['validation_errors'] = validation_errors
+    
+    return sorted_categories, None, error_info
+
+# ...def _integrity_check_json_db_streaming(...)
+
 
-  
 def integrity_check_json_db(jsonFile, options=None):
     """
     Does some integrity-checking and computes basic statistics on a COCO Camera Traps .json file; see
@@ -126,7 +563,8 @@ def integrity_check_json_db(jsonFile, options=None):
     Returns:
         tuple: tuple containing:
             - sorted_categories (dict): list of categories used in [jsonFile], sorted by frequency
-            - data (dict): the data loaded from [jsonFile]
+            - data (dict): the data loaded from [jsonFile], or None if options.bStreamJson 
+              is set and [jsonFile] is a filename
             - error_info (dict): specific validation errors
     """
     
@@ -155,6 +593,9 @@ def integrity_check_json_db(jsonFile, options=None):
         
         assert os.path.isfile(jsonFile), '.json file {} does not exist'.format(jsonFile)
     
+        if options.bStreamJson:
+            return _integrity_check_json_db_streaming(jsonFile,options)
+        
         if options.verbose:
             print('Reading .json {} with base dir [{}]...'.format(
                     jsonFile,base_dir))
@@ -189,12 +630,7 @@ def integrity_check_json_db(jsonFile, options=None):
     
     for cat in tqdm(categories):
         
-        # Confirm that required fields are present
-        assert 'name' in cat
-        assert 'id' in cat
-        
-        assert isinstance(cat['id'],int), 'Illegal category ID type: [{}]'.format(str(cat['id']))
-        assert isinstance(cat['name'],str), 'Illegal category name type [{}]'.format(str(cat['name']))
+        _check_category_fields(cat)
         
         category_id = cat['id']
         category_name = cat['name']
@@ -227,22 +663,10 @@ def integrity_check_json_db(jsonFile, options=None):
         
         image['_count'] = 0
         
-        # Confirm that required fields are present
-        assert 'file_name' in image
-        assert 'id' in image
-
-        image['file_name'] = image['file_name'].replace('\\','/')
+        _check_image_fields(image,options)
                 
         image_paths_in_json.add(image['file_name'])
         
-        assert isinstance(image['file_name'],str), 'Illegal image filename type'
-        
-        if options.allowIntIDs:
-            assert isinstance(image['id'],str) or isinstance(image['id'],int), \
-                'Illegal image ID type'
-        else:
-            assert isinstance(image['id'],str), 'Illegal image ID type'
-        
         image_id = image['id']        
         
         # Confirm ID uniqueness
@@ -250,84 +674,32 @@ def integrity_check_json_db(jsonFile, options=None):
         
         image_id_to_image[image_id] = image
         
-        if 'height' in image:
-            assert 'width' in image, 'Image with height but no width: {}'.format(image['id'])
-        
-        if 'width' in image:
-            assert 'height' in image, 'Image with width but no height: {}'.format(image['id'])
-
-        if options.bRequireLocation:
-            assert 'location' in image, 'No location available for: {}'.format(image['id'])
-            
         if 'location' in image:
-            # We previously supported ints here; this should be strings now
-            # assert isinstance(image['location'], str) or isinstance(image['location'], int), \
-            #  'Illegal image location type'
-            assert isinstance(image['location'], str)
             image_location_set.add(image['location'])
     
         if 'seq_id' in image:
             sequences.add(image['seq_id'])
-            
-        assert not ('sequence_id' in image or 'sequence' in image), 'Illegal sequence identifier'
         
     unused_files = []
                 
-    image_paths_relative = None
-    
     # Are we checking for unused images?
     if (len(base_dir) > 0) and options.bFindUnusedImages:    
         
-        if options.verbose:
-            print('\nEnumerating images...')
-        
-        image_paths_relative = find_images(base_dir,return_relative_paths=True,recursive=True)
-        
-        for fn_relative in image_paths_relative:
-            if fn_relative not in image_paths_in_json:
-                unused_files.append(fn_relative)
+        unused_files = _find_unused_files(base_dir,image_paths_in_json,options)
                 
     # List of (filename,error_string) tuples
     validation_errors = []
     
-    # If we're checking image existence but not image size, we don't need to read the images
-    if options.bCheckImageExistence and not options.bCheckImageSizes:
-        
-        if image_paths_relative is None:
-            image_paths_relative = find_images(base_dir,return_relative_paths=True,recursive=True)
-            
-        image_paths_relative_set = set(image_paths_relative)
-        
-        for im in images:
-            if im['file_name'] not in image_paths_relative_set:                
-                validation_errors.append((im['file_name'],'not found in relative path list'))
-            
-    # If we're checking image size, we need to read the images
-    if options.bCheckImageSizes:
+    if options.bCheckImageExistence or options.bCheckImageSizes:
         
         if len(base_dir) == 0:
-            print('Warning: checking image sizes without a base directory, assuming "."')
+            print('Warning: checking images without a base directory, assuming "."')
          
         if options.verbose:
             print('Checking image existence and/or image sizes...')
         
-        if options.nThreads is not None and options.nThreads > 1:
-            if options.verbose:
-                print('Starting a pool of {} workers'.format(options.nThreads))
-            pool = ThreadPool(options.nThreads)
-            # results = pool.imap_unordered(lambda x: fetch_url(x,nImages), indexedUrlList)
-            default_options.baseDir = options.baseDir
-            default_options.bCheckImageSizes = options.bCheckImageSizes
-            default_options.bCheckImageExistence = options.bCheckImageExistence
-            results = tqdm(pool.imap(_check_image_existence_and_size, images), total=len(images))
-        else:
-            results = []
-            for im in tqdm(images):                
-                results.append(_check_image_existence_and_size(im,options))
-                
-        for i_image,result in enumerate(results):
-            if result is not None:
-                validation_errors.append((images[i_image]['file_name'],result))
+        validation_errors = _check_image_files([_image_file_record(im) for im in images],
+                                               options)
                             
     # ...for each image
     
@@ -339,21 +711,7 @@ def integrity_check_json_db(jsonFile, options=None):
     
     for ann in tqdm(annotations):
     
-        # Confirm that required fields are present
-        assert 'image_id' in ann
-        assert 'id' in ann
-        assert 'category_id' in ann
-        
-        if options.allowIntIDs:
-            assert isinstance(ann['id'],str) or isinstance(ann['id'],int), \
-                'Illegal annotation ID type'
-            assert isinstance(ann['image_id'],str) or isinstance(ann['image_id'],int), \
-                'Illegal annotation image ID type'
-        else:
-            assert isinstance(ann['id'],str), 'Illegal annotation ID type'
-            assert isinstance(ann['image_id'],str), 'Illegal annotation image ID type'
-        
-        assert isinstance(ann['category_id'],int), 'Illegal annotation category ID type'
+        _check_annotation_fields(ann,options)
         
         if 'bbox' in ann:
             nBoxes += 1
@@ -393,38 +751,9 @@ def integrity_check_json_db(jsonFile, options=None):
             elif image['_count'] > 1:
                 nMultiAnnotated += 1
                 
-        print('Found {} unannotated images, {} images with multiple annotations'.format(
-                nUnannotated,nMultiAnnotated))
-        
-        if (len(base_dir) > 0) and options.bFindUnusedImages:
-            print('Found {} unused image files'.format(len(unused_files)))
-            
-        n_unused_categories = 0
-        
-        # Find unused categories
-        for cat in categories:
-            if cat['_count'] == 0:
-                print('Unused category: {}'.format(cat['name']))
-                n_unused_categories += 1
-        
-        print('Found {} unused categories'.format(n_unused_categories))
-                
-        sequenceString = 'no sequence info'
-        if len(sequences) > 0:
-            sequenceString = '{} sequences'.format(len(sequences))
-            
-        print('\nDB contains {} images, {} annotations, {} bboxes, {} categories, {}\n'.format(
-                len(images),len(annotations),nBoxes,len(categories),sequenceString))
-    
-        if len(image_location_set) > 0:
-            print('DB contains images from {} locations\n'.format(len(image_location_set)))
-                
-        print('Categories and annotation (not image) counts:\n')
-        
-        for cat in sorted_categories:
-            print('{:6} {}'.format(cat['_count'],cat['name']))
-        
-        print('')
+        _print_statistics(options, base_dir, len(images), len(annotations), nBoxes,
+                          nUnannotated, nMultiAnnotated, unused_files, categories, 
+                          sorted_categories, len(sequences), len(image_location_set))
     
     error_info = {}
     error_info['unused_files'] = unused_files
@@ -459,6 +788,9 @@ def main():
     parser.add_argument('--nThreads', action='store', type=int, default=10, 
                         help='Number of threads (only relevant when verifying image ' + \
                              'sizes and/or existence)')
+    parser.add_argument('--bStreamJson', action='store_true',
+                        help='Stream the .json file rather than loading it into memory ' + \
+                             '(requires the ijson package)')
     
     if len(sys.argv[1:])==0:
         parser.print_help()
@@ -22,6 +22,7 @@ from functools import partial
 from tqdm import tqdm
 
 from megadetector.utils.path_utils import find_images
+from megadetector.data_management.read_exif import read_image_header
 
 image_base = ''
 default_n_threads = 1
@@ -46,6 +47,14 @@ def _get_image_size(image_path,image_prefix=None):
         print('Could not find image {}'.format(full_path))
         return (image_path,-1,-1)
 
+    # Read the size from the file header if we can, otherwise fall back to PIL
+    try:
+        header = read_image_header(full_path)
+    except Exception:
+        header = None
+    if header is not None:
+        return (image_path,header['width'],header['height'])
+    
     try:        
         pil_im = Image.open(full_path)
         w = pil_im.width            
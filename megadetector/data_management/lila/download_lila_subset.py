@@ -16,7 +16,7 @@ from tqdm import tqdm
 from collections import defaultdict
 
 from megadetector.data_management.lila.lila_common import \
-    read_lila_all_images_file, is_empty, lila_base_urls
+    open_lila_all_images_db, query_lila_all_images_db, lila_base_urls
 
 for s in lila_base_urls.values():
     assert s.endswith('/')
@@ -46,38 +46,37 @@ random.seed(0)
 
 #%% Download and open the giant table of image URLs and labels
 
-# Takes ~2 minutes to download, unzip, and open
-df = read_lila_all_images_file(metadata_dir)
+# The first time this runs, takes ~2 minutes to download and unzip, then a few more minutes
+# to convert the .csv file to a local database.  After that, this is instantaneous.
+db = open_lila_all_images_db(metadata_dir)
 
 
 #%% Find all the images we want to download
 
-# Takes ~2 minutes
+# Takes a few seconds
 
 common_name_to_count = defaultdict(int)
 
 ds_name_to_urls = defaultdict(list)
 
-def find_items(row):
-    
-    if is_empty(row['common_name']):
-        return
+# This is the only bit of this file that's specific to a particular query.  In this case
+# we're retrieving rows whose common name contains any of our species of interest, but 
+# you do you.
+df = query_lila_all_images_db(db,
+                              common_name_substrings=species_of_interest,
+                              columns=['dataset_name','common_name','url_' + preferred_provider])
+
+for row in tqdm(df.itertuples(index=False),total=len(df)):
     
-    match = False
+    row = row._asdict()
     
-    # This is the only bit of this file that's specific to a particular query.  In this case
-    # we're checking whether each row is on a list of species of interest, but you do you.
+    # Attribute each row to the first matching species of interest
     for species_name in species_of_interest:
         if species_name in row['common_name']:
-            match = True
             common_name_to_count[species_name] += 1
             break
     
-    if match:
-        ds_name_to_urls[row['dataset_name']].append(row['url_' + preferred_provider])
-
-tqdm.pandas()
-_ = df.progress_apply(find_items,axis=1)
+    ds_name_to_urls[row['dataset_name']].append(row['url_' + preferred_provider])
 
 # We have a list of URLs for each dataset, flatten them all into a list of URLs
 all_urls = list(ds_name_to_urls.values())
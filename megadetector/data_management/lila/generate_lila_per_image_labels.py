@@ -426,6 +426,9 @@ os.makedirs(preview_folder,exist_ok=True)
 np.random.seed(0)
 images_to_download = []
 
+# Find the rows for each dataset in a single pass over the table
+dataset_name_to_row_indices = df.groupby('dataset_name').indices
+
 # ds_name = list(metadata_table.keys())[2]
 for ds_name in metadata_table.keys():
     
@@ -433,7 +436,7 @@ for ds_name in metadata_table.keys():
         continue
     
     # Find all rows for this dataset
-    ds_rows = df.loc[df['dataset_name'] == ds_name]
+    ds_rows = df.iloc[dataset_name_to_row_indices.get(ds_name,[])]
     
     print('{} rows available for {}'.format(len(ds_rows),ds_name))
     assert len(ds_rows) > 0
@@ -10,6 +10,7 @@ Common constants and functions related to LILA data management/retrieval.
 
 import os
 import json
+import sqlite3
 import zipfile
 import pandas as pd
 
@@ -47,6 +48,12 @@ lila_cloud_urls = {
 for url in lila_base_urls.values():
     assert url.endswith('/')
 
+# Table name and indexed columns for the SQLite version of the giant .csv file with labels
+# for all LILA images
+lila_all_images_table_name = 'images'
+lila_all_images_indexed_columns = ('dataset_name','scientific_name','common_name')
+lila_all_images_db_chunk_size = 500000
+
 
 #%% Common functions
 
@@ -181,20 +188,12 @@ def read_lila_metadata(metadata_dir, force_download=False):
     return metadata_table    
     
 
-def read_lila_all_images_file(metadata_dir, force_download=False):
+def _download_lila_all_images_file(metadata_dir, force_download=False):
     """
     Downloads if necessary - then unzips if necessary - the .csv file with label mappings for
-    all LILA files, and opens the resulting .csv file as a Pandas DataFrame.
-    
-    Args:
-        metadata_dir (str): folder to use for temporary LILA metadata files
-        force_download (bool, optional): download the metadata file even if 
-            the local file exists.
-        
-    Returns:
-        pd.DataFrame: a DataFrame containing one row per identification in a LILA camera trap image
+    all LILA files, returning the unzipped .csv filename.
     """
-        
+    
     p = urlparse(lila_all_images_url)
     lila_all_images_zip_filename = os.path.join(metadata_dir,os.path.basename(p.path))
     download_url(lila_all_images_url, lila_all_images_zip_filename,
@@ -205,16 +204,197 @@ def read_lila_all_images_file(metadata_dir, force_download=False):
     assert len(files) == 1
     
     unzipped_csv_filename = os.path.join(metadata_dir,files[0])
-    if not os.path.isfile(unzipped_csv_filename):
+    if force_download or (not os.path.isfile(unzipped_csv_filename)):
         unzip_file(lila_all_images_zip_filename,metadata_dir)
     else:
         print('{} already unzipped'.format(unzipped_csv_filename))    
     
+    return unzipped_csv_filename
+
+
+def read_lila_all_images_file(metadata_dir, force_download=False):
+    """
+    Downloads if necessary - then unzips if necessary - the .csv file with label mappings for
+    all LILA files, and opens the resulting .csv file as a Pandas DataFrame.
+    
+    This loads the entire (very large) table into memory; if you only need a subset of the
+    table, open_lila_all_images_db() and query_lila_all_images_db() are much faster.
+    
+    Args:
+        metadata_dir (str): folder to use for temporary LILA metadata files
+        force_download (bool, optional): download the metadata file even if 
+            the local file exists.
+        
+    Returns:
+        pd.DataFrame: a DataFrame containing one row per identification in a LILA camera trap image
+    """
+        
+    unzipped_csv_filename = _download_lila_all_images_file(metadata_dir, 
+                                                           force_download=force_download)
+    
     df = pd.read_csv(unzipped_csv_filename)
     
     return df
 
 
+def create_lila_all_images_db(csv_filename, db_filename=None, force=False):
+    """
+    Converts the .csv file with label mappings for all LILA files (or any .csv file in the 
+    same format) to a SQLite database with a single table, indexed by dataset name, 
+    scientific name, and common name.  This is a one-time operation; subsequent queries
+    via query_lila_all_images_db() don't need to read the whole table.
+    
+    Args:
+        csv_filename (str): the .csv file to convert
+        db_filename (str, optional): the database file to create; defaults to [csv_filename]
+            with the extension replaced by .db
+        force (bool, optional): re-create the database even if it already exists and is
+            newer than [csv_filename]
+            
+    Returns:
+        str: the database filename
+    """
+    
+    if db_filename is None:
+        db_filename = os.path.splitext(csv_filename)[0] + '.db'
+        
+    if (not force) and os.path.isfile(db_filename) and \
+        (os.path.getmtime(db_filename) >= os.path.getmtime(csv_filename)):
+        print('Using existing database {}'.format(db_filename))
+        return db_filename
+    
+    print('Creating database {} from {}'.format(db_filename,csv_filename))
+    
+    # Write to a temporary file, so we never leave a partial database behind
+    temp_db_filename = db_filename + '.tmp'
+    if os.path.isfile(temp_db_filename):
+        os.remove(temp_db_filename)
+        
+    conn = sqlite3.connect(temp_db_filename)
+    
+    try:
+        
+        n_rows = 0
+        for chunk in pd.read_csv(csv_filename, chunksize=lila_all_images_db_chunk_size,
+                                 low_memory=False):
+            chunk.to_sql(lila_all_images_table_name, conn, if_exists='append', index=False)
+            n_rows += len(chunk)
+            print('Wrote {} rows'.format(n_rows))
+            
+        for column in lila_all_images_indexed_columns:
+            conn.execute('CREATE INDEX idx_{} ON {} ({})'.format(
+                column,lila_all_images_table_name,column))
+        conn.commit()
+        
+    finally:
+        
+        conn.close()
+        
+    os.replace(temp_db_filename,db_filename)
+    
+    return db_filename
+
+# ...def create_lila_all_images_db(...)
+
+
+def open_lila_all_images_db(metadata_dir, force_download=False):
+    """
+    Downloads if necessary - then unzips if necessary - the .csv file with label mappings for
+    all LILA files, converts it to a SQLite database if necessary (see 
+    create_lila_all_images_db()), and opens that database.
+    
+    Args:
+        metadata_dir (str): folder to use for temporary LILA metadata files
+        force_download (bool, optional): download the metadata file even if 
+            the local file exists.
+            
+    Returns:
+        sqlite3.Connection: an open connection to the database, suitable for passing to
+        query_lila_all_images_db()
+    """
+    
+    unzipped_csv_filename = _download_lila_all_images_file(metadata_dir, 
+                                                           force_download=force_download)
+    db_filename = create_lila_all_images_db(unzipped_csv_filename)
+    return sqlite3.connect(db_filename)
+
+
+def query_lila_all_images_db(db, 
+                             dataset_names=None, 
+                             scientific_names=None, 
+                             common_names=None,
+                             common_name_substrings=None,
+                             columns=None):
+    """
+    Retrieves rows from the database created by create_lila_all_images_db() that match 
+    all of the supplied criteria.  Criteria that are None are ignored; if all criteria are
+    None, returns the whole table.
+    
+    Args:
+        db (str or sqlite3.Connection): database filename or open connection
+        dataset_names (list, optional): dataset names to include
+        scientific_names (list, optional): scientific names to include
+        common_names (list, optional): common names to include
+        common_name_substrings (list, optional): include rows whose common name contains any
+            of these (case-sensitive) strings; this criterion can't use an index, but is 
+            still evaluated entirely within SQLite
+        columns (list, optional): columns to retrieve, defaults to all columns
+        
+    Returns:
+        pd.DataFrame: a DataFrame in the same format returned by read_lila_all_images_file(),
+        containing only the matching rows
+    """
+    
+    close_connection = False
+    if isinstance(db,str):
+        assert os.path.isfile(db), 'Could not find database {}'.format(db)
+        db = sqlite3.connect(db)
+        close_connection = True
+    
+    def _to_list(v):
+        if v is None or isinstance(v,list):
+            return v
+        if isinstance(v,str):
+            return [v]
+        return list(v)
+    
+    clauses = []
+    params = []
+    
+    for column,values in (('dataset_name',_to_list(dataset_names)),
+                          ('scientific_name',_to_list(scientific_names)),
+                          ('common_name',_to_list(common_names))):
+        if values is None:
+            continue
+        clauses.append('{} IN ({})'.format(column,','.join(['?'] * len(values))))
+        params.extend(values)
+        
+    common_name_substrings = _to_list(common_name_substrings)
+    if common_name_substrings is not None:
+        substring_clauses = ['instr(common_name,?) > 0'] * len(common_name_substrings)
+        clauses.append('({})'.format(' OR '.join(substring_clauses)))
+        params.extend(common_name_substrings)
+    
+    if columns is None:
+        column_string = '*'
+    else:
+        column_string = ','.join(['"{}"'.format(c) for c in _to_list(columns)])
+        
+    query = 'SELECT {} FROM {}'.format(column_string,lila_all_images_table_name)
+    if len(clauses) > 0:
+        query += ' WHERE ' + ' AND '.join(clauses)
+        
+    try:
+        df = pd.read_sql_query(query, db, params=params)
+    finally:
+        if close_connection:
+            db.close()
+            
+    return df
+
+# ...def query_lila_all_images_db(...)
+
+
 def read_metadata_file_for_dataset(ds_name,
                                    metadata_dir,
                                    metadata_table=None,
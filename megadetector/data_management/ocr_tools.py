@@ -46,6 +46,8 @@ import json
 import numpy as np
 import datetime
 import re
+import subprocess
+import tempfile
 
 from functools import partial
 from dateutil.parser import parse as dateparse
@@ -56,6 +58,8 @@ from tqdm import tqdm
 
 from megadetector.utils.path_utils import find_images
 from megadetector.utils.path_utils import open_file
+from megadetector.utils.path_utils import file_cache_key
+from megadetector.utils.path_utils import read_jsonl_manifest
 from megadetector.utils import write_html_image_list        
 from megadetector.utils.ct_utils import is_iterable
 from megadetector.visualization import visualization_utils as vis_utils
@@ -246,16 +250,11 @@ def crop_to_solid_region(rough_crop,crop_location,options=None):
     max_y = -1
     
     # Find the first and last row that are mostly the background color
-    for y in range(h):
-        row_count = 0
-        for x in range(w):
-            if analysis_image[y][x] > 0:
-                row_count += 1
-        row_fraction = row_count / w
-        if row_fraction > options.min_background_fraction_for_background_row:
-            if min_y == -1:
-                min_y = y
-            max_y = y
+    row_fractions = np.count_nonzero(analysis_image,axis=1) / w
+    background_rows = np.flatnonzero(row_fractions > options.min_background_fraction_for_background_row)
+    if len(background_rows) > 0:
+        min_y = int(background_rows[0])
+        max_y = int(background_rows[-1])
     
     assert (min_y == -1 and max_y == -1) or (min_y != -1 and max_y != -1)
     
@@ -296,6 +295,30 @@ def crop_to_solid_region(rough_crop,crop_location,options=None):
 # ...crop_to_solid_region(...)    
 
 
+def _prepare_crop_for_ocr(rough_crop,crop_location,options):
+    """
+    Crops [rough_crop] to the portion with a solid background color, falling back to the 
+    whole rough crop if that fails, and optionally sharpens the result.  Returns a tuple
+    of (the image we should run OCR on, the results of crop_to_solid_region()).
+    """
+    
+    # Crop to the portion of the rough crop with a solid background color
+    crop_to_solid_region_results = crop_to_solid_region(rough_crop,crop_location,options)
+    
+    # Try cropping to a solid region; if that doesn't work, try running OCR on the whole
+    # rough crop.
+    if crop_to_solid_region_results['p_success'] >= options.p_crop_success_threshold:
+        padded_crop_pil = crop_to_solid_region_results['padded_crop_pil']
+    else:            
+        # continue
+        padded_crop_pil = rough_crop        
+        
+    if options.apply_sharpening_filter:
+        padded_crop_pil = padded_crop_pil.filter(ImageFilter.SHARPEN)
+    
+    return padded_crop_pil,crop_to_solid_region_results
+
+
 def find_text_in_crops(rough_crops,options=None,tesseract_config_string=None):
     """
     Finds all text in each Image in the dict [rough_crops]; those images should be pretty small 
@@ -329,23 +352,12 @@ def find_text_in_crops(rough_crops,options=None,tesseract_config_string=None):
         
         rough_crop = rough_crops[crop_location]
         
-        # Crop to the portion of the rough crop with a solid background color
-        crop_to_solid_region_results = crop_to_solid_region(rough_crop,crop_location,options)
+        padded_crop_pil,crop_to_solid_region_results = \
+            _prepare_crop_for_ocr(rough_crop,crop_location,options)
         
         find_text_in_crops_results[crop_location]['crop_to_solid_region_results'] = \
             crop_to_solid_region_results
         
-        # Try cropping to a solid region; if that doesn't work, try running OCR on the whole
-        # rough crop.
-        if crop_to_solid_region_results['p_success'] >= options.p_crop_success_threshold:
-            padded_crop_pil = crop_to_solid_region_results['padded_crop_pil']
-        else:            
-            # continue
-            padded_crop_pil = rough_crop        
-            
-        if options.apply_sharpening_filter:
-            padded_crop_pil = padded_crop_pil.filter(ImageFilter.SHARPEN)
-        
         # Find text in the padded crop
         pytesseract.pytesseract.tesseract_cmd = options.tesseract_cmd
         text = pytesseract.image_to_string(padded_crop_pil, lang='eng', 
@@ -584,8 +596,272 @@ def try_get_datetime_from_image(filename,include_crops=False,options=None):
     return result
 
 
+#%% Batched OCR pipeline
+
+def ocr_image_batch(images,tesseract_config_string,options=None):
+    """
+    Runs OCR on a list of (small) PIL images with a single Tesseract process, rather than 
+    starting Tesseract (and re-loading its models) once per image.  Falls back to running
+    Tesseract once per image if the batched output can't be split into one result per image.
+    
+    Args:
+        images (list): list of PIL Images
+        tesseract_config_string (str): CLI arguments to pass to Tesseract
+        options (DatetimeExtractionOptions, optional): OCR parameters; only tesseract_cmd is
+            used here
+            
+    Returns:
+        list: list of strings, one per image in [images], with newlines replaced by spaces
+    """
+    
+    if options is None:
+        options = DatetimeExtractionOptions()
+        
+    if len(images) == 0:
+        return []
+    
+    texts = None
+    
+    # Tesseract accepts a text file listing images to process, and writes a page separator
+    # (a form feed by default) after the text for each image.
+    with tempfile.TemporaryDirectory() as temp_dir:
+        
+        image_files = []
+        for i_image,image in enumerate(images):
+            image_file = os.path.join(temp_dir,'{}.png'.format(i_image))
+            image.save(image_file)
+            image_files.append(image_file)
+            
+        list_file = os.path.join(temp_dir,'images.txt')
+        with open(list_file,'w') as f:
+            for image_file in image_files:
+                f.write(image_file + '\n')
+        
+        cmd = [options.tesseract_cmd,list_file,'stdout','-l','eng'] + \
+            tesseract_config_string.split()
+        
+        try:
+            result = subprocess.run(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE,
+                                    check=True)
+            pages = result.stdout.decode('utf-8',errors='replace').split('\f')
+            if (len(pages) == len(images) + 1) and (len(pages[-1].strip()) == 0):
+                texts = pages[:-1]
+            else:
+                print('Warning: batched OCR returned {} pages for {} images, falling back to '
+                      'per-image OCR'.format(len(pages)-1,len(images)))
+        except Exception as e:
+            print('Warning: batched OCR failed ({}), falling back to per-image OCR'.format(str(e)))
+    
+    # ...with a temporary folder
+    
+    if texts is None:
+        pytesseract.pytesseract.tesseract_cmd = options.tesseract_cmd
+        texts = [pytesseract.image_to_string(image, lang='eng', config=tesseract_config_string) \
+                 for image in images]
+    
+    return [text.replace('\n', ' ').replace('\r', '').strip() for text in texts]
+
+# ...def ocr_image_batch(...)
+
+
+def _read_image_strips(fn,options_list):
+    """
+    Loads the image [fn] and keeps only the top and bottom strips we'll need to make rough
+    crops for every option set in [options_list], so we don't hold whole images in memory
+    while we run OCR on a batch.
+    """
+    
+    image = vis_utils.load_image(fn)
+    w = image.width
+    h = image.height
+    
+    top_height = max([round(options.image_crop_fraction[0] * h) for options in options_list])
+    bottom_height = max([round(options.image_crop_fraction[1] * h) for options in options_list])
+    
+    strips = {}
+    strips['height'] = h
+    strips['top'] = image.crop([0,0,w,top_height])
+    strips['bottom'] = image.crop([0,h-bottom_height,w,h])
+    return strips
+
+
+def _make_rough_crops_from_strips(strips,options):
+    """
+    Equivalent to make_rough_crops(), for strips returned by _read_image_strips().
+    """
+    
+    h = strips['height']
+    w = strips['top'].width
+    
+    crop_height_top = round(options.image_crop_fraction[0] * h)
+    crop_height_bottom = round(options.image_crop_fraction[1] * h)
+    
+    bottom_strip_height = strips['bottom'].height
+    top_crop = strips['top'].crop([0,0,w,crop_height_top])
+    bottom_crop = strips['bottom'].crop([0,bottom_strip_height-crop_height_bottom,
+                                         w,bottom_strip_height])
+    return {'top':top_crop,'bottom':bottom_crop}
+
+
+def _get_datetimes_for_image_batch(filenames,options):
+    """
+    Batched equivalent of calling try_get_datetime_from_image(fn,options=options) for 
+    each file in [filenames] (without crops): decodes each image once, then for each
+    option set and each Tesseract config string, runs OCR on the crops from all the
+    images that don't have a datetime yet in a single Tesseract call.
+    
+    Returns a list of (filename,result) tuples.
+    """
+    
+    if not is_iterable(options):
+        options = [options]
+        
+    filename_to_result = {}
+    filename_to_strips = {}
+    
+    for fn in filenames:
+        filename_to_result[fn] = {'error':None}
+        try:
+            filename_to_strips[fn] = _read_image_strips(fn,options)
+        except Exception as e:
+            filename_to_result[fn]['error'] = str(e)
+            
+    pending_filenames = [fn for fn in filenames if fn in filename_to_strips]
+    
+    # current_options = options[0]
+    for i_option_set,current_options in enumerate(options):
+        
+        if len(pending_filenames) == 0:
+            break
+        
+        # Crop the top and bottom from each image
+        filename_to_crops = {}
+        for fn in pending_filenames:
+            try:
+                rough_crops = _make_rough_crops_from_strips(filename_to_strips[fn],current_options)
+                filename_to_crops[fn] = \
+                    [_prepare_crop_for_ocr(rough_crops[crop_location],crop_location,current_options)[0] \
+                     for crop_location in ('top','bottom')]
+            except Exception as e:
+                filename_to_result[fn]['error'] = str(e)
+        
+        # Per-image state for this option set
+        filename_to_state = {}
+        for fn in filename_to_crops:
+            filename_to_state[fn] = {'datetime':None,
+                                     'text_results':[],
+                                     'all_extracted_datetimes':{}}
+            
+        # Find text, possibly trying all config strings
+        active_filenames = list(filename_to_crops.keys())
+        
+        for tesseract_config_string in current_options.tesseract_config_strings:
+            
+            if len(active_filenames) == 0:
+                break
+            
+            crops = []
+            for fn in active_filenames:
+                crops.extend(filename_to_crops[fn])
+            texts = ocr_image_batch(crops,tesseract_config_string,current_options)
+            
+            next_active_filenames = []
+            
+            for i_file,fn in enumerate(active_filenames):
+                
+                state = filename_to_state[fn]
+                text_results = texts[2*i_file:2*i_file+2]
+                state['text_results'].append(text_results)
+                
+                extracted_datetime = _get_datetime_from_strings(text_results,current_options)
+                state['all_extracted_datetimes'][tesseract_config_string] = extracted_datetime
+                
+                if extracted_datetime is not None:
+                    if state['datetime'] is None:
+                        state['datetime'] = extracted_datetime
+                    if not current_options.force_all_ocr_options:
+                        continue
+                next_active_filenames.append(fn)
+                
+            active_filenames = next_active_filenames
+        
+        # ...for each set of OCR options
+        
+        for fn,state in filename_to_state.items():
+            
+            extracted_datetime = state['datetime']
+            if (extracted_datetime is not None) and \
+               not (extracted_datetime.year <= 2023 and extracted_datetime.year >= 1990):
+                filename_to_result[fn]['error'] = \
+                    'Extracted datetime {} out of range'.format(str(extracted_datetime))
+                continue
+            
+            result = {}
+            result['datetime'] = extracted_datetime
+            result['text_results'] = state['text_results']
+            result['all_extracted_datetimes'] = state['all_extracted_datetimes']
+            result['ocr_results'] = None
+            result['options_index'] = i_option_set
+            result['error'] = None
+            filename_to_result[fn] = result
+            
+        pending_filenames = [fn for fn in pending_filenames if \
+                             filename_to_result[fn].get('datetime') is None]
+        
+    # ...for each option set
+    
+    return [(fn,filename_to_result[fn]) for fn in filenames]
+
+# ...def _get_datetimes_for_image_batch(...)
+
+
+def _get_datetimes_for_images_individually(filenames,options):
+    """
+    Calls try_get_datetime_from_image for each file in [filenames], returning a list of
+    (filename,result) tuples.
+    """
+    
+    return [(fn,try_get_datetime_from_image(fn,options=options)) for fn in filenames]
+
+
+def _parse_cached_datetime(s):
+    
+    if s is None:
+        return None
+    return datetime.datetime.fromisoformat(s)
+
+
+def _read_ocr_cache(cache_file):
+    """
+    Reads the resumable OCR cache [cache_file], a .jsonl file with one line per image (see
+    path_utils.read_jsonl_manifest()), returning a dict mapping filenames to (key,result) 
+    tuples.  Error results are ignored, so those images get retried.
+    """
+    
+    filename_to_record = read_jsonl_manifest(
+        cache_file,record_filter=lambda d: d['result'].get('error') is None)
+    
+    filename_to_cached_result = {}
+    
+    for fn,d in filename_to_record.items():
+        try:
+            result = d['result']
+            if 'datetime' in result:
+                result['datetime'] = _parse_cached_datetime(result['datetime'])
+            if result.get('all_extracted_datetimes') is not None:
+                for k in result['all_extracted_datetimes']:
+                    result['all_extracted_datetimes'][k] = \
+                        _parse_cached_datetime(result['all_extracted_datetimes'][k])
+            filename_to_cached_result[fn] = (d['key'],result)
+        except Exception:
+            continue
+            
+    return filename_to_cached_result
+
+
 def get_datetimes_for_folder(folder_name,output_file=None,n_to_sample=-1,options=None,
-                             n_workers=16,use_threads=False):
+                             n_workers=16,use_threads=False,ocr_batch_size=None,
+                             cache_file=None):
     """
     The main entry point for this module.  Tries to retrieve metadata from pixels for every 
     image in [folder_name], optionally the results to the .json file [output_file].
@@ -602,6 +878,12 @@ def get_datetimes_for_folder(folder_name,output_file=None,n_to_sample=-1,options
             parallelization
         use_threads (bool, optional): whether to use threads (True) or processes (False) for
             parallelization; not relevant if n_workers <= 1
+        ocr_batch_size (int, optional): if this is not None, each worker processes batches of this
+            many images, decoding each image once and running Tesseract once per batch (per config 
+            string) rather than once per crop.  Crops are not included in the results in this mode.
+        cache_file (str, optional): a .jsonl file to which results are appended as they're
+            computed; images that already have results in this file (and haven't changed since) 
+            are not processed again, so an interrupted job can be resumed.
             
     Returns:
         dict: a dict mapping filenames to datetime extraction results, see try_get_datetime_from_images
@@ -619,18 +901,51 @@ def get_datetimes_for_folder(folder_name,output_file=None,n_to_sample=-1,options
         import random
         random.seed(0)
         image_file_names = random.sample(image_file_names,n_to_sample)
-            
-    if n_workers <= 1:
+    
+    filename_to_results = {}
+    
+    # Use cached results for images that haven't changed
+    filename_to_cached_result = _read_ocr_cache(cache_file)
+    filename_to_cache_key = {}
+    
+    if cache_file is not None:
+        
+        for fn_abs in image_file_names:
+            try:
+                filename_to_cache_key[fn_abs] = file_cache_key(fn_abs)
+            except OSError:
+                filename_to_cache_key[fn_abs] = None
+            if (fn_abs in filename_to_cached_result) and \
+               (filename_to_cached_result[fn_abs][0] == filename_to_cache_key[fn_abs]):
+                filename_to_results[fn_abs] = filename_to_cached_result[fn_abs][1]
+        
+        print('Read cached results for {} of {} images'.format(
+            len(filename_to_results),len(image_file_names)))
         
-        all_results = []
-        for fn_abs in tqdm(image_file_names):
-            all_results.append(try_get_datetime_from_image(fn_abs,options=options))
+    image_file_names_to_process = [fn for fn in image_file_names if fn not in filename_to_results]
+    
+    # Divide images into work units
+    if ocr_batch_size is not None:
+        batch_size = ocr_batch_size
+        worker_function = partial(_get_datetimes_for_image_batch,options=options)
+    else:
+        batch_size = 1
+        worker_function = partial(_get_datetimes_for_images_individually,options=options)
+        
+    batches = [image_file_names_to_process[i:i+batch_size] for i in \
+               range(0,len(image_file_names_to_process),batch_size)]
+    
+    pool = None
+    
+    if n_workers <= 1 or len(batches) <= 1:
+        
+        batch_results = (worker_function(batch) for batch in batches)
             
     else:    
         
-        # Don't spawn more than one worker per image
-        if n_workers > len(image_file_names):
-            n_workers = len(image_file_names)
+        # Don't spawn more than one worker per batch
+        if n_workers > len(batches):
+            n_workers = len(batches)
             
         if use_threads:
             from multiprocessing.pool import ThreadPool
@@ -643,15 +958,39 @@ def get_datetimes_for_folder(folder_name,output_file=None,n_to_sample=-1,options
             
         print('Starting a pool of {} {}'.format(n_workers,worker_string))
         
-        all_results = list(tqdm(pool.imap(
-            partial(try_get_datetime_from_image,options=options),image_file_names),
-            total=len(image_file_names)))
-    
-    filename_to_results = {}
+        batch_results = pool.imap_unordered(worker_function,batches)
     
-    # fn_relative = image_file_names[0]
-    for i_file,fn_abs in enumerate(image_file_names):
-        filename_to_results[fn_abs] = all_results[i_file]
+    cache_f = None
+    if cache_file is not None:
+        cache_f = open(cache_file,'a')
+        
+    try:
+        
+        for batch_result in tqdm(batch_results,total=len(batches)):
+            
+            for fn_abs,result in batch_result:
+                
+                filename_to_results[fn_abs] = result
+                
+                # Don't cache errors, so failed images are retried on the next run
+                if (cache_f is not None) and (result.get('error') is None):
+                    cache_record = {'file':fn_abs,'key':filename_to_cache_key[fn_abs],
+                                    'result':result}
+                    cache_f.write(json.dumps(cache_record,default=str) + '\n')
+                    
+            if cache_f is not None:
+                cache_f.flush()
+                
+    finally:
+        
+        if cache_f is not None:
+            cache_f.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    # Return results in the same order we enumerated images
+    filename_to_results = {fn_abs:filename_to_results[fn_abs] for fn_abs in image_file_names}
     
     if output_file is not None:
         with open(output_file,'w') as f:
@@ -16,7 +16,10 @@ path.  No attempt is made to be consistent in format across the two approaches.
 import os
 import subprocess
 import json
+import struct
+import threading
 from datetime import datetime
+from multiprocessing import util as multiprocessing_util
 
 from multiprocessing.pool import ThreadPool as ThreadPool
 from multiprocessing.pool import Pool as Pool
@@ -84,7 +87,26 @@ class ReadExifOptions:
         self.byte_handling = 'convert_to_string' # 'convert_to_string','delete','raw'
         
         #: Should we use exiftool or PIL?
-        self.processing_library = 'pil' # 'exiftool','pil'
+        #:
+        #: 'header' reads only size, orientation, datetime, and GPS information, directly
+        #: from JPEG/PNG headers (falling back to PIL for other formats); this is much 
+        #: faster than PIL, especially on network file systems.
+        self.processing_library = 'pil' # 'exiftool','pil','header'
+        
+        #: If we're using exiftool, should we keep one long-running exiftool process per
+        #: worker (via "-stay_open"), and send it batches of images (rather than starting
+        #: a new exiftool process for every image)?
+        #:
+        #: This is much faster for large folders, but the output format differs from the 
+        #: default exiftool mode: exiftool reports tag names (e.g. "DateTimeOriginal") rather
+        #: than tag descriptions (e.g. "Date/Time Original"), numeric values are reported as 
+        #: numbers rather than strings, and [tags_to_include]/[tags_to_exclude] should 
+        #: refer to tag names.
+        self.use_persistent_exiftool = False
+        
+        #: Number of images to send to exiftool in each request, only relevant if 
+        #: use_persistent_exiftool is True.
+        self.exiftool_batch_size = 100
         
 
 class ExifResultsToCCTOptions:
@@ -338,6 +360,345 @@ def _filter_tags(tags,options):
         return tags_to_return
 
 
+#%% Header-only metadata reading
+
+# By default, we read this many bytes at a time when scanning image headers; for most
+# camera trap images, everything we need fits in a single read.
+default_header_read_size = 64 * 1024
+
+# JPEG start-of-frame markers (SOF0-SOF15, excluding DHT/JPG/DAC)
+_JPEG_SOF_MARKERS = set([0xC0,0xC1,0xC2,0xC3,0xC5,0xC6,0xC7,0xC9,0xCA,0xCB,0xCD,0xCE,0xCF])
+
+# Maps the number of JPEG components to the mode PIL would use for that image
+_JPEG_COMPONENTS_TO_MODE = {1:'L',3:'RGB',4:'CMYK'}
+
+# Maps PNG color types to the mode PIL would use for that image (for 8-bit images)
+_PNG_COLOR_TYPE_TO_MODE = {0:'L',2:'RGB',3:'P',4:'LA',6:'RGBA'}
+
+# Maps TIFF field types to (struct format, size in bytes)
+_TIFF_FIELD_TYPES = {
+    1:('B',1),  # BYTE
+    2:('s',1),  # ASCII
+    3:('H',2),  # SHORT
+    4:('I',4),  # LONG
+    5:('I',8),  # RATIONAL (two LONGs)
+    6:('b',1),  # SBYTE
+    7:('s',1),  # UNDEFINED
+    8:('h',2),  # SSHORT
+    9:('i',4),  # SLONG
+    10:('i',8), # SRATIONAL (two SLONGs)
+    11:('f',4), # FLOAT
+    12:('d',8)  # DOUBLE
+}
+
+_EXIF_TAG_ORIENTATION = 0x0112
+_EXIF_TAG_DATETIME = 0x0132
+_EXIF_TAG_EXIF_IFD = 0x8769
+_EXIF_TAG_GPS_IFD = 0x8825
+_EXIF_TAG_DATETIME_ORIGINAL = 0x9003
+
+
+def _read_tiff_value(data,offset,field_type,count,byte_order):
+    """
+    Read a single value from an IFD entry in a TIFF block.  Returns a scalar for 
+    single-element numeric values, otherwise a tuple.
+    """
+    
+    fmt,size = _TIFF_FIELD_TYPES[field_type]
+    
+    if field_type == 2:
+        s = data[offset:offset+count].split(b'\x00',1)[0]
+        return s.decode('utf-8',errors='replace').strip()
+    
+    if field_type == 7:
+        return bytes(data[offset:offset+count])
+    
+    if field_type in (5,10):
+        raw = struct.unpack_from('{}{}{}'.format(byte_order,2*count,fmt),data,offset)
+        values = []
+        for i_value in range(0,count):
+            numerator = raw[2*i_value]
+            denominator = raw[2*i_value+1]
+            values.append(None if denominator == 0 else numerator / denominator)
+    else:
+        values = struct.unpack_from('{}{}{}'.format(byte_order,count,fmt),data,offset)
+    
+    if count == 1:
+        return values[0]
+    return tuple(values)
+    
+
+def _read_tiff_ifd(data,offset,byte_order):
+    """
+    Read all the entries we know how to read from the IFD at [offset] in the TIFF 
+    block [data].  Returns a dict mapping integer tags to values.  Entries that point 
+    outside of [data] are ignored.
+    """
+    
+    tags = {}
+    if offset + 2 > len(data):
+        return tags
+    
+    n_entries = struct.unpack_from(byte_order + 'H',data,offset)[0]
+    
+    for i_entry in range(0,n_entries):
+        
+        entry_offset = offset + 2 + 12 * i_entry
+        if entry_offset + 12 > len(data):
+            break
+        tag,field_type,count = struct.unpack_from(byte_order + 'HHI',data,entry_offset)
+        if (field_type not in _TIFF_FIELD_TYPES) or (count == 0):
+            continue
+        
+        # Values that fit in four bytes are stored in the entry itself
+        value_size = _TIFF_FIELD_TYPES[field_type][1] * count
+        if value_size <= 4:
+            value_offset = entry_offset + 8
+        else:
+            value_offset = struct.unpack_from(byte_order + 'I',data,entry_offset + 8)[0]
+        if value_offset + value_size > len(data):
+            continue
+        
+        tags[tag] = _read_tiff_value(data,value_offset,field_type,count,byte_order)
+        
+    # ...for each IFD entry
+    
+    return tags
+
+
+def _parse_exif_block(data,header):
+    """
+    Parse the TIFF-formatted EXIF block [data] (starting at the byte order mark), 
+    populating the 'orientation', 'datetime', 'datetime_original', and 'gps_info' 
+    fields in [header].
+    """
+    
+    if len(data) < 8:
+        return
+    if data[0:2] == b'II':
+        byte_order = '<'
+    elif data[0:2] == b'MM':
+        byte_order = '>'
+    else:
+        return
+    
+    ifd0_offset = struct.unpack_from(byte_order + 'I',data,4)[0]
+    ifd0 = _read_tiff_ifd(data,ifd0_offset,byte_order)
+    
+    if isinstance(ifd0.get(_EXIF_TAG_ORIENTATION),int):
+        header['orientation'] = ifd0[_EXIF_TAG_ORIENTATION]
+    if isinstance(ifd0.get(_EXIF_TAG_DATETIME),str):
+        header['datetime'] = ifd0[_EXIF_TAG_DATETIME]
+    
+    if isinstance(ifd0.get(_EXIF_TAG_EXIF_IFD),int):
+        exif_ifd = _read_tiff_ifd(data,ifd0[_EXIF_TAG_EXIF_IFD],byte_order)
+        if isinstance(exif_ifd.get(_EXIF_TAG_DATETIME_ORIGINAL),str):
+            header['datetime_original'] = exif_ifd[_EXIF_TAG_DATETIME_ORIGINAL]
+    
+    if isinstance(ifd0.get(_EXIF_TAG_GPS_IFD),int):
+        gps_ifd = _read_tiff_ifd(data,ifd0[_EXIF_TAG_GPS_IFD],byte_order)
+        gps_info = {}
+        for tag in gps_ifd:
+            gps_info[ExifTags.GPSTAGS.get(tag,tag)] = gps_ifd[tag]
+        header['gps_info'] = gps_info
+
+
+def _read_jpeg_header(f,header):
+    """
+    Walk the marker segments of the JPEG file [f] (positioned just after the SOI marker),
+    reading the APP1 (EXIF) and SOF segments and skipping everything else, stopping
+    at the first SOF segment.
+    """
+    
+    while True:
+        
+        b = f.read(2)
+        if len(b) < 2 or b[0] != 0xFF:
+            return
+        marker = b[1]
+        
+        # Skip fill bytes
+        while marker == 0xFF:
+            b = f.read(1)
+            if len(b) < 1:
+                return
+            marker = b[0]
+            
+        # Markers without a payload
+        if marker == 0x01 or (0xD0 <= marker <= 0xD8):
+            continue
+        
+        # End of image or start of scan; no more header information
+        if marker in (0xD9,0xDA):
+            return
+        
+        b = f.read(2)
+        if len(b) < 2:
+            return
+        segment_length = struct.unpack('>H',b)[0] - 2
+        if segment_length < 0:
+            return
+        
+        if marker in _JPEG_SOF_MARKERS:
+            
+            b = f.read(6)
+            if len(b) < 6:
+                return
+            _,height,width,n_components = struct.unpack('>BHHB',b)
+            header['width'] = width
+            header['height'] = height
+            header['mode'] = _JPEG_COMPONENTS_TO_MODE.get(n_components)
+            return
+        
+        elif marker == 0xE1 and header['orientation'] is None:
+            
+            data = f.read(segment_length)
+            if data[0:6] == b'Exif\x00\x00':
+                _parse_exif_block(data[6:],header)
+                
+        else:
+            
+            f.seek(segment_length,1)
+        
+    # ...for each segment
+    
+    
+def _read_png_header(f,header):
+    """
+    Walk the chunks of the PNG file [f] (positioned just after the signature), reading 
+    the IHDR and eXIf chunks and skipping everything else, stopping at the first IDAT
+    chunk.
+    """
+    
+    while True:
+        
+        b = f.read(8)
+        if len(b) < 8:
+            return
+        chunk_length,chunk_type = struct.unpack('>I4s',b)
+        
+        if chunk_type in (b'IDAT',b'IEND'):
+            return
+        
+        if chunk_type == b'IHDR':
+            
+            data = f.read(chunk_length)
+            if len(data) < 10:
+                return
+            width,height,bit_depth,color_type = struct.unpack_from('>IIBB',data,0)
+            header['width'] = width
+            header['height'] = height
+            mode = _PNG_COLOR_TYPE_TO_MODE.get(color_type)
+            if color_type == 0 and bit_depth == 16:
+                mode = 'I;16'
+            elif color_type == 0 and bit_depth == 1:
+                mode = '1'
+            header['mode'] = mode
+            
+        elif chunk_type == b'eXIf':
+            
+            data = f.read(chunk_length)
+            _parse_exif_block(data,header)
+            
+        else:
+            
+            f.seek(chunk_length,1)
+            
+        # Skip the CRC
+        f.seek(4,1)
+        
+    # ...for each chunk
+
+
+def read_image_header(file_path,read_size=None):
+    """
+    Read the size, EXIF orientation, EXIF datetime, and GPS information for a JPEG or 
+    PNG image in a single pass over the file header, without decoding pixels or going 
+    through PIL.  Reads are bounded to the header segments we care about (SOF/APP1 for
+    JPEG, IHDR/eXIf for PNG); typically this requires a single small read per file.
+    
+    Width and height are the stored dimensions, i.e. they do not reflect EXIF rotation
+    (this is consistent with the size PIL reports before rotation).
+    
+    Args:
+        file_path (str): the image file to read
+        read_size (int, optional): buffer size to use when reading the file, defaults to 
+            default_header_read_size
+            
+    Returns:
+        dict: a dict with fields 'format' ('jpeg' or 'png'), 'width', 'height', 'mode' 
+        (the PIL mode this image would load as), 'orientation' (int), 'datetime' (str), 
+        'datetime_original' (str), and 'gps_info' (a dict mapping GPS tag names to values).
+        Fields are None if they're not present in the file.  Returns None if [file_path]
+        is not a JPEG or PNG file, or if we couldn't parse the header.
+    """
+    
+    if read_size is None:
+        read_size = default_header_read_size
+        
+    header = {'format':None,'width':None,'height':None,'mode':None,
+              'orientation':None,'datetime':None,'datetime_original':None,'gps_info':None}
+    
+    with open(file_path,'rb',buffering=read_size) as f:
+        
+        signature = f.read(8)
+        try:
+            if signature[0:2] == b'\xff\xd8':
+                header['format'] = 'jpeg'
+                f.seek(2)
+                _read_jpeg_header(f,header)
+            elif signature == b'\x89PNG\r\n\x1a\n':
+                header['format'] = 'png'
+                _read_png_header(f,header)
+            else:
+                return None
+        except (struct.error,ValueError):
+            return None
+    
+    if header['width'] is None or header['height'] is None:
+        return None
+    
+    return header
+
+# ...def read_image_header(...)
+
+
+def read_header_exif(file_path,read_size=None):
+    """
+    Read the subset of EXIF information that's available via read_image_header(), in the 
+    same format used by read_pil_exif().  This is primarily an internal function; the main
+    entry point for single-image EXIF information is read_exif_tags_for_image().
+    
+    Args:
+        file_path (str): the image file to read
+        read_size (int, optional): buffer size to use when reading the file
+        
+    Returns:
+        dict: a dictionary mapping EXIF tag names to their values, or None if we couldn't 
+        read the image header
+    """
+    
+    header = read_image_header(file_path,read_size=read_size)
+    if header is None:
+        return None
+    
+    exif_tags = {}
+    exif_tags['ImageWidth'] = header['width']
+    exif_tags['ImageHeight'] = header['height']
+    if header['orientation'] is not None:
+        exif_tags['Orientation'] = header['orientation']
+    if header['datetime'] is not None:
+        exif_tags['DateTime'] = header['datetime']
+    if header['datetime_original'] is not None:
+        exif_tags['DateTimeOriginal'] = header['datetime_original']
+    if header['gps_info'] is not None:
+        exif_tags['GPSInfo'] = header['gps_info']
+        
+    return exif_tags
+
+
+#%% Single-image EXIF reading
+
 def read_exif_tags_for_image(file_path,options=None):
     """
     Get relevant fields from EXIF data for an image
@@ -349,6 +710,8 @@ def read_exif_tags_for_image(file_path,options=None):
             
             - For exiftool, 'tags' is a list of lists, where each element is (type/tag/value)
             - For PIL, 'tags' is a dict (str:str)
+            - For header, 'tags' is a dict in the same format used for PIL, but only 
+              containing size, orientation, datetime, and GPS information
     """
     
     if options is None:
@@ -356,10 +719,15 @@ def read_exif_tags_for_image(file_path,options=None):
     
     result = {'status':'unknown','tags':[]}
     
-    if options.processing_library == 'pil':
+    if options.processing_library in ('pil','header'):
         
         try:
-            exif_tags = read_pil_exif(file_path,options)
+            exif_tags = None
+            if options.processing_library == 'header':
+                exif_tags = read_header_exif(file_path)
+            # Fall back to PIL for formats we can't read headers for
+            if exif_tags is None:
+                exif_tags = read_pil_exif(file_path,options)
 
         except Exception as e:
             if options.verbose:
@@ -454,6 +822,238 @@ def read_exif_tags_for_image(file_path,options=None):
 # ...read_exif_tags_for_image()
 
 
+#%% Persistent exiftool processes
+
+# Each worker (thread or process) keeps its own long-running exiftool process, created
+# the first time that worker reads a batch of images.
+_exiftool_thread_state = threading.local()
+_exiftool_processes = []
+_exiftool_processes_lock = threading.Lock()
+_exiftool_finalizer_registered = False
+
+
+class _PersistentExiftool:
+    """
+    Wrapper for a long-running "exiftool -stay_open True -@ -" process, which reads 
+    arguments from stdin and processes a command every time it sees "-execute", so 
+    we only pay exiftool's startup cost once per worker.
+    """
+    
+    def __init__(self, exiftool_command_name):
+        
+        self.exiftool_command_name = exiftool_command_name
+        self.process = subprocess.Popen(
+            [exiftool_command_name, '-stay_open', 'True', '-@', '-'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            encoding='utf8', errors='replace')
+        
+    def execute(self, args):
+        """
+        Run a single exiftool command (a list of arguments, not including the 
+        executable name), and return the command's output as a string.
+        """
+        
+        for arg in args:
+            assert '\n' not in arg, 'Illegal exiftool argument {}'.format(arg)
+            self.process.stdin.write(arg + '\n')
+        self.process.stdin.write('-execute\n')
+        self.process.stdin.flush()
+        
+        # exiftool writes "{ready}" when it finishes each command
+        output_lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if len(line) == 0:
+                raise RuntimeError('exiftool process exited unexpectedly')
+            if line.rstrip() == '{ready}':
+                break
+            output_lines.append(line)
+            
+        return ''.join(output_lines)
+    
+    def close(self):
+        
+        if self.process.poll() is not None:
+            return
+        try:
+            self.process.stdin.write('-stay_open\nFalse\n')
+            self.process.stdin.flush()
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except Exception:
+            self.process.kill()
+
+# ...class _PersistentExiftool
+
+
+def _get_persistent_exiftool(options):
+    """
+    Return the exiftool process associated with the current thread, starting one if 
+    necessary.
+    """
+    
+    et = getattr(_exiftool_thread_state, 'exiftool', None)
+    if et is not None and \
+        (et.exiftool_command_name != options.exiftool_command_name or \
+         et.process.poll() is not None):
+        _close_persistent_exiftool(et)
+        et = None
+        
+    if et is None:
+        
+        et = _PersistentExiftool(options.exiftool_command_name)
+        _exiftool_thread_state.exiftool = et
+        with _exiftool_processes_lock:
+            # Make sure we shut down our exiftool processes when this process (typically 
+            # a pool worker) exits.
+            global _exiftool_finalizer_registered
+            if not _exiftool_finalizer_registered:
+                multiprocessing_util.Finalize(None, _close_persistent_exiftool_processes,
+                                              exitpriority=10)
+                _exiftool_finalizer_registered = True
+            _exiftool_processes.append(et)
+            
+    return et
+
+
+def _close_persistent_exiftool(et):
+    """
+    Shut down a single exiftool process and stop tracking it.
+    """
+    
+    with _exiftool_processes_lock:
+        if et in _exiftool_processes:
+            _exiftool_processes.remove(et)
+    if getattr(_exiftool_thread_state, 'exiftool', None) is et:
+        _exiftool_thread_state.exiftool = None
+    et.close()
+    
+
+def _close_persistent_exiftool_processes():
+    """
+    Shut down all the exiftool processes started by this process.
+    """
+    
+    with _exiftool_processes_lock:
+        processes = list(_exiftool_processes)
+        _exiftool_processes.clear()
+    for et in processes:
+        et.close()
+    _exiftool_thread_state.exiftool = None
+
+
+def _exiftool_record_to_tags(record,options):
+    """
+    Convert a single image's record from exiftool's -json -G output, e.g.:
+        
+    {"SourceFile": "a.jpg", "EXIF:Make": "Reconyx", ...}
+    
+    ...to a list of three-element lists (type/tag/value), applying the same filtering we 
+    apply to exiftool's text output.
+    """
+    
+    exif_tags = []
+    
+    for k in record.keys():
+        
+        if k == 'SourceFile':
+            continue
+        
+        field_name_type_tokens = k.split(':',1)
+        assert len(field_name_type_tokens) == 2, 'EXIF tokenization failure for {}'.format(k)
+        field_type = field_name_type_tokens[0]
+        field_name = field_name_type_tokens[1]
+        
+        if field_type in options.tag_types_to_ignore:
+            if options.verbose:
+                print('Ignoring tag with type {}'.format(field_type))
+            continue        
+        if options.tags_to_exclude is not None and field_name in options.tags_to_exclude:
+            continue
+        if options.tags_to_include is not None and field_name not in options.tags_to_include:
+            continue
+        exif_tags.append([field_type,field_name,record[k]])
+        
+    return exif_tags
+
+
+def read_exif_tags_for_images_with_exiftool(file_paths,options=None):
+    """
+    Read EXIF data for a batch of images using a persistent exiftool process (one per
+    thread), which is much faster than starting exiftool once per image.
+    
+    Args:
+        file_paths (list): list of image filenames to process
+        options (ReadExifOptions, optional): parameters controlling metadata extraction
+        
+    Returns:
+        list: a list of dicts in the same order as [file_paths], in the same format 
+        returned by read_exif_tags_for_image() for the exiftool library.  
+    """
+    
+    if options is None:
+        options = ReadExifOptions()
+    
+    results = [{'status':'unknown','tags':[]} for _ in file_paths]
+    if len(file_paths) == 0:
+        return results
+    
+    et = _get_persistent_exiftool(options)
+    
+    args = ['-G','-json','-charset','filename=utf8']
+    args.extend(file_paths)
+    
+    try:
+        output = et.execute(args)
+    except Exception as e:
+        # Don't re-use a process that's in an unknown state
+        _close_persistent_exiftool(et)
+        for result in results:
+            result['status'] = 'read_failure'
+            result['error'] = str(e)
+        return results
+    
+    output = output.strip()
+    if len(output) == 0:
+        records = []
+    else:
+        records = json.loads(output)
+    
+    # exiftool doesn't return records for files it can't read, so we match records 
+    # to inputs by filename.
+    def _normalize_path(fn):
+        return os.path.normcase(os.path.normpath(fn)).replace('\\','/')
+    
+    normalized_path_to_record = {}
+    for record in records:
+        normalized_path_to_record[_normalize_path(record['SourceFile'])] = record
+    
+    for i_file,file_path in enumerate(file_paths):
+        
+        result = results[i_file]
+        normalized_path = _normalize_path(file_path)
+        if normalized_path not in normalized_path_to_record:
+            result['status'] = 'read_failure'
+            result['error'] = 'No exiftool output for {}'.format(file_path)
+            continue
+        
+        record = normalized_path_to_record[normalized_path]
+        if not any([k.lower().startswith('exif:') for k in record.keys()]):
+            result['status'] = 'failure'
+            continue
+        
+        result['status'] = 'success'
+        result['tags'] = _exiftool_record_to_tags(record,options)
+        
+    # ...for each file
+    
+    return results
+
+# ...read_exif_tags_for_images_with_exiftool(...)
+
+
+#%% Folder-level EXIF reading
+
 def _populate_exif_data(im, image_base, options=None):
     """
     Populate EXIF data into the 'exif_tags' field in the image object [im].
@@ -499,6 +1099,66 @@ def _populate_exif_data(im, image_base, options=None):
 # ..._populate_exif_data()
 
 
+def _populate_exif_data_for_batch(ims, image_base, options=None):
+    """
+    Populate EXIF data into the 'exif_tags' field for each image object in [ims], using
+    a persistent exiftool process.  Equivalent to calling _populate_exif_data() on each
+    image.
+    
+    Returns a modified version of [ims], also modifies [ims] in place.
+    """
+    
+    if options is None:
+        options = ReadExifOptions()
+        
+    file_paths = []
+    ims_to_read = []
+    
+    for im in ims:
+        fn = im['file_name']
+        if options.verbose:
+            print('Processing {}'.format(fn))
+        file_path = os.path.join(image_base,fn)
+        if not os.path.isfile(file_path):
+            s = 'Error on {}: Could not find file {}'.format(fn,file_path)
+            print(s)
+            im['error'] = s
+            im['status'] = 'read failure'
+            im['exif_tags'] = None
+            continue
+        file_paths.append(file_path)
+        ims_to_read.append(im)
+    
+    try:
+        
+        results = read_exif_tags_for_images_with_exiftool(file_paths,options)
+        
+    except Exception as e:
+        
+        for im in ims_to_read:
+            s = 'Error on {}: {}'.format(im['file_name'],str(e))
+            print(s)
+            im['error'] = s
+            im['status'] = 'read failure'
+            im['exif_tags'] = None
+        return ims
+            
+    for im,file_path,result in zip(ims_to_read,file_paths,results):
+        if result['status'] == 'success':
+            im['exif_tags'] = result['tags']
+        else:
+            im['exif_tags'] = None
+            im['status'] = result['status']
+            if 'error' in result:
+                im['error'] = result['error']
+            if options.verbose:
+                print('Error reading EXIF data for {}'.format(file_path))
+    
+    return ims
+
+# ..._populate_exif_data_for_batch()
+
+
 def _create_image_objects(image_files,recursive=True):
     """
     Create empty image objects for every image in [image_files], which can be a 
@@ -544,11 +1204,27 @@ def _populate_exif_for_images(image_base,images,options=None):
     if options is None:
         options = ReadExifOptions()
 
+    use_batches = (options.processing_library == 'exiftool') and options.use_persistent_exiftool
+    
+    # When we're using a persistent exiftool process, each worker handles a batch of images
+    if use_batches:
+        assert options.exiftool_batch_size > 0
+        work_items = [images[i:i+options.exiftool_batch_size] for i in \
+                      range(0,len(images),options.exiftool_batch_size)]
+        worker_function = _populate_exif_data_for_batch
+    else:
+        work_items = images
+        worker_function = _populate_exif_data
+        
     if options.n_workers == 1:
       
-        results = []
-        for im in tqdm(images):
-            results.append(_populate_exif_data(im,image_base,options))
+        try:
+            results = []
+            for item in tqdm(work_items):
+                results.append(worker_function(item,image_base,options))
+        finally:
+            if use_batches:
+                _close_persistent_exiftool_processes()
         
     else:
         
@@ -560,9 +1236,20 @@ def _populate_exif_for_images(image_base,images,options=None):
             print('Starting parallel process pool with {} workers'.format(options.n_workers))
             pool = Pool(options.n_workers)
     
-        results = list(tqdm(pool.imap(partial(_populate_exif_data,image_base=image_base,
-                                        options=options),images),total=len(images)))
-
+        try:
+            results = list(tqdm(pool.imap(partial(worker_function,image_base=image_base,
+                                            options=options),work_items),total=len(work_items)))
+        finally:
+            # Closing (rather than terminating) the pool lets worker processes shut down 
+            # their exiftool processes
+            pool.close()
+            pool.join()
+            if use_batches and options.use_threads:
+                _close_persistent_exiftool_processes()
+
+    if use_batches:
+        results = [im for batch in results for im in batch]
+        
     return results
 
 
@@ -698,7 +1385,7 @@ def read_exif_from_folder(input_folder,output_file=None,options=None,filenames=N
             print('Could not write to file {}'.format(output_file))
             raise
         
-    if options.processing_library == 'exif':
+    if options.processing_library == 'exiftool':
         assert is_executable(options.exiftool_command_name), 'exiftool not available'
 
     if filenames is None:
@@ -822,6 +1509,146 @@ def exif_results_to_cct(exif_results,cct_output_file=None,options=None):
 # ...exif_results_to_cct(...)
 
     
+#%% Test driver
+
+# A minimal stand-in for exiftool, used by __module_test__(), supporting single-image
+# text output ("exiftool -G [file]") and "-stay_open True -@ -" mode with -json output.  
+# Reports EXIF tags for every file whose name doesn't contain "noexif", and no output 
+# for files whose names contain "unreadable".
+_fake_exiftool_source = r'''
+import os
+import sys
+import json
+
+def _tags(fn):
+    if 'unreadable' in os.path.basename(fn):
+        return None
+    tags = [('File','FileSize','FileSize','12 kB')]
+    if 'noexif' not in os.path.basename(fn):
+        tags.append(('EXIF','Make','Make','FakeCam'))
+        tags.append(('EXIF','DateTimeOriginal','Date/Time Original','2020:01:02 03:04:05'))
+        tags.append(('EXIF','ISO','ISO',400))
+    return tags
+
+def _run(args):
+    files = [a for a in args if not a.startswith('-') and a != 'filename=utf8']
+    if '-json' in args:
+        records = []
+        for fn in files:
+            tags = _tags(fn)
+            if tags is None:
+                continue
+            record = {'SourceFile':fn}
+            for group,name,_,value in tags:
+                record[group + ':' + name] = value
+            records.append(record)
+        if len(records) > 0:
+            sys.stdout.write(json.dumps(records,indent=1) + '\n')
+    else:
+        for fn in files:
+            for group,_,description,value in (_tags(fn) or []):
+                sys.stdout.write('[{}]    {:<32}: {}\n'.format(group,description,value))
+
+argv = sys.argv[1:]
+if argv[0:2] == ['-stay_open','True']:
+    args = []
+    for line in sys.stdin:
+        line = line.rstrip('\n')
+        if line == '-execute':
+            _run(args)
+            sys.stdout.write('{ready}\n')
+            sys.stdout.flush()
+            args = []
+        elif args[-1:] == ['-stay_open'] and line == 'False':
+            break
+        else:
+            args.append(line)
+else:
+    _run(argv)
+'''
+
+
+def __module_test__():
+    """
+    Module test driver: tests both exiftool modes against a fake exiftool script.
+    """
+    
+    import sys
+    import shutil
+    import tempfile
+    
+    if os.name == 'nt':
+        print('Skipping exiftool tests on Windows')
+        return
+    
+    test_dir = tempfile.mkdtemp(prefix='read_exif_test_')
+    
+    try:
+        
+        exiftool_fn = os.path.join(test_dir,'exiftool')
+        with open(exiftool_fn,'w') as f:
+            f.write('#!{}\n'.format(sys.executable) + _fake_exiftool_source)
+        os.chmod(exiftool_fn,0o755)
+        
+        image_dir = os.path.join(test_dir,'images')
+        os.makedirs(os.path.join(image_dir,'sub'))
+        image_files = ['a.jpg','b.jpg','sub/c.jpg','sub/d noexif.jpg','e_unreadable.jpg']
+        for fn in image_files:
+            Image.new('RGB',(8,8)).save(os.path.join(image_dir,fn))
+        
+        options = ReadExifOptions()
+        options.processing_library = 'exiftool'
+        options.exiftool_command_name = exiftool_fn
+        
+        
+        ##%% Default (one process per image) mode
+        
+        results = read_exif_from_folder(image_dir,options=options)
+        fn_to_result = {r['file_name']:r for r in results}
+        assert len(fn_to_result) == len(image_files)
+        assert fn_to_result['a.jpg']['exif_tags'] == \
+            [['EXIF','Make','FakeCam'],
+             ['EXIF','Date/Time Original','2020:01:02 03:04:05'],
+             ['EXIF','ISO','400']]
+        assert fn_to_result['sub/d noexif.jpg']['exif_tags'] is None
+        assert fn_to_result['e_unreadable.jpg']['exif_tags'] is None
+        
+        
+        ##%% Persistent mode
+        
+        options.use_persistent_exiftool = True
+        options.exiftool_batch_size = 2
+        
+        for n_workers,use_threads in ((1,True),(2,True),(2,False)):
+            
+            options.n_workers = n_workers
+            options.use_threads = use_threads
+            results = read_exif_from_folder(image_dir,options=options)
+            fn_to_result = {r['file_name']:r for r in results}
+            assert len(fn_to_result) == len(image_files)
+            for fn in ('a.jpg','b.jpg','sub/c.jpg'):
+                assert fn_to_result[fn]['exif_tags'] == \
+                    [['EXIF','Make','FakeCam'],
+                     ['EXIF','DateTimeOriginal','2020:01:02 03:04:05'],
+                     ['EXIF','ISO',400]], fn_to_result[fn]
+            assert fn_to_result['sub/d noexif.jpg']['status'] == 'failure'
+            assert fn_to_result['e_unreadable.jpg']['status'] == 'read_failure'
+            assert len(_exiftool_processes) == 0
+        
+        options.n_workers = 1
+        options.tags_to_include = ['DateTimeOriginal']
+        results = read_exif_from_folder(image_dir,options=options)
+        fn_to_result = {r['file_name']:r for r in results}
+        assert fn_to_result['b.jpg']['exif_tags'] == \
+            [['EXIF','DateTimeOriginal','2020:01:02 03:04:05']]
+    
+    finally:
+        
+        shutil.rmtree(test_dir)
+        
+# ...def __module_test__(...)
+
+
 #%% Interactive driver
 
 if False:
@@ -868,7 +1695,14 @@ def main():
     parser.add_argument('--use_threads', action='store_true',
                         help='Use threads (instead of processes) for multitasking')
     parser.add_argument('--processing_library', type=str, default=options.processing_library,
-                        help='Processing library (exif or pil)')
+                        help='Processing library (exiftool, pil, or header)')
+    parser.add_argument('--persistent_exiftool', action='store_true',
+                        help='Keep one exiftool process per worker, rather than starting a new ' + \
+                             'exiftool process for every image (only relevant for exiftool); ' + \
+                             'reports tag names rather than tag descriptions')
+    parser.add_argument('--exiftool_batch_size', type=int, default=options.exiftool_batch_size,
+                        help='Number of images to send to exiftool at once (defaults to {})'.format(
+                            options.exiftool_batch_size))
     
     if len(sys.argv[1:]) == 0:
         parser.print_help()
@@ -877,6 +1711,7 @@ def main():
     args = parser.parse_args()    
     args_to_object(args, options)
     options.processing_library = options.processing_library.lower()
+    options.use_persistent_exiftool = args.persistent_exiftool
     
     read_exif_from_folder(args.input_folder,args.output_file,options)
     
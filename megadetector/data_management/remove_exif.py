@@ -3,9 +3,12 @@
 remove_exif.py
 
 Removes all EXIF/IPTC/XMP metadata from a folder of images, without making 
-backup copies, using pyexiv2.  Ignores non-jpeg images.
+backup copies.  Ignores non-jpeg images.
 
-This module is rarely used, and pyexiv2 is not thread-safe, so pyexiv2 is not
+By default, metadata is removed by rewriting only the JPEG metadata segments (APP1,
+which holds EXIF and XMP data, and APP13, which holds IPTC data); pixel data is copied
+byte-for-byte, so this is lossless and doesn't require any dependencies.  pyexiv2 can
+also be used; this module is rarely used, and pyexiv2 is not thread-safe, so pyexiv2 is not
 included in package-level dependency lists.  YMMV.
 
 """
@@ -13,11 +16,30 @@ included in package-level dependency lists.  YMMV.
 #%% Imports and constants
 
 import os
-import glob
+import json
+import shutil
+import sys
+import argparse
 
 from multiprocessing.pool import Pool as Pool
+from multiprocessing.pool import ThreadPool
+from functools import partial
 from tqdm import tqdm
 
+from megadetector.utils.path_utils import recursive_file_list
+from megadetector.utils.path_utils import file_cache_key, file_matches_cache_key, \
+    read_jsonl_manifest
+
+# JPEG markers for the segments we remove: APP1 (EXIF, XMP) and APP13 (IPTC/Photoshop)
+jpeg_metadata_markers = (0xE1,0xED)
+
+# JPEG markers that aren't followed by a segment length
+_jpeg_markers_without_length = set([0x01] + list(range(0xD0,0xD8)))
+
+_jpeg_soi_marker = 0xD8
+_jpeg_eoi_marker = 0xD9
+_jpeg_sos_marker = 0xDA
+
 
 #%% Support functions
 
@@ -25,7 +47,7 @@ from tqdm import tqdm
 #
 # Parallelizing across processes is fine.
 def remove_exif_from_image(fn):
-
+    
     import pyexiv2
     
     try:
@@ -40,52 +62,276 @@ def remove_exif_from_image(fn):
     return True
 
 
+def strip_jpeg_metadata(input_fn,output_fn=None):
+    """
+    Removes EXIF, XMP, and IPTC metadata from a JPEG file by dropping its APP1 and APP13
+    segments, without decoding or re-encoding pixel data.  All other segments (including
+    the JFIF header, ICC profiles, and Adobe color transform information) are preserved.
+    
+    Writes to a temporary file and then renames it, so [input_fn] is never left
+    half-written, even if [output_fn] is the same as [input_fn].
+    
+    Args:
+        input_fn (str): the JPEG file to process
+        output_fn (str, optional): the file to write; if this is None, modifies [input_fn]
+            in place
+    
+    Returns:
+        int: the number of bytes removed; if this is zero and [output_fn] is None,
+        [input_fn] was not modified
+    """
+    
+    if output_fn is None:
+        output_fn = input_fn
+    
+    with open(input_fn,'rb') as f:
+        data = f.read()
+    
+    if len(data) < 4 or data[0] != 0xFF or data[1] != _jpeg_soi_marker:
+        raise ValueError('{} is not a JPEG file'.format(input_fn))
+    
+    # Chunks of [data] we're keeping
+    chunks = [data[0:2]]
+    n_bytes_removed = 0
+    
+    offset = 2
+    
+    while offset < len(data):
+        
+        if data[offset] != 0xFF:
+            raise ValueError('Invalid JPEG segment at offset {} in {}'.format(offset,input_fn))
+        
+        # Markers can be preceded by any number of fill bytes
+        marker_start = offset
+        while offset < len(data) and data[offset] == 0xFF:
+            offset += 1
+        if offset >= len(data):
+            raise ValueError('Truncated JPEG file {}'.format(input_fn))
+        marker = data[offset]
+        offset += 1
+        
+        # Everything from the start of the scan data to the end of the file is
+        # copied verbatim
+        if marker in (_jpeg_sos_marker,_jpeg_eoi_marker):
+            chunks.append(data[marker_start:])
+            break
+        
+        if marker in _jpeg_markers_without_length:
+            chunks.append(data[marker_start:offset])
+            continue
+        
+        if offset + 2 > len(data):
+            raise ValueError('Truncated JPEG file {}'.format(input_fn))
+        segment_length = (data[offset] << 8) + data[offset+1]
+        segment_end = offset + segment_length
+        if segment_length < 2 or segment_end > len(data):
+            raise ValueError('Invalid JPEG segment length at offset {} in {}'.format(
+                offset,input_fn))
+        
+        if marker in jpeg_metadata_markers:
+            n_bytes_removed += segment_end - marker_start
+        else:
+            chunks.append(data[marker_start:segment_end])
+        
+        offset = segment_end
+    
+    # ...for each segment
+    
+    if n_bytes_removed == 0 and output_fn == input_fn:
+        return 0
+    
+    output_dir = os.path.dirname(os.path.abspath(output_fn))
+    os.makedirs(output_dir,exist_ok=True)
+    temp_fn = output_fn + '.tmp'
+    with open(temp_fn,'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    shutil.copymode(input_fn,temp_fn)
+    os.replace(temp_fn,output_fn)
+    
+    return n_bytes_removed
+
+# ...def strip_jpeg_metadata(...)
+
+
+def _remove_exif_from_image_with_status(fn,method):
+    """
+    Removes metadata from [fn] using [method] ('segments' or 'pyexiv2'), returning a
+    manifest record.
+    """
+    
+    record = {'file':fn,'error':None,'bytes_removed':None,'key':None}
+    
+    try:
+        if method == 'segments':
+            record['bytes_removed'] = strip_jpeg_metadata(fn)
+        else:
+            assert method == 'pyexiv2'
+            remove_exif_from_image(fn)
+        record['key'] = file_cache_key(fn)
+    except Exception as e:
+        print('EXIF error on {}: {}'.format(fn,str(e)))
+        record['error'] = str(e)
+    
+    return record
+
+
 #%% Remove EXIF data
 
-def remove_exif(image_base_folder,recursive=True,n_processes=1):
+def remove_exif(image_base_folder,recursive=True,n_processes=1,method='segments',
+                manifest_file=None):
     """
-    Removes all EXIF/IPTC/XMP metadata from a folder of images, without making 
-    backup copies, using pyexiv2.  Ignores non-jpeg images.
+    Removes all EXIF/IPTC/XMP metadata from a folder of images, without making
+    backup copies.  Ignores non-jpeg images.
     
     Args:
         image_base_folder (str): the folder from which we should remove EXIF data
         recursive (bool, optional): whether to process [image_base_folder] recursively
         n_processes (int, optional): number of concurrent workers.  Because pyexiv2 is not
-            thread-safe, only process-based parallelism is supported.        
+            thread-safe, only process-based parallelism is supported when [method] is 'pyexiv2';
+            when [method] is 'segments', this is the number of threads.
+        method (str, optional): 'segments' (remove metadata segments directly from the JPEG files,
+            without re-encoding) or 'pyexiv2' (use pyexiv2)
+        manifest_file (str, optional): a .jsonl file to which we append a record for each image
+            as it's processed; images recorded in this file that haven't changed since they were
+            processed are skipped, so an interrupted job can be resumed
+    
+    Returns:
+        list: list of manifest records (dicts with fields 'file', 'error', 'bytes_removed', and
+        'key') for the images processed in this call
     """
-    try:
-        import pyexiv2 #noqa
-    except:
-        print('pyexiv2 not available; try "pip install pyexiv2"')
-        raise
-
-        
+    
+    assert method in ('segments','pyexiv2'), 'Unrecognized method {}'.format(method)
+    
+    if method == 'pyexiv2':
+        try:
+            import pyexiv2 #noqa
+        except:
+            print('pyexiv2 not available; try "pip install pyexiv2"')
+            raise
+    
+    
     ##%% List files
-
+    
     assert os.path.isdir(image_base_folder), \
         'Could not find folder {}'.format(image_base_folder)
-    all_files = [f for f in glob.glob(image_base_folder+ "*/**", recursive=recursive)]
+    all_files = recursive_file_list(image_base_folder,recursive=recursive,convert_slashes=False)
     image_files = [s for s in all_files if \
                    (s.lower().endswith('.jpg') or s.lower().endswith('.jpeg'))]
+    
+    
+    ##%% Skip images we've already processed
+    
+    filename_to_record = read_jsonl_manifest(manifest_file,
+                                             record_filter=lambda r: r['error'] is None)
+    
+    if len(filename_to_record) > 0:
         
-
+        image_files_to_process = []
+        for fn in image_files:
+            record = filename_to_record.get(fn)
+            if (record is not None) and file_matches_cache_key(fn,record['key']):
+                continue
+            image_files_to_process.append(fn)
+        
+        print('Skipping {} of {} images that were already processed'.format(
+            len(image_files) - len(image_files_to_process),len(image_files)))
+        image_files = image_files_to_process
+    
+    
     ##%% Remove EXIF data (execution)
-
-    if n_processes == 1:
+    
+    worker_function = partial(_remove_exif_from_image_with_status,method=method)
+    
+    pool = None
+    
+    if n_processes <= 1:
         
         # fn = image_files[0]
-        for fn in tqdm(image_files):
-            remove_exif_from_image(fn)
-            
+        results = (worker_function(fn) for fn in image_files)
+    
     else:
-        # pyexiv2 is not thread-safe, so we need to use processes
-        print('Starting parallel process pool with {} workers'.format(n_processes))
-        pool = Pool(n_processes)
-        _ = list(tqdm(pool.imap(remove_exif_from_image,image_files),total=len(image_files)))
-            
+        
+        if method == 'pyexiv2':
+            # pyexiv2 is not thread-safe, so we need to use processes
+            print('Starting parallel process pool with {} workers'.format(n_processes))
+            pool = Pool(n_processes)
+        else:
+            print('Starting parallel thread pool with {} workers'.format(n_processes))
+            pool = ThreadPool(n_processes)
+        results = pool.imap_unordered(worker_function,image_files,chunksize=16)
+    
+    records = []
+    manifest_f = None
+    if manifest_file is not None:
+        manifest_f = open(manifest_file,'a')
+    
+    try:
+        
+        for record in tqdm(results,total=len(image_files)):
+            records.append(record)
+            if manifest_f is not None:
+                manifest_f.write(json.dumps(record) + '\n')
+                if len(records) % 1000 == 0:
+                    manifest_f.flush()
+    
+    finally:
+        
+        if manifest_f is not None:
+            manifest_f.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    n_errors = sum([record['error'] is not None for record in records])
+    print('Processed {} images ({} errors)'.format(len(records),n_errors))
+    
+    return records
+
 # ...remove_exif(...)
 
 
 #%% Command-line driver
 
-## TODO
+def main():
+    
+    parser = argparse.ArgumentParser(
+        description='Removes EXIF/IPTC/XMP metadata from all the JPEG files in a folder, in place')
+    
+    parser.add_argument(
+        'image_base_folder',
+        type=str,
+        help='The folder to process, recursively')
+    
+    parser.add_argument(
+        '--n_workers',
+        type=int,
+        default=1,
+        help='Number of concurrent workers (default 1)')
+    
+    parser.add_argument(
+        '--method',
+        type=str,
+        default='segments',
+        help='Method to use for removing metadata ("segments" or "pyexiv2", default "segments")')
+    
+    parser.add_argument(
+        '--manifest_file',
+        type=str,
+        default=None,
+        help='.jsonl file used to record progress, so interrupted jobs can be resumed')
+    
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        parser.exit()
+    
+    args = parser.parse_args()
+    
+    remove_exif(args.image_base_folder,
+                recursive=True,
+                n_processes=args.n_workers,
+                method=args.method,
+                manifest_file=args.manifest_file)
+
+if __name__ == '__main__':
+    main()
@@ -1,187 +1,329 @@
-"""
-
-rename_images.py
-
-Copies images from a possibly-nested folder structure to a flat folder structure, including EXIF
-timestamps in each filename.  Loosely equivalent to camtrapR's imageRename() function.
-
-"""
-
-#%% Imports and constants
-
-import os
-
-from megadetector.utils.path_utils import \
-    find_images, insert_before_extension, parallel_copy_files
-from megadetector.data_management.read_exif import \
-    ReadExifOptions, read_exif_from_folder
-
-
-#%% Functions
-
-def rename_images(input_folder,
-                  output_folder,
-                  dry_run=False,
-                  verbose=False,
-                  read_exif_options=None,
-                  n_copy_workers=8):
-    """
-    For the given image struct in COCO format and associated list of annotations, reformats the 
-    detections into labelme format.  
-    
-    Args:
-        input_folder: the folder to search for images, always recursive
-        output_folder: the folder to which we will copy images; cannot be the
-            same as [input_folder]
-        dry_run: only map images, don't actually copy
-        verbose (bool, optional): enable additional debug output
-        read_exif_options (ReadExifOptions, optional): parameters controlling the reading of
-            EXIF information
-        n_copy_workers (int, optional): number of parallel threads to use for copying
-                    
-    Returns:
-        dict: a dict mapping relative filenames in the input folder to relative filenames in the output 
-        folder
-    """
-    
-    assert os.path.isdir(input_folder), 'Input folder {} does not exist'.format(
-        input_folder)
-    
-    if not dry_run:
-        os.makedirs(output_folder,exist_ok=True)
-    
-    # Read exif information
-    if read_exif_options is None:
-        read_exif_options = ReadExifOptions()
-   
-    read_exif_options.tags_to_include = ['DateTime','Model','Make','ExifImageWidth','ExifImageHeight','DateTime',
-                                         'DateTimeOriginal']    
-    read_exif_options.verbose = False
-    
-    exif_info = read_exif_from_folder(input_folder=input_folder,
-                                      output_file=None,
-                                      options=read_exif_options,
-                                      filenames=None,recursive=True)
-    
-    print('Read EXIF information for {} images'.format(len(exif_info)))
-    
-    filename_to_exif_info = {info['file_name']:info for info in exif_info}
-    
-    image_files = find_images(input_folder,return_relative_paths=True,convert_slashes=True,recursive=True)
-    
-    for fn in image_files:
-        assert fn in filename_to_exif_info, 'No EXIF info available for {}'.format(fn)
-    
-    input_fn_relative_to_output_fn_relative = {}
-    
-    # fn_relative = image_files[0]
-    for fn_relative in image_files:
-        
-        input_fn_abs = os.path.join(input_folder,fn_relative)
-        image_exif_info = filename_to_exif_info[fn_relative]
-        if 'exif_tags' in image_exif_info:
-            image_exif_info = image_exif_info['exif_tags']
-        
-        if image_exif_info is None or \
-            'DateTimeOriginal' not in image_exif_info or \
-            image_exif_info['DateTimeOriginal'] is None:
-                
-            dt_tag = 'unknown_datetime'
-            print('Warning: no datetime for {}'.format(fn_relative))
-            
-        else:
-            
-            dt_tag = str(image_exif_info['DateTimeOriginal']).replace(':','-').replace(' ','_').strip()            
-        
-        flat_filename = fn_relative.replace('\\','/').replace('/','_')
-        
-        output_fn_relative = insert_before_extension(flat_filename,dt_tag)
-        
-        input_fn_relative_to_output_fn_relative[fn_relative] = output_fn_relative
-        
-    if not dry_run:
-        
-        input_fn_abs_to_output_fn_abs = {}
-        for input_fn_relative in input_fn_relative_to_output_fn_relative:
-            output_fn_relative = input_fn_relative_to_output_fn_relative[input_fn_relative]
-            input_fn_abs = os.path.join(input_folder,input_fn_relative)
-            output_fn_abs = os.path.join(output_folder,output_fn_relative)
-            input_fn_abs_to_output_fn_abs[input_fn_abs] = output_fn_abs
-            
-            parallel_copy_files(input_file_to_output_file=input_fn_abs_to_output_fn_abs,
-                                max_workers=n_copy_workers, 
-                                use_threads=True, 
-                                overwrite=True, 
-                                verbose=verbose)
-            
-    return input_fn_relative_to_output_fn_relative
-
-# ...def rename_images()
-
-
-#%% Interactive driver
-
-if False:
-    
-    pass
-
-    #%% Configure options
-    
-    input_folder = r'G:\camera_traps\camera_trap_videos\2024.05.25\cam3'
-    output_folder = r'G:\camera_traps\camera_trap_videos\2024.05.25\cam3_flat'
-    dry_run = False
-    verbose = True
-    read_exif_options = ReadExifOptions()
-    read_exif_options.tags_to_include = ['DateTime','Model','Make','ExifImageWidth','ExifImageHeight','DateTime',
-                               'DateTimeOriginal']    
-    read_exif_options.n_workers = 8
-    read_exif_options.verbose = verbose    
-    n_copy_workers = 8
-    
-    
-    #%% Programmatic execution
-    
-    input_fn_relative_to_output_fn_relative = rename_images(input_folder,
-                                                            output_folder,
-                                                            dry_run=dry_run,
-                                                            verbose=verbose,
-                                                            read_exif_options=read_exif_options,
-                                                            n_copy_workers=n_copy_workers)
-    
-
-#%% Command-line driver
-
-import sys,argparse
-
-def main():
-
-    parser = argparse.ArgumentParser(
-        description='Copies images from a possibly-nested folder structure to a flat folder structure, ' + \
-            'adding datetime information from EXIF to each filename')
-    
-    parser.add_argument(
-        'input_folder',
-        type=str,
-        help='The folder to search for images, always recursive')
-    
-    parser.add_argument(
-        'output_folder',
-        type=str,
-        help='The folder to which we should write the flattened image structure')
-    
-    parser.add_argument(
-        '--dry_run',
-        action='store_true',
-        help="Only map images, don't actually copy")
-
-    if len(sys.argv[1:]) == 0:
-        parser.print_help()
-        parser.exit()
-
-    args = parser.parse_args()
-
-    rename_images(args.input_folder,args.output_folder,dry_run=args.dry_run,
-                  verbose=True,read_exif_options=None)
-
-if __name__ == '__main__':
-    main()
+"""
+
+rename_images.py
+
+Copies images from a possibly-nested folder structure to a flat folder structure, including EXIF
+timestamps in each filename.  Loosely equivalent to camtrapR's imageRename() function.
+
+"""
+
+#%% Imports and constants
+
+import os
+import json
+import shutil
+
+from multiprocessing.pool import ThreadPool
+from functools import partial
+from tqdm import tqdm
+
+from megadetector.utils.path_utils import \
+    find_images, insert_before_extension, file_cache_key, file_matches_cache_key, \
+    read_jsonl_manifest
+from megadetector.data_management.read_exif import \
+    ReadExifOptions, read_exif_from_folder
+from megadetector.data_management.remove_exif import strip_jpeg_metadata
+
+
+#%% Support functions
+
+def _copy_renamed_image(input_fn_relative_and_output_fn_relative,
+                        input_folder,output_folder,strip_exif=False):
+    """
+    Copies a single image from [input_folder] to [output_folder], optionally removing metadata
+    from JPEG files along the way.  Returns a manifest record.
+    """
+    
+    input_fn_relative = input_fn_relative_and_output_fn_relative[0]
+    output_fn_relative = input_fn_relative_and_output_fn_relative[1]
+    
+    input_fn_abs = os.path.join(input_folder,input_fn_relative)
+    output_fn_abs = os.path.join(output_folder,output_fn_relative)
+    
+    record = {'input':input_fn_relative,'output':output_fn_relative,'error':None,'key':None}
+    
+    try:
+        # Read the key before copying, so a file modified during the copy gets re-copied
+        # next time
+        key = file_cache_key(input_fn_abs)
+        os.makedirs(os.path.dirname(output_fn_abs),exist_ok=True)
+        copied = False
+        if strip_exif and input_fn_abs.lower().endswith(('.jpg','.jpeg')):
+            try:
+                strip_jpeg_metadata(input_fn_abs,output_fn_abs)
+                copied = True
+            except ValueError:
+                # Not something we can parse as a JPEG; copy it unchanged
+                pass
+        if not copied:
+            shutil.copyfile(input_fn_abs,output_fn_abs)
+        record['key'] = key
+    except Exception as e:
+        print('Error copying {} to {}: {}'.format(input_fn_abs,output_fn_abs,str(e)))
+        record['error'] = str(e)
+    
+    return record
+
+
+#%% Functions
+
+def rename_images(input_folder,
+                  output_folder,
+                  dry_run=False,
+                  verbose=False,
+                  read_exif_options=None,
+                  n_copy_workers=8,
+                  manifest_file=None,
+                  strip_exif=False):
+    """
+    Copies images from a possibly-nested folder structure to a flat folder structure, including 
+    EXIF timestamps in each filename.
+    
+    Args:
+        input_folder: the folder to search for images, always recursive
+        output_folder: the folder to which we will copy images; cannot be the
+            same as [input_folder]
+        dry_run: only map images, don't actually copy
+        verbose (bool, optional): enable additional debug output
+        read_exif_options (ReadExifOptions, optional): parameters controlling the reading of
+            EXIF information
+        n_copy_workers (int, optional): number of parallel threads to use for copying
+        manifest_file (str, optional): a .jsonl file to which we append a record for each image
+            as it's copied; images recorded in this file that haven't changed since they were
+            copied are skipped (including EXIF reading), so an interrupted job can be resumed.
+            Not written when [dry_run] is True.
+        strip_exif (bool, optional): remove EXIF/IPTC/XMP metadata from JPEG files as they're
+            copied, without re-encoding them (see remove_exif.strip_jpeg_metadata)
+                    
+    Returns:
+        dict: a dict mapping relative filenames in the input folder to relative filenames in the output 
+        folder
+    """
+    
+    assert os.path.isdir(input_folder), 'Input folder {} does not exist'.format(
+        input_folder)
+    
+    if not dry_run:
+        os.makedirs(output_folder,exist_ok=True)
+    
+    image_files = find_images(input_folder,return_relative_paths=True,convert_slashes=True,recursive=True)
+    
+    input_fn_relative_to_output_fn_relative = {}
+    
+    
+    ##%% Skip images we've already copied
+    
+    input_fn_to_record = read_jsonl_manifest(manifest_file,key_field='input',
+                                             record_filter=lambda r: r['error'] is None)
+    
+    if len(input_fn_to_record) > 0:
+        
+        image_files_to_process = []
+        
+        for fn_relative in image_files:
+            record = input_fn_to_record.get(fn_relative)
+            if (record is not None) and \
+               file_matches_cache_key(os.path.join(input_folder,fn_relative),record['key']):
+                input_fn_relative_to_output_fn_relative[fn_relative] = record['output']
+                continue
+            image_files_to_process.append(fn_relative)
+            
+        print('Skipping {} of {} images that were already copied'.format(
+            len(image_files) - len(image_files_to_process),len(image_files)))
+        image_files = image_files_to_process
+    
+    if len(image_files) == 0:
+        return input_fn_relative_to_output_fn_relative
+    
+    
+    ##%% Read EXIF information
+    
+    if read_exif_options is None:
+        read_exif_options = ReadExifOptions()
+   
+    read_exif_options.tags_to_include = ['DateTime','Model','Make','ExifImageWidth','ExifImageHeight','DateTime',
+                                         'DateTimeOriginal']    
+    read_exif_options.verbose = False
+    
+    exif_info = read_exif_from_folder(input_folder=input_folder,
+                                      output_file=None,
+                                      options=read_exif_options,
+                                      filenames=image_files,recursive=True)
+    
+    print('Read EXIF information for {} images'.format(len(exif_info)))
+    
+    filename_to_exif_info = {info['file_name']:info for info in exif_info}
+    
+    for fn in image_files:
+        assert fn in filename_to_exif_info, 'No EXIF info available for {}'.format(fn)
+    
+    
+    ##%% Map input filenames to output filenames
+    
+    input_and_output_filenames = []
+    
+    # fn_relative = image_files[0]
+    for fn_relative in image_files:
+        
+        image_exif_info = filename_to_exif_info[fn_relative]
+        if 'exif_tags' in image_exif_info:
+            image_exif_info = image_exif_info['exif_tags']
+        
+        if image_exif_info is None or \
+            'DateTimeOriginal' not in image_exif_info or \
+            image_exif_info['DateTimeOriginal'] is None:
+                
+            dt_tag = 'unknown_datetime'
+            print('Warning: no datetime for {}'.format(fn_relative))
+            
+        else:
+            
+            dt_tag = str(image_exif_info['DateTimeOriginal']).replace(':','-').replace(' ','_').strip()            
+        
+        flat_filename = fn_relative.replace('\\','/').replace('/','_')
+        
+        output_fn_relative = insert_before_extension(flat_filename,dt_tag)
+        
+        input_fn_relative_to_output_fn_relative[fn_relative] = output_fn_relative
+        input_and_output_filenames.append((fn_relative,output_fn_relative))
+    
+    if dry_run:
+        return input_fn_relative_to_output_fn_relative
+    
+    
+    ##%% Copy images
+    
+    worker_function = partial(_copy_renamed_image,
+                              input_folder=input_folder,
+                              output_folder=output_folder,
+                              strip_exif=strip_exif)
+    
+    pool = None
+    
+    if n_copy_workers <= 1:
+        
+        results = (worker_function(t) for t in input_and_output_filenames)
+        
+    else:
+        
+        if verbose:
+            print('Starting parallel thread pool with {} workers'.format(n_copy_workers))
+        pool = ThreadPool(n_copy_workers)
+        results = pool.imap_unordered(worker_function,input_and_output_filenames,chunksize=16)
+    
+    n_records = 0
+    n_errors = 0
+    manifest_f = None
+    if manifest_file is not None:
+        manifest_f = open(manifest_file,'a')
+    
+    try:
+        
+        for record in tqdm(results,total=len(input_and_output_filenames)):
+            n_records += 1
+            if record['error'] is not None:
+                n_errors += 1
+            if manifest_f is not None:
+                manifest_f.write(json.dumps(record) + '\n')
+                if n_records % 1000 == 0:
+                    manifest_f.flush()
+    
+    finally:
+        
+        if manifest_f is not None:
+            manifest_f.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    print('Copied {} images ({} errors)'.format(n_records,n_errors))
+    
+    return input_fn_relative_to_output_fn_relative
+
+# ...def rename_images()
+
+
+#%% Interactive driver
+
+if False:
+    
+    pass
+
+    #%% Configure options
+    
+    input_folder = r'G:\camera_traps\camera_trap_videos\2024.05.25\cam3'
+    output_folder = r'G:\camera_traps\camera_trap_videos\2024.05.25\cam3_flat'
+    dry_run = False
+    verbose = True
+    read_exif_options = ReadExifOptions()
+    read_exif_options.tags_to_include = ['DateTime','Model','Make','ExifImageWidth','ExifImageHeight','DateTime',
+                               'DateTimeOriginal']    
+    read_exif_options.n_workers = 8
+    read_exif_options.verbose = verbose    
+    n_copy_workers = 8
+    
+    
+    #%% Programmatic execution
+    
+    input_fn_relative_to_output_fn_relative = rename_images(input_folder,
+                                                            output_folder,
+                                                            dry_run=dry_run,
+                                                            verbose=verbose,
+                                                            read_exif_options=read_exif_options,
+                                                            n_copy_workers=n_copy_workers)
+    
+
+#%% Command-line driver
+
+import sys,argparse
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Copies images from a possibly-nested folder structure to a flat folder structure, ' + \
+            'adding datetime information from EXIF to each filename')
+    
+    parser.add_argument(
+        'input_folder',
+        type=str,
+        help='The folder to search for images, always recursive')
+    
+    parser.add_argument(
+        'output_folder',
+        type=str,
+        help='The folder to which we should write the flattened image structure')
+    
+    parser.add_argument(
+        '--dry_run',
+        action='store_true',
+        help="Only map images, don't actually copy")
+
+    parser.add_argument(
+        '--n_workers',
+        type=int,
+        default=8,
+        help='Number of parallel threads to use for copying (default 8)')
+    
+    parser.add_argument(
+        '--manifest_file',
+        type=str,
+        default=None,
+        help='.jsonl file used to record progress, so interrupted jobs can be resumed')
+    
+    parser.add_argument(
+        '--strip_exif',
+        action='store_true',
+        help='Remove EXIF/IPTC/XMP metadata from JPEG files as they\'re copied (lossless)')
+    
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        parser.exit()
+
+    args = parser.parse_args()
+
+    rename_images(args.input_folder,args.output_folder,dry_run=args.dry_run,
+                  verbose=True,read_exif_options=None,n_copy_workers=args.n_workers,
+                  manifest_file=args.manifest_file,strip_exif=args.strip_exif)
+
+if __name__ == '__main__':
+    main()
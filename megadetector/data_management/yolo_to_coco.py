@@ -11,6 +11,8 @@ Converts a folder of YOLO-formatted annotation files to a COCO-formatted dataset
 import json
 import os
 
+import numpy as np
+
 from multiprocessing.pool import ThreadPool
 from multiprocessing.pool import Pool
 from functools import partial
@@ -21,7 +23,7 @@ from megadetector.utils.path_utils import find_images
 from megadetector.utils.path_utils import recursive_file_list
 from megadetector.utils.path_utils import find_image_strings
 from megadetector.utils.ct_utils import invert_dictionary
-from megadetector.visualization.visualization_utils import open_image
+from megadetector.visualization.visualization_utils import parallel_get_image_sizes
 from megadetector.data_management.yolo_output_to_md_output import read_classes_from_yolo_dataset_file
 
 
@@ -34,11 +36,47 @@ def _filename_to_image_id(fn):
     return fn.replace(' ','_').replace('\\','/')
 
 
-def _process_image(fn_abs,input_folder,category_id_to_name,label_folder):
+def yolo_boxes_to_coco_boxes(yolo_boxes,image_widths,image_heights):
+    """
+    Converts an array of YOLO boxes (normalized [x_center, y_center, width, height]) to COCO 
+    boxes (absolute [x_min, y_min, width, height]), all at once.
+    
+    Args:
+        yolo_boxes (array-like): an N x 4 array of YOLO boxes
+        image_widths (array-like): a length-N array of widths of the images to which each box 
+            belongs
+        image_heights (array-like): a length-N array of heights of the images to which each box 
+            belongs
+            
+    Returns:
+        np.array: an N x 4 float array of COCO boxes
+    """
+    
+    yolo_boxes = np.asarray(yolo_boxes,dtype=np.float64).reshape(-1,4)
+    image_widths = np.asarray(image_widths,dtype=np.float64)
+    image_heights = np.asarray(image_heights,dtype=np.float64)
+    
+    absolute_x_center = yolo_boxes[:,0] * image_widths
+    absolute_y_center = yolo_boxes[:,1] * image_heights
+    absolute_width = yolo_boxes[:,2] * image_widths
+    absolute_height = yolo_boxes[:,3] * image_heights
+    absolute_x_min = absolute_x_center - absolute_width / 2
+    absolute_y_min = absolute_y_center - absolute_height / 2
+    
+    return np.stack([absolute_x_min,absolute_y_min,absolute_width,absolute_height],axis=1)
+
+
+def _process_image(fn_abs_and_size,input_folder,category_id_to_name,label_folder):
     """
-    Internal support function for processing one image's labels.
+    Internal support function for processing one image's labels.  [fn_abs_and_size] is 
+    a tuple of (absolute filename, (w,h)); the size is None if the image failed to load.
+    
+    Returns a tuple of (image, annotations, yolo_boxes), where the annotations don't 
+    have bboxes yet; yolo_boxes contains the normalized YOLO box for each annotation.
     """
     
+    fn_abs,image_size = fn_abs_and_size
+    
     # Create the image object for this image
     #
     # Always use forward slashes in image filenames and IDs
@@ -57,19 +95,18 @@ def _process_image(fn_abs,input_folder,category_id_to_name,label_folder):
     im['id'] = image_id
     
     annotations_this_image = []
+    yolo_boxes_this_image = []
     
-    try:        
-        pil_im = open_image(fn_abs)
-        im_width, im_height = pil_im.size
-        im['width'] = im_width
-        im['height'] = im_height
-        im['error'] = None
-    except Exception as e:
-        print('Warning: error reading {}:\n{}'.format(image_fn_relative,str(e)))
+    if image_size is None:
+        print('Warning: error reading {}'.format(image_fn_relative))
         im['width'] = -1
         im['height'] = -1
-        im['error'] = str(e)
-        return (im,annotations_this_image)
+        im['error'] = 'Could not read image {}'.format(image_fn_relative)
+        return (im,annotations_this_image,yolo_boxes_this_image)
+    
+    im['width'] = image_size[0]
+    im['height'] = image_size[1]
+    im['error'] = None
         
     # Is there an annotation file for this image?
     if label_folder is not None:
@@ -108,35 +145,20 @@ def _process_image(fn_abs,input_folder,category_id_to_name,label_folder):
             ann['category_id'] = category_id
             ann['sequence_level_annotation'] = False
             
-            # COCO: [x_min, y_min, width, height] in absolute coordinates
             # YOLO: [class, x_center, y_center, width, height] in normalized coordinates
-            
+            #
+            # Boxes get converted to COCO format for all images at once, in yolo_to_coco()
             yolo_bbox = [float(x) for x in tokens[1:]]
-            
-            normalized_x_center = yolo_bbox[0]
-            normalized_y_center = yolo_bbox[1]
-            normalized_width = yolo_bbox[2]
-            normalized_height = yolo_bbox[3]
-            
-            absolute_x_center = normalized_x_center * im_width 
-            absolute_y_center = normalized_y_center * im_height
-            absolute_width = normalized_width * im_width
-            absolute_height = normalized_height * im_height
-            absolute_x_min = absolute_x_center - absolute_width / 2
-            absolute_y_min = absolute_y_center - absolute_height / 2
-            
-            coco_bbox = [absolute_x_min, absolute_y_min, absolute_width, absolute_height]
-            
-            ann['bbox'] = coco_bbox
             annotation_number += 1
             
-            annotations_this_image.append(ann)                
+            annotations_this_image.append(ann)
+            yolo_boxes_this_image.append(yolo_bbox)
             
         # ...for each annotation 
         
     # ...if this image has annotations
     
-    return (im,annotations_this_image)
+    return (im,annotations_this_image,yolo_boxes_this_image)
 
 # ...def _process_image(...)
 
@@ -408,7 +430,8 @@ def yolo_to_coco(input_folder,
                  exclude_string=None,
                  include_string=None,
                  overwrite_handling='overwrite',
-                 label_folder=None):
+                 label_folder=None,
+                 image_size_cache_file=None):
     """
     Converts a YOLO-formatted dataset to a COCO-formatted dataset.
     
@@ -447,6 +470,9 @@ def yolo_to_coco(input_folder,
         overwrite_handling (bool, optional): behavior if output_file exists ('load', 'overwrite', or 
             'error')
         label_folder (str, optional): label folder, if different from the image folder
+        image_size_cache_file (str, optional): a .json file used to cache image sizes across calls
+            (see visualization_utils.parallel_get_image_sizes()), so repeated conversions of the
+            same images don't re-open them
     
     Returns:
         dict: COCO-formatted data, the same as what's written to [output_file]
@@ -560,6 +586,17 @@ def yolo_to_coco(input_folder,
         image_ids.add(image_id)
     
     
+    ## Read image sizes
+    
+    print('Reading image sizes...')
+    
+    image_sizes = parallel_get_image_sizes(image_files_abs,
+                                           max_workers=n_workers,
+                                           use_threads=(pool_type == 'thread'),
+                                           cache_file=image_size_cache_file)
+    image_files_abs_and_sizes = [(fn,image_sizes[fn]) for fn in image_files_abs]
+    
+    
     ## Main loop to process labels
     
     print('Processing labels...')
@@ -567,9 +604,9 @@ def yolo_to_coco(input_folder,
     if n_workers <= 1:
         
         image_results = []        
-        # fn_abs = image_files_abs[0]
-        for fn_abs in tqdm(image_files_abs):                
-            image_results.append(_process_image(fn_abs,
+        # fn_abs_and_size = image_files_abs_and_sizes[0]
+        for fn_abs_and_size in tqdm(image_files_abs_and_sizes):                
+            image_results.append(_process_image(fn_abs_and_size,
                                                 input_folder,
                                                 category_id_to_name,
                                                 label_folder))
@@ -589,13 +626,43 @@ def yolo_to_coco(input_folder,
                     input_folder=input_folder,
                     category_id_to_name=category_id_to_name,
                     label_folder=label_folder)
-        image_results = list(tqdm(pool.imap(p, image_files_abs),
-                                  total=len(image_files_abs)))
-                
+        try:
+            image_results = list(tqdm(pool.imap(p, image_files_abs_and_sizes),
+                                      total=len(image_files_abs_and_sizes)))
+        finally:
+            pool.close()
+            pool.join()
     
     assert len(image_results) == len(image_files_abs)
     
     
+    ## Convert boxes from YOLO to COCO format
+    
+    # COCO: [x_min, y_min, width, height] in absolute coordinates
+    # YOLO: [class, x_center, y_center, width, height] in normalized coordinates
+    
+    yolo_boxes = []
+    box_image_widths = []
+    box_image_heights = []
+    
+    for im,_,yolo_boxes_this_image in image_results:
+        yolo_boxes.extend(yolo_boxes_this_image)
+        box_image_widths.extend([im['width']] * len(yolo_boxes_this_image))
+        box_image_heights.extend([im['height']] * len(yolo_boxes_this_image))
+    
+    if len(yolo_boxes) > 0:
+        
+        coco_boxes = yolo_boxes_to_coco_boxes(yolo_boxes,
+                                              box_image_widths,
+                                              box_image_heights).tolist()
+        i_box = 0
+        for _,annotations_this_image,_ in image_results:
+            for ann in annotations_this_image:
+                ann['bbox'] = coco_boxes[i_box]
+                i_box += 1
+        assert i_box == len(coco_boxes)
+    
+    
     ## Re-assembly of results into a COCO dict
     
     print('Assembling labels...')
@@ -1006,17 +1006,26 @@ def _write_checkpoint(checkpoint_path, results):
 
 def get_image_datetime(image):
     """
-    Reads EXIF datetime from a PIL Image object.
+    Reads EXIF datetime from a PIL Image object or an image file.
     
     Args:
-        image (Image): the PIL Image object from which we should read datetime information
+        image (Image or str): the PIL Image object (or filename) from which we should 
+            read datetime information; for JPEG/PNG files, we only read the file header
         
     Returns:
-        str: the EXIF datetime from [image] (a PIL Image object), if available, as a string;
-        returns None if EXIF datetime is not available.
+        str: the EXIF datetime from [image], if available, as a string; returns None if 
+        EXIF datetime is not available.
     """
     
-    exif_tags = read_exif.read_pil_exif(image,exif_options)
+    exif_tags = None
+    if isinstance(image,str):
+        try:
+            exif_tags = read_exif.read_header_exif(image)
+        except Exception:
+            # Fall back to PIL if we can't parse the header
+            exif_tags = None
+    if exif_tags is None:
+        exif_tags = read_exif.read_pil_exif(image,exif_options)
     
     try:
         datetime_str = exif_tags['DateTimeOriginal']
@@ -36,6 +36,7 @@ import random
 import copy
 import urllib
 import itertools
+import uuid
 
 import numpy as np
 
@@ -53,6 +54,7 @@ from megadetector.utils.write_html_image_list import write_html_image_list
 from megadetector.utils.ct_utils import invert_dictionary, get_iou
 from megadetector.utils import path_utils
 from megadetector.visualization.visualization_utils import get_text_size
+from megadetector.postprocessing.detector_calibration import MaxConfidenceTable
 
 def _maxempty(L):
     """
@@ -204,6 +206,11 @@ class BatchComparisonOptions:
         #: output page?
         self.parse_link_paths = True
         
+        #: Should we write resized copies of source images to [output_folder]/resized_images, so 
+        #: each source image is only decoded and resized once, no matter how many comparisons 
+        #: it appears in?  Only relevant when target_width is not None.
+        self.share_resized_images = True
+        
 # ...class BatchComparisonOptions
     
 
@@ -265,6 +272,105 @@ main_page_footer = '<br/><br/><br/></body></html>\n'
 
 #%% Comparison functions
 
+def _resized_image_folder(options):
+    """
+    Returns the folder in which we share resized copies of source images across comparisons.
+    """
+    
+    return os.path.join(options.output_folder,'resized_images',str(options.target_width))
+    
+    
+def _load_source_image(fn,options):
+    """
+    Loads the source image [fn] (relative to options.image_folder), resized to 
+    options.target_width.  If options.share_resized_images is set, re-uses (or writes)
+    a resized copy in the shared resized image folder, so each source image is only
+    decoded at full resolution once per job.  Shared copies are written as .png files, so 
+    rendered images don't go through an extra round of lossy compression.
+    
+    Args:
+        fn (str): image filename, relative to options.image_folder
+        options (BatchComparisonOptions): job options
+        
+    Returns:
+        PIL.Image.Image: the loaded (and possibly resized) image
+    """
+    
+    input_image_path = os.path.join(options.image_folder,fn)
+    assert os.path.isfile(input_image_path), 'Image {} does not exist'.format(input_image_path)
+    
+    if options.target_width is None:
+        return visualization_utils.open_image(input_image_path)
+    
+    resized_image_path = None
+    
+    if options.share_resized_images:
+        resized_image_path = os.path.join(_resized_image_folder(options),
+                                          path_utils.flatten_path(fn) + '.png')
+        if os.path.isfile(resized_image_path) and \
+            (os.path.getmtime(resized_image_path) >= os.path.getmtime(input_image_path)):
+            # We don't write EXIF data to resized images, and the pixels have already been rotated
+            return visualization_utils.open_image(resized_image_path,ignore_exif_rotation=True)
+        
+    im = visualization_utils.resize_image(input_image_path, options.target_width,
+                                          use_thumbnail_cache=True)
+    
+    if resized_image_path is not None:
+        # Write to a temporary file first, so a concurrent worker never sees a partially-written
+        # image
+        os.makedirs(os.path.dirname(resized_image_path),exist_ok=True)
+        tokens = os.path.splitext(resized_image_path)
+        temp_path = tokens[0] + '.' + str(uuid.uuid4()) + tokens[1]
+        im.save(temp_path)
+        os.replace(temp_path,resized_image_path)
+        
+    return im
+
+# ...def _load_source_image(...)
+
+
+def _load_results_for_comparison(filename,options,loaded_results=None):
+    """
+    Loads a MD results file, normalizes path separators, and applies the filtering rules in
+    [options].  If [loaded_results] is not None, it's used as a cache (keyed by filename), so 
+    each results file is only loaded once for a set of comparisons.
+    
+    Args:
+        filename (str): MD results file to load
+        options (BatchComparisonOptions): job options containing filtering rules
+        loaded_results (dict, optional): dict mapping filenames to previously-loaded results
+        
+    Returns:
+        tuple: (results, filename_to_image), where [results] is the (subsetted) MD results dict, 
+        and [filename_to_image] maps filenames to image dicts in [results]
+    """
+    
+    if (loaded_results is not None) and (filename in loaded_results):
+        return loaded_results[filename]
+    
+    assert os.path.isfile(filename), "Can't find results file {}".format(filename)
+    
+    with open(filename,'r') as f:
+        results = json.load(f)
+    
+    # Don't let path separators confuse things
+    for im in results['images']:
+        if 'file' in im:
+            im['file'] = im['file'].replace('\\','/')
+    
+    # Restrict this comparison to specific files if requested
+    results = _subset_md_results(results, options)
+    
+    filename_to_image = {im['file']:im for im in results['images']}
+    
+    if loaded_results is not None:
+        loaded_results[filename] = (results,filename_to_image)
+        
+    return results,filename_to_image
+
+# ...def _load_results_for_comparison(...)
+
+
 def _render_image_pair(fn,image_pairs,category_folder,options,pairwise_options):
     """
     Render two sets of results (i.e., a comparison) for a single image.
@@ -281,10 +387,7 @@ def _render_image_pair(fn,image_pairs,category_folder,options,pairwise_options):
         str: rendered image filename            
     """
     
-    input_image_path = os.path.join(options.image_folder,fn)
-    assert os.path.isfile(input_image_path), 'Image {} does not exist'.format(input_image_path)
-    
-    im = visualization_utils.open_image(input_image_path)
+    im = _load_source_image(fn,options)
     image_pair = image_pairs[fn]
     detections_a = image_pair['im_a']['detections']
     detections_b = image_pair['im_b']['detections']    
@@ -305,9 +408,6 @@ def _render_image_pair(fn,image_pairs,category_folder,options,pairwise_options):
             custom_strings_b[i_det] = '({})'.format(
                 det['transferred_from'].split('.')[0])
     
-    if options.target_width is not None:
-        im = visualization_utils.resize_image(im, options.target_width)
-        
     label_map = None
     if options.show_category_names_on_detected_boxes:
         label_map=options.detection_category_id_to_name        
@@ -530,11 +630,16 @@ def _subset_ground_truth(gt_data,options):
     """
     Subset a set of COCO annotations according to the rules defined in the 
     BatchComparisonOptions object [options].  Typically used to filter for files
-    containing a particular string.  Modifies [results] in place, also returns.
+    containing a particular string.  Does not modify [gt_data]; the ground truth data
+    may be shared across comparisons.
     
     Args:
         gt_data (dict): COCO-formatted annotations
         options (BatchComparisonOptions): job options containing filtering rules
+        
+    Returns:
+        dict: a copy of [gt_data] containing only the images (and annotations) that match
+        the filtering rules, or [gt_data] itself if no filtering rules are defined
     """
     
     if options.required_token is None:
@@ -561,6 +666,7 @@ def _subset_ground_truth(gt_data,options):
             len(images_to_keep),len(gt_data['images']),
             len(annotations_to_keep),len(gt_data['annotations'])))
         
+    gt_data = copy.copy(gt_data)
     gt_data['images'] = images_to_keep
     gt_data['annotations'] = annotations_to_keep
     
@@ -569,7 +675,8 @@ def _subset_ground_truth(gt_data,options):
 # ...def _subset_ground_truth(...)
 
 
-def _pairwise_compare_batch_results(options,output_index,pairwise_options):
+def _pairwise_compare_batch_results(options,output_index,pairwise_options,loaded_results=None,
+                                    gt_data=None):
     """
     The main entry point for this module is compare_batch_results(), which calls 
     this function for each pair of comparisons the caller has requested.  Generates an
@@ -579,6 +686,10 @@ def _pairwise_compare_batch_results(options,output_index,pairwise_options):
         options (BatchComparisonOptions): overall job options for this comparison group
         output_index (int): a numeric index used for generating HTML titles    
         pairwise_options (PairwiseBatchComparisonOptions): job options for this comparison
+        loaded_results (dict, optional): dict mapping results filenames to already-loaded
+            results, shared across comparisons; see _load_results_for_comparison
+        gt_data (dict, optional): already-loaded ground truth data, shared across 
+            comparisons; if this is None, ground truth is loaded from options.ground_truth_file
         
     Returns:
         PairwiseBatchComparisonResults: the results of this pairwise comparison
@@ -606,10 +717,6 @@ def _pairwise_compare_batch_results(options,output_index,pairwise_options):
 
     ##%% Validate inputs
     
-    assert os.path.isfile(pairwise_options.results_filename_a), \
-        "Can't find results file {}".format(pairwise_options.results_filename_a)
-    assert os.path.isfile(pairwise_options.results_filename_b), \
-        "Can't find results file {}".format(pairwise_options.results_filename_b)
     assert os.path.isdir(options.image_folder), \
         "Can't find image folder {}".format(options.image_folder)
     os.makedirs(options.output_folder,exist_ok=True)
@@ -617,19 +724,10 @@ def _pairwise_compare_batch_results(options,output_index,pairwise_options):
     
     ##%% Load both result sets
     
-    with open(pairwise_options.results_filename_a,'r') as f:
-        results_a = json.load(f)
-    
-    with open(pairwise_options.results_filename_b,'r') as f:
-        results_b = json.load(f)
-        
-    # Don't let path separators confuse things
-    for im in results_a['images']:
-        if 'file' in im:
-            im['file'] = im['file'].replace('\\','/')
-    for im in results_b['images']:
-        if 'file' in im:
-            im['file'] = im['file'].replace('\\','/')
+    results_a, filename_to_image_a = _load_results_for_comparison(
+        pairwise_options.results_filename_a, options, loaded_results)
+    results_b, filename_to_image_b = _load_results_for_comparison(
+        pairwise_options.results_filename_b, options, loaded_results)
     
     if not options.class_agnostic_comparison:
         assert results_a['detection_categories'] == results_b['detection_categories'], \
@@ -655,15 +753,8 @@ def _pairwise_compare_batch_results(options,output_index,pairwise_options):
         else:            
             pairwise_options.results_description_b = results_b['info']['detector']
     
-    # Restrict this comparison to specific files if requested
-    results_a = _subset_md_results(results_a, options)
-    results_b = _subset_md_results(results_b, options)
-        
     images_a = results_a['images']
     images_b = results_b['images']
-        
-    filename_to_image_a = {im['file']:im for im in images_a}
-    filename_to_image_b = {im['file']:im for im in images_b}
     
     
     ##%% Make sure they represent the same set of images
@@ -695,22 +786,22 @@ def _pairwise_compare_batch_results(options,output_index,pairwise_options):
     
     # ...and determine what type of GT is available, boxes or image-level labels
     
-    gt_data = None
     gt_category_id_to_detection_category_id = None
     
-    if options.ground_truth_file is None:
+    if (gt_data is None) and (options.ground_truth_file is None):
         
         ground_truth_type = 'no_gt'
         
     else:
         
         # Read ground truth data if necessary
-        if isinstance(options.ground_truth_file,dict):            
-            gt_data = options.ground_truth_file            
-        else:        
-            assert isinstance(options.ground_truth_file,str)
-            with open(options.ground_truth_file,'r') as f:
-                gt_data = json.load(f)
+        if gt_data is None:
+            if isinstance(options.ground_truth_file,dict):            
+                gt_data = options.ground_truth_file            
+            else:        
+                assert isinstance(options.ground_truth_file,str)
+                with open(options.ground_truth_file,'r') as f:
+                    gt_data = json.load(f)
         
         # Restrict this comparison to specific files if requested
         gt_data = _subset_ground_truth(gt_data, options)
@@ -1540,6 +1631,15 @@ def compare_batch_results(options):
     
     options.pairwise_options = None
     
+    # Load ground truth once, rather than once per comparison
+    gt_data = None
+    if isinstance(options.ground_truth_file,str):
+        with open(options.ground_truth_file,'r') as f:
+            gt_data = json.load(f)
+    
+    # Each results file is loaded once and shared across all the comparisons it appears in
+    loaded_results = {}
+    
     html_content = ''
     all_pairwise_results = []
     
@@ -1548,7 +1648,9 @@ def compare_batch_results(options):
     for i_comparison,pairwise_options in enumerate(pairwise_options_list):
         print('Running comparison {} of {}'.format(i_comparison,n_comparisons))
         pairwise_results = \
-            _pairwise_compare_batch_results(options,i_comparison,pairwise_options)
+            _pairwise_compare_batch_results(options,i_comparison,pairwise_options,
+                                            loaded_results=loaded_results,
+                                            gt_data=gt_data)
         html_content += pairwise_results.html_content
         all_pairwise_results.append(pairwise_results)
 
@@ -1578,7 +1680,9 @@ def n_way_comparison(filenames,
                      model_names=None):
     """
     Performs N pairwise comparisons for the list of results files in [filenames], by generating
-    sets of pairwise options and calling compare_batch_results.
+    sets of pairwise options and calling compare_batch_results.  Each results file is loaded once, 
+    and (if options.share_resized_images is True) each source image is decoded and resized once, 
+    regardless of how many comparisons it appears in.
     
     Args:
         filenames (list): list of MD results filenames to compare
@@ -1708,123 +1812,65 @@ def find_equivalent_threshold(results_a,
     that produces the same fraction of *images* with detections as threshold_a does for 
     results_a.  Uses all categories.
     
+    If you're calling this repeatedly for the same results, pass MaxConfidenceTable 
+    objects (see detector_calibration.py) rather than filenames or dicts; per-image 
+    confidence values are then only computed once, and each query is a sorted-array lookup.
+    
     Args:
-        results_a (str or dict): the first set of results, either a .json filename or a results
-            dict
-        results_b (str or dict): the second set of results, either a .json filename or a results
-            dict
-        threshold_a (float, optional): the threshold used to determine the target number of 
-            detections in results_a
+        results_a (str, dict, or MaxConfidenceTable): the first set of results, either a .json 
+            filename, a results dict, or a precomputed MaxConfidenceTable
+        results_b (str, dict, or MaxConfidenceTable): the second set of results, either a .json 
+            filename, a results dict, or a precomputed MaxConfidenceTable
+        threshold_a (float or list, optional): the threshold used to determine the target number of 
+            detections in results_a, or a list of thresholds
         category_names (list or str, optional): the list of category names to consider (defaults
             to using all categories), or the name of a single category.
         verbose (bool, optional): enable additional debug output
             
     Returns:
-        float: the threshold that - when applied to results_b - produces the same number
-            of image-level detections that results from applying threshold_a to results_a
+        float or np.ndarray: the threshold that - when applied to results_b - produces the same number
+            of image-level detections that results from applying threshold_a to results_a.  If
+            threshold_a is a list, returns an array of thresholds.
     """
     
-    if isinstance(results_a,str):
-        if verbose:
+    if not isinstance(results_a,MaxConfidenceTable):
+        if verbose and isinstance(results_a,str):
             print('Loading results from {}'.format(results_a))
-        with open(results_a,'r') as f:
-            results_a = json.load(f)
+        results_a = MaxConfidenceTable(results_a)
     
-    if isinstance(results_b,str):
-        if verbose:
+    if not isinstance(results_b,MaxConfidenceTable):
+        if verbose and isinstance(results_b,str):
             print('Loading results from {}'.format(results_b))
-        with open(results_b,'r') as f:
-            results_b = json.load(f)
+        results_b = MaxConfidenceTable(results_b)
     
     category_ids_to_consider_a = None
     category_ids_to_consider_b = None
     
     if category_names is not None:
         
-        if isinstance(category_names,str):
-            category_names = [category_names]
-        
-        categories_a = results_a['detection_categories']
-        categories_b = results_b['detection_categories']
-        category_name_to_id_a = invert_dictionary(categories_a)
-        category_name_to_id_b = invert_dictionary(categories_b)
+        category_ids_to_consider_a = results_a.category_ids_for_names(category_names)
+        category_ids_to_consider_b = results_b.category_ids_for_names(category_names)
         
-        category_ids_to_consider_a = []
-        category_ids_to_consider_b = []
-        
-        # category_name = category_names[0]
-        for category_name in category_names:
-            category_id_a = category_name_to_id_a[category_name]
-            category_id_b = category_name_to_id_b[category_name]
-            category_ids_to_consider_a.append(category_id_a)
-            category_ids_to_consider_b.append(category_id_b)
-            
         assert len(category_ids_to_consider_a) > 0 and len(category_ids_to_consider_b) > 0, \
             'Category name list did not map to any category IDs in one or both detection sets'
     
-    def _get_confidence_values_for_results(images,category_ids_to_consider,threshold):
-        """
-        Return a list of the maximum confidence value for each image in [images].
-        Returns zero confidence for images with no detections (or no detections
-        in the specified categories).  Does not return anything for invalid images.
-        """
-        
-        confidence_values = []
-        images_above_threshold = []
-        
-        for im in images:
-            if 'detections' in im and im['detections'] is not None:
-                if len(im['detections']) == 0:
-                    confidence_values.append(0)
-                else:
-                    confidence_values_this_image = []
-                    for det in im['detections']:
-                        if category_ids_to_consider is not None:
-                            if det['category'] not in category_ids_to_consider:
-                                continue
-                        confidence_values_this_image.append(det['conf'])
-                    if len(confidence_values_this_image) == 0:
-                        confidence_values.append(0)
-                    else:
-                        max_conf_value = max(confidence_values_this_image)
-                        
-                        if threshold is not None and max_conf_value >= threshold:
-                            images_above_threshold.append(im)
-                        confidence_values.append(max_conf_value)
-        # ...for each image
-        
-        return confidence_values, images_above_threshold
-    
-    confidence_values_a,images_above_threshold_a = \
-        _get_confidence_values_for_results(results_a['images'],
-                                          category_ids_to_consider_a,
-                                          threshold_a)
-        
-    # ...def _get_confidence_values_for_results(...)
-        
     if verbose:
-        print('For result set A, considering {} of {} images'.format(
-            len(confidence_values_a),len(results_a['images'])))
-    confidence_values_a_above_threshold = [c for c in confidence_values_a if c >= threshold_a]
-    
-    confidence_values_b,_ = _get_confidence_values_for_results(results_b['images'],
-                                                              category_ids_to_consider_b,
-                                                              threshold=None)
-    if verbose:
-        print('For result set B, considering {} of {} images'.format(
-            len(confidence_values_b),len(results_b['images'])))
-    confidence_values_b = sorted(confidence_values_b)        
-        
-    target_detection_fraction = len(confidence_values_a_above_threshold) / len(confidence_values_a)
+        print('For result set A, considering {} images'.format(len(results_a.filenames)))
+        print('For result set B, considering {} images'.format(len(results_b.filenames)))
         
-    detection_cutoff_index = round((1.0-target_detection_fraction) * len(confidence_values_b))    
-    threshold_b = confidence_values_b[detection_cutoff_index]
+    target_detection_fraction = results_a.fraction_above_threshold(threshold_a,
+                                                                   category_ids_to_consider_a)
+    threshold_b = results_b.thresholds_for_fraction(target_detection_fraction,
+                                                    category_ids_to_consider_b)
     
     if verbose:
-        print('{} confidence values above threshold (A)'.format(len(confidence_values_a_above_threshold)))
-        confidence_values_b_above_threshold = [c for c in confidence_values_b if c >= threshold_b]
-        print('{} confidence values above threshold (B)'.format(len(confidence_values_b_above_threshold)))
-            
+        print('{} confidence values above threshold (A)'.format(
+            results_a.n_images_above_threshold(threshold_a,category_ids_to_consider_a)))
+        print('{} confidence values above threshold (B)'.format(
+            results_b.n_images_above_threshold(threshold_b,category_ids_to_consider_b)))
+    
+    if np.isscalar(threshold_a):
+        return float(threshold_b)
     return threshold_b
 
 # ...def find_equivalent_threshold(...)
@@ -11,15 +11,25 @@ of images representing all above-threshold crops from the original folder.
 
 import os
 import json
+import math
+from io import BytesIO
 from tqdm import tqdm
 
 from multiprocessing.pool import Pool, ThreadPool
 from collections import defaultdict
 from functools import partial
 
+from PIL import Image
+
 from megadetector.utils.path_utils import insert_before_extension
+from megadetector.utils.path_utils import read_jsonl_manifest
 from megadetector.visualization.visualization_utils import crop_image
 from megadetector.visualization.visualization_utils import exif_preserving_save
+from megadetector.visualization.visualization_utils import get_image_size
+from megadetector.visualization.visualization_utils import load_image
+from megadetector.classification.crop_detections import crop_image as crop_image_square
+from megadetector.classification.crop_loading import CropShardWriter
+from megadetector.classification.crop_loading import default_crops_per_shard
 
 
 #%% Support classes
@@ -48,6 +58,29 @@ class CreateCropFolderOptions:
         
         #: Whether to use processes ('process') or threads ('thread') for parallelization
         self.pool_type = 'thread'
+        
+        #: Crop geometry: 'box' crops each box (expanded by [expansion] pixels on each 
+        #: side, clipped to the image), 'square' crops the smallest square containing each 
+        #: box, padded with black where it extends past the image boundary
+        self.crop_shape = 'box'
+        
+        #: If this is not None, crops larger than max_crop_size pixels in either dimension are
+        #: downsized to fit in a max_crop_size x max_crop_size square, and JPEGs are decoded at 
+        #: reduced size when that's still large enough for every crop in the image
+        self.max_crop_size = None
+        
+        #: Output format: 'files' (one .jpg file per crop) or 'shards' (crops are packed
+        #: into .tar shards in the output folder, see classification/crop_loading.py)
+        self.output_format = 'files'
+        
+        #: Number of crops per shard, only used when output_format is 'shards'
+        self.crops_per_shard = default_crops_per_shard
+        
+        #: .jsonl file recording which crops have been written, only used when output_format
+        #: is 'files'.  If [overwrite] is False, crops listed here are skipped without checking
+        #: the output folder; if this is None, we check for each crop file individually.  When
+        #: output_format is 'shards', the shard index serves the same purpose.
+        self.manifest_file = None
                 
           
 #%% Support functions
@@ -62,44 +95,288 @@ def _get_crop_filename(image_fn,crop_id):
     return insert_before_extension(image_fn,'crop_' + crop_id)
 
 
+def _load_image_for_crops(input_fn_abs,crops_this_image,options):
+    """
+    Loads the image [input_fn_abs], at reduced size if options.max_crop_size allows it.
+    
+    Returns a tuple (image, scale), where [scale] is the ratio between the size of
+    the loaded image and the full-resolution image.
+    """
+    
+    if options.max_crop_size is None:
+        return load_image(input_fn_abs), 1.0
+    
+    full_size = get_image_size(input_fn_abs)
+    if full_size is None:
+        return load_image(input_fn_abs), 1.0
+    
+    # The long side of each crop is at least the long side of its box, and boxes are
+    # at least as large as their smaller dimension times the short side of the image, so 
+    # this is a conservative estimate of the resolution we need.  Using the short side
+    # makes this independent of EXIF rotation.
+    short_side = min(full_size)
+    required_scale = 0
+    for crop_info in crops_this_image:
+        bbox = crop_info['detection']['bbox']
+        box_size = max(bbox[2],bbox[3]) * short_side
+        if box_size <= 0:
+            continue
+        required_scale = max(required_scale,options.max_crop_size / box_size)
+    
+    if required_scale >= 1 or required_scale == 0:
+        return load_image(input_fn_abs), 1.0
+    
+    min_side = math.ceil(short_side * required_scale)
+    image = load_image(input_fn_abs,min_size=(min_side,min_side))
+    
+    return image, min(image.size) / short_side
+        
+
+def _encode_crop(cropped_image,quality):
+    """
+    Encodes [cropped_image] as a JPEG, returning the bytes.
+    """
+    
+    if (quality is None) or (quality == 'keep'):
+        quality = 85
+    kwargs = {'format':'JPEG','quality':quality}
+    if 'exif' in cropped_image.info:
+        kwargs['exif'] = cropped_image.info['exif']
+    with BytesIO() as buf:
+        cropped_image.save(buf,**kwargs)
+        return buf.getvalue()
+
+
 def _generate_crops_for_single_image(crops_this_image,
                                      input_folder,
                                      output_folder,
                                      options):
     """
-    Generate all the crops required for a single image.
+    Generate all the crops required for a single image, decoding the image once.
+    
+    Returns a dict with fields 'image' (the relative image filename), 'crops' (the 
+    relative filenames of the crops that were generated), and 'error' (None on success).  
+    When options.output_format is 'shards', crops are not written to disk; instead the 
+    encoded crops are returned in the 'crop_data' field, parallel to 'crops'.
     """
+    
     if len(crops_this_image) == 0:
-        return
+        return None
+    
+    image_fn_relative = crops_this_image[0]['image_fn_relative']
+    
+    result = {'image':image_fn_relative,'crops':[],'error':None}
+    write_shards = (options.output_format == 'shards')
+    if write_shards:
+        result['crop_data'] = []
+    
+    # If we're not using a manifest, check for each crop individually
+    if (not write_shards) and (not options.overwrite) and (options.manifest_file is None):
+        crops_this_image = [c for c in crops_this_image if not os.path.isfile(
+            os.path.join(output_folder,c['crop_filename_relative']))]
+        if len(crops_this_image) == 0:
+            return result
     
-    image_fn_relative = crops_this_image[0]['image_fn_relative']    
     input_fn_abs = os.path.join(input_folder,image_fn_relative)
-    assert os.path.isfile(input_fn_abs)
     
-    detections_to_crop = [c['detection'] for c in crops_this_image]
+    try:
+        
+        image, scale = _load_image_for_crops(input_fn_abs,crops_this_image,options)
+        
+        # crop_info = crops_this_image[0]
+        for crop_info in crops_this_image:
+            
+            assert crop_info['image_fn_relative'] == image_fn_relative
+            crop_filename_relative = crop_info['crop_filename_relative']
+            
+            if options.crop_shape == 'square':
+                cropped_image = crop_image_square(image,crop_info['detection']['bbox'],
+                                                  square_crop=True)
+            else:
+                assert options.crop_shape == 'box', \
+                    'Unrecognized crop shape {}'.format(options.crop_shape)
+                # Ground truth boxes may not have confidence values
+                detection = {'conf':1.0,'bbox':crop_info['detection']['bbox']}
+                cropped_image = crop_image([detection],
+                                           image,
+                                           confidence_threshold=-1,
+                                           expansion=options.expansion * scale)[0]
+            
+            if (cropped_image is None) or (min(cropped_image.size) == 0):
+                print('Warning: skipping empty crop {}'.format(crop_filename_relative))
+                continue
+            
+            if (options.max_crop_size is not None) and \
+               (max(cropped_image.size) > options.max_crop_size):
+                cropped_image = cropped_image.copy()
+                cropped_image.thumbnail((options.max_crop_size,options.max_crop_size),
+                                        Image.LANCZOS)
+            
+            if write_shards:
+                result['crop_data'].append(_encode_crop(cropped_image,options.quality))
+            else:
+                crop_filename_abs = os.path.join(output_folder,crop_filename_relative).replace('\\','/')
+                os.makedirs(os.path.dirname(crop_filename_abs),exist_ok=True)            
+                exif_preserving_save(cropped_image,crop_filename_abs,quality=options.quality)
+            
+            result['crops'].append(crop_filename_relative)
+            
+        # ...for each crop
+        
+    except Exception as e:
+        
+        print('Error cropping {}: {}'.format(input_fn_abs,str(e)))
+        result['error'] = str(e)
+        
+    return result
+
+# ...def _generate_crops_for_single_image(...)
+
+
+#%% Crop generation
+
+def generate_crops(image_fn_relative_to_crops,
+                   input_folder,
+                   output_folder,
+                   options=None):
+    """
+    Generates crops for a set of images, decoding each image once, in parallel.  This 
+    is the crop engine used by create_crop_folder() and classification/crop_detections.py.
+    
+    Args:
+        image_fn_relative_to_crops (dict): maps image filenames (relative to [input_folder]) 
+            to lists of dicts with fields 'image_fn_relative', 'crop_filename_relative' 
+            (relative to [output_folder]), and 'detection' (an MD-formatted detection dict, 
+            only 'bbox' is required)
+        input_folder (str): input image folder
+        output_folder (str): output (cropped) image folder
+        options (CreateCropFolderOptions, optional): crop parameters; options.confidence_threshold
+            is not used here, all crops in [image_fn_relative_to_crops] are generated
+            
+    Returns:
+        list: a list of dicts with fields 'image', 'crops', and 'error', one per image
+        that was processed in this call
+    """
+    
+    if options is None:
+        options = CreateCropFolderOptions()
+    
+    assert options.output_format in ('files','shards'), \
+        'Unrecognized output format {}'.format(options.output_format)
+    
+    os.makedirs(output_folder,exist_ok=True)
+    
     
-    cropped_images = crop_image(detections_to_crop,
-                                input_fn_abs,
-                                confidence_threshold=0,
-                                expansion=options.expansion)
+    ##%% Figure out which crops we need to generate
     
-    assert len(cropped_images) == len(crops_this_image)
+    shard_writer = None
+    crops_written = set()
     
-    # i_crop = 0; crop_info = crops_this_image[0]
-    for i_crop,crop_info in enumerate(crops_this_image):
+    # Maps relative image filenames to manifest records; each record lists all the crops 
+    # written for that image so far, so the last record for each image is sufficient.
+    image_to_manifest_record = {}
+    
+    if options.output_format == 'shards':
+        shard_writer = CropShardWriter(output_folder,
+                                       crops_per_shard=options.crops_per_shard,
+                                       append=(not options.overwrite))
+        crops_written = shard_writer
+    elif (not options.overwrite):
+        image_to_manifest_record = read_jsonl_manifest(options.manifest_file,key_field='image')
+        for record in image_to_manifest_record.values():
+            crops_written.update(record['crops'])
+    
+    crop_lists = []
+    n_crops_skipped = 0
+    
+    for crops_this_image in image_fn_relative_to_crops.values():
+        crops_to_generate = [c for c in crops_this_image if \
+                             c['crop_filename_relative'] not in crops_written]
+        n_crops_skipped += (len(crops_this_image) - len(crops_to_generate))
+        if len(crops_to_generate) > 0:
+            crop_lists.append(crops_to_generate)
+    
+    if n_crops_skipped > 0:
+        print('Skipping {} crops that were already generated'.format(n_crops_skipped))
+    
+    
+    ##%% Generate crops
+    
+    worker_function = partial(_generate_crops_for_single_image,
+                              input_folder=input_folder,
+                              output_folder=output_folder,
+                              options=options)
+    
+    pool = None
+    
+    if options.n_workers <= 1:
         
-        assert crop_info['image_fn_relative'] == image_fn_relative
-        crop_filename_relative = _get_crop_filename(image_fn_relative, crop_info['crop_id'])        
-        crop_filename_abs = os.path.join(output_folder,crop_filename_relative).replace('\\','/')
+        results = (worker_function(crops_this_image) for crops_this_image in crop_lists)
         
-        if os.path.isfile(crop_filename_abs) and not options.overwrite:
-            continue
-         
-        cropped_image = cropped_images[i_crop]            
-        os.makedirs(os.path.dirname(crop_filename_abs),exist_ok=True)            
-        exif_preserving_save(cropped_image,crop_filename_abs,quality=options.quality)
+    else:
+        
+        print('Creating a {} pool with {} workers'.format(options.pool_type,options.n_workers))
+
+        if options.pool_type == 'thread':
+            pool = ThreadPool(options.n_workers)
+        else:
+            assert options.pool_type == 'process'
+            pool = Pool(options.n_workers)
+        
+        results = pool.imap_unordered(worker_function,crop_lists)
+    
+    manifest_f = None
+    if (options.output_format == 'files') and (options.manifest_file is not None):
+        manifest_dir = os.path.dirname(options.manifest_file)
+        if len(manifest_dir) > 0:
+            os.makedirs(manifest_dir,exist_ok=True)
+        manifest_f = open(options.manifest_file,'w' if options.overwrite else 'a')
     
-    # ...for each crop
+    records = []
+    
+    try:
+        
+        for result in tqdm(results,total=len(crop_lists)):
+            
+            if shard_writer is not None:
+                for crop_filename_relative,data in zip(result['crops'],result['crop_data']):
+                    shard_writer.add(crop_filename_relative,data)
+                del result['crop_data']
+                
+            if manifest_f is not None:
+                # Include crops written for this image by previous runs, so this record
+                # can replace the previous one
+                manifest_record = dict(result)
+                if result['image'] in image_to_manifest_record:
+                    previous_crops = image_to_manifest_record[result['image']]['crops']
+                    manifest_record['crops'] = previous_crops + \
+                        [c for c in result['crops'] if c not in previous_crops]
+                manifest_f.write(json.dumps(manifest_record) + '\n')
+                if len(records) % 1000 == 0:
+                    manifest_f.flush()
+            
+            records.append(result)
+            
+        # ...for each image
+        
+    finally:
+        
+        if manifest_f is not None:
+            manifest_f.close()
+        if shard_writer is not None:
+            shard_writer.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    n_errors = sum([r['error'] is not None for r in records])
+    n_crops = sum([len(r['crops']) for r in records])
+    print('Generated {} crops from {} images ({} errors)'.format(
+        n_crops,len(records),n_errors))
+    
+    return records
+
+# ...def generate_crops(...)
 
 
 #%% Main function
@@ -268,7 +545,8 @@ def create_crop_folder(input_file,
         
     ##%% Make a list of crops that we need to create
     
-    # Maps input images to list of dicts, with keys 'crop_id','detection'
+    # Maps input images to list of dicts, with keys 'image_fn_relative','crop_id',
+    # 'crop_filename_relative','detection'
     image_fn_relative_to_crops = defaultdict(list)
     n_crops = 0
     
@@ -288,13 +566,14 @@ def create_crop_folder(input_file,
                             
                 det['crop_id'] = i_detection
                 
+                crop_filename_relative = _get_crop_filename(image_fn_relative, 
+                                                            i_detection)
+                det['crop_filename_relative'] = crop_filename_relative
+                
                 crop_info = {'image_fn_relative':image_fn_relative,
                              'crop_id':i_detection,
+                             'crop_filename_relative':crop_filename_relative,
                              'detection':det}
-                
-                crop_filename_relative = _get_crop_filename(image_fn_relative, 
-                                                            crop_info['crop_id'])
-                det['crop_filename_relative'] = crop_filename_relative
 
                 image_fn_relative_to_crops[image_fn_relative].append(crop_info)
                 n_crops += 1
@@ -306,40 +585,11 @@ def create_crop_folder(input_file,
         
     
     ##%% Generate crops
-        
-    if options.n_workers <= 1:
-                
-        # image_fn_relative = next(iter(image_fn_relative_to_crops))
-        for image_fn_relative in tqdm(image_fn_relative_to_crops.keys()):
-            crops_this_image = image_fn_relative_to_crops[image_fn_relative]            
-            _generate_crops_for_single_image(crops_this_image=crops_this_image,
-                                             input_folder=input_folder,
-                                             output_folder=output_folder,
-                                             options=options)
-                
-    else:
-        
-        print('Creating a {} pool with {} workers'.format(options.pool_type,options.n_workers))
-
-        if options.pool_type == 'thread':
-            pool = ThreadPool(options.n_workers)
-        else:
-            assert options.pool_type == 'process'
-            pool = Pool(options.n_workers)
-        
-        # Each element in this list is the list of crops for a single image
-        crop_lists = list(image_fn_relative_to_crops.values())
-        
-        with tqdm(total=len(image_fn_relative_to_crops)) as pbar:
-            for i,_ in enumerate(pool.imap_unordered(partial(
-                        _generate_crops_for_single_image,
-                            input_folder=input_folder,
-                            output_folder=output_folder,
-                            options=options),
-                        crop_lists)):
-                pbar.update()
-
-    # ...if we're using parallel processing    
+    
+    generate_crops(image_fn_relative_to_crops,
+                   input_folder=input_folder,
+                   output_folder=output_folder,
+                   options=options)
     
     
     ##%% Write output file
@@ -9,6 +9,7 @@ versions of MegaDetector.
 
 #%% Constants and imports
 
+import json
 import random
 import copy
 
@@ -22,7 +23,7 @@ import matplotlib.pyplot as plt
 
 from megadetector.postprocessing.validate_batch_results import \
     validate_batch_results, ValidateBatchResultsOptions
-from megadetector.utils.ct_utils import get_iou, max_none, is_iterable
+from megadetector.utils.ct_utils import get_iou, max_none, is_iterable, invert_dictionary
 
 
 #%% Classes
@@ -109,6 +110,186 @@ class CalibrationResults:
 # ...class CalibrationResults        
 
 
+class MaxConfidenceTable:
+    """
+    Per-image, per-category maximum confidence values for a set of MD results, with sorted
+    arrays that allow threshold queries (e.g. "how many images have a detection above each 
+    of these thresholds?") to be answered with np.searchsorted, rather than with another loop
+    over all detections.  Build this once per results file, then query it as often as you like.
+    
+    Images that failed (i.e., have no "detections" field) are not included.  Images with no 
+    detections (or no detections in the queried categories) have a max confidence of zero.
+    """
+    
+    def __init__(self, results):
+        """
+        Args:
+            results (str or dict): a MD results .json filename, or a loaded results dict
+        """
+        
+        if isinstance(results,str):
+            with open(results,'r') as f:
+                results = json.load(f)
+        
+        #: dict mapping category IDs to category names
+        self.detection_categories = results['detection_categories']
+        
+        #: Category IDs corresponding to columns in [max_conf]
+        self.category_ids = sorted(self.detection_categories.keys())
+        
+        category_id_to_column = {c:i for i,c in enumerate(self.category_ids)}
+        
+        valid_images = [im for im in results['images'] if \
+                        ('detections' in im) and (im['detections'] is not None)]
+        
+        #: Filenames corresponding to rows in [max_conf]
+        self.filenames = [im['file'] for im in valid_images]
+        
+        rows = []
+        columns = []
+        confidence_values = []
+        
+        for i_image,im in enumerate(valid_images):
+            for det in im['detections']:
+                if det['category'] not in category_id_to_column:
+                    # Tolerate categories that aren't in the category table by adding columns
+                    category_id_to_column[det['category']] = len(self.category_ids)
+                    self.category_ids.append(det['category'])
+                rows.append(i_image)
+                columns.append(category_id_to_column[det['category']])
+                confidence_values.append(det['conf'])
+                
+        #: n_images x n_categories array of maximum confidence values; -inf for categories
+        #: with no detections in an image
+        self.max_conf = np.full((len(valid_images),len(self.category_ids)),-np.inf,
+                                dtype=np.float64)
+        np.maximum.at(self.max_conf,
+                      (np.array(rows,dtype=np.int64),np.array(columns,dtype=np.int64)),
+                      np.array(confidence_values,dtype=np.float64))
+        
+        self._category_id_to_column = category_id_to_column
+        self._sorted_values_cache = {}
+        
+    def _columns_for_categories(self, category_ids=None):
+        
+        if category_ids is None:
+            return None
+        if isinstance(category_ids,str):
+            category_ids = [category_ids]
+        return tuple(sorted(set(self._category_id_to_column[c] for c in category_ids \
+                                if c in self._category_id_to_column)))
+        
+    def category_ids_for_names(self, category_names):
+        """
+        Maps a category name (or list of category names) to a list of category IDs.
+        """
+        
+        if isinstance(category_names,str):
+            category_names = [category_names]
+        category_name_to_id = invert_dictionary(self.detection_categories)
+        return [category_name_to_id[category_name] for category_name in category_names]
+    
+    def image_max_confidence_values(self, category_ids=None):
+        """
+        Returns an array with the maximum confidence value for each image, considering 
+        only [category_ids] (a category ID or list of category IDs), or all categories if 
+        [category_ids] is None.  Rows correspond to self.filenames.
+        """
+        
+        columns = self._columns_for_categories(category_ids)
+        if columns is None:
+            if self.max_conf.shape[1] == 0:
+                return np.zeros(self.max_conf.shape[0])
+            max_conf = self.max_conf.max(axis=1)
+        elif len(columns) == 0:
+            return np.zeros(self.max_conf.shape[0])
+        else:
+            max_conf = self.max_conf[:,list(columns)].max(axis=1)
+        
+        # Images with no detections in these categories have a max confidence of zero
+        max_conf[np.isneginf(max_conf)] = 0
+        return max_conf
+    
+    def sorted_max_confidence_values(self, category_ids=None):
+        """
+        Returns the output of image_max_confidence_values(), sorted in ascending order.  
+        Cached for each set of categories.
+        """
+        
+        columns = self._columns_for_categories(category_ids)
+        if columns not in self._sorted_values_cache:
+            self._sorted_values_cache[columns] = \
+                np.sort(self.image_max_confidence_values(category_ids))
+        return self._sorted_values_cache[columns]
+    
+    def n_images_above_threshold(self, thresholds, category_ids=None):
+        """
+        Returns the number of images with a max confidence >= each threshold in [thresholds],
+        which can be a scalar or any array-like.
+        """
+        
+        sorted_values = self.sorted_max_confidence_values(category_ids)
+        return len(sorted_values) - \
+            np.searchsorted(sorted_values,np.asarray(thresholds),side='left')
+    
+    def fraction_above_threshold(self, thresholds, category_ids=None):
+        """
+        Returns the fraction of images with a max confidence >= each threshold in [thresholds].
+        """
+        
+        n_images = self.max_conf.shape[0]
+        assert n_images > 0, 'No valid images in this results set'
+        return self.n_images_above_threshold(thresholds,category_ids) / n_images
+    
+    def thresholds_for_fraction(self, fractions, category_ids=None):
+        """
+        Returns the threshold(s) at which (approximately) the fraction(s) [fractions] of 
+        images have a max confidence at or above the threshold.
+        """
+        
+        sorted_values = self.sorted_max_confidence_values(category_ids)
+        assert len(sorted_values) > 0, 'No valid images in this results set'
+        indices = np.round((1.0 - np.asarray(fractions)) * len(sorted_values)).astype(int)
+        indices = np.clip(indices,0,len(sorted_values)-1)
+        return sorted_values[indices]
+    
+    def precision_recall(self, filename_to_positive, thresholds, category_ids=None):
+        """
+        Computes image-level precision and recall at each threshold in [thresholds], 
+        given image-level ground truth.
+        
+        Args:
+            filename_to_positive (dict): maps filenames to bools indicating whether each image
+                is a positive according to ground truth; images not in this dict are ignored
+            thresholds (array-like): confidence thresholds at which to compute P/R
+            category_ids (list, optional): category IDs to consider (defaults to all categories)
+            
+        Returns:
+            tuple: (precision,recall), each an array the same length as [thresholds]
+        """
+        
+        max_conf = self.image_max_confidence_values(category_ids)
+        gt_mask = np.array([fn in filename_to_positive for fn in self.filenames],dtype=bool)
+        is_positive = np.array([filename_to_positive[fn] for fn in self.filenames if \
+                                fn in filename_to_positive],dtype=bool)
+        max_conf = max_conf[gt_mask]
+        
+        thresholds = np.asarray(thresholds)
+        sorted_positive = np.sort(max_conf[is_positive])
+        sorted_negative = np.sort(max_conf[~is_positive])
+        
+        tp = len(sorted_positive) - np.searchsorted(sorted_positive,thresholds,side='left')
+        fp = len(sorted_negative) - np.searchsorted(sorted_negative,thresholds,side='left')
+        
+        with np.errstate(divide='ignore',invalid='ignore'):
+            precision = np.where((tp + fp) > 0, tp / np.maximum(tp + fp,1), 1.0)
+            recall = tp / max(len(sorted_positive),1)
+            
+        return precision, recall
+        
+# ...class MaxConfidenceTable
+
+
 #%% Calibration functions
 
 def compare_model_confidence_values(json_filename_a,json_filename_b,json_filename_gt=None,options=None):
@@ -232,6 +413,13 @@ def compare_model_confidence_values(json_filename_a,json_filename_b,json_filenam
         im_gt = None
         if gt_data is not None:
             im_gt = image_filename_to_gt_im[fn]
+        
+        # Group above-threshold detections in result set B by category once per image, 
+        # rather than re-scanning all of B's detections for each detection in A
+        category_to_detections_b = defaultdict(list)
+        for det_b in im_b['detections']:
+            if det_b['conf'] >= options.confidence_threshold:
+                category_to_detections_b[det_b['category']].append(det_b)
             
         # For each detection in result set A...
         #
@@ -255,21 +443,13 @@ def compare_model_confidence_values(json_filename_a,json_filename_b,json_filenam
             best_iou_conf = None
             best_bbox_b = None
             
-            # For each detection in result set B...
+            # For each above-threshold detection in result set B in the same category...
             #
-            # det_b = im_b['detections'][0]
-            for det_b in im_b['detections']:
+            # det_b = category_to_detections_b[category_id][0]
+            for det_b in category_to_detections_b.get(category_id,[]):
             
-                # Is this the same category?
-                if det_b['category'] != category_id:
-                    continue
-                
                 conf_b = det_b['conf']
                 
-                # Is this above threshold?
-                if conf_b < options.confidence_threshold:
-                    continue
-                
                 bbox_b = det_b['bbox']
                 
                 iou = get_iou(bbox_a,bbox_b)
@@ -385,6 +565,48 @@ def compare_model_confidence_values(json_filename_a,json_filename_b,json_filenam
 # ...def compare_model_confidence_values(...)
 
 
+def find_equivalent_thresholds_from_matches(calibration_results, thresholds_a, category_ids=None):
+    """
+    Given paired confidence values for matched detections (from compare_model_confidence_values),
+    finds the thresholds for model B that keep the same number of matched detections as 
+    each threshold in [thresholds_a] keeps for model A.  Answers all thresholds in one 
+    sorted-array query.
+    
+    Args:
+        calibration_results (CalibrationResults): output from compare_model_confidence_values
+        thresholds_a (float or array-like): one or more thresholds for model A
+        category_ids (list, optional): category IDs to consider (defaults to all categories)
+        
+    Returns:
+        float or np.ndarray: thresholds for model B, the same shape as [thresholds_a]
+    """
+    
+    matches = calibration_results.calibration_matches
+    if category_ids is not None:
+        if isinstance(category_ids,str):
+            category_ids = [category_ids]
+        category_ids = set(category_ids)
+        matches = [m for m in matches if \
+                   m[CalibrationMatchColumns.COLUMN_CATEGORY_ID] in category_ids]
+    
+    assert len(matches) > 0, 'No matched detections available'
+    
+    conf_a = np.sort(np.array([m[CalibrationMatchColumns.COLUMN_CONF_A] for m in matches]))
+    conf_b = np.sort(np.array([m[CalibrationMatchColumns.COLUMN_CONF_B] for m in matches]))
+    
+    # Number of matched A detections at or above each threshold
+    n_above_a = len(conf_a) - np.searchsorted(conf_a,np.asarray(thresholds_a),side='left')
+    
+    indices = np.clip(len(conf_b) - n_above_a,0,len(conf_b)-1)
+    thresholds_b = conf_b[indices]
+    
+    if np.isscalar(thresholds_a):
+        return float(thresholds_b)
+    return thresholds_b
+
+# ...def find_equivalent_thresholds_from_matches(...)
+
+
 #%% Plotting functions
 
 def plot_matched_confidence_values(calibration_results,output_filename,options=None):
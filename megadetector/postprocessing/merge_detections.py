@@ -20,9 +20,10 @@ import sys
 import json
 import os
 
+from collections import defaultdict
 from tqdm import tqdm
 
-from megadetector.utils.ct_utils import get_iou
+from megadetector.utils.ct_utils import get_iou_matrix
 
 
 #%% Structs
@@ -65,6 +66,111 @@ class MergeDetectionsOptions:
         self.overwrite = False
 
 
+#%% Support functions
+
+def _merge_detections_for_image(source_im,
+                                target_im,
+                                detection_categories,
+                                source_confidence_threshold,
+                                source_detector_name,
+                                options):
+    """
+    Merges detections from the image dict [source_im] into [target_im] (in place).  For each
+    category, computes one IoU matrix between eligible source boxes and above-threshold target 
+    boxes, rather than comparing boxes one pair at a time.
+    """
+    
+    if 'detections' not in source_im or source_im['detections'] is None:
+        return
+    
+    if 'detections' not in target_im or target_im['detections'] is None:
+        return
+            
+    # Group detections by category once per image
+    source_detections_by_category = defaultdict(list)
+    for det in source_im['detections']:
+        source_detections_by_category[det['category']].append(det)
+        
+    target_detections_by_category = defaultdict(list)
+    for det in target_im['detections']:
+        target_detections_by_category[det['category']].append(det)
+      
+    detections_to_transfer = []
+    
+    # detection_category = list(detection_categories)[0]
+    for detection_category in detection_categories:
+        
+        target_detections_this_category = target_detections_by_category.get(detection_category,[])
+        
+        max_target_confidence_this_category = 0.0
+        
+        if len(target_detections_this_category) > 0:
+            max_target_confidence_this_category = max([det['conf'] for \
+              det in target_detections_this_category])
+        
+        # If we have a valid detection in the target file, and we're only merging
+        # into images that have no detections at all, we don't need to review the individual
+        # detections in the source file.
+        if options.merge_empty_only and \
+            (max_target_confidence_this_category >= options.target_confidence_threshold):
+            continue
+        
+        # Only look at above-threshold source boxes within the size range (boxes are x/y/w/h)
+        candidate_detections = [
+            det for det in source_detections_by_category.get(detection_category,[]) if \
+                (det['bbox'][2]*det['bbox'][3] <= options.max_detection_size) and \
+                (det['bbox'][2]*det['bbox'][3] >= options.min_detection_size) and \
+                (det['conf'] >= source_confidence_threshold)
+                ]
+        
+        if len(candidate_detections) == 0:
+            continue
+        
+        # Check only whole images
+        if options.merge_empty_only:
+            
+            # We verified this above, asserting here for clarity
+            assert max_target_confidence_this_category < options.target_confidence_threshold
+            detections_to_transfer_this_category = candidate_detections
+            
+        # Check individual detections
+        else:
+            
+            target_boxes = [det['bbox'] for det in target_detections_this_category if \
+                            det['conf'] >= options.target_confidence_threshold]
+            
+            if len(target_boxes) == 0:
+                detections_to_transfer_this_category = candidate_detections
+            else:
+                # Does each source detection match any existing above-threshold
+                # target category detections?
+                iou_matrix = get_iou_matrix([det['bbox'] for det in candidate_detections],
+                                            target_boxes)
+                matches_existing_box = (iou_matrix >= options.iou_threshold).any(axis=1)
+                detections_to_transfer_this_category = \
+                    [det for i_det,det in enumerate(candidate_detections) if \
+                     not matches_existing_box[i_det]]
+        
+        for det in detections_to_transfer_this_category:
+            det['transferred_from'] = source_detector_name
+            detections_to_transfer.append(det)
+                            
+    # ...for each detection category
+    
+    if len(detections_to_transfer) > 0:
+        
+        detections = target_im['detections']
+        detections.extend(detections_to_transfer)
+
+        # Update the max_detection_conf field (if present)
+        if 'max_detection_conf' in target_im:
+            target_im['max_detection_conf'] = max([d['conf'] for d in detections])
+    
+    # ...if we have any detections to transfer
+
+# ...def _merge_detections_for_image(...)
+
+
 #%% Main function
 
 def merge_detections(source_files,target_file,output_file,options=None):
@@ -81,6 +187,10 @@ def merge_detections(source_files,target_file,output_file,options=None):
     the results of the "target" file.  I.e., the "target" file wins all ties.
     
     The results are written to [output_file].
+    
+    All source files are loaded before merging, and merged in a single pass over the target 
+    images.  Source files are applied in order, so detections transferred from earlier source 
+    files can suppress similar detections from later source files.
 
     """
     
@@ -152,10 +262,15 @@ def merge_detections(source_files,target_file,output_file,options=None):
     else:
         detection_categories = detection_categories_raw
     
+    # Load all the source files up front, so we can merge them in a single pass over
+    # the target images.  Source files are still applied in order, so detections transferred
+    # from earlier source files are visible when merging later source files.
+    sources = []
+    
     # i_source_file = 0; source_file = source_files[i_source_file]
     for i_source_file,source_file in enumerate(source_files):
     
-        print('Processing detections from file {}'.format(source_file))
+        print('Loading detections from file {}'.format(source_file))
         
         with open(source_file,'r') as f:
             source_data = json.load(f)
@@ -171,115 +286,39 @@ def merge_detections(source_files,target_file,output_file,options=None):
         assert source_data['detection_categories'] == output_data['detection_categories'], \
             'Cannot merge files with different detection category maps'
         
-        source_confidence_threshold = options.source_confidence_thresholds[i_source_file]
-        
-        # source_im = source_data['images'][0]
-        for source_im in tqdm(source_data['images']):
-            
-            image_filename = source_im['file']            
-            
+        source_fn_to_image = {}
+        for source_im in source_data['images']:
+            image_filename = source_im['file']
             assert image_filename in fn_to_image, 'Image {} not in target image set'.format(image_filename)
-            target_im = fn_to_image[image_filename]
+            source_fn_to_image[image_filename] = source_im
             
-            if 'detections' not in source_im or source_im['detections'] is None:
-                continue
+        sources.append({'fn_to_image':source_fn_to_image,
+                        'detector_name':source_detector_name,
+                        'confidence_threshold':options.source_confidence_thresholds[i_source_file]})
+        
+    # ...for each source file
+    
+    print('Merging detections from {} source file(s)'.format(len(sources)))
+    
+    # target_im = output_data['images'][0]
+    for target_im in tqdm(output_data['images']):
+        
+        for source in sources:
             
-            if 'detections' not in target_im or target_im['detections'] is None:
+            source_im = source['fn_to_image'].get(target_im['file'])
+            if source_im is None:
                 continue
-                    
-            source_detections_this_image = source_im['detections']
-            target_detections_this_image = target_im['detections']
-              
-            detections_to_transfer = []
-            
-            # detection_category = list(detection_categories)[0]
-            for detection_category in detection_categories:
-                
-                target_detections_this_category = \
-                    [det for det in target_detections_this_image if det['category'] == \
-                     detection_category]
-                
-                max_target_confidence_this_category = 0.0
-                
-                if len(target_detections_this_category) > 0:
-                    max_target_confidence_this_category = max([det['conf'] for \
-                      det in target_detections_this_category])
-                
-                # If we have a valid detection in the target file, and we're only merging
-                # into images that have no detections at all, we don't need to review the individual
-                # detections in the source file.
-                if options.merge_empty_only and \
-                    (max_target_confidence_this_category >= options.target_confidence_threshold):
-                    continue
-                
-                source_detections_this_category_raw = [det for det in \
-                  source_detections_this_image if det['category'] == detection_category]
-                
-                # Boxes are x/y/w/h
-                # source_sizes = [det['bbox'][2]*det['bbox'][3] for det in source_detections_this_category_raw]
-                
-                # Only look at source boxes within the size range
-                source_detections_this_category_filtered = [
-                    det for det in source_detections_this_category_raw if \
-                        (det['bbox'][2]*det['bbox'][3] <= options.max_detection_size) and \
-                        (det['bbox'][2]*det['bbox'][3] >= options.min_detection_size) \
-                        ]
-                           
-                # det = source_detections_this_category_filtered[0]
-                for det in source_detections_this_category_filtered:
-                    
-                    if det['conf'] >= source_confidence_threshold:
-
-                        # Check only whole images
-                        if options.merge_empty_only:
-                            
-                            # We verified this above, asserting here for clarity
-                            assert max_target_confidence_this_category < options.target_confidence_threshold
-                            det['transferred_from'] = source_detector_name
-                            detections_to_transfer.append(det)
-
-                        # Check individual detections                       
-                        else:
-                            
-                            # Does this source detection match any existing above-threshold
-                            # target category detections?
-                            matches_existing_box = False
-                            
-                            # target_detection = target_detections_this_category[0]
-                            for target_detection in target_detections_this_category:
-                                
-                                if (target_detection['conf'] >= options.target_confidence_threshold) \
-                                   and \
-                                   (get_iou(det['bbox'],target_detection['bbox']) >= options.iou_threshold):
-                                    matches_existing_box = True
-                                    break
-                                
-                            if (not matches_existing_box):
-                                det['transferred_from'] = source_detector_name
-                                detections_to_transfer.append(det)
-                    
-                    # ...if this source detection is above the confidence threshold
-                    
-                # ...for each source detection within category                            
-                                    
-            # ...for each detection category
-            
-            if len(detections_to_transfer) > 0:
-                
-                # print('Adding {} detections to image {}'.format(len(detections_to_transfer),image_filename))
-                detections = fn_to_image[image_filename]['detections']                
-                detections.extend(detections_to_transfer)
-
-                # Update the max_detection_conf field (if present)
-                if 'max_detection_conf' in fn_to_image[image_filename]:
-                    fn_to_image[image_filename]['max_detection_conf'] = \
-                        max([d['conf'] for d in detections])
             
-            # ...if we have any detections to transfer
+            _merge_detections_for_image(source_im,
+                                        target_im,
+                                        detection_categories,
+                                        source['confidence_threshold'],
+                                        source['detector_name'],
+                                        options)
             
-        # ...for each image
+        # ...for each source file
         
-    # ...for each source file        
+    # ...for each image
     
     with open(output_file,'w') as f:
         json.dump(output_data,f,indent=1)
@@ -23,8 +23,10 @@ import argparse
 import collections
 import copy
 import errno
+import hashlib
 import io
 import os
+import shutil
 import sys
 import time
 import uuid
@@ -65,6 +67,10 @@ warnings.filterwarnings('ignore', '(Possibly )?corrupt EXIF data', UserWarning)
 DEFAULT_NEGATIVE_CLASSES = ['empty']
 DEFAULT_UNKNOWN_CLASSES = ['unknown', 'unlabeled', 'ambiguous']
 
+# Bump this whenever a change to the rendering code would change the pixels we write, 
+# to invalidate previously-cached rendered images.
+RENDERING_CACHE_VERSION = 1
+
 # Make sure there is no overlap between the two sets, because this will cause
 # issues in the code
 assert not sets_overlap(DEFAULT_NEGATIVE_CLASSES, DEFAULT_UNKNOWN_CLASSES), (
@@ -194,13 +200,24 @@ class PostProcessingOptions:
         self.almost_detection_confidence_threshold = None
     
         #: Enable/disable rendering parallelization    
-        self.parallelize_rendering = False
+        self.parallelize_rendering = True
         
-        #: Number of threads/processes to use for rendering parallelization
-        self.parallelize_rendering_n_cores = 25
+        #: Number of threads/processes to use for rendering parallelization; None uses
+        #: one worker per CPU core
+        self.parallelize_rendering_n_cores = None
         
         #: Whether to use threads (True) or processes (False) for rendering parallelization
-        self.parallelize_rendering_with_threads = True
+        self.parallelize_rendering_with_threads = False
+        
+        #: Should we cache rendered images, so images whose rendering inputs (source file, 
+        #: detections, thresholds, and rendering options) haven't changed since a previous 
+        #: run are linked into the output folder rather than re-rendered?
+        self.cache_rendered_images = True
+        
+        #: Folder in which to cache rendered images; if this is None, defaults to
+        #: [output_dir]/rendered_image_cache.  Point this at a shared folder to re-use 
+        #: rendered images across output folders.
+        self.rendered_image_cache_dir = None
         
         #: When classification results are present, should be sort alphabetically by class name (False)
         #: or in descending order by frequency (True)?
@@ -210,6 +227,11 @@ class PostProcessingOptions:
         #: N images?
         self.max_figures_per_html_file = None
         
+        #: Should we write each page as a lazy-loaded page that adds images as the user
+        #: scrolls, with filtering by category and confidence?  This keeps very large pages
+        #: responsive; max_figures_per_html_file is ignored if this is True.
+        self.lazy_load_html_pages = False
+        
         #: Footer text for the index page
         # self.footer_text = '<br/><p style="font-size:80%;">Preview page created with the <a href="{}">MegaDetector Python package</a>.</p>'.\
         #    format('https://megadetector.readthedocs.io')
@@ -460,72 +482,91 @@ def _render_bounding_boxes(
         else:
             image_full_path = os.path.join(image_base_dir, image_relative_path)
 
-        # os.path.isfile() is slow when mounting remote directories; much faster
-        # to just try/except on the image open.
-        try:
-            image = vis_utils.open_image(image_full_path)
-        except:
-            print('Warning: could not open image file {}'.format(image_full_path))
-            image = None
-            # return ''
-        
         # Render images to a flat folder
         sample_name = res + '_' + path_utils.flatten_path(image_relative_path)
-        fullpath = os.path.join(options.output_dir, res, sample_name)
-
-        if image is not None:
+        
+        # Preprare per-category confidence thresholds
+        if isinstance(options.confidence_threshold,float):
+            rendering_confidence_threshold = options.confidence_threshold
+        else:
+            category_ids = set()
+            for d in detections:
+                category_ids.add(d['category'])
+            rendering_confidence_threshold = {}
+            for category_id in category_ids:
+                rendering_confidence_threshold[category_id] = \
+                    _get_threshold_for_category_id(category_id, options, detection_categories)
+        
+        cached_image_path = None
+        if options.cache_rendered_images:
+            cached_image_path = _get_cached_rendering_path(
+                image_full_path, detections, ground_truth_boxes, rendering_confidence_threshold,
+                detection_categories, classification_categories, options)
+        
+        if (cached_image_path is not None) and (os.path.isfile(cached_image_path)):
             
-            original_size = image.size
-    
-            # Resize the image if necessary
-            if options.viz_target_width is not None:
-                image = vis_utils.resize_image(image, options.viz_target_width)
-    
-            # Render ground truth boxes if necessary
-            if ground_truth_boxes is not None and len(ground_truth_boxes) > 0:
-                
-                # Create class labels like "gt_1" or "gt_27"
-                gt_classes = [0] * len(ground_truth_boxes)
-                label_map = {0:'ground truth'}
-                # for i_box,box in enumerate(ground_truth_boxes):
-                #    gt_classes.append('_' + str(box[-1]))
-                vis_utils.render_db_bounding_boxes(ground_truth_boxes, gt_classes, image,
-                                                   original_size=original_size,label_map=label_map,
-                                                   thickness=4,expansion=4)
-        
-            # Preprare per-category confidence thresholds
-            if isinstance(options.confidence_threshold,float):
-                rendering_confidence_threshold = options.confidence_threshold
-            else:
-                category_ids = set()
-                for d in detections:
-                    category_ids.add(d['category'])
-                rendering_confidence_threshold = {}
-                for category_id in category_ids:
-                    rendering_confidence_threshold[category_id] = \
-                        _get_threshold_for_category_id(category_id, options, detection_categories)
+            sample_name = _write_rendered_image(
+                partial(_link_cached_rendering,cached_image_path),res,sample_name,options)
             
-            # Render detection boxes
-            vis_utils.render_detection_bounding_boxes(
-                detections, image,
-                label_map=detection_categories,
-                classification_label_map=classification_categories,
-                confidence_threshold=rendering_confidence_threshold,
-                classification_confidence_threshold=options.classification_confidence_threshold,
-                thickness=options.line_thickness,
-                expansion=options.box_expansion)
-    
+        else:
+            
+            # os.path.isfile() is slow when mounting remote directories; much faster
+            # to just try/except on the image open.
+            #
+            # JPEGs are decoded at reduced size (or loaded from the thumbnail cache) if we're
+            # going to downsize them anyway.
             try:
-                image.save(fullpath)
-            except OSError as e:
-                # errno.ENAMETOOLONG doesn't get thrown properly on Windows, so
-                # we awkwardly check against a hard-coded limit
-                if (e.errno == errno.ENAMETOOLONG) or (len(fullpath) >= 259):
-                    extension = os.path.splitext(sample_name)[1]
-                    sample_name = res + '_' + str(uuid.uuid4()) + extension
-                    image.save(os.path.join(options.output_dir, res, sample_name))
+                image, original_size = vis_utils.open_image_for_target_size(
+                    image_full_path, options.viz_target_width)
+            except:
+                print('Warning: could not open image file {}'.format(image_full_path))
+                image = None
+                # return ''
+            
+            if image is not None:
+                
+                # Resize the image if necessary
+                if options.viz_target_width is not None:
+                    image = vis_utils.resize_image(image, options.viz_target_width)
+        
+                # Render ground truth boxes if necessary
+                if ground_truth_boxes is not None and len(ground_truth_boxes) > 0:
+                    
+                    # Create class labels like "gt_1" or "gt_27"
+                    gt_classes = [0] * len(ground_truth_boxes)
+                    label_map = {0:'ground truth'}
+                    # for i_box,box in enumerate(ground_truth_boxes):
+                    #    gt_classes.append('_' + str(box[-1]))
+                    vis_utils.render_db_bounding_boxes(ground_truth_boxes, gt_classes, image,
+                                                       original_size=original_size,label_map=label_map,
+                                                       thickness=4,expansion=4)
+            
+                # Render detection boxes
+                vis_utils.render_detection_bounding_boxes(
+                    detections, image,
+                    label_map=detection_categories,
+                    classification_label_map=classification_categories,
+                    confidence_threshold=rendering_confidence_threshold,
+                    classification_confidence_threshold=options.classification_confidence_threshold,
+                    thickness=options.line_thickness,
+                    expansion=options.box_expansion)
+        
+                if cached_image_path is None:
+                    sample_name = _write_rendered_image(image.save,res,sample_name,options)
                 else:
-                    raise
+                    # Write to a temporary file first, so a concurrent worker never sees 
+                    # a partially-written cache entry
+                    os.makedirs(os.path.dirname(cached_image_path),exist_ok=True)
+                    temp_path = os.path.splitext(cached_image_path)[0] + '.' + \
+                        str(uuid.uuid4()) + os.path.splitext(cached_image_path)[1]
+                    image.save(temp_path)
+                    os.replace(temp_path,cached_image_path)
+                    sample_name = _write_rendered_image(
+                        partial(_link_cached_rendering,cached_image_path),res,sample_name,options)
+
+            # ...if we were able to open the image
+            
+        # ...if we did/didn't find this image in the cache
 
     # Use slashes regardless of os
     file_name = '{}/{}'.format(res,sample_name)
@@ -553,6 +594,128 @@ def _render_bounding_boxes(
 # ..._render_bounding_boxes
 
 
+def _get_cached_rendering_path(image_full_path, detections, ground_truth_boxes, 
+                               rendering_confidence_threshold, detection_categories,
+                               classification_categories, options):
+    """
+    Computes the path in the rendered image cache for an image, based on everything that 
+    impacts the rendered pixels: the source path and modification time, the boxes we draw,
+    and the rendering options.  Returns None if the source image can't be stat'd (e.g. if 
+    it's a URL), in which case the image should be rendered without caching.
+    """
+    
+    if image_full_path.startswith(('http://','https://')):
+        return None
+    
+    try:
+        st = os.stat(image_full_path)
+    except OSError:
+        return None
+    
+    key_info = {
+        'version':RENDERING_CACHE_VERSION,
+        'image_full_path':os.path.abspath(image_full_path),
+        'mtime':st.st_mtime,
+        'size':st.st_size,
+        'detections':detections,
+        'ground_truth_boxes':ground_truth_boxes,
+        'confidence_threshold':rendering_confidence_threshold,
+        'classification_confidence_threshold':options.classification_confidence_threshold,
+        'detection_categories':detection_categories,
+        'classification_categories':classification_categories,
+        'viz_target_width':options.viz_target_width,
+        'line_thickness':options.line_thickness,
+        'box_expansion':options.box_expansion
+    }
+    
+    key = hashlib.sha1(json.dumps(key_info,sort_keys=True,default=str).encode('utf-8')).hexdigest()
+    extension = os.path.splitext(image_full_path)[1].lower()
+    
+    cache_dir = options.rendered_image_cache_dir
+    if cache_dir is None:
+        cache_dir = os.path.join(options.output_dir,'rendered_image_cache')
+        
+    return os.path.join(cache_dir, key[0:2], key + extension)
+
+
+def _link_cached_rendering(cached_image_path, output_path):
+    """
+    Makes [output_path] refer to the cached rendered image [cached_image_path], via a hard link
+    if possible, otherwise via a copy.
+    """
+    
+    if os.path.isfile(output_path):
+        if os.path.samefile(cached_image_path,output_path):
+            return
+        os.remove(output_path)
+        
+    try:
+        os.link(cached_image_path,output_path)
+    except OSError as e:
+        if e.errno == errno.ENAMETOOLONG:
+            raise
+        shutil.copyfile(cached_image_path,output_path)
+        
+
+def _write_rendered_image(write_fn, res, sample_name, options):
+    """
+    Calls write_fn(output_path) to write a rendered image to [options.output_dir]/[res]/[sample_name], 
+    falling back to a random filename if that path is too long.  Returns the sample name that
+    was actually used.
+    """
+    
+    fullpath = os.path.join(options.output_dir, res, sample_name)
+    
+    try:
+        write_fn(fullpath)
+    except OSError as e:
+        # errno.ENAMETOOLONG doesn't get thrown properly on Windows, so
+        # we awkwardly check against a hard-coded limit
+        if (e.errno == errno.ENAMETOOLONG) or (len(fullpath) >= 259):
+            extension = os.path.splitext(sample_name)[1]
+            sample_name = res + '_' + str(uuid.uuid4()) + extension
+            write_fn(os.path.join(options.output_dir, res, sample_name))
+        else:
+            raise
+    
+    return sample_name
+
+
+def _create_rendering_pool(options,initializer=None,initargs=()):
+    """
+    Creates the thread or process pool used for rendering, based on the parallelization
+    settings in [options].  [initializer] and [initargs] are passed to the pool, and are
+    run once in each worker.
+    """
+    
+    n_workers = options.parallelize_rendering_n_cores
+    if n_workers is None:
+        n_workers = os.cpu_count()
+        
+    if options.parallelize_rendering_with_threads:
+        pool = ThreadPool(n_workers,initializer=initializer,initargs=initargs)
+        worker_string = 'threads'
+    else:
+        pool = Pool(n_workers,initializer=initializer,initargs=initargs)
+        worker_string = 'processes'
+    print('Rendering images with {} {}'.format(n_workers,worker_string))
+    
+    return pool
+
+
+def _options_for_rendering_workers(options):
+    """
+    Returns a shallow copy of [options] without the fields that rendering workers don't need, 
+    which can be large (e.g. a results table passed in by the caller).  This keeps the 
+    per-task payload small when rendering with a process pool.
+    """
+    
+    rendering_options = copy.copy(options)
+    rendering_options.api_detection_results = None
+    rendering_options.api_other_fields = None
+    return rendering_options
+
+
 def _prepare_html_subpages(images_html, output_dir, options=None):
     """
     Write out a series of html image lists, e.g. the "detections" or "non-detections"
@@ -606,6 +769,7 @@ def _prepare_html_subpages(images_html, output_dir, options=None):
         
         html_image_list_options = {}    
         html_image_list_options['maxFiguresPerHtmlFile'] = options.max_figures_per_html_file
+        html_image_list_options['lazyLoad'] = options.lazy_load_html_pages
         html_image_list_options['headerHtml'] = '<h1>{}</h1>'.format(res.upper())
         html_image_list_options['pageTitle'] = '{}'.format(res.lower())
         
@@ -813,6 +977,9 @@ def _render_image_no_gt(file_info,
         classes_rendered_this_image = set()
         max_conf = 0
         
+        # Category names used for filtering on lazy-loaded pages
+        category_names_this_image = set()
+        
         for det in detections:
             
             if det['conf'] > max_conf:
@@ -824,6 +991,8 @@ def _render_image_no_gt(file_info,
                 _get_threshold_for_category_id(det['category'], options, detection_categories)
             if det['conf'] < detection_threshold:
                 continue
+            
+            category_names_this_image.add(detection_categories[det['category']])
                 
             if ('classifications' in det) and (len(det['classifications']) > 0) and \
                 (res != 'non_detections'):
@@ -833,6 +1002,7 @@ def _render_image_no_gt(file_info,
                 top1_class_id = classifications[0][0]
                 top1_class_name = classification_categories[top1_class_id]
                 top1_class_score = classifications[0][1]
+                category_names_this_image.add(top1_class_name)
 
                 # If we either don't have a classification confidence threshold, or 
                 # we've met our classification confidence threshold
@@ -852,6 +1022,8 @@ def _render_image_no_gt(file_info,
         # ...for each detection
 
         image_result[0][1]['max_conf'] = max_conf
+        image_result[0][1]['confidence'] = max_conf
+        image_result[0][1]['categories'] = sorted(category_names_this_image)
         
     # ...if we got valid rendering info back from _render_bounding_boxes()
     
@@ -942,6 +1114,32 @@ def _render_image_with_gt(file_info,ground_truth_indexed_db,
 
 # ...def _render_image_with_gt()
 
+
+# The ground truth database used by rendering workers, installed once per worker by 
+# _set_worker_ground_truth_db(), so we don't send the whole database with every task
+_worker_ground_truth_db = None
+
+def _set_worker_ground_truth_db(ground_truth_indexed_db):
+    """
+    Pool initializer: stores [ground_truth_indexed_db] for use by 
+    _render_image_with_gt_in_worker().
+    """
+    
+    global _worker_ground_truth_db
+    _worker_ground_truth_db = ground_truth_indexed_db
+
+
+def _render_image_with_gt_in_worker(file_info,detection_categories,
+                                    classification_categories,options):
+    """
+    Calls _render_image_with_gt() with the ground truth database installed in this worker
+    by _set_worker_ground_truth_db().
+    """
+    
+    assert _worker_ground_truth_db is not None, 'Ground truth database not initialized'
+    return _render_image_with_gt(file_info,_worker_ground_truth_db,
+                                 detection_categories,classification_categories,options)
+
     
 #%% Main function
 
@@ -1423,28 +1621,22 @@ def process_batch_results(options):
 
         start_time = time.time()
         if options.parallelize_rendering:
-            if options.parallelize_rendering_n_cores is None:                
-                if options.parallelize_rendering_with_threads:
-                    pool = ThreadPool()
-                else:
-                    pool = Pool()
-            else:
-                if options.parallelize_rendering_with_threads:
-                    pool = ThreadPool(options.parallelize_rendering_n_cores)
-                    worker_string = 'threads'
-                else:
-                    pool = Pool(options.parallelize_rendering_n_cores)
-                    worker_string = 'processes'
-                print('Rendering images with {} {}'.format(options.parallelize_rendering_n_cores,
-                                                           worker_string))
-                
-            rendering_results = list(tqdm(pool.imap(
-                partial(_render_image_with_gt,
-                        ground_truth_indexed_db=ground_truth_indexed_db,
-                        detection_categories=detection_categories,
-                        classification_categories=classification_categories,
-                        options=options), 
-                files_to_render), total=len(files_to_render)))
+            
+            # Send the ground truth database to each worker once, rather than with every image
+            pool = _create_rendering_pool(options,
+                                          initializer=_set_worker_ground_truth_db,
+                                          initargs=(ground_truth_indexed_db,))
+            try:
+                rendering_results = list(tqdm(pool.imap(
+                    partial(_render_image_with_gt_in_worker,
+                            detection_categories=detection_categories,
+                            classification_categories=classification_categories,
+                            options=_options_for_rendering_workers(options)), 
+                    files_to_render), total=len(files_to_render)))
+            finally:
+                pool.close()
+                pool.join()
+                _set_worker_ground_truth_db(None)
         else:
             for file_info in tqdm(files_to_render):
                 rendering_results.append(_render_image_with_gt(
@@ -1675,31 +1867,22 @@ def process_batch_results(options):
         start_time = time.time()
         if options.parallelize_rendering:
             
-            if options.parallelize_rendering_n_cores is None:                
-                if options.parallelize_rendering_with_threads:
-                    pool = ThreadPool()
-                else:
-                    pool = Pool()
-            else:
-                if options.parallelize_rendering_with_threads:
-                    pool = ThreadPool(options.parallelize_rendering_n_cores)
-                    worker_string = 'threads'
-                else:
-                    pool = Pool(options.parallelize_rendering_n_cores)
-                    worker_string = 'processes'
-                print('Rendering images with {} {}'.format(options.parallelize_rendering_n_cores,
-                                                           worker_string))
+            pool = _create_rendering_pool(options)
                 
             # _render_image_no_gt(file_info,detection_categories_to_results_name,
             # detection_categories,classification_categories)
 
-            rendering_results = list(tqdm(pool.imap(
-                partial(_render_image_no_gt, 
-                        detection_categories_to_results_name=detection_categories_to_results_name,
-                        detection_categories=detection_categories,
-                        classification_categories=classification_categories,
-                        options=options),
-                        files_to_render), total=len(files_to_render)))
+            try:
+                rendering_results = list(tqdm(pool.imap(
+                    partial(_render_image_no_gt, 
+                            detection_categories_to_results_name=detection_categories_to_results_name,
+                            detection_categories=detection_categories,
+                            classification_categories=classification_categories,
+                            options=_options_for_rendering_workers(options)),
+                            files_to_render), total=len(files_to_render)))
+            finally:
+                pool.close()
+                pool.join()
         else:
             for file_info in tqdm(files_to_render):
                 rendering_result = _render_image_no_gt(file_info,
@@ -2010,12 +2193,26 @@ def main():
         '--sort_by_confidence', action='store_true',
         help='Sort output in decreasing order by confidence (defaults to sorting by filename)')
     parser.add_argument(
-        '--n_cores', type=int, default=1,
-        help='Number of threads to use for rendering (default: 1)')
+        '--n_cores', type=int, default=None,
+        help='Number of workers to use for rendering (default: one per CPU core, 1 disables ' + \
+             'parallelization)')
+    parser.add_argument(
+        '--parallelize_rendering_with_threads', 
+        action='store_true',
+        help='Should we use threads (instead of processes) for parallelization?')
     parser.add_argument(
         '--parallelize_rendering_with_processes', 
         action='store_true',
-        help='Should we use processes (instead of threads) for parallelization?')
+        help='Use processes for parallelization (this is the default, this flag is retained for ' + \
+             'backwards compatibility)')
+    parser.add_argument(
+        '--rendered_image_cache_dir', 
+        type=str, default=None,
+        help='Folder in which to cache rendered images (defaults to [output_dir]/rendered_image_cache)')
+    parser.add_argument(
+        '--no_rendered_image_cache', 
+        action='store_true',
+        help='Disable caching of rendered images')
     parser.add_argument(
         '--no_separate_detections_by_category', 
         action='store_true',
@@ -2028,6 +2225,11 @@ def main():
         '--max_figures_per_html_file', 
         type=int, default=None,
         help='Maximum number of images to put on a single HTML page')
+    parser.add_argument(
+        '--lazy_load_html_pages', 
+        action='store_true',
+        help='Write pages that load images as you scroll, with filtering by category and ' + \
+             'confidence (recommended for very large result sets)')
     
     if len(sys.argv[1:]) == 0:
         parser.print_help()
@@ -2035,15 +2237,17 @@ def main():
 
     args = parser.parse_args()
     
-    if args.n_cores != 1:
-        assert (args.n_cores > 1), 'Illegal number of cores: {}'.format(args.n_cores)
-        if args.parallelize_rendering_with_processes:
-            args.parallelize_rendering_with_threads = False
-        args.parallelize_rendering = True
-        args.parallelize_rendering_n_cores = args.n_cores        
+    if args.n_cores is not None:
+        assert (args.n_cores >= 1), 'Illegal number of cores: {}'.format(args.n_cores)
+    args.parallelize_rendering = (args.n_cores != 1)
+    args.parallelize_rendering_n_cores = args.n_cores        
 
     args_to_object(args, options)    
 
+    if args.no_rendered_image_cache:
+        options.cache_rendered_images = False
+        
+
     if args.no_separate_detections_by_category:
         options.separate_detections_by_category = False
     
@@ -20,7 +20,6 @@ import sklearn.cluster
 import numpy as np
 import jsonpickle
 import traceback
-import pandas as pd
 import json
 import shutil
 
@@ -300,7 +299,8 @@ class RepeatDetectionResults:
         #: The data table after modification
         self.detectionResultsFiltered = None
     
-        #: dict mapping folder names to whole rows from the data table
+        #: dict mapping folder names to lists of rows from the data table, where each row
+        #: is a plain dict with keys ['file','detections','max_detection_conf','failure']
         self.rowsByDirectory = None
     
         #: dict mapping filenames to rows in the master table
@@ -562,14 +562,15 @@ def _find_matches_in_directory(dirNameAndRows, options):
     "name" is a location name, typically a folder name, though this may be an arbitrary
     location identifier.
     
-    "rows" is a Pandas dataframe with one row per image in this location, with columns:
+    "rows" is a list of dicts with one element per image in this location, with keys:
         
         * 'file': relative file name
         * 'detections': a list of MD detection objects, i.e. dicts with keys ['category','conf','bbox']
         * 'max_detection_conf': maximum confidence of any detection, in any category
+        * 'failure': failure string, or None
     
-    "rows" can also point to a .csv file, in which case the detection table will be read from that
-    .csv file, and results will be written to a .csv file rather than being returned.
+    "rows" can also point to a .json file, in which case the detection table will be read from that
+    .json file, and results will be written to a .json file rather than being returned.
     
     Find all unique detections in this directory.
     
@@ -587,15 +588,14 @@ def _find_matches_in_directory(dirNameAndRows, options):
     dirName = dirNameAndRows[0]    
     rows = dirNameAndRows[1]
     
-    detections_loaded_from_csv_file = None
+    detections_loaded_from_file = None
     
     if isinstance(rows,str):
-        detections_loaded_from_csv_file = rows
+        detections_loaded_from_file = rows
         print('Loading results for location {} from {}'.format(
-            dirName,detections_loaded_from_csv_file))
-        rows = pd.read_csv(detections_loaded_from_csv_file)
-        # Pandas writes out detections out as strings, convert them back to lists
-        rows['detections'] = rows['detections'].apply(lambda s: json.loads(s.replace('\'','"')))
+            dirName,detections_loaded_from_file))
+        with open(detections_loaded_from_file,'r') as f:
+            rows = json.load(f)
         
     if options.maxImagesPerFolder is not None and len(rows) > options.maxImagesPerFolder:
         print('Ignoring directory {} because it has {} images (limit set to {})'.format(
@@ -616,14 +616,14 @@ def _find_matches_in_directory(dirNameAndRows, options):
         
     # For each image in this directory
     #
-    # iDirectoryRow = 0; row = rows.iloc[iDirectoryRow]
+    # iDirectoryRow = 0; row = rows[iDirectoryRow]
     #
-    # iDirectoryRow is a pandas index, so it may not start from zero;
-    # for debugging, we maintain i_iteration as a loop index.
+    # i_iteration is maintained separately from iDirectoryRow for historical reasons 
+    # (this used to iterate over a pandas index that didn't necessarily start from zero).
     i_iteration = -1
     n_boxes_evaluated = 0
     
-    for iDirectoryRow, row in rows.iterrows():
+    for iDirectoryRow, row in enumerate(rows):
 
         i_iteration += 1
         filename = row['file']
@@ -788,9 +788,9 @@ def _find_matches_in_directory(dirNameAndRows, options):
     candidateDetections.sort(
         key=lambda x: x.id, reverse=False)
     
-    if detections_loaded_from_csv_file is not None:
+    if detections_loaded_from_file is not None:
         location_results_file = \
-            os.path.splitext(detections_loaded_from_csv_file)[0] + \
+            os.path.splitext(detections_loaded_from_file)[0] + \
             '_results.json'
         print('Writing results for location {} to {}'.format(
             dirName,location_results_file))
@@ -824,6 +824,15 @@ def _update_detection_table(repeatDetectionResults, options, outputFilename=None
     # Has fields ['file', 'detections','failure'].
     detectionResults = repeatDetectionResults.detectionResults
 
+    # Pull out the columns we need as plain lists; the detection lists are shared with the
+    # table, so modifying them here modifies the table.
+    allDetections = detectionResults['detections'].tolist()
+    allMaxConfs = detectionResults['max_detection_conf'].tolist()
+    if 'failure' in detectionResults.columns:
+        allFailures = detectionResults['failure'].tolist()
+    else:
+        allFailures = [None] * len(detectionResults)
+        
     # An array of length nDirs, where each element is a list of DetectionLocation 
     # objects for that directory that have been flagged as suspicious
     suspiciousDetectionsByDirectory = repeatDetectionResults.suspiciousDetections
@@ -857,8 +866,7 @@ def _update_detection_table(repeatDetectionResults, options, outputFilename=None
 
                 assert instance.filename in repeatDetectionResults.filenameToRow
                 iRow = repeatDetectionResults.filenameToRow[instance.filename]
-                row = detectionResults.iloc[iRow]
-                rowDetections = row['detections']
+                rowDetections = allDetections[iRow]
                 detectionToModify = rowDetections[instance.iDetection]
 
                 # Make sure the bounding box matches
@@ -883,17 +891,16 @@ def _update_detection_table(repeatDetectionResults, options, outputFilename=None
     nProbChangesToNegative = 0
     nProbChangesAcrossThreshold = 0
 
-    for iRow, row in detectionResults.iterrows():
+    for iRow, detections in enumerate(allDetections):
 
-        detections = row['detections']
         if (detections is None) or isinstance(detections,float):
-            assert isinstance(row['failure'],str)
+            assert isinstance(allFailures[iRow],str)
             continue
         
         if len(detections) == 0:
             continue
 
-        maxPOriginal = float(row['max_detection_conf'])
+        maxPOriginal = float(allMaxConfs[iRow])
         
         # No longer strictly true; sometimes I run RDE on RDE output
         # assert maxPOriginal >= 0
@@ -914,7 +921,7 @@ def _update_detection_table(repeatDetectionResults, options, outputFilename=None
         
         # We should only be making detections *less* likely in this process
         assert maxP <= maxPOriginal
-        detectionResults.at[iRow, 'max_detection_conf'] = maxP
+        allMaxConfs[iRow] = maxP
 
         # If there was a meaningful change, count it
         if abs(maxP - maxPOriginal) > 1e-3:
@@ -938,6 +945,8 @@ def _update_detection_table(repeatDetectionResults, options, outputFilename=None
 
     # ...for each row
 
+    detectionResults['max_detection_conf'] = allMaxConfs
+    
     # If we're also writing output...
     if outputFilename is not None and len(outputFilename) > 0:
         write_api_results(detectionResults, repeatDetectionResults.otherFields, 
@@ -985,11 +994,14 @@ def _render_sample_image_for_detection(detection,filteringDir,options):
         
     try:
         
-        im = open_image(inputFullPath)
-        
         # Should we render (typically in a very light color) detections
         # *other* than the one we're highlighting here?
         if options.bRenderOtherDetections:
+            
+            # JPEGs are decoded at reduced size (or loaded from the thumbnail cache) if 
+            # we're going to downsize them anyway
+            im, _ = vis_utils.open_image_for_target_size(inputFullPath,
+                                                         options.maxOutputImageWidth)
                                 
             # Optionally resize the output image
             if (options.maxOutputImageWidth is not None) and \
@@ -1033,6 +1045,7 @@ def _render_sample_image_for_detection(detection,filteringDir,options):
             
         else:
             
+            im = open_image(inputFullPath)
             _render_bounding_box(detection, inputFullPath, outputFullPath,
                 lineWidth=options.lineThickness, expansion=options.boxExpansion)
         
@@ -1193,20 +1206,32 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
 
     ##%% Separate files into locations
 
-    # This will be a map from a directory name to smaller data frames
-    rowsByDirectory = {}
-
+    # Pull the columns we need out of the table once, rather than iterating over rows; 
+    # everything downstream of this point operates on plain lists and dicts.
+    allFiles = detectionResults['file'].tolist()
+    allDetections = detectionResults['detections'].tolist()
+    allMaxConfs = detectionResults['max_detection_conf'].tolist()
+    if 'failure' in detectionResults.columns:
+        allFailures = detectionResults['failure'].tolist()
+    else:
+        allFailures = [None] * len(allFiles)
+        
     # This is a mapping back into the rows of the original table
-    filenameToRow = {}
-
+    filenameToRow = {relativePath:iRow for iRow,relativePath in enumerate(allFiles)}
+    assert len(filenameToRow) == len(allFiles), 'Duplicate filenames in results file'
+    
     print('Separating images into locations...')
 
+    # Map each location name to an integer index, in order of first appearance
+    dirNameToIndex = {}
+    
+    # The location index for each row in the table
+    dirIndexByRow = np.zeros(len(allFiles),dtype=np.int64)
+    
     nCustomDirReplacements = 0
     
-    # iRow = 0; row = detectionResults.iloc[0]
-    for iRow, row in tqdm(detectionResults.iterrows(),total=len(detectionResults)):
-        
-        relativePath = row['file']
+    # iRow = 0; relativePath = allFiles[0]
+    for iRow, relativePath in tqdm(enumerate(allFiles),total=len(allFiles)):
         
         if options.customDirNameFunction is not None:
             basicDirName = os.path.dirname(relativePath.replace('\\','/'))
@@ -1227,26 +1252,33 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
                     dirName = os.path.dirname(dirName)
             assert len(dirName) > 0
 
-        if not dirName in rowsByDirectory:
-            # Create a new DataFrame with just this row
-            # rowsByDirectory[dirName] = pd.DataFrame(row)
-            rowsByDirectory[dirName] = []
+        if dirName not in dirNameToIndex:
+            dirNameToIndex[dirName] = len(dirNameToIndex)
+        dirIndexByRow[iRow] = dirNameToIndex[dirName]
 
-        rowsByDirectory[dirName].append(row)
-
-        assert relativePath not in filenameToRow
-        filenameToRow[relativePath] = iRow
-
-    # ...for each unique detection
+    # ...for each image
     
     if options.customDirNameFunction is not None:
         print('Custom dir name function made {} replacements (of {} images)'.format(
             nCustomDirReplacements,len(detectionResults)))
 
-    # Convert lists of rows to proper DataFrames
-    dirs = list(rowsByDirectory.keys())
-    for d in dirs:
-        rowsByDirectory[d] = pd.DataFrame(rowsByDirectory[d])
+    # Group rows by location with a single stable sort, so rows within each location
+    # stay in their original order
+    sortedRowIndices = np.argsort(dirIndexByRow,kind='stable')
+    rowCountByDir = np.bincount(dirIndexByRow,minlength=len(dirNameToIndex))
+    dirEndIndices = np.cumsum(rowCountByDir)
+    
+    # This will be a map from a directory name to a list of image dicts
+    rowsByDirectory = {}
+    
+    for dirName, iDir in dirNameToIndex.items():
+        dirEnd = dirEndIndices[iDir]
+        dirStart = dirEnd - rowCountByDir[iDir]
+        rowsByDirectory[dirName] = [
+            {'file':allFiles[iRow],
+             'detections':allDetections[iRow],
+             'max_detection_conf':allMaxConfs[iRow],
+             'failure':allFailures[iRow]} for iRow in sortedRowIndices[dirStart:dirEnd]]
 
     toReturn.rowsByDirectory = rowsByDirectory
     toReturn.filenameToRow = filenameToRow
@@ -1352,9 +1384,10 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
                     assert location_name in location_name_to_normalized_location_name
                     normalized_location_name = location_name_to_normalized_location_name[location_name]
                     intermediate_results_file = os.path.join(intermediate_json_file_folder,
-                                                             normalized_location_name + '.csv')
-                    detections_table_this_location = location_info[1]
-                    detections_table_this_location.to_csv(intermediate_results_file,header=True,index=False)
+                                                             normalized_location_name + '.json')
+                    rows_this_location = location_info[1]
+                    with open(intermediate_results_file,'w') as f:
+                        json.dump(rows_this_location,f)
                     dirNameAndIntermediateFile.append((location_name,intermediate_results_file))
                     
                     
@@ -1559,8 +1592,7 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
                 detection.sampleImageRelativeFileName = outputRelativePath                
             
                 iRow = filenameToRow[relativePath]
-                row = detectionResults.iloc[iRow]
-                detection.sampleImageDetections = row['detections']
+                detection.sampleImageDetections = allDetections[iRow]
                 
             # ...for each suspicious detection in this folder
             
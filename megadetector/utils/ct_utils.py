@@ -284,6 +284,42 @@ def get_iou(bb1, bb2):
     return iou
 
 
+def get_iou_matrix(boxes_a, boxes_b):
+    """
+    Calculates the intersection over union (IoU) between every box in [boxes_a] and every 
+    box in [boxes_b], vectorized with numpy.  Uses the same arithmetic as get_iou(), so
+    thresholding the output gives the same results as calling get_iou() on each pair.
+
+    Args:
+        boxes_a (list or np.ndarray): N boxes, each [x_min, y_min, width_of_box, height_of_box]
+        boxes_b (list or np.ndarray): M boxes, each [x_min, y_min, width_of_box, height_of_box]
+
+    Returns:
+        np.ndarray: an N x M array of IoU values in [0, 1]
+    """
+    
+    boxes_a = np.asarray(boxes_a,dtype=np.float64).reshape(-1,4)
+    boxes_b = np.asarray(boxes_b,dtype=np.float64).reshape(-1,4)
+    
+    assert np.all(boxes_a[:,2] > 0) and np.all(boxes_a[:,3] > 0), 'Malformed bounding box'
+    assert np.all(boxes_b[:,2] > 0) and np.all(boxes_b[:,3] > 0), 'Malformed bounding box'
+    
+    # Convert to xyxy
+    x0_a = boxes_a[:,0][:,None]; y0_a = boxes_a[:,1][:,None]
+    x1_a = x0_a + boxes_a[:,2][:,None]; y1_a = y0_a + boxes_a[:,3][:,None]
+    x0_b = boxes_b[:,0][None,:]; y0_b = boxes_b[:,1][None,:]
+    x1_b = x0_b + boxes_b[:,2][None,:]; y1_b = y0_b + boxes_b[:,3][None,:]
+    
+    intersection_w = np.clip(np.minimum(x1_a,x1_b) - np.maximum(x0_a,x0_b),0,None)
+    intersection_h = np.clip(np.minimum(y1_a,y1_b) - np.maximum(y0_a,y0_b),0,None)
+    intersection_area = intersection_w * intersection_h
+    
+    area_a = (x1_a - x0_a) * (y1_a - y0_a)
+    area_b = (x1_b - x0_b) * (y1_b - y0_b)
+    
+    return intersection_area / (area_a + area_b - intersection_area)
+
+
 def _get_max_conf_from_detections(detections):
     """
     Internal function used by get_max_conf(); don't call this directly.
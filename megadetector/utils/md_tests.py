@@ -784,6 +784,16 @@ def run_python_tests(options):
     from megadetector.utils.ct_utils import __module_test__ as ct_utils_test
     ct_utils_test()
     
+    print('\n** Running url_utils module test **\n')
+    
+    from megadetector.utils.url_utils import __module_test__ as url_utils_test
+    url_utils_test()
+    
+    print('\n** Running read_exif module test **\n')
+    
+    from megadetector.data_management.read_exif import __module_test__ as read_exif_test
+    read_exif_test()
+    
     
     ## Import tests
     
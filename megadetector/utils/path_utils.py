@@ -24,6 +24,7 @@ import tarfile
 import webbrowser
 import subprocess
 import re
+import time
 
 from zipfile import ZipFile
 from datetime import datetime
@@ -42,6 +43,231 @@ SEPARATOR_CHARS = r":\/"
 VALID_PATH_CHARS = VALID_FILENAME_CHARS + SEPARATOR_CHARS
 CHAR_LIMIT = 255
 
+#: Number of threads used to enumerate folders in recursive_file_list() and find_images() when 
+#: the caller doesn't specify n_workers; if this is <= 1 and no cache file is in use, these 
+#: functions use os.walk()/glob() as they always have.
+default_folder_scan_workers = 1
+
+#: Folder listing cache used by recursive_file_list() and find_images() when the caller doesn't
+#: specify cache_file; None disables caching.  Setting this once (e.g. at the top of a script)
+#: lets every entry point that enumerates images re-use listings of unchanged folders.
+default_folder_scan_cache_file = None
+
+# Cached folder listings are only trusted if the folder's mtime is at least this many seconds
+# older than the time the listing was made, since file systems with coarse mtime granularity
+# won't register changes made during the same tick as the listing
+folder_scan_cache_mtime_slack_seconds = 2.0
+
+folder_scan_cache_version = 1
+
+
+#%% Parallel folder scanning
+
+def _scan_single_folder(folder, cached_listing=None):
+    """
+    Lists the files and subfolders in [folder] via a single os.scandir() call, or returns
+    [cached_listing] if [folder]'s mtime hasn't changed since that listing was made.
+    
+    Listings are lists of [mtime_ns, scan_time, filenames, subfolder_names, 
+    symlinked_subfolder_names].
+    
+    Returns:
+        tuple: (folder, listing, listing_was_cached); listing is None if [folder] could not 
+        be listed
+    """
+    
+    try:
+        mtime_ns = os.stat(folder).st_mtime_ns
+    except OSError:
+        return folder, None, False
+    
+    if (cached_listing is not None) and (cached_listing[0] == mtime_ns) and \
+       (cached_listing[1] - (mtime_ns / 1e9) > folder_scan_cache_mtime_slack_seconds):
+        return folder, cached_listing, True
+    
+    scan_time = time.time()
+    filenames = []
+    subfolder_names = []
+    symlinked_subfolder_names = []
+    
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    if entry.is_symlink():
+                        symlinked_subfolder_names.append(entry.name)
+                    else:
+                        subfolder_names.append(entry.name)
+                else:
+                    filenames.append(entry.name)
+    except OSError:
+        return folder, None, False
+    
+    return folder, [mtime_ns, scan_time, filenames, subfolder_names, 
+                    symlinked_subfolder_names], False
+
+
+def _is_symlink_cycle(folder,subfolder):
+    """
+    Determines whether [subfolder] (a symlinked child of [folder]) points to [folder] or to one 
+    of its ancestors, i.e. whether following it would recurse forever.
+    """
+    
+    real_folder = os.path.realpath(folder)
+    real_subfolder = os.path.realpath(subfolder)
+    return (real_folder == real_subfolder) or \
+        real_folder.startswith(os.path.join(real_subfolder,''))
+    
+
+def _read_folder_scan_cache(cache_file):
+    """
+    Reads a folder listing cache written by scan_folder_tree(), returning an empty cache
+    if [cache_file] doesn't exist or can't be read.
+    """
+    
+    if (cache_file is not None) and os.path.isfile(cache_file):
+        try:
+            with open(cache_file,'r') as f:
+                d = json.load(f)
+            if d['version'] == folder_scan_cache_version:
+                return d['folders']
+            print('Warning: ignoring folder scan cache {} with version {}'.format(
+                cache_file,d['version']))
+        except Exception as e:
+            print('Warning: could not read folder scan cache {}: {}'.format(cache_file,str(e)))
+    return {}
+
+
+def _write_folder_scan_cache(cache_file,cache):
+    """
+    Writes a folder listing cache, via a temporary file so that interrupted writes don't
+    corrupt an existing cache.
+    """
+    
+    cache_dir = os.path.dirname(os.path.abspath(cache_file))
+    os.makedirs(cache_dir,exist_ok=True)
+    temp_file = cache_file + '.tmp'
+    with open(temp_file,'w') as f:
+        json.dump({'version':folder_scan_cache_version,'folders':cache},f)
+    os.replace(temp_file,cache_file)
+    
+
+def scan_folder_tree(base_dir, recursive=True, n_workers=None, cache_file=None, 
+                     follow_symlinks=False, verbose=False):
+    """
+    Enumerates files (not directories) in [base_dir], using os.scandir() and listing the 
+    folders at each level of the tree concurrently.
+    
+    If [cache_file] is supplied, folder listings are stored there, keyed by absolute folder path.
+    On subsequent calls, each folder is stat'd (rather than listed), and its cached listing is 
+    used if its mtime hasn't changed.  Adding, removing, or renaming files in a folder changes 
+    that folder's mtime, so this only misses modifications to files that already existed, 
+    which don't matter for enumeration.  One cache file can be shared across base folders.
+    
+    Args:
+        base_dir (str): folder to enumerate
+        recursive (bool, optional): enumerate recursively
+        n_workers (int, optional): number of concurrent threads; if this is None, uses 
+            default_folder_scan_workers
+        cache_file (str, optional): .json file in which to cache folder listings
+        follow_symlinks (bool, optional): recurse into symlinked folders (os.walk() doesn't 
+            by default, glob() does), other than links to a folder's own ancestors
+        verbose (bool, optional): enable additional debug output
+        
+    Returns:
+        list: list of filenames (not sorted), using the native path separator and starting 
+        with [base_dir]
+    """
+    
+    assert os.path.isdir(base_dir), '{} is not a folder'.format(base_dir)
+    
+    if n_workers is None:
+        n_workers = default_folder_scan_workers
+        
+    cache = _read_folder_scan_cache(cache_file)
+    updated_cache = {}
+    
+    all_files = []
+    folders_to_scan = [base_dir]
+    n_folders = 0
+    n_cached_folders = 0
+    
+    pool = None
+    if n_workers > 1:
+        pool = ThreadPool(n_workers)
+    
+    try:
+        
+        # Scan one level of the tree at a time
+        while len(folders_to_scan) > 0:
+            
+            folder_keys = [os.path.abspath(folder) for folder in folders_to_scan]
+            cached_listings = [cache.get(k) for k in folder_keys]
+            
+            if pool is not None:
+                results = pool.starmap(_scan_single_folder, zip(folders_to_scan,cached_listings))
+            else:
+                results = [_scan_single_folder(folder,cached_listing) for \
+                           folder,cached_listing in zip(folders_to_scan,cached_listings)]
+            
+            folders_to_scan = []
+            
+            for folder_key,(folder,listing,listing_was_cached) in zip(folder_keys,results):
+                
+                if listing is None:
+                    print('Warning: could not list folder {}'.format(folder))
+                    continue
+                
+                
+                n_folders += 1
+                if listing_was_cached:
+                    n_cached_folders += 1
+                updated_cache[folder_key] = listing
+                
+                all_files.extend([os.path.join(folder,fn) for fn in listing[2]])
+                if recursive:
+                    folders_to_scan.extend([os.path.join(folder,subfolder) for \
+                                            subfolder in listing[3]])
+                    if follow_symlinks:
+                        linked_folders = [os.path.join(folder,subfolder) for \
+                                          subfolder in listing[4]]
+                        folders_to_scan.extend([sf for sf in linked_folders if \
+                                                not _is_symlink_cycle(folder,sf)])
+                    
+            # ...for each folder at this level
+            
+        # ...while we have folders to scan
+            
+    finally:
+        
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    if verbose:
+        print('Enumerated {} files in {} folders ({} listings from cache)'.format(
+            len(all_files),n_folders,n_cached_folders))
+        
+    if (cache_file is not None) and (n_cached_folders < n_folders):
+        
+        # Drop listings for folders under [base_dir] that no longer exist
+        if recursive:
+            base_key = os.path.abspath(base_dir)
+            base_prefix = os.path.join(base_key,'')
+            for k in list(cache.keys()):
+                if (k == base_key or k.startswith(base_prefix)) and (k not in updated_cache):
+                    del cache[k]
+        cache.update(updated_cache)
+        _write_folder_scan_cache(cache_file,cache)
+        
+    return all_files
+
+# ...def scan_folder_tree(...)
+
 
 #%% General path functions
 
@@ -49,7 +275,9 @@ def recursive_file_list(base_dir,
                         convert_slashes=True, 
                         return_relative_paths=False, 
                         sort_files=True,
-                        recursive=True):
+                        recursive=True,
+                        n_workers=None,
+                        cache_file=None):
     r"""
     Enumerates files (not directories) in [base_dir], optionally converting
     backslahes to slashes
@@ -61,8 +289,12 @@ def recursive_file_list(base_dir,
         return_relative_paths (bool, optional): return paths that are relative to [base_dir],
             rather than absolute paths
         sort_files (bool, optional): force files to be sorted, otherwise uses the sorting
-            provided by os.walk()
+            provided by os.walk() (or by scan_folder_tree())
         recursive (bool, optional): enumerate recursively
+        n_workers (int, optional): number of threads to use for enumeration; if this is None, 
+            uses default_folder_scan_workers.  See scan_folder_tree().
+        cache_file (str, optional): folder listing cache file; if this is None, uses 
+            default_folder_scan_cache_file.  See scan_folder_tree().
         
     Returns:
         list: list of filenames
@@ -70,9 +302,17 @@ def recursive_file_list(base_dir,
     
     assert os.path.isdir(base_dir), '{} is not a folder'.format(base_dir)
     
+    if n_workers is None:
+        n_workers = default_folder_scan_workers
+    if cache_file is None:
+        cache_file = default_folder_scan_cache_file
+        
     all_files = []
 
-    if recursive:
+    if (n_workers > 1) or (cache_file is not None):
+        all_files = scan_folder_tree(base_dir,recursive=recursive,n_workers=n_workers,
+                                     cache_file=cache_file)
+    elif recursive:
         for root, _, filenames in os.walk(base_dir):
             for filename in filenames:
                 full_path = os.path.join(root, filename)
@@ -417,7 +657,9 @@ def find_image_strings(strings):
 def find_images(dirname, 
                 recursive=False, 
                 return_relative_paths=False, 
-                convert_slashes=True):
+                convert_slashes=True,
+                n_workers=None,
+                cache_file=None):
     """
     Finds all files in a directory that look like image file names. Returns
     absolute paths unless return_relative_paths is set.  Uses the OS-native
@@ -430,6 +672,10 @@ def find_images(dirname,
         return_relative_paths (str, optional): return paths that are relative
             to [dirname], rather than absolute paths
         convert_slashes (bool, optional): force forward slashes in return values
+        n_workers (int, optional): number of threads to use for enumeration; if this is None, 
+            uses default_folder_scan_workers.  See scan_folder_tree().
+        cache_file (str, optional): folder listing cache file; if this is None, uses 
+            default_folder_scan_cache_file.  See scan_folder_tree().
 
     Returns:
         list: list of image filenames found in [dirname]
@@ -437,7 +683,19 @@ def find_images(dirname,
     
     assert os.path.isdir(dirname), '{} is not a folder'.format(dirname)
     
-    if recursive:
+    if n_workers is None:
+        n_workers = default_folder_scan_workers
+    if cache_file is None:
+        cache_file = default_folder_scan_cache_file
+        
+    if (n_workers > 1) or (cache_file is not None):
+        strings = scan_folder_tree(dirname,recursive=recursive,n_workers=n_workers,
+                                   cache_file=cache_file,follow_symlinks=True)
+        # Match glob() semantics, which skip hidden files and folders
+        n_prefix_chars = len(os.path.join(dirname,''))
+        strings = [fn for fn in strings if not any(token.startswith('.') for token in \
+                   fn[n_prefix_chars:].replace('\\','/').split('/'))]
+    elif recursive:
         strings = glob.glob(os.path.join(dirname, '**', '*.*'), recursive=True)
     else:
         strings = glob.glob(os.path.join(dirname, '*.*'))
@@ -914,6 +1172,82 @@ def parallel_get_file_sizes(filenames,
 # ...def parallel_get_file_sizes(...)
 
 
+#%% Resumable manifest functions
+
+def file_cache_key(filename):
+    """
+    Returns a key that changes whenever [filename] is modified, for validating cached 
+    per-file results (e.g. records in a .jsonl manifest) on subsequent runs.
+    
+    Args:
+        filename (str): the file for which we should compute a key
+        
+    Returns:
+        list: a [mtime_ns,size] list; raises OSError if [filename] can't be stat'd
+    """
+    
+    st = os.stat(filename)
+    return [st.st_mtime_ns,st.st_size]
+
+
+def file_matches_cache_key(filename,key):
+    """
+    Determines whether [filename] is unchanged since [key] was computed by file_cache_key().
+    
+    Args:
+        filename (str): the file to check
+        key (list): a key previously returned by file_cache_key(), or None
+        
+    Returns:
+        bool: True if [key] is not None and [filename] still has the same key, False if
+        the file has changed or can't be stat'd
+    """
+    
+    if key is None:
+        return False
+    try:
+        return file_cache_key(filename) == list(key)
+    except OSError:
+        return False
+
+
+def read_jsonl_manifest(manifest_file,key_field='file',record_filter=None):
+    """
+    Reads a .jsonl manifest (one JSON record per line), typically written incrementally by 
+    a long-running job so it can be resumed.  Later lines take precedence over earlier 
+    lines, and lines that don't parse (typically a partial line at the end of the file from 
+    an interrupted job) are ignored.
+    
+    Args:
+        manifest_file (str): the .jsonl file to read; can be None or a file that doesn't 
+            exist, in which case we return an empty dict
+        key_field (str, optional): the record field to use as the key in the returned dict
+        record_filter (function, optional): a function that takes a record and returns 
+            False for records that should be ignored (e.g. errors, or records created with
+            different parameters)
+            
+    Returns:
+        dict: a dict mapping record[key_field] to records
+    """
+    
+    key_to_record = {}
+    
+    if (manifest_file is None) or (not os.path.isfile(manifest_file)):
+        return key_to_record
+    
+    with open(manifest_file,'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                if (record_filter is not None) and (not record_filter(record)):
+                    continue
+                key_to_record[record[key_field]] = record
+            except Exception:
+                continue
+            
+    return key_to_record
+
+
 #%% Zip functions
 
 def zip_file(input_fn, output_fn=None, overwrite=False, verbose=False, compresslevel=9):
@@ -10,8 +10,10 @@ Frequently-used functions for downloading or manipulating URLs
 
 import os
 import re
+import time
 import urllib
 import tempfile
+import threading
 import requests
 
 from functools import partial
@@ -23,6 +25,20 @@ from multiprocessing.pool import Pool
 url_utils_temp_dir = None
 max_path_len = 255
 
+# Partially-downloaded files are written to [destination_filename][partial_download_suffix],
+# then renamed when the download finishes, so partial downloads can be resumed.
+partial_download_suffix = '.partial'
+
+# Default number of times we retry a failed download, and the delay before the first retry
+# (which doubles after each failure)
+default_download_retries = 3
+default_retry_backoff_seconds = 1.0
+
+download_chunk_size = 1024 * 1024
+
+# Each thread keeps its own requests.Session, so we re-use connections across downloads
+_session_thread_state = threading.local()
+
 
 #%% Download functions
 
@@ -71,12 +87,102 @@ def get_temp_folder(preferred_name='url_utils'):
     return url_utils_temp_dir
     
            
+def _get_session():
+    """
+    Returns the requests.Session associated with the current thread, creating it if necessary.
+    """
+    
+    session = getattr(_session_thread_state,'session',None)
+    if session is None:
+        session = requests.Session()
+        _session_thread_state.session = session
+    return session
+
+
+def _download_to_file(url, destination_filename, progress_updater=None, 
+                      expected_size=None, timeout=None):
+    """
+    Internal function to download [url] to [destination_filename] with a single request
+    (on the current thread's persistent session), via a partial file that gets renamed
+    when the download completes.  If a partial file already exists, requests the remaining
+    bytes via a Range header.
+    """
+    
+    partial_filename = destination_filename + partial_download_suffix
+    
+    resume_offset = 0
+    if os.path.isfile(partial_filename):
+        resume_offset = os.path.getsize(partial_filename)
+    
+    # Ask for the bytes exactly as they're stored on the server; we write the raw stream
+    # without decoding, and Range/Content-Length refer to the encoded bytes.
+    headers = {'Accept-Encoding':'identity'}
+    if resume_offset > 0:
+        headers['Range'] = 'bytes={}-'.format(resume_offset)
+        
+    session = _get_session()
+    
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+    
+        # If the partial file is no longer consistent with the remote file, start over
+        if r.status_code == 416:
+            os.remove(partial_filename)
+            raise IOError('Could not resume download of {}'.format(url))
+        
+        r.raise_for_status()
+        
+        # The server may ignore the Range header and send the whole file
+        if r.status_code == 206:
+            assert resume_offset > 0
+            content_range = r.headers.get('Content-Range','')
+            if not content_range.startswith('bytes {}-'.format(resume_offset)):
+                os.remove(partial_filename)
+                raise IOError('Unexpected range {} when resuming download of {}'.format(
+                    content_range,url))
+            mode = 'ab'
+        else:
+            resume_offset = 0
+            mode = 'wb'
+        
+        total_size = None
+        if 'Content-Length' in r.headers:
+            total_size = resume_offset + int(r.headers['Content-Length'])
+        if expected_size is None:
+            expected_size = total_size
+        
+        n_bytes = resume_offset
+        with open(partial_filename,mode) as f:
+            # Write bytes exactly as they're stored on the server, i.e. don't decode
+            # compressed transfers
+            for chunk in r.raw.stream(download_chunk_size, decode_content=False):
+                f.write(chunk)
+                n_bytes += len(chunk)
+                if progress_updater is not None:
+                    progress_updater(n_bytes // download_chunk_size, download_chunk_size,
+                                     -1 if total_size is None else total_size)
+                
+    if (expected_size is not None) and (n_bytes != expected_size):
+        # We can only resume downloads that are too short
+        if n_bytes > expected_size:
+            os.remove(partial_filename)
+        raise IOError('Size mismatch downloading {}: expected {} bytes, received {}'.format(
+            url,expected_size,n_bytes))
+    
+    os.replace(partial_filename,destination_filename)
+    
+# ...def _download_to_file(...)
+
+
 def download_url(url, 
                  destination_filename=None, 
                  progress_updater=None, 
                  force_download=False, 
                  verbose=True,
-                 escape_spaces=True):
+                 escape_spaces=True,
+                 n_retries=default_download_retries,
+                 retry_backoff_seconds=default_retry_backoff_seconds,
+                 expected_size=None,
+                 timeout=None):
     """
     Downloads a URL to a file.  If no file is specified, creates a temporary file, 
     making a best effort to avoid filename collisions.
@@ -94,6 +200,15 @@ def download_url(url,
             exists.
         verbose (bool, optional): enable additional debug console output
         escape_spaces (bool, optional): replace ' ' with '%20'
+        n_retries (int, optional): number of times to retry a failed download; retries resume
+            from the bytes we've already downloaded, if the server supports Range requests
+        retry_backoff_seconds (float, optional): time to wait before the first retry; doubles
+            after each failure
+        expected_size (int, optional): if not None, the download fails unless the file
+            has exactly this many bytes.  Regardless of this value, we always verify the 
+            size against the Content-Length header, if it's present.
+        timeout (float, optional): timeout in seconds for connecting to or reading from the 
+            server; see requests.get() for precise documentation
         
     Returns:
         str: the filename to which [url] was downloaded, the same as [destination_filename]
@@ -132,8 +247,33 @@ def download_url(url,
         if verbose:
             print('Downloading file {} to {}'.format(os.path.basename(url_no_sas),destination_filename),end='')
         target_dir = os.path.dirname(destination_filename)
-        os.makedirs(target_dir,exist_ok=True)
-        urllib.request.urlretrieve(url, destination_filename, progress_updater)  
+        if len(target_dir) > 0:
+            os.makedirs(target_dir,exist_ok=True)
+        if not url.lower().startswith(('http://','https://')):
+            # Fall back to urllib for non-http URLs (e.g. ftp://, file://)
+            urllib.request.urlretrieve(url, destination_filename, progress_updater)  
+        else:
+            for i_attempt in range(0,n_retries+1):
+                try:
+                    _download_to_file(url, destination_filename, 
+                                      progress_updater=progress_updater,
+                                      expected_size=expected_size,
+                                      timeout=timeout)
+                    break
+                except Exception as e:
+                    if i_attempt == n_retries:
+                        raise
+                    # Don't retry client errors, other than timeouts and rate limiting
+                    if isinstance(e,requests.HTTPError) and (e.response is not None) and \
+                        (400 <= e.response.status_code < 500) and \
+                        (e.response.status_code not in (408,429)):
+                        raise
+                    sleep_time = retry_backoff_seconds * (2 ** i_attempt)
+                    if verbose:
+                        print('\nError downloading {} ({}), retrying in {} seconds'.format(
+                            url_no_sas,str(e),sleep_time))
+                    time.sleep(sleep_time)
+            # ...for each attempt
         assert(os.path.isfile(destination_filename))
         nBytes = os.path.getsize(destination_filename)
         if verbose:
@@ -173,7 +313,8 @@ def download_relative_filename(url, output_base, verbose=False):
 # ...def download_relative_filename(...)
 
 
-def _do_parallelized_download(download_info,overwrite=False,verbose=False):
+def _do_parallelized_download(download_info,overwrite=False,verbose=False,
+                              n_retries=default_download_retries):
     """
     Internal function for download parallelization.
     """
@@ -191,7 +332,9 @@ def _do_parallelized_download(download_info,overwrite=False,verbose=False):
         download_url(url=url, 
                      destination_filename=target_file,
                      verbose=verbose, 
-                     force_download=overwrite)
+                     force_download=overwrite,
+                     n_retries=n_retries,
+                     expected_size=download_info['expected_size'])
     except Exception as e:
         print('Warning: error downloading URL {}: {}'.format(
             url,str(e)))     
@@ -205,12 +348,16 @@ def _do_parallelized_download(download_info,overwrite=False,verbose=False):
 
 
 def parallel_download_urls(url_to_target_file,verbose=False,overwrite=False,
-                           n_workers=20,pool_type='thread'):
+                           n_workers=20,pool_type='thread',n_retries=default_download_retries,
+                           url_to_expected_size=None):
     """
     Downloads a list of URLs to local files.
     
     Catches exceptions and reports them in the returned "results" array.    
     
+    Each worker re-uses a single HTTP session (and therefore its connections) across 
+    downloads, which matters a lot when downloading many small files.
+    
     Args:
         url_to_target_file: a dict mapping URLs to local filenames.
         verbose (bool, optional): enable additional debug console output
@@ -218,6 +365,9 @@ def parallel_download_urls(url_to_target_file,verbose=False,overwrite=False,
         n_workers (int, optional): number of concurrent workers, set to <=1 to disable
             parallelization
         pool_type (str, optional): worker type to use; should be 'thread' or 'process'
+        n_retries (int, optional): number of times to retry each failed download
+        url_to_expected_size (dict, optional): a dict mapping URLs to expected file sizes in
+            bytes; downloads that don't match their expected size are treated as errors
         
     Returns:
         list: list of dicts with keys:
@@ -234,6 +384,9 @@ def parallel_download_urls(url_to_target_file,verbose=False,overwrite=False,
         download_info = {}
         download_info['url'] = url
         download_info['target_file'] = url_to_target_file[url]
+        download_info['expected_size'] = None
+        if url_to_expected_size is not None:
+            download_info['expected_size'] = url_to_expected_size.get(url)
         all_download_info.append(download_info)
         
     print('Downloading {} images on {} workers'.format(
@@ -244,7 +397,8 @@ def parallel_download_urls(url_to_target_file,verbose=False,overwrite=False,
         results = []
         
         for download_info in tqdm(all_download_info):        
-            result = _do_parallelized_download(download_info,overwrite=overwrite,verbose=verbose)
+            result = _do_parallelized_download(download_info,overwrite=overwrite,verbose=verbose,
+                                               n_retries=n_retries)
             results.append(result)
         
     else:
@@ -258,7 +412,8 @@ def parallel_download_urls(url_to_target_file,verbose=False,overwrite=False,
         print('Starting a {} pool with {} workers'.format(pool_type,n_workers))
         
         results = list(tqdm(pool.imap(
-            partial(_do_parallelized_download,overwrite=overwrite,verbose=verbose),
+            partial(_do_parallelized_download,overwrite=overwrite,verbose=verbose,
+                    n_retries=n_retries),
             all_download_info), total=len(all_download_info)))
                 
     return results
@@ -418,3 +573,168 @@ def get_url_sizes(urls,n_workers=1,pool_type='thread',timeout=None,verbose=False
     return url_to_size
 
 # ...get_url_sizes(...)
+
+
+#%% Test driver
+
+def __module_test__():
+    """
+    Module test driver: tests download_url() against a local http.server instance, 
+    including resuming an interrupted download and a server that compresses responses
+    when the client accepts compression.
+    """
+    
+    import gzip
+    import random
+    import shutil
+    import http.server
+    
+    random.seed(0)
+    binary_data = bytes(random.getrandbits(8) for _ in range(300000))
+    text_data = ('The quick brown fox jumps over the lazy dog.\n' * 300).encode()[0:12000]
+    
+    # Requests received by the server, as (path, headers) tuples
+    requests_received = []
+    
+    # Paths for which we've already dropped a connection
+    dropped_paths = set()
+    
+    class _TestRequestHandler(http.server.BaseHTTPRequestHandler):
+        
+        def log_message(self, *args):
+            pass
+        
+        def do_GET(self):
+            
+            path = self.path.split('?')[0]
+            requests_received.append((path,dict(self.headers)))
+            
+            if path == '/text.txt':
+                data = text_data
+                if 'gzip' in self.headers.get('Accept-Encoding',''):
+                    data = gzip.compress(data)
+                    self.send_response(200)
+                    self.send_header('Content-Encoding','gzip')
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length',str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+                
+            if path not in ('/binary.bin','/dropped.bin'):
+                self.send_error(404)
+                return
+            
+            data = binary_data
+            range_header = self.headers.get('Range')
+            if range_header is not None:
+                start = int(range_header.replace('bytes=','').split('-')[0])
+                self.send_response(206)
+                self.send_header('Content-Range','bytes {}-{}/{}'.format(
+                    start,len(data)-1,len(data)))
+                data = data[start:]
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length',str(len(data)))
+            self.end_headers()
+            
+            # Drop the connection halfway through the first request for /dropped.bin
+            if path == '/dropped.bin' and path not in dropped_paths:
+                dropped_paths.add(path)
+                self.wfile.write(data[0:len(data)//2])
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            
+            self.wfile.write(data)
+            
+    # ...class _TestRequestHandler
+    
+    server = http.server.ThreadingHTTPServer(('127.0.0.1',0),_TestRequestHandler)
+    server_thread = threading.Thread(target=server.serve_forever,daemon=True)
+    server_thread.start()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    
+    output_dir = tempfile.mkdtemp(prefix='url_utils_test_')
+    
+    try:
+        
+        ##%% Simple download
+        
+        fn = download_url(base_url + '/binary.bin',os.path.join(output_dir,'binary.bin'),
+                          verbose=False)
+        with open(fn,'rb') as f:
+            assert f.read() == binary_data
+        assert not os.path.isfile(fn + partial_download_suffix)
+        
+        
+        ##%% Resume from an existing partial file
+        
+        fn = os.path.join(output_dir,'resumed.bin')
+        with open(fn + partial_download_suffix,'wb') as f:
+            f.write(binary_data[0:100000])
+        n_requests = len(requests_received)
+        download_url(base_url + '/binary.bin',fn,verbose=False)
+        with open(fn,'rb') as f:
+            assert f.read() == binary_data
+        assert len(requests_received) == n_requests + 1
+        assert requests_received[-1][1]['Range'] == 'bytes=100000-'
+        
+        
+        ##%% Resume after a dropped connection
+        
+        fn = os.path.join(output_dir,'dropped.bin')
+        download_url(base_url + '/dropped.bin',fn,verbose=False,retry_backoff_seconds=0)
+        with open(fn,'rb') as f:
+            assert f.read() == binary_data
+        assert requests_received[-1][0] == '/dropped.bin'
+        assert 'Range' in requests_received[-1][1]
+        
+        
+        ##%% Server that compresses responses
+        
+        fn = download_url(base_url + '/text.txt',os.path.join(output_dir,'text.txt'),
+                          verbose=False)
+        with open(fn,'rb') as f:
+            assert f.read() == text_data
+        assert requests_received[-1][1]['Accept-Encoding'] == 'identity'
+        
+        
+        ##%% Size verification
+        
+        fn = os.path.join(output_dir,'wrong_size.bin')
+        try:
+            download_url(base_url + '/binary.bin',fn,verbose=False,n_retries=0,
+                         expected_size=len(binary_data)+1)
+            raise AssertionError('Size mismatch not detected')
+        except IOError:
+            pass
+        assert not os.path.isfile(fn)
+        
+        
+        ##%% Parallel download
+        
+        url_to_target_file = {}
+        for i_file in range(0,10):
+            url_to_target_file[base_url + '/binary.bin?i={}'.format(i_file)] = \
+                os.path.join(output_dir,'parallel','binary_{}.bin'.format(i_file))
+        url_to_target_file[base_url + '/missing.bin'] = \
+            os.path.join(output_dir,'parallel','missing.bin')
+        
+        results = parallel_download_urls(url_to_target_file,n_workers=4,n_retries=0)
+        for r in results:
+            if r['url'].endswith('missing.bin'):
+                assert r['status'] != 'success'
+            else:
+                assert r['status'] == 'success', r
+                with open(r['target_file'],'rb') as f:
+                    assert f.read() == binary_data
+                    
+    finally:
+        
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(output_dir)
+
+# ...def __module_test__(...)
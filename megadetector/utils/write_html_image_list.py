@@ -8,16 +8,251 @@ shows all those images, with optional one-line headers above each.
 Each "filename" can also be a dict with elements 'filename','title',
 'imageStyle','textStyle', 'linkTarget'
 
+With the 'lazyLoad' option, writes a small page that loads image information from a 
+sidecar file, adds figures to the page as the user scrolls, only loads images that are 
+near the visible part of the page, and supports filtering by category and confidence.  
+This stays responsive for hundreds of thousands of images.
+
 """
 
 #%% Constants and imports
 
 import os
 import math
+import json
 import urllib
 
 from megadetector.utils import path_utils
 
+# Number of figures added to a lazy-loaded page each time the user scrolls near the bottom
+lazy_load_figures_per_batch = 100
+
+# Viewer script for lazy-loaded pages; reads image information from the global
+# "imageListData", defined in the sidecar file
+_lazy_load_viewer_script = """
+(function() {
+
+  var defaults = imageListData.defaults;
+  var images = imageListData.images;
+  var filteredImages = images;
+  var nRendered = 0;
+
+  var container = document.getElementById('image-list');
+  var sentinel = document.getElementById('image-list-sentinel');
+  var categoryFilter = document.getElementById('category-filter');
+  var confidenceFilter = document.getElementById('confidence-filter');
+  var imageCount = document.getElementById('image-count');
+
+  // Populate the category list, and hide filters that don't apply to this page
+  var categories = {};
+  var hasConfidence = false;
+  images.forEach(function(im) {
+    (im.c || []).forEach(function(c) { categories[c] = true; });
+    if (im.p !== undefined) { hasConfidence = true; }
+  });
+  Object.keys(categories).sort().forEach(function(c) {
+    var option = document.createElement('option');
+    option.value = c;
+    option.textContent = c;
+    categoryFilter.appendChild(option);
+  });
+  if (Object.keys(categories).length == 0) {
+    document.getElementById('category-filter-span').style.display = 'none';
+  }
+  if (!hasConfidence) {
+    document.getElementById('confidence-filter-span').style.display = 'none';
+  }
+
+  // Images are loaded when they get close to the viewport, and unloaded (keeping
+  // their size, so the page doesn't jump) when they're far away
+  var imageObserver = new IntersectionObserver(function(entries) {
+    entries.forEach(function(entry) {
+      var img = entry.target;
+      if (entry.isIntersecting) {
+        if (!img.getAttribute('src')) {
+          img.setAttribute('src', img.dataset.src);
+        }
+      } else if (img.getAttribute('src') && img.complete && img.offsetHeight > 0) {
+        img.style.width = img.offsetWidth + 'px';
+        img.style.height = img.offsetHeight + 'px';
+        img.removeAttribute('src');
+      }
+    });
+  }, {rootMargin: '1500px 0px'});
+
+  function renderFigure(im) {
+    var figure = document.createElement('div');
+    if (im.t) {
+      var p = document.createElement('p');
+      p.setAttribute('style', im.ts || defaults.textStyle);
+      p.innerHTML = im.t;
+      figure.appendChild(p);
+    }
+    var img = document.createElement('img');
+    img.setAttribute('style', im.is || defaults.imageStyle);
+    img.dataset.src = im.f;
+    if (im.l) {
+      var a = document.createElement('a');
+      a.href = im.l;
+      a.appendChild(img);
+      figure.appendChild(a);
+    } else {
+      figure.appendChild(img);
+    }
+    imageObserver.observe(img);
+    return figure;
+  }
+
+  function renderMore() {
+    var fragment = document.createDocumentFragment();
+    var end = Math.min(nRendered + FIGURES_PER_BATCH, filteredImages.length);
+    for (; nRendered < end; nRendered++) {
+      fragment.appendChild(renderFigure(filteredImages[nRendered]));
+    }
+    container.appendChild(fragment);
+    // Re-observing forces another callback if the sentinel is still in range
+    sentinelObserver.unobserve(sentinel);
+    if (nRendered < filteredImages.length) {
+      sentinelObserver.observe(sentinel);
+    }
+  }
+
+  var sentinelObserver = new IntersectionObserver(function(entries) {
+    if (entries[0].isIntersecting) {
+      renderMore();
+    }
+  }, {rootMargin: '2000px 0px'});
+
+  function applyFilters() {
+    var category = categoryFilter.value;
+    var minConfidence = parseFloat(confidenceFilter.value);
+    if (isNaN(minConfidence)) { minConfidence = 0; }
+    filteredImages = images.filter(function(im) {
+      if (category && (!im.c || im.c.indexOf(category) < 0)) { return false; }
+      if (minConfidence > 0 && (im.p === undefined || im.p < minConfidence)) { return false; }
+      return true;
+    });
+    imageObserver.disconnect();
+    container.innerHTML = '';
+    nRendered = 0;
+    imageCount.textContent = 'Showing ' + filteredImages.length + ' of ' + images.length + ' images';
+    renderMore();
+  }
+
+  categoryFilter.addEventListener('change', applyFilters);
+  confidenceFilter.addEventListener('change', applyFilters);
+  applyFilters();
+
+})();
+"""
+
+
+#%% Support functions
+
+def _prepare_image_for_output(image,options):
+    """
+    Returns the (title, filename, linkTarget) strings to write for the image dict [image], 
+    with non-ASCII characters removed and filenames/links URL-encoded as specified in 
+    [options].
+    """
+    
+    title = image['title']
+    filename = image['filename']
+    linkTarget = image['linkTarget']
+    
+    # Remove unicode characters
+    title = title.encode('ascii','ignore').decode('ascii')
+    filename = filename.encode('ascii','ignore').decode('ascii')
+    
+    filename = filename.replace('\\','/')
+    if options['urlEncodeFilenames']:            
+        filename = urllib.parse.quote(filename)
+    
+    linkTarget = linkTarget.replace('\\','/')
+    if options['urlEncodeLinkTargets']:
+        # These are typically absolute paths, so we only want to mess with certain characters
+        linkTarget = urllib.parse.quote(linkTarget,safe=':/')
+        
+    return title, filename, linkTarget
+
+
+def _write_lazy_html_image_list(filename,images,options):
+    """
+    Writes a lazy-loaded HTML page for [images] to [filename], with image information 
+    stored in a sidecar .js file next to [filename].  [images] should already be normalized 
+    to a list of dicts.
+    """
+    
+    sidecar_filename = os.path.splitext(filename)[0] + '_images.js'
+    
+    # Styles are only stored for images whose styles differ from the defaults
+    defaults = {'imageStyle':options['defaultImageStyle'],
+                'textStyle':options['defaultTextStyle']}
+    
+    # Image information is stored as JSON in a .js file (rather than a .json file), so
+    # the page works when it's opened directly from disk, where browsers don't allow
+    # pages to load .json files.
+    with open(sidecar_filename,'w') as f:
+        
+        f.write('var imageListData = {{"defaults":{},"images":[\n'.format(json.dumps(defaults)))
+        
+        for iImage,image in enumerate(images):
+            
+            title, image_filename, linkTarget = _prepare_image_for_output(image,options)
+            
+            # Keys are abbreviated to keep the sidecar file small
+            record = {'f':image_filename}
+            if len(title) > 0:
+                record['t'] = title
+            if len(linkTarget) > 0:
+                record['l'] = linkTarget
+            if image['imageStyle'] != defaults['imageStyle']:
+                record['is'] = image['imageStyle']
+            if image['textStyle'] != defaults['textStyle']:
+                record['ts'] = image['textStyle']
+            if 'categories' in image and image['categories'] is not None:
+                record['c'] = list(image['categories'])
+            if 'confidence' in image and image['confidence'] is not None:
+                record['p'] = round(float(image['confidence']),4)
+            
+            f.write(json.dumps(record,separators=(',',':')))
+            if iImage != len(images)-1:
+                f.write(',')
+            f.write('\n')
+            
+        f.write(']};\n')
+    
+    titleString = ''
+    if len(options['pageTitle']) > 0:
+        titleString = '<title>{}</title>'.format(options['pageTitle'])
+        
+    filterStyle = 'font-family:calibri,verdana,arial;margin-top:5px;margin-bottom:10px;'
+    
+    with open(filename,'w') as f:
+        
+        f.write('<html><head>{}<meta charset="utf-8"></head><body>\n'.format(titleString))
+        f.write(options['headerHtml'])
+        f.write('<div style="{}">\n'.format(filterStyle))
+        f.write('<span id="category-filter-span">Category: <select id="category-filter">' + \
+                '<option value="">(all)</option></select>&nbsp;&nbsp;</span>\n')
+        f.write('<span id="confidence-filter-span">Minimum confidence: ' + \
+                '<input id="confidence-filter" type="number" min="0" max="1" step="0.05" ' + \
+                'value="0">&nbsp;&nbsp;</span>\n')
+        f.write('<span id="image-count"></span>\n')
+        f.write('</div>\n')
+        f.write('<div id="image-list"></div>\n')
+        f.write('<div id="image-list-sentinel"></div>\n')
+        f.write(options['trailerHtml'])
+        f.write('<script src="{}"></script>\n'.format(
+            urllib.parse.quote(os.path.basename(sidecar_filename))))
+        f.write('<script>\n')
+        f.write(_lazy_load_viewer_script.replace('FIGURES_PER_BATCH',
+                                                 str(lazy_load_figures_per_batch)))
+        f.write('</script>\n')
+        f.write('</body></html>\n')
+
+# ...def _write_lazy_html_image_list(...)
+
 
 #%% write_html_image_list
 
@@ -38,6 +273,8 @@ def write_html_image_list(filename=None,images=None,options=None):
             - textStyle (css style for the title associated with this image)
             - title (text label for this image)
             - linkTarget (URL to which this image should link on click)
+            - categories (list of category names, used for filtering when lazyLoad is True)
+            - confidence (float, used for filtering when lazyLoad is True)
             
         options (dict, optional): a dict with one or more of the following fields:        
             
@@ -52,6 +289,9 @@ def write_html_image_list(filename=None,images=None,options=None):
               multiple files and a TOC with links)
             - urlEncodeFilenames (default True, e.g. '#' will be replaced by '%23')
             - urlEncodeLinkTargets (default True, e.g. '#' will be replaced by '%23')
+            - lazyLoad (default False): write a single page that adds figures as the user
+              scrolls and only loads nearby images, with image information in a sidecar
+              .js file; maxFiguresPerHtmlFile is ignored in this case
             
     """
     
@@ -93,6 +333,9 @@ def write_html_image_list(filename=None,images=None,options=None):
     if 'maxFiguresPerHtmlFile' not in options or options['maxFiguresPerHtmlFile'] is None:
         options['maxFiguresPerHtmlFile'] = math.inf    
     
+    if 'lazyLoad' not in options or options['lazyLoad'] is None:
+        options['lazyLoad'] = False
+    
     if filename is None or images is None:
         return options
     
@@ -116,6 +359,15 @@ def write_html_image_list(filename=None,images=None,options=None):
     
     nImages = len(images)
     
+    # Lazy-loaded pages don't need to be broken up
+    if options['lazyLoad']:
+        
+        if options['fHtml'] != -1:
+            raise ValueError(
+                    "You can't supply your own file handle when writing a lazy-loaded page")
+        _write_lazy_html_image_list(filename,images,options)
+        return options
+    
     # If we need to break this up into multiple files...
     if nImages > options['maxFiguresPerHtmlFile']:
     
@@ -192,30 +444,15 @@ def write_html_image_list(filename=None,images=None,options=None):
     # Write out images
     for iImage,image in enumerate(images):
         
-        title = image['title']
         imageStyle = image['imageStyle']
         textStyle = image['textStyle']
-        filename = image['filename']
-        linkTarget = image['linkTarget']
-        
-        # Remove unicode characters
-        title = title.encode('ascii','ignore').decode('ascii')
-        filename = filename.encode('ascii','ignore').decode('ascii')
-        
-        filename = filename.replace('\\','/')
-        if options['urlEncodeFilenames']:            
-            filename = urllib.parse.quote(filename)
+        title, filename, linkTarget = _prepare_image_for_output(image,options)
         
         if len(title) > 0:       
             fHtml.write(
                     '<p style="{}">{}</p>\n'\
                     .format(textStyle,title))            
 
-        linkTarget = linkTarget.replace('\\','/')
-        if options['urlEncodeLinkTargets']:
-            # These are typically absolute paths, so we only want to mess with certain characters
-            linkTarget = urllib.parse.quote(linkTarget,safe=':/')
-            
         if len(linkTarget) > 0:
             fHtml.write('<a href="{}">'.format(linkTarget))
             # imageStyle.append(';border:0px;')
@@ -91,10 +91,11 @@ def render_images_with_thumbnails(
     assert primary_image_location in ['left','right']
     
     # Load primary image and resize to desired width
-    primary_image = vis_utils.load_image(primary_image_filename)
     if primary_image_width is not None:
-        primary_image = vis_utils.resize_image(primary_image, primary_image_width, 
-                                               target_height=-1)
+        primary_image = vis_utils.resize_image(primary_image_filename, primary_image_width, 
+                                               target_height=-1, use_thumbnail_cache=True)
+    else:
+        primary_image = vis_utils.load_image(primary_image_filename)
 
     # Compute the number of grid elements for the secondary images
     # to best fit the available aspect ratio
@@ -9,23 +9,32 @@ Rendering functions shared across visualization scripts
 #%% Constants and imports
 
 import time
+import json
+import math
+import uuid
+import hashlib
+import struct
+import threading
 import numpy as np
 import requests
 import os
 import cv2
 
 from io import BytesIO
-from PIL import Image, ImageFile, ImageFont, ImageDraw, ImageFilter
+from PIL import Image, ImageFile, ImageFont, ImageDraw, ImageFilter, ImageColor
 from multiprocessing.pool import ThreadPool
 from multiprocessing.pool import Pool
 from tqdm import tqdm
 from functools import partial
 
 from megadetector.utils.path_utils import find_images
+from megadetector.utils.path_utils import file_cache_key, file_matches_cache_key, \
+    read_jsonl_manifest
 from megadetector.data_management.annotations import annotation_constants
 from megadetector.data_management.annotations.annotation_constants import \
     detector_bbox_category_id_to_name
 from megadetector.utils.ct_utils import sort_list_of_dicts_by_key
+from megadetector.data_management.read_exif import read_image_header
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -59,6 +68,21 @@ retry_sleep_time = 0.01
 # we'll retry, otherwise it's just an error.
 error_names_for_retry = ['ConnectionError']
 
+# Format version for the image size cache used by parallel_get_image_sizes()
+image_size_cache_version = 1
+
+# Folder for the on-disk cache of downsized images shared by rendering tools (see 
+# open_image()), or None to disable the cache.  Defaults to the environment variable
+# MEGADETECTOR_THUMBNAIL_CACHE_DIR, so all the tools in a review workflow can share a 
+# cache without additional configuration.
+thumbnail_cache_dir = os.environ.get('MEGADETECTOR_THUMBNAIL_CACHE_DIR', None)
+
+# Sizes (in pixels, along the long side of the image) stored in the thumbnail cache
+thumbnail_cache_sizes = (256, 512, 1024, 2048)
+
+# JPEG quality used for images in the thumbnail cache
+thumbnail_cache_quality = 90
+
 DEFAULT_BOX_THICKNESS = 4
 DEFAULT_LABEL_FONT_SIZE = 16
 
@@ -93,7 +117,8 @@ DEFAULT_COLORS = [
 
 #%% Functions
 
-def open_image(input_file, ignore_exif_rotation=False):
+def open_image(input_file, ignore_exif_rotation=False, min_size=None, 
+               use_thumbnail_cache=False):
     """
     Opens an image in binary format using PIL.Image and converts to RGB mode.
     
@@ -108,11 +133,27 @@ def open_image(input_file, ignore_exif_rotation=False):
             that PIL can open), a URL, or an image as a stream of bytes
         ignore_exif_rotation (bool, optional): don't rotate the loaded pixels,
             even if we are loading a JPEG and that JPEG says it should be rotated
+        min_size (tuple, optional): if this is not None and the image is a JPEG, allows
+            PIL to decode the image at a reduced size (1/2, 1/4, or 1/8 scale), as long as 
+            the result is at least min_size (a (w,h) tuple, after EXIF rotation) in each 
+            dimension.  This is much faster than decoding the full image and resizing
+            it, when a small version of the image is all you need.
+        use_thumbnail_cache (bool, optional): if this is True, [min_size] is not None, 
+            [input_file] is a local file, and thumbnail_cache_dir is set, returns the 
+            smallest cached version of the image that is at least [min_size] (creating
+            cache entries if necessary).  Cached images are already rotated and don't
+            include EXIF data.
 
     Returns:
         PIL.Image.Image: A PIL Image object in RGB mode
     """
     
+    if use_thumbnail_cache and (min_size is not None) and (thumbnail_cache_dir is not None) \
+        and isinstance(input_file, str) and (not input_file.startswith(('http://', 'https://'))):
+        image = _open_image_from_thumbnail_cache(input_file, ignore_exif_rotation, min_size)
+        if image is not None:
+            return image
+    
     if (isinstance(input_file, str)
             and input_file.startswith(('http://', 'https://'))):
         try:
@@ -142,6 +183,19 @@ def open_image(input_file, ignore_exif_rotation=False):
     else:
         image = Image.open(input_file)
     
+    # This has to happen before anything forces the image to be decoded
+    if (min_size is not None) and (image.format == 'JPEG'):
+        min_w = min_size[0]; min_h = min_size[1]
+        if not ignore_exif_rotation:
+            try:
+                orientation = image.getexif().get(274, None)
+                # 90- and 270-degree rotations swap width and height
+                if orientation in (6,8):
+                    min_w, min_h = min_h, min_w
+            except Exception:
+                pass
+        image.draft(image.mode,(min_w,min_h))
+        
     # Convert to RGB if necessary
     if image.mode not in ('RGBA', 'RGB', 'L', 'I;16'):
         raise AttributeError(
@@ -227,7 +281,8 @@ def exif_preserving_save(pil_image,output_file,quality='keep',default_quality=85
 # ...def exif_preserving_save(...)
 
 
-def load_image(input_file, ignore_exif_rotation=False):
+def load_image(input_file, ignore_exif_rotation=False, min_size=None,
+               use_thumbnail_cache=False):
     """
     Loads an image file.  This is the non-lazy version of open_file(); i.e., 
     it forces image decoding before returning.
@@ -237,18 +292,168 @@ def load_image(input_file, ignore_exif_rotation=False):
             that PIL can open), a URL, or an image as a stream of bytes
         ignore_exif_rotation (bool, optional): don't rotate the loaded pixels,
             even if we are loading a JPEG and that JPEG says it should be rotated
+        min_size (tuple, optional): allow reduced-size decoding of JPEG images, as long
+            as the result is at least this large; see open_image()
+        use_thumbnail_cache (bool, optional): allow the image to be loaded from the 
+            thumbnail cache; see open_image()
 
     Returns: 
         PIL.Image.Image: a PIL Image object in RGB mode
     """
     
-    image = open_image(input_file, ignore_exif_rotation=ignore_exif_rotation)
+    image = open_image(input_file, ignore_exif_rotation=ignore_exif_rotation,
+                       min_size=min_size, use_thumbnail_cache=use_thumbnail_cache)
     image.load()
     return image
 
 
+def open_image_for_target_size(input_file, target_width=-1, target_height=-1,
+                               ignore_exif_rotation=False):
+    """
+    Opens an image that the caller is about to resize to (target_width,target_height) (see 
+    resize_image() for how -1 values are handled), decoding JPEGs at a reduced size when the 
+    result is still at least as large as the target size.  Resizing the result looks the same
+    as resizing the full-resolution image, but decoding is several times faster for large 
+    images.
+    
+    Reduced-size decoding is only used for local files; URLs are opened at full resolution.
+    If thumbnail_cache_dir is set, the image is loaded from (or added to) the thumbnail
+    cache.
+    
+    Args:
+        input_file (str or BytesIO): can be a path to an image file (anything
+            that PIL can open), a URL, or an image as a stream of bytes
+        target_width (int, optional): width to which the caller will resize this image, or -1
+        target_height (int, optional): height to which the caller will resize this image, or -1
+        ignore_exif_rotation (bool, optional): don't rotate the loaded pixels,
+            even if we are loading a JPEG and that JPEG says it should be rotated
+    
+    Returns:
+        tuple: (image, original_size), where [image] is a PIL Image in RGB mode, and
+        [original_size] is the (w,h) size of the full-resolution image (after EXIF rotation), 
+        which may be larger than image.size
+    """
+    
+    if target_width is None:
+        target_width = -1
+    if target_height is None:
+        target_height = -1
+        
+    original_size = None
+    
+    if (target_width > 0 or target_height > 0) and isinstance(input_file,str) and \
+        (not input_file.startswith(('http://', 'https://'))):
+        original_size = _get_image_size_from_header(input_file)
+        
+    if original_size is None:
+        image = open_image(input_file, ignore_exif_rotation=ignore_exif_rotation)
+        return image, image.size
+    
+    # PIL picks the smallest scale that's at least this large in both dimensions
+    min_size = (max(target_width,1), max(target_height,1))
+    image = open_image(input_file, ignore_exif_rotation=ignore_exif_rotation,
+                       min_size=min_size, use_thumbnail_cache=True)
+    
+    # The size in the file header doesn't reflect EXIF rotation
+    w,h = image.size
+    if abs(w*original_size[0] - h*original_size[1]) < abs(w*original_size[1] - h*original_size[0]):
+        original_size = (original_size[1],original_size[0])
+        
+    return image, tuple(original_size)
+
+# ...def open_image_for_target_size(...)
+
+
+def _get_thumbnail_cache_path(input_file, cache_size, ignore_exif_rotation):
+    """
+    Returns the path of [input_file] in the thumbnail cache at size [cache_size].  Cache 
+    entries are keyed on the absolute path, modification time, and size of the source image, 
+    so modified images are never served from the cache.
+    """
+    
+    st = os.stat(input_file)
+    key = '{}|{}|{}|{}'.format(os.path.abspath(input_file), st.st_mtime_ns, st.st_size,
+                               ignore_exif_rotation)
+    key_hash = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(thumbnail_cache_dir, key_hash[0:2], 
+                        '{}_{}.jpg'.format(key_hash, cache_size))
+
+
+def _open_image_from_thumbnail_cache(input_file, ignore_exif_rotation, min_size):
+    """
+    Returns the smallest cached version of [input_file] that's at least [min_size], 
+    creating it (and all smaller sizes, from a single decode) if necessary.  Returns None
+    if the cache can't satisfy this request, e.g. if [min_size] is close to the full 
+    image size.
+    """
+    
+    try:
+        
+        full_size = _get_image_size_from_header(input_file)
+        if full_size is None:
+            return None
+        
+        # We don't know whether EXIF rotation swaps the width and height until we've opened
+        # the image, so choose a size that's large enough in either orientation
+        required_long_side = max(min_size) * max(full_size) / min(full_size)
+        
+        cache_size = None
+        for size in sorted(thumbnail_cache_sizes):
+            if size >= required_long_side:
+                cache_size = size
+                break
+        if (cache_size is None) or (cache_size >= max(full_size)):
+            return None
+        
+        cache_path = _get_thumbnail_cache_path(input_file, cache_size, ignore_exif_rotation)
+        
+        if os.path.isfile(cache_path):
+            image = Image.open(cache_path)
+            image.load()
+            return image
+        
+        # Decode the source image once, at reduced size if possible, then write this size and 
+        # each smaller size, resizing from the next-larger size
+        min_short_side = math.ceil(min(full_size) * cache_size / max(full_size))
+        image = load_image(input_file, ignore_exif_rotation=ignore_exif_rotation,
+                           min_size=(min_short_side, min_short_side))
+        
+        result = None
+        
+        for size in sorted([s for s in thumbnail_cache_sizes if s <= cache_size], reverse=True):
+            
+            scale = size / max(image.size)
+            if scale < 1:
+                image = image.resize((max(1, round(image.size[0] * scale)), 
+                                      max(1, round(image.size[1] * scale))),
+                                     Image.LANCZOS)
+            if result is None:
+                result = image
+                
+            output_path = _get_thumbnail_cache_path(input_file, size, ignore_exif_rotation)
+            if not os.path.isfile(output_path):
+                # Write to a temporary file first, so a concurrent reader never sees a 
+                # partially-written cache entry
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                temp_path = output_path + '.' + str(uuid.uuid4()) + '.tmp'
+                image.save(temp_path, format='JPEG', quality=thumbnail_cache_quality)
+                os.replace(temp_path, output_path)
+        
+        # ...for each cache size
+        
+        return result
+    
+    except Exception as e:
+        
+        print('Warning: thumbnail cache error for {}: {}'.format(input_file, str(e)))
+        return None
+
+# ...def _open_image_from_thumbnail_cache(...)
+
+
 def resize_image(image, target_width=-1, target_height=-1, output_file=None,
-                 no_enlarge_width=False, verbose=False, quality='keep'):
+                 no_enlarge_width=False, verbose=False, quality='keep',
+                 use_thumbnail_cache=False):
     """
     Resizes a PIL Image object to the specified width and height; does not resize
     in place. If either width or height are -1, resizes with aspect ratio preservation.
@@ -272,6 +477,9 @@ def resize_image(image, target_width=-1, target_height=-1, output_file=None,
             but will write to output_file if supplied
         verbose (bool, optional): enable additional debug output
         quality (str or int, optional): passed to exif_preserving_save, see docs for more detail
+        use_thumbnail_cache (bool, optional): if [image] is a filename, decode it at reduced size
+            and/or load it from the thumbnail cache (see open_image()) when that's still large
+            enough for the target size; cached images don't include EXIF data
         
     returns:
         PIL.Image.Image: the resized image, which may be the original image if no resizing is 
@@ -281,7 +489,13 @@ def resize_image(image, target_width=-1, target_height=-1, output_file=None,
     image_fn = 'in_memory'
     if isinstance(image,str):
         image_fn = image
-        image = load_image(image)
+        min_size = None
+        if use_thumbnail_cache:
+            min_width = target_width if target_width is not None else -1
+            min_height = target_height if target_height is not None else -1
+            if min_width > 0 or min_height > 0:
+                min_size = (max(min_width,1),max(min_height,1))
+        image = load_image(image, min_size=min_size, use_thumbnail_cache=use_thumbnail_cache)
         
     if target_width is None:
         target_width = -1
@@ -468,7 +682,8 @@ def render_detection_bounding_boxes(detections,
                                     label_font_size=DEFAULT_LABEL_FONT_SIZE,
                                     custom_strings=None,
                                     box_sort_order='confidence',
-                                    verbose=False):
+                                    verbose=False,
+                                    rendering_context=None):
     """
     Renders bounding boxes (with labels and confidence values) on an image for all
     detections above a threshold.
@@ -549,6 +764,8 @@ def render_detection_bounding_boxes(detections,
         box_sort_order (str, optional): sorting scheme for detection boxes, can be None, "confidence", or 
             "reverse_confidence".
         verbose (bool, optional): enable additional debug output
+        rendering_context (RenderingContext, optional): cached fonts and text sizes; defaults
+            to a context shared by all rendering functions
     """
 
     # Input validation
@@ -673,7 +890,8 @@ def render_detection_bounding_boxes(detections,
                                  display_strs=display_strs, thickness=thickness, 
                                  expansion=expansion, colormap=colormap, 
                                  textalign=textalign, vtextalign=vtextalign,
-                                 label_font_size=label_font_size)
+                                 label_font_size=label_font_size,
+                                 rendering_context=rendering_context)
 
 # ...render_detection_bounding_boxes(...)
 
@@ -688,7 +906,8 @@ def draw_bounding_boxes_on_image(image,
                                  textalign=TEXTALIGN_LEFT,
                                  vtextalign=VTEXTALIGN_TOP,
                                  text_rotation=None,
-                                 label_font_size=DEFAULT_LABEL_FONT_SIZE):
+                                 label_font_size=DEFAULT_LABEL_FONT_SIZE,
+                                 rendering_context=None):
     """
     Draws bounding boxes on an image.  Modifies the image in place.
 
@@ -712,6 +931,8 @@ def draw_bounding_boxes_on_image(image,
         vtextalign (int, optional): VTEXTALIGN_TOP or VTEXTALIGN_BOTTOM
         text_rotation (float, optional): rotation to apply to text
         label_font_size (float, optional): font size for labels
+        rendering_context (RenderingContext, optional): cached fonts and text sizes; defaults
+            to a context shared by all rendering functions
     """
 
     boxes_shape = boxes.shape
@@ -719,6 +940,13 @@ def draw_bounding_boxes_on_image(image,
         return
     if len(boxes_shape) != 2 or boxes_shape[1] != 4:
         return
+    
+    if rendering_context is None:
+        rendering_context = default_rendering_context
+        
+    # All boxes are drawn with the same ImageDraw object
+    draw = ImageDraw.Draw(image)
+    
     for i in range(boxes_shape[0]):
         display_str_list = None
         if display_strs:
@@ -732,7 +960,9 @@ def draw_bounding_boxes_on_image(image,
                                    textalign=textalign,
                                    vtextalign=vtextalign,
                                    text_rotation=text_rotation,
-                                   label_font_size=label_font_size)
+                                   label_font_size=label_font_size,
+                                   rendering_context=rendering_context,
+                                   draw=draw)
 
 # ...draw_bounding_boxes_on_image(...)
 
@@ -767,6 +997,121 @@ def get_text_size(font,s):
     return w,h
 
 
+class RenderingContext:
+    """
+    Caches resources that are used repeatedly when rendering boxes on many images: fonts 
+    (by size), text sizes (by font size and string), colors, and rotated label images.
+    
+    All the box rendering functions in this module share a default context, so callers 
+    don't need to create one; pass a RenderingContext explicitly to use a different font.
+    
+    Safe to share across threads; fonts are loaded once per thread, since FreeType font
+    objects should not be used from multiple threads at once.
+    """
+    
+    #: Caches are cleared when they exceed this many entries, so rendering many unique
+    #: strings (e.g. custom per-detection strings) doesn't grow memory without bound
+    max_cache_entries = 100000
+    
+    def __init__(self, font_name='arial.ttf'):
+        """
+        Args:
+            font_name (str, optional): TrueType font file to use for labels; if this can't
+                be loaded, PIL's default font is used
+        """
+        
+        self.font_name = font_name
+        self._thread_local = threading.local()
+        self._text_sizes = {}
+        self._colors = {}
+        self._rotated_labels = {}
+        
+    def get_font(self, font_size):
+        """
+        Returns the label font at size [font_size], loading it if this thread hasn't used
+        that size yet.
+        """
+        
+        fonts = getattr(self._thread_local, 'fonts', None)
+        if fonts is None:
+            fonts = {}
+            self._thread_local.fonts = fonts
+        font = fonts.get(font_size)
+        if font is None:
+            try:
+                font = ImageFont.truetype(self.font_name, font_size)
+            except IOError:
+                font = ImageFont.load_default()
+            fonts[font_size] = font
+        return font
+    
+    def get_text_size(self, font_size, s):
+        """
+        Returns the (w,h) size of the string [s] rendered at [font_size], see 
+        get_text_size().
+        """
+        
+        key = (font_size, s)
+        size = self._text_sizes.get(key)
+        if size is None:
+            size = get_text_size(self.get_font(font_size), s)
+            if len(self._text_sizes) >= self.max_cache_entries:
+                self._text_sizes = {}
+            self._text_sizes[key] = size
+        return size
+    
+    def get_color(self, color, mode='RGB'):
+        """
+        Converts a color name to a color value for an image in mode [mode].  Colors that
+        aren't strings (e.g. RGB/RGBA tuples) are returned unchanged.
+        """
+        
+        if not isinstance(color, str):
+            return color
+        
+        key = (color, mode)
+        value = self._colors.get(key)
+        if value is None:
+            value = ImageColor.getcolor(color, mode)
+            self._colors[key] = value
+        return value
+    
+    def get_rotated_label(self, font_size, s, color, margin, text_rotation):
+        """
+        Returns an image containing the string [s] in black on a [color] background, 
+        rotated by [text_rotation] degrees.  The returned image should not be modified.
+        """
+        
+        # Lists can't be used in cache keys
+        if isinstance(color, list):
+            color_key = tuple(color)
+        else:
+            color_key = color
+        key = (font_size, s, color_key, margin, text_rotation)
+        rotated_text = self._rotated_labels.get(key)
+        
+        if rotated_text is None:
+            
+            text_width, text_height = self.get_text_size(font_size, s)
+            image_tmp = Image.new('RGB',(text_width+2*margin,text_height+2*margin))
+            image_tmp_draw = ImageDraw.Draw(image_tmp)
+            image_tmp_draw.rectangle([0,0,text_width+2*margin,text_height+2*margin],fill=color)
+            image_tmp_draw.text( (margin,margin), s, font=self.get_font(font_size), fill='black')
+            rotated_text = image_tmp.rotate(text_rotation,expand=1)
+            
+            if len(self._rotated_labels) >= self.max_cache_entries:
+                self._rotated_labels = {}
+            self._rotated_labels[key] = rotated_text
+            
+        return rotated_text
+
+# ...class RenderingContext
+
+
+# Shared by all rendering functions when the caller doesn't provide a context
+default_rendering_context = RenderingContext()
+
+
 def draw_bounding_box_on_image(image,
                                ymin,
                                xmin,
@@ -781,7 +1126,9 @@ def draw_bounding_box_on_image(image,
                                colormap=None,
                                textalign=TEXTALIGN_LEFT,                               
                                vtextalign=VTEXTALIGN_TOP,
-                               text_rotation=None):
+                               text_rotation=None,
+                               rendering_context=None,
+                               draw=None):
     """
     Adds a bounding box to an image.  Modifies the image in place.
 
@@ -817,6 +1164,10 @@ def draw_bounding_box_on_image(image,
         textalign (int, optional): TEXTALIGN_LEFT, TEXTALIGN_CENTER, or TEXTALIGN_RIGHT        
         vtextalign (int, optional): VTEXTALIGN_TOP or VTEXTALIGN_BOTTOM
         text_rotation (float, optional): rotation to apply to text
+        rendering_context (RenderingContext, optional): cached fonts and text sizes; defaults
+            to a context shared by all rendering functions
+        draw (PIL.ImageDraw.ImageDraw, optional): drawing context for [image], so callers
+            drawing many boxes on the same image don't need to create one per box
     """
     
     if colormap is None:
@@ -825,13 +1176,18 @@ def draw_bounding_box_on_image(image,
     if display_str_list is None:
         display_str_list = []
         
+    if rendering_context is None:
+        rendering_context = default_rendering_context
+        
     if clss is None:
         # Default to the MegaDetector animal class ID (1)
-        color = colormap[1]
+        color_name = colormap[1]
     else:
-        color = colormap[int(clss) % len(colormap)]
+        color_name = colormap[int(clss) % len(colormap)]
+    color = rendering_context.get_color(color_name, image.mode)
 
-    draw = ImageDraw.Draw(image)
+    if draw is None:
+        draw = ImageDraw.Draw(image)
     im_width, im_height = image.size
     if use_normalized_coordinates:
         (left, right, top, bottom) = (xmin * im_width, xmax * im_width,
@@ -869,12 +1225,10 @@ def draw_bounding_box_on_image(image,
 
     if display_str_list is not None:
 
-        try:
-            font = ImageFont.truetype('arial.ttf', label_font_size)
-        except IOError:
-            font = ImageFont.load_default()
+        font = rendering_context.get_font(label_font_size)
     
-        display_str_heights = [get_text_size(font,ds)[1] for ds in display_str_list]
+        display_str_heights = [rendering_context.get_text_size(label_font_size,ds)[1] \
+                               for ds in display_str_list]
     
         # Each display_str has a top and bottom margin of 0.05x.
         total_display_str_height = (1 + 2 * 0.05) * sum(display_str_heights)
@@ -886,19 +1240,16 @@ def draw_bounding_box_on_image(image,
             if len(display_str) == 0:
                 continue
             
-            text_width, text_height = get_text_size(font,display_str)            
+            text_width, text_height = rendering_context.get_text_size(label_font_size,display_str)
             margin = int(np.ceil(0.05 * text_height))
                 
             if text_rotation is not None and text_rotation != 0:
                 
                 assert text_rotation == -90, \
                     'Only -90-degree text rotation is supported'
-                    
-                image_tmp = Image.new('RGB',(text_width+2*margin,text_height+2*margin))
-                image_tmp_draw = ImageDraw.Draw(image_tmp)
-                image_tmp_draw.rectangle([0,0,text_width+2*margin,text_height+2*margin],fill=color)
-                image_tmp_draw.text( (margin,margin), display_str, font=font, fill='black')
-                rotated_text = image_tmp.rotate(text_rotation,expand=1)
+                
+                rotated_text = rendering_context.get_rotated_label(
+                    label_font_size,display_str,color_name,margin,text_rotation)
                 
                 if textalign == TEXTALIGN_RIGHT:
                     text_left = right
@@ -1017,7 +1368,8 @@ def render_db_bounding_boxes(boxes,
                              vtextalign=VTEXTALIGN_TOP,
                              text_rotation=None,
                              label_font_size=DEFAULT_LABEL_FONT_SIZE,
-                             tags=None):
+                             tags=None,
+                             rendering_context=None):
     """
     Render bounding boxes (with class labels) on an image.  This is a wrapper for
     draw_bounding_boxes_on_image, allowing the caller to operate on a resized image
@@ -1047,6 +1399,8 @@ def render_db_bounding_boxes(boxes,
         label_font_size (float, optional): font size for labels
         tags (list, optional): list of strings of length len(boxes) that should be appended
             after each class name (e.g. to show scores)
+        rendering_context (RenderingContext, optional): cached fonts and text sizes; defaults
+            to a context shared by all rendering functions
     """
 
     display_boxes = []
@@ -1100,7 +1454,8 @@ def render_db_bounding_boxes(boxes,
                                  textalign=textalign,
                                  vtextalign=vtextalign,
                                  text_rotation=text_rotation,
-                                 label_font_size=label_font_size)
+                                 label_font_size=label_font_size,
+                                 rendering_context=rendering_context)
 
 # ...def render_db_bounding_boxes(...)
 
@@ -1116,7 +1471,8 @@ def draw_bounding_boxes_on_file(input_file,
                                 label_font_size=DEFAULT_LABEL_FONT_SIZE,
                                 custom_strings=None,
                                 target_size=None,
-                                ignore_exif_rotation=False):
+                                ignore_exif_rotation=False,
+                                rendering_context=None):
     """
     Renders detection bounding boxes on an image loaded from file, optionally writing the results to 
     a new image file.
@@ -1141,6 +1497,8 @@ def draw_bounding_boxes_on_file(input_file,
             see resize_image() for documentation.  If None or (-1,-1), uses the original image size.
         ignore_exif_rotation (bool, optional): don't rotate the loaded pixels,
             even if we are loading a JPEG and that JPEG says it should be rotated.
+        rendering_context (RenderingContext, optional): cached fonts and text sizes; defaults
+            to a context shared by all rendering functions
             
     Returns:
         PIL.Image.Image: loaded and modified image
@@ -1155,7 +1513,8 @@ def draw_bounding_boxes_on_file(input_file,
             detections, image, label_map=detector_label_map,
             confidence_threshold=confidence_threshold,
             thickness=thickness,expansion=expansion,colormap=colormap,
-            custom_strings=custom_strings,label_font_size=label_font_size)
+            custom_strings=custom_strings,label_font_size=label_font_size,
+            rendering_context=rendering_context)
 
     if output_file is not None:
         image.save(output_file)
@@ -1170,7 +1529,8 @@ def draw_db_boxes_on_file(input_file,
                           label_map=None, 
                           thickness=DEFAULT_BOX_THICKNESS, 
                           expansion=0,
-                          ignore_exif_rotation=False):
+                          ignore_exif_rotation=False,
+                          rendering_context=None):
     """
     Render COCO-formatted bounding boxes (in absolute coordinates) on an image loaded from file, 
     writing the results to a new image file.
@@ -1188,6 +1548,8 @@ def draw_db_boxes_on_file(input_file,
             detection
         ignore_exif_rotation (bool, optional): don't rotate the loaded pixels,
             even if we are loading a JPEG and that JPEG says it should be rotated
+        rendering_context (RenderingContext, optional): cached fonts and text sizes; defaults
+            to a context shared by all rendering functions
     
     Returns:
         PIL.Image.Image: the loaded and modified image
@@ -1199,7 +1561,8 @@ def draw_db_boxes_on_file(input_file,
         classes = [0] * len(boxes)
         
     render_db_bounding_boxes(boxes, classes, image, original_size=None,
-                             label_map=label_map, thickness=thickness, expansion=expansion)
+                             label_map=label_map, thickness=thickness, expansion=expansion,
+                             rendering_context=rendering_context)
     
     image.save(output_file)
     
@@ -1234,7 +1597,41 @@ def gray_scale_fraction(image,crop_size=(0.1,0.1)):
     if len(image.getbands()) == 1:
         return 1.0
     
-    # Crop if necessary
+    image = _crop_top_and_bottom(image,crop_size)
+    
+    # It doesn't matter if these are actually R/G/B, they're just names
+    r = np.array(image.getchannel(0))
+    g = np.array(image.getchannel(1))
+    b = np.array(image.getchannel(2))
+        
+    gray_pixels = np.logical_and(r == g, r == b)
+    n_pixels = gray_pixels.size
+    n_gray_pixels = gray_pixels.sum()
+    
+    return n_gray_pixels / n_pixels
+
+    # Non-numpy way to do the same thing, briefly keeping this here for posterity
+    if False:
+        
+        w, h = image.size
+        n_pixels = w*h
+        n_gray_pixels = 0
+        for i in range(w):
+            for j in range(h):
+                r, g, b = image.getpixel((i,j))
+                if r == g and r == b and g == b:
+                    n_gray_pixels += 1            
+
+# ...def gray_scale_fraction(...)
+
+
+def _crop_top_and_bottom(image,crop_size):
+    """
+    Removes the fraction crop_size[0] of [image] from the top and crop_size[1] from the 
+    bottom, typically to remove information overlays, before computing gray-scale 
+    statistics.
+    """
+    
     if crop_size[0] > 0 or crop_size[1] > 0:
         
         assert (crop_size[0] + crop_size[1]) < 1.0, \
@@ -1257,31 +1654,214 @@ def gray_scale_fraction(image,crop_size=(0.1,0.1)):
         second_crop = first_crop.crop((left, second_crop_top, right, second_crop_bottom))
         
         image = second_crop
-    
-    # It doesn't matter if these are actually R/G/B, they're just names
-    r = np.array(image.getchannel(0))
-    g = np.array(image.getchannel(1))
-    b = np.array(image.getchannel(2))
         
-    gray_pixels = np.logical_and(r == g, r == b)
-    n_pixels = gray_pixels.size
-    n_gray_pixels = gray_pixels.sum()
+    return image
+
+
+def gray_scale_statistics(image,crop_size=(0.1,0.1),decode_size=256):
+    """
+    Computes the gray-scale fraction of [image] (see gray_scale_fraction()), along with 
+    simple brightness statistics.  If [image] is a filename, it's loaded via open_image() (so 
+    EXIF rotation is applied), and JPEGs are decoded at reduced size, which is much faster 
+    than a full decode and gives nearly the same results.
     
-    return n_gray_pixels / n_pixels
+    Args:
+        image (str or PIL.Image.Image): image or filename to analyze
+        crop_size (optional): a 2-element list/tuple, representing the fraction of the 
+            image to crop at the top and bottom, respectively, before analyzing
+        decode_size (int, optional): if [image] is a JPEG filename, allow PIL to decode 
+            the image at reduced size (1/2, 1/4, or 1/8 scale), as long as both dimensions 
+            are at least [decode_size]; None to decode at full resolution
+    
+    Returns:
+        dict: a dict with fields 'gray_scale_fraction' (the fraction of pixels where R==G==B), 
+        'mean_brightness' and 'std_brightness' (the mean and standard deviation of the 
+        per-pixel mean over channels, from 0 to 255)
+    """
+    
+    # Apply EXIF rotation, so the top/bottom crop removes the right edges
+    if isinstance(image,str):
+        min_size = None
+        if decode_size is not None:
+            min_size = (decode_size,decode_size)
+        image = open_image(image,min_size=min_size)
+    
+    if image.mode not in ('RGB','L'):
+        image = image.convert('RGB')
+    
+    image = _crop_top_and_bottom(image,crop_size)
+    pixels = np.asarray(image)
+    
+    if pixels.ndim == 2:
+        gray_fraction = 1.0
+        brightness = pixels.astype(np.float32)
+    else:
+        gray_pixels = (pixels[:,:,0] == pixels[:,:,1]) & (pixels[:,:,0] == pixels[:,:,2])
+        gray_fraction = float(gray_pixels.mean())
+        brightness = pixels.mean(axis=2,dtype=np.float32)
+    
+    return {'gray_scale_fraction':gray_fraction,
+            'mean_brightness':float(brightness.mean()),
+            'std_brightness':float(brightness.std())}
 
-    # Non-numpy way to do the same thing, briefly keeping this here for posterity
-    if False:
+# ...def gray_scale_statistics(...)
+
+
+def _gray_scale_statistics_for_file(filename,crop_size,decode_size):
+    """
+    Computes gray-scale statistics for a single file, returning a record for the
+    per-image table written by parallel_gray_scale_statistics().
+    """
+    
+    record = {'file':os.path.abspath(filename),'key':None,
+              'crop_size':list(crop_size),'decode_size':decode_size,
+              'gray_scale_fraction':None,'mean_brightness':None,'std_brightness':None,
+              'error':None}
+    
+    try:
+        record['key'] = file_cache_key(filename)
+        record.update(gray_scale_statistics(filename,crop_size=crop_size,
+                                            decode_size=decode_size))
+    except Exception as e:
+        record['error'] = str(e)
         
-        w, h = image.size
-        n_pixels = w*h
-        n_gray_pixels = 0
-        for i in range(w):
-            for j in range(h):
-                r, g, b = image.getpixel((i,j))
-                if r == g and r == b and g == b:
-                    n_gray_pixels += 1            
+    return record
 
-# ...def gray_scale_fraction(...)
+
+def parallel_gray_scale_statistics(filenames,
+                                   table_file=None,
+                                   n_workers=16,
+                                   use_threads=False,
+                                   crop_size=(0.1,0.1),
+                                   decode_size=256,
+                                   recursive=True,
+                                   verbose=False):
+    """
+    Computes gray-scale statistics (see gray_scale_statistics()) for a list or folder of 
+    images, typically to separate day and night images.
+    
+    Args:
+        filenames (list or str): a list of image filenames or a folder
+        table_file (str, optional): a .jsonl file to which we append one record per image; 
+            images recorded in this file (with the same [crop_size] and [decode_size]) that
+            haven't changed since they were processed are not re-processed, so this serves as 
+            a cache across calls, and an interrupted job can be resumed
+        n_workers (int, optional): the number of parallel workers to use; set to <=1 to disable
+            parallelization
+        use_threads (bool, optional): whether to use threads (True) or processes (False) for
+            parallelization
+        crop_size (optional): fraction of each image to ignore at the top and bottom, see
+            gray_scale_fraction()
+        decode_size (int, optional): minimum size for reduced-size JPEG decoding, see 
+            gray_scale_statistics()
+        recursive (bool, optional): if [filenames] is a folder, whether to search recursively 
+            for images.  Ignored if [filenames] is a list.
+        verbose (bool, optional): enable additional debug output
+        
+    Returns:
+        dict: a dict mapping filenames to dicts with fields 'gray_scale_fraction', 
+        'mean_brightness', and 'std_brightness'; the value will be None for images that 
+        fail to load.
+    """
+    
+    if isinstance(filenames,str) and os.path.isdir(filenames):
+        if verbose:
+            print('Enumerating images in {}'.format(filenames))
+        filenames = find_images(filenames,recursive=recursive,return_relative_paths=False)
+    
+    
+    ##%% Read previous results
+    
+    # Only use records computed with the same parameters
+    def _record_filter(record):
+        return (record['error'] is None) and \
+               (record['crop_size'] == list(crop_size)) and \
+               (record['decode_size'] == decode_size)
+    
+    filename_to_record = read_jsonl_manifest(table_file,record_filter=_record_filter)
+    
+    filenames_to_process = []
+    filename_to_stats = {}
+    
+    for fn in filenames:
+        record = filename_to_record.get(os.path.abspath(fn))
+        if (record is not None) and file_matches_cache_key(fn,record['key']):
+            filename_to_stats[fn] = record
+            continue
+        filenames_to_process.append(fn)
+        
+    if verbose or len(filename_to_stats) > 0:
+        print('Read gray-scale statistics for {} of {} images from {}'.format(
+            len(filename_to_stats),len(filenames),table_file))
+    
+    
+    ##%% Process images
+    
+    worker_function = partial(_gray_scale_statistics_for_file,
+                              crop_size=crop_size,
+                              decode_size=decode_size)
+    
+    n_workers = min(n_workers,len(filenames_to_process))
+    pool = None
+    
+    if n_workers <= 1:
+        results = (worker_function(fn) for fn in filenames_to_process)
+    else:
+        if use_threads:
+            pool = ThreadPool(n_workers)
+        else:
+            pool = Pool(n_workers)
+        results = pool.imap(worker_function,filenames_to_process,chunksize=16)
+    
+    table_f = None
+    if table_file is not None:
+        table_dir = os.path.dirname(os.path.abspath(table_file))
+        os.makedirs(table_dir,exist_ok=True)
+        table_f = open(table_file,'a')
+    
+    n_errors = 0
+    
+    try:
+        
+        for i_file,(fn,record) in enumerate(tqdm(zip(filenames_to_process,results),
+                                                 total=len(filenames_to_process))):
+            if record['error'] is not None:
+                n_errors += 1
+                if verbose:
+                    print('Error processing {}: {}'.format(fn,record['error']))
+            filename_to_stats[fn] = record
+            if table_f is not None:
+                table_f.write(json.dumps(record) + '\n')
+                if (i_file % 1000) == 0:
+                    table_f.flush()
+                    
+    finally:
+        
+        if table_f is not None:
+            table_f.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    if n_errors > 0:
+        print('Warning: failed to process {} of {} images'.format(
+            n_errors,len(filenames_to_process)))
+    
+    
+    ##%% Format results
+    
+    to_return = {}
+    for fn in filenames:
+        record = filename_to_stats[fn]
+        if record['error'] is not None:
+            to_return[fn] = None
+        else:
+            to_return[fn] = {k:record[k] for k in \
+                             ('gray_scale_fraction','mean_brightness','std_brightness')}
+    
+    return to_return
+
+# ...def parallel_gray_scale_statistics(...)
 
 
 def _resize_relative_image(fn_relative,
@@ -1531,10 +2111,42 @@ def resize_image_folder(input_folder,
 # ...def resize_image_folder(...)
 
 
+def _get_image_size_from_header(input_file):
+    """
+    Retrieve the size of a local JPEG/PNG image (after EXIF rotation) from the file header, 
+    without decoding the image.  Returns None if the size can't be determined from the 
+    header, or if the image would fail to load via open_image(), in which case the caller
+    should fall back to load_image().
+    """
+    
+    if input_file.startswith(('http://', 'https://')):
+        return None
+    
+    try:
+        header = read_image_header(input_file)
+    except Exception:
+        return None
+    
+    if (header is None) or (header['mode'] not in ('RGBA', 'RGB', 'L', 'I;16')):
+        return None
+    if header['width'] <= 0 or header['height'] <= 0:
+        return None
+    
+    # Match open_image(), which only applies non-mirrored EXIF rotations
+    if header['format'] == 'jpeg' and header['orientation'] in EXIF_IMAGE_ROTATIONS and \
+        EXIF_IMAGE_ROTATIONS[header['orientation']] in (90,270):
+        return (header['height'],header['width'])
+    
+    return (header['width'],header['height'])
+
+
 def get_image_size(im,verbose=False):
     """
     Retrieve the size of an image.  Returns None if the image fails to load.
     
+    For local JPEG/PNG files, the size is read from the file header, without decoding 
+    the image.
+    
     Args:
         im (str or PIL.Image): filename or PIL image
         
@@ -1546,6 +2158,9 @@ def get_image_size(im,verbose=False):
     
     try:        
         if isinstance(im,str):
+            size = _get_image_size_from_header(im)
+            if size is not None:
+                return size
             image_name = im
             im = load_image(im)
         w = im.width
@@ -1565,11 +2180,70 @@ def get_image_size(im,verbose=False):
 # ...def get_image_size(...)
 
 
+def _read_image_size_cache(cache_file):
+    """
+    Reads an image size cache written by parallel_get_image_sizes(), returning an empty
+    cache if [cache_file] doesn't exist or can't be read.
+    """
+    
+    if (cache_file is not None) and os.path.isfile(cache_file):
+        try:
+            with open(cache_file,'r') as f:
+                d = json.load(f)
+            if d['version'] == image_size_cache_version:
+                return d['images']
+            print('Warning: ignoring image size cache {} with version {}'.format(
+                cache_file,d['version']))
+        except Exception as e:
+            print('Warning: could not read image size cache {}: {}'.format(cache_file,str(e)))
+    return {}
+
+
+def _write_image_size_cache(cache_file,cache):
+    """
+    Writes an image size cache, via a temporary file so that interrupted writes don't
+    corrupt an existing cache.
+    """
+    
+    cache_dir = os.path.dirname(os.path.abspath(cache_file))
+    os.makedirs(cache_dir,exist_ok=True)
+    temp_file = cache_file + '.tmp'
+    with open(temp_file,'w') as f:
+        json.dump({'version':image_size_cache_version,'images':cache},f)
+    os.replace(temp_file,cache_file)
+
+
+def _get_image_size_with_cache(filename_and_cache_entry,verbose=False):
+    """
+    Retrieve the size of a local image, using [cache_entry] (a [mtime_ns,file_size,w,h] list, 
+    or None) if the file hasn't changed since that entry was created.  Returns a (size,cache_entry)
+    tuple, where size is None if the image fails to load, and cache_entry is None if the image
+    couldn't be stat'd or fails to load.
+    """
+    
+    filename,cache_entry = filename_and_cache_entry
+    
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return get_image_size(filename,verbose=verbose),None
+    
+    if (cache_entry is not None) and (cache_entry[0] == st.st_mtime_ns) and \
+        (cache_entry[1] == st.st_size):
+        return (cache_entry[2],cache_entry[3]),cache_entry
+    
+    size = get_image_size(filename,verbose=verbose)
+    if size is None:
+        return None,None
+    return size,[st.st_mtime_ns,st.st_size,size[0],size[1]]
+    
+    
 def parallel_get_image_sizes(filenames,
                              max_workers=16, 
                              use_threads=True, 
                              recursive=True,
-                             verbose=False):
+                             verbose=False,
+                             cache_file=None):
     """
     Retrieve image sizes for a list or folder of images
     
@@ -1582,6 +2256,10 @@ def parallel_get_image_sizes(filenames,
         recursive (bool, optional): if [filenames] is a folder, whether to search recursively for images.
             Ignored if [filenames] is a list.
         verbose (bool, optional): enable additional debug output
+        cache_file (str, optional): a .json file in which to persist image sizes, keyed by absolute 
+            path and validated by file size and modification time, so that repeated calls (e.g. 
+            from different dataset conversions) don't re-open unchanged images.  Can be shared 
+            across datasets.
             
     Returns:
         dict: a dict mapping filenames to (w,h) tuples; the value will be None for images that fail
@@ -1598,11 +2276,20 @@ def parallel_get_image_sizes(filenames,
     if verbose:
         print('Getting image sizes for {} images'.format(len(filenames)))
     
+    if cache_file is not None:
+        cache = _read_image_size_cache(cache_file)
+        cache_keys = [os.path.abspath(fn) for fn in filenames]
+        worker_inputs = [(fn,cache.get(k)) for fn,k in zip(filenames,cache_keys)]
+        worker_function = partial(_get_image_size_with_cache,verbose=verbose)
+    else:
+        worker_inputs = filenames
+        worker_function = partial(get_image_size,verbose=verbose)
+        
     if n_workers <= 1:
         
         results = []
-        for filename in filenames:
-            results.append(get_image_size(filename,verbose=verbose))
+        for worker_input in worker_inputs:
+            results.append(worker_function(worker_input))
         
     else:
         
@@ -1611,11 +2298,30 @@ def parallel_get_image_sizes(filenames,
         else:
             pool = Pool(n_workers)
     
-        results = list(tqdm(pool.imap(
-            partial(get_image_size,verbose=verbose),filenames), total=len(filenames)))
+        try:
+            results = list(tqdm(pool.imap(worker_function,worker_inputs,chunksize=16), 
+                                total=len(filenames)))
+        finally:
+            pool.close()
+            pool.join()
     
     assert len(filenames) == len(results), 'Internal error in parallel_get_image_sizes'
     
+    if cache_file is not None:
+        
+        n_cache_updates = 0
+        for k,worker_input,(_,cache_entry) in zip(cache_keys,worker_inputs,results):
+            # Compare by value; with a process pool, entries come back as copies
+            if (cache_entry is not None) and (cache_entry != worker_input[1]):
+                cache[k] = cache_entry
+                n_cache_updates += 1
+        if verbose:
+            print('Read {} of {} image sizes from cache'.format(
+                len(filenames)-n_cache_updates,len(filenames)))
+        if n_cache_updates > 0:
+            _write_image_size_cache(cache_file,cache)
+        results = [r[0] for r in results]
+        
     to_return = {}
     for i_file,filename in enumerate(filenames):
         to_return[filename] = results[i_file]
@@ -1637,14 +2343,18 @@ def check_image_integrity(filename,modes=None):
             - 'pil'
             - 'skimage'
             - 'jpeg_trailer' 
+            - 'jpeg_structure'
                 
             'jpeg_trailer' checks that the binary data ends with ffd9.  It does not check whether
             the image is actually a jpeg, and even if it is, there are lots of reasons the image might not
             end with ffd9.  It's also true the JPEGs that cause "premature end of jpeg segment" issues
             don't end with ffd9, so this may be a useful diagnostic.  High precision, very low recall
             for corrupt jpegs.
+            
+            'jpeg_structure' validates the JPEG marker segments and trailer without decoding 
+            pixels; see check_jpeg_structure().  It's not included in the default modes.
                 
-            Set to None to use all modes.
+            Set to None to use all default modes.
     
     Returns:
         dict: a dict with a key called 'file' (the value of [filename]), one key for each string in
@@ -1658,7 +2368,8 @@ def check_image_integrity(filename,modes=None):
         if isinstance(modes,str):
             modes = [modes]
         for mode in modes:
-            assert mode in ('cv','pil','skimage'), 'Unrecognized mode {}'.format(mode)
+            assert mode in ('cv','pil','skimage','jpeg_trailer','jpeg_structure'), \
+                'Unrecognized mode {}'.format(mode)
         
     assert os.path.isfile(filename), 'Could not find file {}'.format(filename)
     
@@ -1707,6 +2418,11 @@ def check_image_integrity(filename,modes=None):
                     result[mode] = 'success'
             except Exception as e:
                 result[mode] = 'error: {}'.format(str(e))
+        elif mode == 'jpeg_structure':
+            try:
+                result[mode] = check_jpeg_structure(filename)
+            except Exception as e:
+                result[mode] = 'error: {}'.format(str(e))
                 
     # ...for each mode            
     
@@ -1770,6 +2486,333 @@ def parallel_check_image_integrity(filenames,
     return results
 
 
+# JPEG markers that don't have a length field
+_JPEG_STANDALONE_MARKERS = set([0x01] + list(range(0xD0,0xD9)))
+
+# JPEG start-of-frame markers (excluding DHT, JPG, and DAC, which share the 0xCn range)
+_JPEG_SOF_MARKERS = set(range(0xC0,0xD0)) - set([0xC4,0xC8,0xCC])
+
+# Number of bytes we read from the end of each file to check the JPEG trailer
+jpeg_trailer_read_size = 1024
+
+# Minimum length of a run of zeros immediately before the EOI marker that we consider
+# suspicious (typically a truncated file that was zero-filled during recovery)
+jpeg_zero_run_threshold = 256
+
+
+def check_jpeg_structure(filename):
+    """
+    Validates the structure of a JPEG file without decoding pixels: checks for the SOI 
+    marker, walks the marker segments up to the first start-of-scan, verifying that each 
+    segment length fits within the file, and checks that the file ends with an EOI marker.
+    Only the header segments and the last [jpeg_trailer_read_size] bytes of the file are
+    read, so this is much faster than decoding the image.
+    
+    Passing this check does not guarantee that the entropy-coded image data is intact, and 
+    failing it does not guarantee that the image won't load (lots of cameras write data 
+    after the EOI marker), but files that pass are very rarely corrupt.
+    
+    Args:
+        filename (str): the file to check
+        
+    Returns:
+        str: 'success' if the structure looks valid, 'not a jpeg' if [filename] doesn't start
+        with a JPEG SOI marker, otherwise a description of the problem
+    """
+    
+    file_size = os.path.getsize(filename)
+    
+    with open(filename,'rb',buffering=8192) as f:
+        
+        if f.read(2) != b'\xff\xd8':
+            return 'not a jpeg'
+        
+        found_sof = False
+        
+        ## Walk the header segments
+        
+        while True:
+            
+            b = f.read(2)
+            if len(b) < 2:
+                return 'truncated in header at offset {}'.format(f.tell())
+            if b[0] != 0xFF:
+                return 'invalid marker 0x{:02x}{:02x} at offset {}'.format(
+                    b[0],b[1],f.tell()-2)
+            marker = b[1]
+            
+            # Skip fill bytes
+            while marker == 0xFF:
+                b = f.read(1)
+                if len(b) < 1:
+                    return 'truncated in header at offset {}'.format(f.tell())
+                marker = b[0]
+            
+            if marker in _JPEG_STANDALONE_MARKERS:
+                continue
+            
+            if marker == 0xD9:
+                return 'EOI marker before start of scan'
+            
+            b = f.read(2)
+            if len(b) < 2:
+                return 'truncated in header at offset {}'.format(f.tell())
+            segment_length = struct.unpack('>H',b)[0]
+            if segment_length < 2:
+                return 'invalid length {} for marker 0x{:02x} at offset {}'.format(
+                    segment_length,marker,f.tell()-4)
+            if (f.tell() + segment_length - 2) > file_size:
+                return 'segment for marker 0x{:02x} extends past end of file'.format(marker)
+            
+            if marker in _JPEG_SOF_MARKERS:
+                b = f.read(min(segment_length-2,6))
+                if len(b) < 6:
+                    return 'invalid SOF segment'
+                _,height,width,n_components = struct.unpack('>BHHB',b)
+                if width == 0 or n_components == 0:
+                    return 'invalid SOF segment: {}x{}, {} components'.format(
+                        width,height,n_components)
+                found_sof = True
+                f.seek(segment_length-2-len(b),1)
+            elif marker == 0xDA:
+                if not found_sof:
+                    return 'start of scan before SOF segment'
+                break
+            else:
+                f.seek(segment_length-2,1)
+        
+        # ...for each header segment
+        
+        header_end = f.tell() + segment_length - 2
+        
+        ## Check the trailer
+        
+        trailer_start = max(header_end,file_size-jpeg_trailer_read_size)
+        f.seek(trailer_start)
+        trailer = f.read()
+        
+    # ...with open(...)
+    
+    if not trailer.endswith(b'\xff\xd9'):
+        if b'\xff\xd9' in trailer:
+            return 'data after EOI marker'
+        else:
+            return 'missing EOI marker (file may be truncated)'
+    
+    zero_run_start = len(trailer) - 2 - jpeg_zero_run_threshold
+    if (zero_run_start >= 0) and \
+       (trailer[zero_run_start:-2].count(0) == jpeg_zero_run_threshold):
+        return 'zero-filled data before EOI marker'
+    
+    return 'success'
+
+# ...def check_jpeg_structure(...)
+
+
+def fast_check_image_integrity(filename,decode_modes=('pil',)):
+    """
+    Tiered version of check_image_integrity(): checks JPEG structure via 
+    check_jpeg_structure(), and only fully decodes files that fail that check (or that 
+    aren't JPEGs).
+    
+    Args:
+        filename (str): the filename to evaluate
+        decode_modes (list, optional): modes to use for full decoding of suspicious files, 
+            see check_image_integrity()
+        
+    Returns:
+        dict: a dict with fields 'file' (the value of [filename]), 'structure' (the result of 
+        check_jpeg_structure()), 'decode' (a dict mapping each decode mode to a success 
+        indicator, or None if the file wasn't decoded), and 'status'.  'status' is 'success' 
+        if the structure is valid or a non-JPEG file decodes successfully, 'warning' if a 
+        JPEG has structural problems but decodes successfully (truncated JPEGs typically load 
+        with gray fill, since we set LOAD_TRUNCATED_IMAGES), or 'error' if the file can't be 
+        read or decoded.
+    """
+    
+    result = {'file':filename,'structure':None,'decode':None,'status':None}
+    
+    try:
+        result['structure'] = check_jpeg_structure(filename)
+    except Exception as e:
+        result['structure'] = 'error: {}'.format(str(e))
+        result['status'] = 'error'
+        return result
+    
+    if result['structure'] == 'success':
+        result['status'] = 'success'
+        return result
+    
+    decode_results = check_image_integrity(filename,modes=decode_modes)
+    del decode_results['file']
+    result['decode'] = decode_results
+    
+    decode_succeeded = all(v.startswith('success') for v in decode_results.values())
+    if not decode_succeeded:
+        result['status'] = 'error'
+    elif result['structure'] == 'not a jpeg':
+        result['status'] = 'success'
+    else:
+        result['status'] = 'warning'
+    
+    return result
+
+# ...def fast_check_image_integrity(...)
+
+
+def _fast_check_image_integrity_for_manifest(filename,decode_modes):
+    """
+    Runs fast_check_image_integrity() on a single file, adding the fields we use to 
+    validate manifest entries on subsequent runs.
+    """
+    
+    try:
+        key = file_cache_key(filename)
+    except Exception:
+        key = None
+    
+    result = fast_check_image_integrity(filename,decode_modes=decode_modes)
+    result['abs_path'] = os.path.abspath(filename)
+    result['key'] = key
+    result['decode_modes'] = list(decode_modes)
+    
+    return result
+
+
+def parallel_fast_check_image_integrity(filenames,
+                                        manifest_file=None,
+                                        decode_modes=('pil',),
+                                        max_workers=16,
+                                        use_threads=True,
+                                        recursive=True,
+                                        verbose=False):
+    """
+    Checks the integrity of a list or folder of images via fast_check_image_integrity(), 
+    i.e., only fully decoding files that fail a JPEG structure check.  This is typically 
+    orders of magnitude faster than parallel_check_image_integrity().
+    
+    Args:
+        filenames (list or str): a list of image filenames or a folder
+        manifest_file (str, optional): a .jsonl file to which we append one record per image;
+            images recorded in this file (with the same [decode_modes]) that haven't changed 
+            since they were checked are not re-checked, so an interrupted job can be resumed
+        decode_modes (list, optional): modes to use for full decoding of suspicious files, 
+            see check_image_integrity()
+        max_workers (int, optional): the number of parallel workers to use; set to <=1 to disable
+            parallelization
+        use_threads (bool, optional): whether to use threads (True) or processes (False) for
+            parallelization
+        recursive (bool, optional): if [filenames] is a folder, whether to search recursively for 
+            images.  Ignored if [filenames] is a list.
+        verbose (bool, optional): enable additional debug output
+            
+    Returns:
+        list: a list of dicts in the same order as [filenames], in the format returned by 
+        fast_check_image_integrity()
+    """
+    
+    if isinstance(filenames,str) and os.path.isdir(filenames):
+        if verbose:
+            print('Enumerating images in {}'.format(filenames))
+        filenames = find_images(filenames,recursive=recursive,return_relative_paths=False)
+    
+    if isinstance(decode_modes,str):
+        decode_modes = [decode_modes]
+    
+    
+    ##%% Read previous results
+    
+    # Only use records checked with the same decode modes
+    def _record_filter(record):
+        return (record['key'] is not None) and \
+               (record['decode_modes'] == list(decode_modes))
+    
+    filename_to_record = read_jsonl_manifest(manifest_file,key_field='abs_path',
+                                             record_filter=_record_filter)
+    
+    filename_to_result = {}
+    filenames_to_check = []
+    
+    for fn in filenames:
+        record = filename_to_record.get(os.path.abspath(fn))
+        if (record is not None) and file_matches_cache_key(fn,record['key']):
+            filename_to_result[fn] = record
+            continue
+        filenames_to_check.append(fn)
+    
+    if verbose or len(filename_to_result) > 0:
+        print('Read integrity results for {} of {} images from {}'.format(
+            len(filename_to_result),len(filenames),manifest_file))
+    
+    if verbose:
+        print('Checking image integrity for {} filenames'.format(len(filenames_to_check)))
+    
+    
+    ##%% Check images
+    
+    worker_function = partial(_fast_check_image_integrity_for_manifest,
+                              decode_modes=decode_modes)
+    
+    n_workers = min(max_workers,len(filenames_to_check))
+    pool = None
+    
+    if n_workers <= 1:
+        results = (worker_function(fn) for fn in filenames_to_check)
+    else:
+        if use_threads:
+            pool = ThreadPool(n_workers)
+        else:
+            pool = Pool(n_workers)
+        results = pool.imap(worker_function,filenames_to_check,chunksize=16)
+    
+    manifest_f = None
+    if manifest_file is not None:
+        manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+        os.makedirs(manifest_dir,exist_ok=True)
+        manifest_f = open(manifest_file,'a')
+    
+    try:
+        
+        for i_file,(fn,result) in enumerate(tqdm(zip(filenames_to_check,results),
+                                                 total=len(filenames_to_check))):
+            filename_to_result[fn] = result
+            if verbose and result['status'] != 'success':
+                print('{}: {} ({})'.format(fn,result['status'],result['structure']))
+            if manifest_f is not None:
+                manifest_f.write(json.dumps(result) + '\n')
+                if (i_file % 1000) == 0:
+                    manifest_f.flush()
+    
+    finally:
+        
+        if manifest_f is not None:
+            manifest_f.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    
+    ##%% Format results
+    
+    to_return = []
+    for fn in filenames:
+        result = filename_to_result[fn]
+        to_return.append({'file':fn,
+                          'structure':result['structure'],
+                          'decode':result['decode'],
+                          'status':result['status']})
+    
+    n_errors = sum(1 for r in to_return if r['status'] == 'error')
+    n_warnings = sum(1 for r in to_return if r['status'] == 'warning')
+    if verbose or n_errors > 0 or n_warnings > 0:
+        print('Checked {} images: {} errors, {} warnings'.format(
+            len(to_return),n_errors,n_warnings))
+        
+    return to_return
+
+# ...def parallel_fast_check_image_integrity(...)
+
+
 #%% Test drivers
 
 if False:
@@ -471,12 +471,15 @@ def visualize_db(db_path, output_dir, image_base_dir, options=None):
                 return False
             
         try:
-            original_image = vis_utils.open_image(img_path)
-            original_size = original_image.size
             if (options.viz_size is None) or (options.viz_size[0] == -1 and options.viz_size[1] == -1):
-                image = original_image
+                image = vis_utils.open_image(img_path)
+                original_size = image.size
             else:
-                image = vis_utils.resize_image(original_image, options.viz_size[0],
+                # JPEGs are decoded at reduced size when that's still large enough for viz_size; 
+                # boxes are still scaled relative to the full-resolution size
+                decoded_image, original_size = vis_utils.open_image_for_target_size(
+                    img_path, options.viz_size[0], options.viz_size[1])
+                image = vis_utils.resize_image(decoded_image, options.viz_size[0],
                                                options.viz_size[1])
         except Exception as e:
             print('Image {} failed to open, error: {}'.format(img_path, e))
@@ -79,8 +79,9 @@ def _render_image(entry,
         rendering_result['missing_image'] = True
         return rendering_result
 
-    # Load the image
-    image = vis_utils.open_image(image_filename_in_abs)
+    # Load the image; JPEGs are decoded at reduced size if we're going to downsize them anyway
+    image, original_size = vis_utils.open_image_for_target_size(image_filename_in_abs, 
+                                                                output_image_width)
     
     # Find categories we're supposed to blur
     category_ids_to_blur = []
@@ -96,7 +97,9 @@ def _render_image(entry,
         if d['conf'] >= confidence_threshold and d['category'] in category_ids_to_blur:
             detections_to_blur.append(d)
     if len(detections_to_blur) > 0:
-        blur_detections(image,detections_to_blur)
+        # The default blur radius refers to full-resolution pixels
+        blur_radius = 40 * (image.size[0] / original_size[0])
+        blur_detections(image,detections_to_blur,blur_radius=blur_radius)
         
     # Resize if necessary
     #